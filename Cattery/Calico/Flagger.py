@@ -8,6 +8,13 @@ import Timba.dmi
 import re
 import tempfile
 import os
+import threading
+import json
+import multiprocessing
+try:
+  import queue
+except ImportError:
+  import Queue as queue
 
 from Cattery import Meow
 import Purr.Pipe
@@ -26,6 +33,16 @@ else:
 
 _addbitflagcol = Meow.MSUtils.find_exec('addbitflagcol');
 
+# arguments of the parallel flagging operation currently in progress. Set by Flagger._flag_parallel()
+_parallel_flag_args = None;
+# tables opened by a worker process: the MS itself (key None), and its sub-MSs by DDID
+_worker_tables = {};
+
+def _run_flag_task (task):
+  """Entry point of worker processes: applies the current flagging operation to one task""";
+  flagger,op,flagstats = _parallel_flag_args;
+  return flagger._flag_task(op,task,flagstats);
+
 # Various argument-formatting methods to use with the Flagger.AutoFlagger class
 # below. These really should be static methods of the class, but that doesn't work
 # with Python (specifically, I cannot include them into static member dicts)
@@ -109,9 +126,367 @@ def _format_clip (arg,argname):
       recfields.append("a%d=[%s]"%(i,','.join(subfields)));
     return "[%s]"%','.join(recfields);
   raise TypeError("invalid value for '%s' keyword (%s)"%(argname,arg));
-    
+
+class _BaselineMask (object):
+  """Compiles a list of (p,q) baselines into a boolean lookup table over the range of antenna numbers
+  they span, so that the row mask of a chunk is a single gather on the ANTENNA1/ANTENNA2 columns, however
+  many baselines are selected. As before, a row matches only if ANTENNA1==p and ANTENNA2==q.""";
+  def __init__ (self,baselines):
+    pq = numpy.array(baselines,int).reshape((-1,2));
+    # antenna number corresponding to the first row/column of the table
+    self.ant0 = min(pq.min(),0) if len(pq) else 0;
+    nant = pq.max()+1-self.ant0 if len(pq) else 0;
+    self.lut = numpy.zeros((nant,nant),bool);
+    self.lut[pq[:,0]-self.ant0,pq[:,1]-self.ant0] = True;
+
+  def rowmask (self,a1,a2):
+    """Returns boolean mask of rows whose (ANTENNA1,ANTENNA2) is one of the baselines""";
+    nant = self.lut.shape[0];
+    a1,a2 = numpy.asarray(a1)-self.ant0,numpy.asarray(a2)-self.ant0;
+    valid = (a1>=0)&(a1<nant)&(a2>=0)&(a2<nant);
+    if valid.all():
+      return self.lut[a1,a2];
+    mask = numpy.zeros(len(a1),bool);
+    mask[valid] = self.lut[a1[valid],a2[valid]];
+    return mask;
+
+  def selects (self,p,q):
+    """Returns True if baseline p,q is selected""";
+    nant = self.lut.shape[0];
+    p,q = p-self.ant0,q-self.ant0;
+    return 0<=p<nant and 0<=q<nant and bool(self.lut[p,q]);
+
+class _ChunkTable (object):
+  """Stands in for an MS (or sub-MS) while one chunk of it is being processed, see _ChunkIO.
+  getcol() returns columns prefetched by the reader thread where available, and reads them otherwise.
+  putcol() hands columns over to the writer thread.""";
+  def __init__ (self,chunkio,ms,prefetched):
+    self._io = chunkio;
+    self._ms = ms;
+    self._prefetched = prefetched;
+    self._written = set();
+
+  def nrows (self):
+    return self._ms.nrows();
+
+  def getcol (self,column,row0=0,nrows=-1):
+    value = self._prefetched.pop((column,row0,nrows),None);
+    if value is None:
+      # make sure we don't read back a column that is still waiting to be written
+      if column in self._written:
+        self._io.sync();
+      with self._io.lock:
+        value = self._ms.getcol(column,row0,nrows);
+    return value;
+
+  def putcol (self,column,value,row0=0,nrows=-1):
+    self._written.add(column);
+    self._io.putcol(self._ms,column,value,row0,nrows);
+
+
+class _CachedChunkTable (_ChunkTable):
+  """Version of _ChunkTable used when several operations are applied to the same chunk. Columns are read
+  at most once, and modified in place. Columns passed to putcol() are only written out by flush(), once
+  all operations are done.""";
+  def __init__ (self,*args):
+    _ChunkTable.__init__(self,*args);
+    self._dirty = {};
+
+  def getcol (self,column,row0=0,nrows=-1):
+    value = self._prefetched.get((column,row0,nrows));
+    if value is None:
+      value = self._prefetched[column,row0,nrows] = _ChunkTable.getcol(self,column,row0,nrows);
+    return value;
+
+  def putcol (self,column,value,row0=0,nrows=-1):
+    self._prefetched[column,row0,nrows] = value;
+    self._dirty[column,row0,nrows] = value;
+
+  def flush (self):
+    for (column,row0,nrows),value in self._dirty.items():
+      _ChunkTable.putcol(self,column,value,row0,nrows);
+    self._dirty = {};
+
+
+class _ChunkIO (object):
+  """Helper class for the chunk loops of the Flagger. chunks() iterates over an MS in chunks of rows.
+  In pipelined mode, a reader thread prefetches the given columns of the next chunk, and a writer thread
+  writes out the previous chunk, while the current chunk is being processed.
+  Table objects should not be used from multiple threads at once, so all table access is serialized via
+  a single lock. Call close() at the end to wait for all writes to complete.""";
+  def __init__ (self,pipelined=False,queue_size=4):
+    self.pipelined = pipelined;
+    self.lock = threading.Lock();
+    self._error = None;
+    if pipelined:
+      self._writeq = queue.Queue(queue_size);
+      self._writer = threading.Thread(target=self._write_loop);
+      self._writer.daemon = True;
+      self._writer.start();
+
+  def _write_loop (self):
+    while True:
+      item = self._writeq.get();
+      try:
+        if item is None:
+          return;
+        if self._error is None:
+          ms,column,value,row0,nrows = item;
+          with self.lock:
+            ms.putcol(column,value,row0,nrows);
+      except BaseException as exc:
+        self._error = exc;
+      finally:
+        self._writeq.task_done();
+
+  def _check (self):
+    """Re-raises the error of a failed write in the caller's thread""";
+    if self._error is not None:
+      error,self._error = self._error,None;
+      raise error;
+
+  def putcol (self,ms,column,value,row0,nrows):
+    if self.pipelined:
+      self._check();
+      self._writeq.put((ms,column,value,row0,nrows));
+    else:
+      ms.putcol(column,value,row0,nrows);
+
+  def sync (self):
+    """Waits for all pending writes to complete""";
+    if self.pipelined:
+      self._writeq.join();
+      self._check();
+
+  def close (self):
+    if self.pipelined:
+      self._writeq.put(None);
+      self._writer.join();
+      self._check();
+
+  def chunks (self,ms,chunksize,columns=(),cached=False,rows=None):
+    """Iterates over ms in chunks of chunksize rows. Yields (row0,nrows,table) tuples, where table is a
+    _ChunkTable that should be used instead of ms for all column access within the chunk.
+    If cached is True, table is a _CachedChunkTable, which is flushed once the caller is done with the chunk.
+    If rows is given, only the rows in the range (start,end) are iterated over.""";
+    row_start,nrow_tot = rows or (0,ms.nrows());
+    starts = list(range(row_start,nrow_tot,chunksize));
+    table_class = _CachedChunkTable if cached else _ChunkTable;
+    if not self.pipelined:
+      for row0 in starts:
+        table = table_class(self,ms,{});
+        yield row0,min(chunksize,nrow_tot-row0),table;
+        cached and table.flush();
+      return;
+    readq = queue.Queue(1);
+    stop = threading.Event();
+    def put (item):
+      while not stop.is_set():
+        try:
+          readq.put(item,timeout=.1);
+          return True;
+        except queue.Full:
+          pass;
+      return False;
+    def read_loop ():
+      try:
+        for row0 in starts:
+          nrows = min(chunksize,nrow_tot-row0);
+          prefetched = {};
+          for column in columns:
+            try:
+              with self.lock:
+                prefetched[column,row0,nrows] = ms.getcol(column,row0,nrows);
+            except Exception:
+              # e.g. missing column: leave it for the chunk loop to deal with
+              pass;
+          if not put((row0,nrows,prefetched)):
+            return;
+      except BaseException as exc:
+        put(exc);
+    reader = threading.Thread(target=read_loop);
+    reader.daemon = True;
+    reader.start();
+    try:
+      for i in range(len(starts)):
+        item = readq.get();
+        if isinstance(item,BaseException):
+          raise item;
+        self._check();
+        row0,nrows,prefetched = item;
+        table = table_class(self,ms,prefetched);
+        yield row0,nrows,table;
+        cached and table.flush();
+    finally:
+      stop.set();
+      reader.join();
+
+
+class _DeferredChunkIO (_ChunkIO):
+  """Version of _ChunkIO used by the worker processes of a parallel flagging operation. Columns passed to
+  putcol() are not written, but collected in the writes list, to be sent back to the parent process.""";
+  def __init__ (self):
+    _ChunkIO.__init__(self);
+    self.writes = [];
+
+  def putcol (self,ms,column,value,row0,nrows):
+    self.writes.append((column,value,row0,nrows));
+
+
+class _FlagOp (object):
+  """Holds the resolved arguments of one flagging operation (see Flagger._make_flag_op()),
+  and accumulates its statistics""";
+  def __init__ (self,**kw):
+    self.__dict__.update(kw);
+    self.stat_rows_nfl = self.stat_rows = self.stat_pixels = self.stat_pixels_nfl = 0;
+
+  def stats (self):
+    """Returns fraction of flagged rows and correlations (in stats mode), or of transferred flags""";
+    stat0 = (self.stat_rows and self.stat_rows_nfl/float(self.stat_rows)) or 0;
+    stat1 = (self.stat_pixels and self.stat_pixels_nfl/float(self.stat_pixels)) or 0;
+    return stat0,stat1;
+
+
+class _FlagStats (object):
+  """Summary of the flags in an MS, used to answer get_stats() queries without reading the flag columns.
+  For every DDID and baseline, it holds a histogram of flag words, counted separately over rows and
+  over individual correlations (pixels). A flag word is the BITFLAG value, with the legacy FLAG column
+  in bit 32. Since histograms are additive, the summary is kept up to date by subtracting the histogram
+  of each modified chunk before the change, and adding it back after. The summary is stored with the
+  MS, and is only valid if the MS has not been modified since (see Flagger._checkout_flagstats()).""";
+  VERSION = 1;
+  LEGACY = 1<<32;
+
+  def __init__ (self,has_bitflags=True):
+    self.has_bitflags = has_bitflags;
+    # modification time and number of rows of the MS, at the time the summary was last updated
+    self.mtime = self.nrows = None;
+    # per-DDID dicts of { (p,q,word):count }
+    self.rows = {};
+    self.pixels = {};
+
+  def columns (self,columns=()):
+    """Returns list of columns, plus the columns read by chunk_words() (for prefetching)""";
+    own = [ 'ANTENNA1','ANTENNA2','FLAG_ROW','FLAG' ] + ([ 'BITFLAG_ROW','BITFLAG' ] if self.has_bitflags else []);
+    return list(columns) + [ col for col in own if col not in columns ];
+
+  def ddids (self):
+    return list(self.rows.keys());
+
+  def add_ddid (self,ddid):
+    self.rows[ddid] = {};
+    self.pixels[ddid] = {};
+
+  def chunk_words (self,tab,row0,nrows):
+    """Reads a chunk of rows, returns antenna columns plus row and pixel flag words""";
+    a1 = tab.getcol('ANTENNA1',row0,nrows);
+    a2 = tab.getcol('ANTENNA2',row0,nrows);
+    rw = tab.getcol('FLAG_ROW',row0,nrows).astype(numpy.int64)<<32;
+    pw = tab.getcol('FLAG',row0,nrows).astype(numpy.int64)<<32;
+    if self.has_bitflags:
+      rw |= tab.getcol('BITFLAG_ROW',row0,nrows);
+      pw |= tab.getcol('BITFLAG',row0,nrows);
+    return a1,a2,rw,pw;
+
+  @staticmethod
+  def _histogram (hist,a1,a2,words,sign):
+    """Adds sign*(histogram of words) to hist. words is an array of shape (nrows,...).""";
+    n = len(a1);
+    if not n:
+      return;
+    uw,iw = numpy.unique(words,return_inverse=True);
+    a1 = numpy.asarray(a1,numpy.int64);
+    a2 = numpy.asarray(a2,numpy.int64);
+    # ifirst gives the first row of every baseline
+    ubl,ifirst,ibl = numpy.unique(a1*(a2.max()+1)+a2,return_index=True,return_inverse=True);
+    index = ibl.reshape((n,1))*len(uw) + iw.reshape((n,-1));
+    counts = numpy.bincount(index.ravel(),minlength=len(ubl)*len(uw));
+    for i in counts.nonzero()[0]:
+      ib,w = divmod(i,len(uw));
+      row = ifirst[ib];
+      key = int(a1[row]),int(a2[row]),int(uw[w]);
+      hist[key] = hist.get(key,0) + sign*int(counts[i]);
+      if not hist[key]:
+        del hist[key];
+
+  def add (self,ddid,words,rowmask=None):
+    """Adds a chunk (as returned by chunk_words()) to the summary""";
+    self._add(ddid,words,rowmask,1);
+
+  def _add (self,ddid,words,rowmask,sign):
+    a1,a2,rw,pw = words if rowmask is None else [ x[rowmask] for x in words ];
+    self._histogram(self.rows[ddid],a1,a2,rw,sign);
+    self._histogram(self.pixels[ddid],a1,a2,pw,sign);
+
+  def merge (self,ddid,rows,pixels):
+    """Adds histograms (e.g. the changes collected by a worker process) to the summary of a DDID""";
+    for hist,delta in (self.rows[ddid],rows),(self.pixels[ddid],pixels):
+      for key,count in delta.items():
+        hist[key] = hist.get(key,0) + count;
+        if not hist[key]:
+          del hist[key];
+
+  def update (self,ddid,before,after):
+    """Updates the summary given the flag words of a chunk before and after it was modified""";
+    changed = (before[2]!=after[2])|(before[3]!=after[3]).reshape((len(before[3]),-1)).any(1);
+    if changed.any():
+      self._add(ddid,before,changed,-1);
+      self._add(ddid,after,changed,1);
+
+  def stats (self,ddids,flagmask,legacy,baseline_mask=None,antennas=None):
+    """Returns fraction of flagged rows and correlations, in the same way as Flagger.get_stats()""";
+    mask = (flagmask&0xFFFFFFFF) | (self.LEGACY if legacy else 0);
+    antennas = antennas is not None and set(antennas);
+    def count (hists):
+      n = nfl = 0;
+      for ddid in ddids:
+        for (p,q,word),num in hists[ddid].items():
+          if baseline_mask is not None and not baseline_mask.selects(p,q):
+            continue;
+          if antennas is not False and p not in antennas and q not in antennas:
+            continue;
+          n += num;
+          if word&mask:
+            nfl += num;
+      return (n and nfl/float(n)) or 0;
+    return count(self.rows),count(self.pixels);
+
+  def save (self,filename):
+    """Writes summary to a JSON file""";
+    ddids = dict([ (str(ddid),dict(rows=[ list(k)+[c] for k,c in self.rows[ddid].items() ],
+                                   pixels=[ list(k)+[c] for k,c in self.pixels[ddid].items() ]))
+                   for ddid in self.rows ]);
+    json.dump(dict(version=self.VERSION,has_bitflags=self.has_bitflags,mtime=self.mtime,nrows=self.nrows,
+                   ddids=ddids),open(filename,'w'));
+
+  @staticmethod
+  def load (filename):
+    """Reads summary from a JSON file""";
+    info = json.load(open(filename));
+    if info.get('version') != _FlagStats.VERSION:
+      raise ValueError("unknown flag stats version");
+    stats = _FlagStats(info['has_bitflags']);
+    stats.mtime,stats.nrows = info['mtime'],info['nrows'];
+    for ddid,hist in info['ddids'].items():
+      stats.rows[int(ddid)] = dict([ (tuple(x[:3]),x[3]) for x in hist['rows'] ]);
+      stats.pixels[int(ddid)] = dict([ (tuple(x[:3]),x[3]) for x in hist['pixels'] ]);
+    return stats;
+
+
 class Flagger (Timba.dmi.verbosity):
-  def __init__ (self,msname,verbose=0,chunksize=200000):
+  FLAGSTATS_FILE = "CALICO_FLAGSTATS.json";
+
+  def __init__ (self,msname,verbose=0,chunksize=200000,pipelined=False,stats_cache=False,processes=1):
+    """Creates flagger for the given MS. The MS is processed in chunks of chunksize rows.
+    If pipelined is True, the next chunk is read in, and the previous one written out, in background
+    threads while the current chunk is being processed.
+    If processes is 2 or more, flag(), unflag(), transfer() and get_stats() process chunks of the DDID
+    subsets of the MS in parallel worker processes. The workers open the MS read-only, and send the modified
+    columns back to the calling process, which does all the writing.
+    If stats_cache is True, get_stats() builds a summary of the flags, which is stored in the MS directory
+    (as FLAGSTATS_FILE) and kept up to date by all subsequent flagging operations. Repeated get_stats() calls
+    that select data by DDID, antennas or baselines only are then answered from the summary. The summary is
+    discarded if the MS is modified by anything else.""";
     Timba.dmi.verbosity.__init__(self,name="Flagger");
     self.set_verbose(verbose);
     if not TABLE:
@@ -119,6 +494,10 @@ class Flagger (Timba.dmi.verbosity):
     self.msname = msname;
     self.ms = None;
     self.chunksize = chunksize;
+    self.pipelined = pipelined;
+    self.stats_cache = stats_cache;
+    self.processes = processes;
+    self._flagstats = None;
     self._reopen();
     
   def close (self):
@@ -206,7 +585,12 @@ class Flagger (Timba.dmi.verbosity):
       if legacy:
         fset += ", plus FLAG/FLAG_ROW";
       self.purrpipe.title("Flagging").comment("Getting flag stats for %s"%fset,endline=False);
-    stats = self._flag(flag=flag,get_stats=True,include_legacy_stats=legacy,**kw);
+    stats = None;
+    # selections by DDID, antennas and baselines can be done on the summary
+    if self.stats_cache and not set(kw.keys()) - set(['ddid','antennas','baselines','purr','progress_callback']):
+      stats = self._cached_stats(flag=flag,legacy=legacy,**kw);
+    if stats is None:
+      stats = self._flag(flag=flag,get_stats=True,include_legacy_stats=legacy,**kw);
     msg = "%.2f%% of rows and %.2f%% of correlations are flagged."%(stats[0]*100,stats[1]*100);
     if kw['purr']:
       self.purrpipe.comment(msg);
@@ -224,6 +608,77 @@ class Flagger (Timba.dmi.verbosity):
         shape = ms.getcol('DATA',row0,nrows).shape;
       return numpy.zeros(shape,dtype=numpy.int32);
   
+  def _table_mtime (self):
+    """Helper method. Returns the latest modification time of the MS data files. The table.dat and table.info
+    files are left out, since creating a flagset rewrites them, without changing any flags.""";
+    mtimes = [ os.path.getmtime(os.path.join(self.msname,f)) for f in os.listdir(self.msname)
+               if f.startswith("table.f") ];
+    return max(mtimes) if mtimes else None;
+
+  def _checkout_flagstats (self):
+    """Helper method. If the stats cache is enabled, returns the flag summary (a _FlagStats object) of the MS,
+    or None if no valid summary exists. Operations that modify the MS must hand the summary back via
+    _commit_flagstats() after updating it, else it is discarded.""";
+    stats,self._flagstats = self._flagstats,None;
+    if not self.stats_cache:
+      return None;
+    ms = self._reopen();
+    filename = os.path.join(self.msname,self.FLAGSTATS_FILE);
+    if stats is None and os.path.exists(filename):
+      try:
+        stats = _FlagStats.load(filename);
+      except:
+        self.dprint(0,"error reading flag stats summary",filename,", ignoring");
+    # flush any pending writes, so that they show up in the modification time
+    ms.flush();
+    if stats is not None and (stats.mtime != self._table_mtime() or stats.nrows != ms.nrows() or
+                              stats.has_bitflags != self.has_bitflags):
+      self.dprint(1,"MS has been modified, discarding flag stats summary");
+      stats = None;
+    return stats;
+
+  def _commit_flagstats (self,stats):
+    """Helper method. Stores flag summary returned by _checkout_flagstats(), once the MS has been modified""";
+    if stats is None:
+      return;
+    ms = self._reopen();
+    ms.flush();
+    stats.mtime,stats.nrows = self._table_mtime(),ms.nrows();
+    self._flagstats = stats;
+    filename = os.path.join(self.msname,self.FLAGSTATS_FILE);
+    try:
+      stats.save(filename);
+      self.dprint(2,"wrote flag stats summary",filename);
+    except:
+      self.dprint(0,"error writing flag stats summary",filename);
+
+  def _cached_stats (self,flag=0,legacy=False,ddid=None,antennas=None,baselines=None,
+                     purr=True,progress_callback=None):
+    """Helper method for get_stats(). Gets stats from the flag summary, first building the summary
+    for any DDIDs that it does not cover.""";
+    op = self._make_flag_op(flag=flag,get_stats=True,include_legacy_stats=legacy,ddid=ddid,
+                            antennas=antennas,baselines=baselines,purr=purr);
+    stats = self._checkout_flagstats() or _FlagStats(self.has_bitflags);
+    missing = [ x for x in op.ddids if x not in stats.rows ];
+    if missing:
+      self.dprintf(1,"building flag stats summary for DDIDs %s\n",missing);
+      sub_mss = self._get_submss(self._reopen(),missing);
+      nrow_tot = sub_mss[-1][1]+sub_mss[-1][2].nrows() if sub_mss else 0;
+      chunkio = _ChunkIO(self.pipelined);
+      try:
+        for ddid_,irow_prev,ms in sub_mss:
+          stats.add_ddid(ddid_);
+          for row0,nrows,tab in chunkio.chunks(ms,self.chunksize,stats.columns()):
+            if progress_callback:
+              progress_callback(irow_prev+row0,nrow_tot);
+            stats.add(ddid_,stats.chunk_words(tab,row0,nrows));
+      finally:
+        chunkio.close();
+      if progress_callback:
+        progress_callback(99,100);
+    self._commit_flagstats(stats);
+    return stats.stats(op.ddids,op.flag,op.include_legacy_stats,op.baseline_mask or None,antennas);
+
   def _get_submss (self,ms,ddids=None):
     """Helper method. Splits MS into subsets by DATA_DESC_ID. 
     Returns list of (ddid,nrows,subms) tuples, where subms is a subset of the MS with the given DDID,
@@ -242,7 +697,7 @@ class Flagger (Timba.dmi.verbosity):
       nrows += subms.nrows();
     return sub_mss;
 
-  def _flag (self,
+  def _make_flag_op (self,
           flag=1,                         # set this flagmask (or flagset name) or
           unflag=0,                       # clear this flagmask (or flagset name)
           create=False,                   # if True and 'flag' is a string, creates new flagset as needed
@@ -267,10 +722,11 @@ class Flagger (Timba.dmi.verbosity):
           clip_fm_above=None,             # same as clip_above/_below, but flags based on the mean
           clip_fm_below=None,             #                       amplitude across all frequencies
           clip_column='CORRECTED_DATA',   # data column for clip_above and clip_below
-          progress_callback=None,         # callback, called with (n,nmax) to report progress
           purr=False                      # if True, writes comments to purrpipe
           ):
-    """Internal _flag method does the actual work.""";
+    """Helper method. Resolves the flagging arguments into a _FlagOp, which is then applied to
+    chunks of the MS by _flag_chunk(). The row subset is given by op.query and op.ddids, plus the baseline
+    selection, which is applied per chunk.""";
     ms = self._reopen();
     if not self.has_bitflags:
       if transfer:
@@ -339,9 +795,8 @@ class Flagger (Timba.dmi.verbosity):
       query = "( " + " ) && ( ".join(queries)+" )";
       purr and self.purrpipe.comment("; effective MS selection is \"%s\""%query,endline=False);
       self.dprintf(2,"selection string is %s\n",query);
-      ms = ms.query(query);
-      self.dprintf(2,"query reduces MS to %d rows\n",ms.nrows());
     else:
+      query = None;
       self.dprintf(2,"no selection applied\n");
     # check list of baselines
     if baselines:
@@ -378,179 +833,316 @@ class Flagger (Timba.dmi.verbosity):
     # putt comment into purrpipe
     purr and self.purrpipe.comment(".");
     self.dprintf(2,"correlation selection is %s\n",corrs);
-    stat_rows_nfl = stat_rows = stat_pixels = stat_pixels_nfl = 0;
+    # columns read by _flag_chunk(), which can be prefetched
+    columns = [ 'ANTENNA1','ANTENNA2' ] if baselines else [];
+    if get_stats:
+      columns += ([ 'FLAG_ROW','FLAG' ] if include_legacy_stats else []) + ([ 'BITFLAG_ROW','BITFLAG' ] if flag else []);
+    elif transfer:
+      columns += [ 'BITFLAG_ROW','FLAG_ROW','FLAG','BITFLAG' ];
+    elif flagrows and self.has_bitflags:
+      columns += [ 'BITFLAG_ROW','BITFLAG' ] + ([ 'FLAG_ROW','FLAG' ] if fill_legacy is not None else []);
+    elif flagrows:
+      columns += [ 'FLAG_ROW','FLAG' ];
+    else:
+      columns += [ 'FLAG' ] + ([ clip_column ] if clip else []);
+      columns += [ 'BITFLAG','BITFLAG_ROW' ] if self.has_bitflags else [];
+      columns += [ 'FLAG_ROW' ] if fill_legacy is not None or not self.has_bitflags else [];
+    return _FlagOp(flag=flag,unflag=unflag,fill_legacy=fill_legacy,transfer=transfer,
+        get_stats=get_stats,include_legacy_stats=include_legacy_stats,ddids=ddids,query=query,
+        baselines=baselines,baseline_mask=baselines and _BaselineMask(baselines),multichan=multichan,corrs=corrs,flagrows=flagrows,
+        clip=clip,clip_above=clip_above,clip_below=clip_below,clip_fm_above=clip_fm_above,
+        clip_fm_below=clip_fm_below,clip_column=clip_column,columns=columns);
+
+  def _flag (self,progress_callback=None,**kw):
+    """Internal _flag method does the actual work. See _make_flag_op() for the arguments.
+    progress_callback, if given, is called with (n,nmax) to report progress.""";
+    op = self._make_flag_op(**kw);
+    flagstats = None if op.get_stats else self._checkout_flagstats();
+    ms = self._reopen();
+    if op.query:
+      ms = ms.query(op.query);
+      self.dprintf(2,"query reduces MS to %d rows\n",ms.nrows());
     # make list of sub-MSs by DDID
-    sub_mss = self._get_submss(ms,ddids);
+    sub_mss = self._get_submss(ms,op.ddids);
     nrow_tot = ms.nrows();
+    if self.processes > 1:
+      tasks = self._split_tasks(sub_mss);
+      # drop all table references, since the MS is closed before the worker processes are started
+      ms = sub_mss = None;
+      self._flag_parallel(op,tasks,nrow_tot,flagstats,progress_callback);
+      self._commit_flagstats(flagstats);
+      return op.stats();
     # go through rows of the MS in chunks
-    for ddid,irow_prev,ms in sub_mss:
-      self.dprintf(2,"processing MS subset for ddid %d\n",ddid);
-      if progress_callback:
-        progress_callback(irow_prev,nrow_tot);
-      for row0 in range(0,ms.nrows(),self.chunksize):
+    chunkio = _ChunkIO(self.pipelined);
+    try:
+      for ddid,irow_prev,ms in sub_mss:
+        self.dprintf(2,"processing MS subset for ddid %d\n",ddid);
         if progress_callback:
-          progress_callback(irow_prev+row0,nrow_tot);
-        nrows = min(self.chunksize,ms.nrows()-row0);
-        self.dprintf(2,"flagging rows %d:%d\n",row0,row0+nrows-1);
-        # get mask of matching baselines
-        if baselines:
-          # init mask of all-false
-          rowmask = numpy.zeros(nrows,dtype=numpy.bool);
-          a1 = ms.getcol('ANTENNA1',row0,nrows);
-          a2 = ms.getcol('ANTENNA2',row0,nrows);
-          # update mask
-          for p,q in baselines:
-            rowmask |= (a1==p) & (a2==q);
-          self.dprintf(2,"baseline selection leaves %d rows\n",len(rowmask.nonzero()[0]));
-        # else select all rows
-        else:
-          rowmask = numpy.s_[:];
-          self.dprintf(2,"no baseline selection applied, flagging %d rows\n",nrows);
-        # form up subsets for channel/correlation selector
-        subsets = [ (rowmask,ch,corrs) for ch in multichan ];
-        # first, handle statistics mode
-        if get_stats:
-          # collect row stats
-          if include_legacy_stats:
-            lfr  = ms.getcol('FLAG_ROW',row0,nrows)[rowmask];
-            lf   = ms.getcol('FLAG',row0,nrows);
-          else:
-            lfr = lf = 0;
-          if flag:
-            bfr = ms.getcol('BITFLAG_ROW',row0,nrows)[rowmask];
-            lfr = lfr + ((bfr&flag)!=0);
-            bf = self._get_bitflag_col(ms,row0,nrows);
-          # size seems to be a method or an attribute depending on numpy version :(
-          stat_rows     += (callable(lfr.size) and lfr.size()) or lfr.size;
-          stat_rows_nfl += lfr.sum();
-          for subset in subsets:
-            if include_legacy_stats:
-              lfm = lf[subset];
-            else:
-              lfm = 0;
-            if flag:
-              lfm = lfm + (bf[subset]&flag)!=0;
-            # size seems to be a method or an attribute depending on numpy version :(
-            stat_pixels     += (callable(lfm.size) and lfm.size()) or lfm.size;
-            stat_pixels_nfl += lfm.sum();
-        # second, handle transfer-flags mode
-        elif transfer:
-          bf = ms.getcol('BITFLAG_ROW',row0,nrows);
-          bfm = bf[rowmask];
-          if unflag:
-            bfm &= ~unflag;
-          lf = ms.getcol('FLAG_ROW',row0,nrows)[rowmask];
-          bf[rowmask] = numpy.where(lf,bfm|flag,bfm);
-            # size seems to be a method or an attribute depending on numpy version :(
-          stat_rows     += (callable(lf.size) and lf.size()) or lf.size;
-          stat_rows_nfl += lf.sum();
-          ms.putcol('BITFLAG_ROW',bf,row0,nrows);
-          lf = ms.getcol('FLAG',row0,nrows);
-          bf = self._get_bitflag_col(ms,row0,nrows,lf.shape);
-          for subset in subsets:
-            bfm = bf[subset];
-            if unflag:
-              bfm &= ~unflag;
-            lfm = lf[subset]
-            bf[subset] = numpy.where(lfm,bfm|flag,bfm);
-            # size seems to be a method or an attribute depending on numpy version :(
-            stat_pixels     += (callable(lfm.size) and lfm.size()) or lfm.size;
-            stat_pixels_nfl += lfm.sum();
-          ms.putcol('BITFLAG',bf,row0,nrows);
-        # else, are we flagging whole rows?
-        elif flagrows:
-          if self.has_bitflags:
-            bfr = ms.getcol('BITFLAG_ROW',row0,nrows);
-            bf = self._get_bitflag_col(ms,row0,nrows);
-            if unflag:
-              bfr[rowmask] &= ~unflag;
-              bf[rowmask,:,:] &= ~unflag;
-            if flag:
-              bfr[rowmask] |= flag;
-              bf[rowmask,:,:] |= flag;
-            ms.putcol('BITFLAG_ROW',bfr,row0,nrows);
-            ms.putcol('BITFLAG',bf,row0,nrows);
-            if fill_legacy is not None:
-              lfr = ms.getcol('FLAG_ROW',row0,nrows);
-              lf = ms.getcol('FLAG',row0,nrows);
-              lfr[rowmask] = ( (bfr[rowmask]&fill_legacy) !=0 );
-              lf[rowmask,:,:] = ( (bf[rowmask]&fill_legacy) !=0 );
-              ms.putcol('FLAG_ROW',lfr,row0,nrows);
-              ms.putcol('FLAG',lf,row0,nrows);
-          else:
-            lfr = ms.getcol('FLAG_ROW',row0,nrows);
-            lf = ms.getcol('FLAG',row0,nrows);
-            lfr[rowmask] = (flag!=0);
-            lf[rowmask,:,:] = (flag!=0);
-            ms.putcol('FLAG_ROW',lfr,row0,nrows);
-            ms.putcol('FLAG',lf,row0,nrows);
-        # else flagging individual correlations or channels
-        else: 
-          # get flags (for clipping purposes)
-          lf = ms.getcol('FLAG',row0,nrows);
-          # 'mask' is what needs to be flagged/unflagged. Start with empty mask.
-          mask = numpy.zeros(lf.shape,bool);
-          # then fill in subsets
-          for subset in subsets:
-            mask[subset] = True;
-          # get clipping mask, if amplitude clipping is in effect
-          if clip:
-            datacol = ms.getcol(clip_column,row0,nrows);
-            clip_mask = numpy.ones(datacol.shape,bool);
-            if clip_above is not None:
-              clip_mask &= abs(datacol)>clip_above;
-            if clip_below is not None:
-              clip_mask &= abs(datacol)<clip_below;
-            if len(datacol.shape) > 1:
-              # mask data column with subset, and with legacy flags
-              datacol = numpy.ma.masked_array(abs(datacol),(~mask)|lf,fill_value=0).mean(1);
-              if clip_fm_above is not None:
-                clip_mask &= (datacol>clip_fm_above)[:,numpy.newaxis,...];
-              if clip_fm_below is not None:
-                clip_mask &= (datacol<clip_fm_below)[:,numpy.newaxis,...];
-            # broadcast shape, if datacol has fewer axes than flags
-            if len(clip_mask.shape) == 1:
-              clip_mask = clip_mask[:,numpy.newaxis,numpy.newaxis];
-            elif len(clip_mask.shape) == 2:
-              clip_mask = clip_mask[:,:,numpy.newaxis];
-            # and multiply mask by the clipping mask
-            mask &= clip_mask;
-          # mask of affected rows
-          rmask = mask.any(2).any(1);
-          # apply flags
-          if self.has_bitflags:
-            bf = self._get_bitflag_col(ms,row0,nrows);
-            bfr = ms.getcol('BITFLAG_ROW',row0,nrows);
-            if unflag:
-              bf[mask] &= ~unflag;
-            if flag:
-              bf[mask] |= flag;
-            # update row flag: mask out all affected bits
-            bf1 = bf[rmask,:,:]&(flag|unflag);
-            # clear all affected bits in rowflag
-            bfr[rmask] &= ~(flag|unflag);
-            # set bits in rowflag that are set in all flags 
-            bfr[rmask] |= numpy.logical_and.reduce(numpy.logical_and.reduce(bf1,2),1);
-            ms.putcol('BITFLAG',bf,row0,nrows);
-            ms.putcol('BITFLAG_ROW',bfr,row0,nrows);
-            # fill legacy flags
-            if fill_legacy is not None:
-              lfr = ms.getcol('FLAG_ROW',row0,nrows);
-              lf[mask] = ( (bf[mask]&fill_legacy) !=0 );
-              lfr[rmask] = ( (bfr[rmask]&fill_legacy) != 0);
-              ms.putcol('FLAG',lf,row0,nrows);
-              ms.putcol('FLAG_ROW',lfr,row0,nrows);
-          else:
-            lfr = ms.getcol('FLAG_ROW',row0,nrows);
-            lf[mask] = (flag!=0);
-            lfr[rmask] = lf[mask].all(2).all(1);
-            ms.putcol('FLAG',lf,row0,nrows);
-            ms.putcol('FLAG_ROW',lfr,row0,nrows);
+          progress_callback(irow_prev,nrow_tot);
+        # if a flag summary is being kept, use cached tables so that flags can be compared before and after
+        track = flagstats is not None and ddid in flagstats.rows;
+        columns = flagstats.columns(op.columns) if track else op.columns;
+        for row0,nrows,tab in chunkio.chunks(ms,self.chunksize,columns,cached=track):
+          if progress_callback:
+            progress_callback(irow_prev+row0,nrow_tot);
+          before = track and flagstats.chunk_words(tab,row0,nrows);
+          self._flag_chunk(op,tab,row0,nrows);
+          track and flagstats.update(ddid,before,flagstats.chunk_words(tab,row0,nrows));
+    finally:
+      chunkio.close();
+    self._commit_flagstats(flagstats);
     if progress_callback:
       progress_callback(99,100);
-    stat0 = (stat_rows and stat_rows_nfl/float(stat_rows)) or 0;
-    stat1 = (stat_pixels and stat_pixels_nfl/float(stat_pixels)) or 0;
-    return stat0,stat1;
+    return op.stats();
+
+  def _subms_query (self,op,ddid):
+    """Helper method. Returns TaQL string selecting the rows of ddid affected by flagging operation op""";
+    return "DATA_DESC_ID==%d"%ddid + (" && ( %s )"%op.query if op.query else "");
+
+  def _split_tasks (self,sub_mss):
+    """Helper method. Splits list of sub-MSs (as returned by _get_submss()) into tasks for worker processes.
+    Returns list of (ddid,irow_prev,row0,row1) tuples, one per chunk of each sub-MS.""";
+    tasks = [];
+    for ddid,irow_prev,subms in sub_mss:
+      nrows = subms.nrows();
+      tasks += [ (ddid,irow_prev,row0,min(row0+self.chunksize,nrows)) for row0 in range(0,nrows,self.chunksize) ];
+    return tasks;
+
+  def _flag_parallel (self,op,tasks,nrow_tot,flagstats,progress_callback=None):
+    """Helper method for _flag(). Applies flagging operation op to the tasks returned by _split_tasks(),
+    using a pool of worker processes. The workers only read the MS: the columns they modify are sent back,
+    and written out here, as tasks complete. Accumulates stats in op, and updates flagstats, if given.""";
+    global _parallel_flag_args;
+    nproc = min(self.processes,len(tasks));
+    self.dprintf(1,"flagging %d chunks using %d processes\n",len(tasks),nproc);
+    # the MS must not be open in this process when the workers are forked, else they would inherit
+    # its table objects (and their lock state) instead of opening the MS themselves
+    self.close();
+    _parallel_flag_args = self,op,flagstats;
+    sub_mss = {};
+    try:
+      pool = multiprocessing.get_context('fork').Pool(nproc);
+      try:
+        ms = self._reopen();
+        nrow_done = 0;
+        for ddid,stats,nrows,delta,writes in pool.imap_unordered(_run_flag_task,tasks):
+          op.stat_rows,op.stat_rows_nfl,op.stat_pixels,op.stat_pixels_nfl = \
+            [ x+y for x,y in zip((op.stat_rows,op.stat_rows_nfl,op.stat_pixels,op.stat_pixels_nfl),stats) ];
+          if delta:
+            flagstats.merge(*delta);
+          if writes:
+            subms = sub_mss.get(ddid);
+            if subms is None:
+              subms = sub_mss[ddid] = ms.query(self._subms_query(op,ddid));
+            for column,value,row0,nrows_ in writes:
+              subms.putcol(column,value,row0,nrows_);
+            # flushes the changes and releases the table lock, so that the workers can carry on reading
+            ms.unlock();
+          nrow_done += nrows;
+          if progress_callback:
+            progress_callback(nrow_done,nrow_tot);
+      finally:
+        pool.close();
+        pool.join();
+    finally:
+      _parallel_flag_args = None;
+      for subms in sub_mss.values():
+        subms.close();
+    if progress_callback:
+      progress_callback(99,100);
+
+  def _flag_task (self,op,task,flagstats):
+    """Helper method, called in a worker process. Applies flagging operation op to the row range given by task
+    (see _split_tasks()). The MS is opened read-only (once per worker process), and nothing is written to it.
+    Returns ddid, op stats, number of rows processed, the changes to the flag summary (or None),
+    and a list of (column,value,row0,nrows) writes to the sub-MS of the ddid.""";
+    ddid,irow_prev,row0,row1 = task;
+    op.stat_rows_nfl = op.stat_rows = op.stat_pixels = op.stat_pixels_nfl = 0;
+    track = flagstats is not None and ddid in flagstats.rows;
+    if track:
+      flagstats = _FlagStats(self.has_bitflags);
+      flagstats.add_ddid(ddid);
+    if None not in _worker_tables:
+      _worker_tables[None] = TABLE(str(self.msname),readonly=True);
+    ms = _worker_tables[None];
+    subms = _worker_tables.get(ddid);
+    if subms is None:
+      subms = _worker_tables[ddid] = ms.query(self._subms_query(op,ddid));
+    self.dprintf(2,"processing rows %d:%d of MS subset for ddid %d\n",row0,row1-1,ddid);
+    # cached tables are always used, so that columns written by one step are read back by the next
+    chunkio = _DeferredChunkIO();
+    try:
+      for row0_,nrows,tab in chunkio.chunks(subms,self.chunksize,cached=True,rows=(row0,row1)):
+        before = track and flagstats.chunk_words(tab,row0_,nrows);
+        self._flag_chunk(op,tab,row0_,nrows);
+        track and flagstats.update(ddid,before,flagstats.chunk_words(tab,row0_,nrows));
+    finally:
+      # release the read lock, so that the parent process can write
+      ms.unlock();
+    stats = op.stat_rows,op.stat_rows_nfl,op.stat_pixels,op.stat_pixels_nfl;
+    return ddid,stats,row1-row0,(track and (ddid,flagstats.rows[ddid],flagstats.pixels[ddid])) or None,chunkio.writes;
+
+  def _flag_chunk (self,op,tab,row0,nrows,selection=None):
+    """Helper method. Applies flagging operation op (see _make_flag_op()) to a chunk of rows of table tab.
+    If selection is given, it is a boolean mask of selected rows in the chunk (in addition to op.baselines).""";
+    flag,unflag,fill_legacy,transfer,get_stats,include_legacy_stats = \
+      op.flag,op.unflag,op.fill_legacy,op.transfer,op.get_stats,op.include_legacy_stats;
+    baselines,multichan,corrs,flagrows = op.baselines,op.multichan,op.corrs,op.flagrows;
+    clip,clip_above,clip_below,clip_fm_above,clip_fm_below,clip_column = \
+      op.clip,op.clip_above,op.clip_below,op.clip_fm_above,op.clip_fm_below,op.clip_column;
+    self.dprintf(2,"flagging rows %d:%d\n",row0,row0+nrows-1);
+    # get mask of matching baselines
+    if baselines:
+      rowmask = op.baseline_mask.rowmask(tab.getcol('ANTENNA1',row0,nrows),tab.getcol('ANTENNA2',row0,nrows));
+      self.dprintf(2,"baseline selection leaves %d rows\n",len(rowmask.nonzero()[0]));
+    # else select all rows
+    else:
+      rowmask = numpy.s_[:];
+      self.dprintf(2,"no baseline selection applied, flagging %d rows\n",nrows);
+    # apply additional row selection
+    if selection is not None:
+      rowmask = rowmask&selection if baselines else selection;
+    # form up subsets for channel/correlation selector
+    subsets = [ (rowmask,ch,corrs) for ch in multichan ];
+    # first, handle statistics mode
+    if get_stats:
+      # collect row stats
+      if include_legacy_stats:
+        lfr  = tab.getcol('FLAG_ROW',row0,nrows)[rowmask];
+        lf   = tab.getcol('FLAG',row0,nrows);
+      else:
+        lfr = lf = 0;
+      if flag:
+        bfr = tab.getcol('BITFLAG_ROW',row0,nrows)[rowmask];
+        lfr = lfr + ((bfr&flag)!=0);
+        bf = self._get_bitflag_col(tab,row0,nrows);
+      # size seems to be a method or an attribute depending on numpy version :(
+      op.stat_rows     += (callable(lfr.size) and lfr.size()) or lfr.size;
+      op.stat_rows_nfl += lfr.sum();
+      for subset in subsets:
+        if include_legacy_stats:
+          lfm = lf[subset];
+        else:
+          lfm = 0;
+        if flag:
+          lfm = lfm + (bf[subset]&flag)!=0;
+        # size seems to be a method or an attribute depending on numpy version :(
+        op.stat_pixels     += (callable(lfm.size) and lfm.size()) or lfm.size;
+        op.stat_pixels_nfl += lfm.sum();
+    # second, handle transfer-flags mode
+    elif transfer:
+      bf = tab.getcol('BITFLAG_ROW',row0,nrows);
+      bfm = bf[rowmask];
+      if unflag:
+        bfm &= ~unflag;
+      lf = tab.getcol('FLAG_ROW',row0,nrows)[rowmask];
+      bf[rowmask] = numpy.where(lf,bfm|flag,bfm);
+        # size seems to be a method or an attribute depending on numpy version :(
+      op.stat_rows     += (callable(lf.size) and lf.size()) or lf.size;
+      op.stat_rows_nfl += lf.sum();
+      tab.putcol('BITFLAG_ROW',bf,row0,nrows);
+      lf = tab.getcol('FLAG',row0,nrows);
+      bf = self._get_bitflag_col(tab,row0,nrows,lf.shape);
+      for subset in subsets:
+        bfm = bf[subset];
+        if unflag:
+          bfm &= ~unflag;
+        lfm = lf[subset]
+        bf[subset] = numpy.where(lfm,bfm|flag,bfm);
+        # size seems to be a method or an attribute depending on numpy version :(
+        op.stat_pixels     += (callable(lfm.size) and lfm.size()) or lfm.size;
+        op.stat_pixels_nfl += lfm.sum();
+      tab.putcol('BITFLAG',bf,row0,nrows);
+    # else, are we flagging whole rows?
+    elif flagrows:
+      if self.has_bitflags:
+        bfr = tab.getcol('BITFLAG_ROW',row0,nrows);
+        bf = self._get_bitflag_col(tab,row0,nrows);
+        if unflag:
+          bfr[rowmask] &= ~unflag;
+          bf[rowmask,:,:] &= ~unflag;
+        if flag:
+          bfr[rowmask] |= flag;
+          bf[rowmask,:,:] |= flag;
+        if flag or unflag:
+          tab.putcol('BITFLAG_ROW',bfr,row0,nrows);
+          tab.putcol('BITFLAG',bf,row0,nrows);
+        if fill_legacy is not None:
+          lfr = tab.getcol('FLAG_ROW',row0,nrows);
+          lf = tab.getcol('FLAG',row0,nrows);
+          lfr[rowmask] = ( (bfr[rowmask]&fill_legacy) !=0 );
+          lf[rowmask,:,:] = ( (bf[rowmask]&fill_legacy) !=0 );
+          tab.putcol('FLAG_ROW',lfr,row0,nrows);
+          tab.putcol('FLAG',lf,row0,nrows);
+      else:
+        lfr = tab.getcol('FLAG_ROW',row0,nrows);
+        lf = tab.getcol('FLAG',row0,nrows);
+        lfr[rowmask] = (flag!=0);
+        lf[rowmask,:,:] = (flag!=0);
+        tab.putcol('FLAG_ROW',lfr,row0,nrows);
+        tab.putcol('FLAG',lf,row0,nrows);
+    # else flagging individual correlations or channels
+    else: 
+      # get flags (for clipping purposes)
+      lf = tab.getcol('FLAG',row0,nrows);
+      # 'mask' is what needs to be flagged/unflagged. Start with empty mask.
+      mask = numpy.zeros(lf.shape,bool);
+      # then fill in subsets
+      for subset in subsets:
+        mask[subset] = True;
+      # get clipping mask, if amplitude clipping is in effect
+      if clip:
+        datacol = tab.getcol(clip_column,row0,nrows);
+        clip_mask = numpy.ones(datacol.shape,bool);
+        if clip_above is not None:
+          clip_mask &= abs(datacol)>clip_above;
+        if clip_below is not None:
+          clip_mask &= abs(datacol)<clip_below;
+        if len(datacol.shape) > 1:
+          # mask data column with subset, and with legacy flags
+          datacol = numpy.ma.masked_array(abs(datacol),(~mask)|lf,fill_value=0).mean(1);
+          if clip_fm_above is not None:
+            clip_mask &= (datacol>clip_fm_above)[:,numpy.newaxis,...];
+          if clip_fm_below is not None:
+            clip_mask &= (datacol<clip_fm_below)[:,numpy.newaxis,...];
+        # broadcast shape, if datacol has fewer axes than flags
+        if len(clip_mask.shape) == 1:
+          clip_mask = clip_mask[:,numpy.newaxis,numpy.newaxis];
+        elif len(clip_mask.shape) == 2:
+          clip_mask = clip_mask[:,:,numpy.newaxis];
+        # and multiply mask by the clipping mask
+        mask &= clip_mask;
+      # mask of affected rows
+      rmask = mask.any(2).any(1);
+      # apply flags
+      if self.has_bitflags:
+        bf = self._get_bitflag_col(tab,row0,nrows);
+        bfr = tab.getcol('BITFLAG_ROW',row0,nrows);
+        if unflag:
+          bf[mask] &= ~unflag;
+        if flag:
+          bf[mask] |= flag;
+        # update row flag: mask out all affected bits
+        bf1 = bf[rmask,:,:]&(flag|unflag);
+        # clear all affected bits in rowflag
+        bfr[rmask] &= ~(flag|unflag);
+        # set bits in rowflag that are set in all flags 
+        bfr[rmask] |= numpy.logical_and.reduce(numpy.logical_and.reduce(bf1,2),1);
+        tab.putcol('BITFLAG',bf,row0,nrows);
+        tab.putcol('BITFLAG_ROW',bfr,row0,nrows);
+        # fill legacy flags
+        if fill_legacy is not None:
+          lfr = tab.getcol('FLAG_ROW',row0,nrows);
+          lf[mask] = ( (bf[mask]&fill_legacy) !=0 );
+          lfr[rmask] = ( (bfr[rmask]&fill_legacy) != 0);
+          tab.putcol('FLAG',lf,row0,nrows);
+          tab.putcol('FLAG_ROW',lfr,row0,nrows);
+      else:
+        lfr = tab.getcol('FLAG_ROW',row0,nrows);
+        lf[mask] = (flag!=0);
+        lfr[rmask] = lf[mask].all(2).all(1);
+        tab.putcol('FLAG',lf,row0,nrows);
+        tab.putcol('FLAG_ROW',lfr,row0,nrows);
 
   BITMASK_ALL = 0xFFFFFFFF;   # 32 bitflags
   LEGACY      = (1<<33);      # legacy flag: bit 33
@@ -705,6 +1297,7 @@ class Flagger (Timba.dmi.verbosity):
       purr and self.purrpipe.comment("; baseline subset is %s"%
         " ".join(["%d-%d"%(p,q) for p,q in baselines]),
         endline=False);
+      baseline_mask = _BaselineMask(baselines);
     # helper func to parse the channels/corrs/timeslots arguments
     def make_slice_list (selection,parm):
       if not selection:
@@ -736,142 +1329,149 @@ class Flagger (Timba.dmi.verbosity):
     # make list of sub-MSs by DDID
     sub_mss = self._get_submss(ms,ddids);
     nrow_tot = ms.nrows();
+    # columns to prefetch (in pipelined mode)
+    columns = ([ 'ANTENNA1','ANTENNA2' ] if baselines else []) + [ 'FLAG','FLAG_ROW' ];
+    columns += [ 'BITFLAG_ROW','BITFLAG' ] if self.has_bitflags else [];
+    columns += [ data_column ] if dataclip else [];
+    flagstats = self._checkout_flagstats() if flag or unflag or fill_legacy else None;
     # go through rows of the MS in chunks
-    for ddid,irow_prev,ms in sub_mss:
-      self.dprintf(2,"processing MS subset for ddid %d\n",ddid);
-      if progress_callback:
-        progress_callback(irow_prev,nrow_tot);
-      for row0 in range(0,ms.nrows(),self.chunksize):
+    chunkio = _ChunkIO(self.pipelined);
+    try:
+      for ddid,irow_prev,ms in sub_mss:
+        self.dprintf(2,"processing MS subset for ddid %d\n",ddid);
         if progress_callback:
-          progress_callback(irow_prev+row0,nrow_tot);
-        nrows = min(self.chunksize,ms.nrows()-row0);
-        self.dprintf(2,"processing rows %d:%d (%d rows total)\n",row0,row0+nrows-1,nrows);
-        # apply baseline selection to the mask
-        if baselines:
-          # rowmask will be True for all selected rows
-          rowmask = numpy.zeros(nrows,bool);
-          a1 = ms.getcol('ANTENNA1',row0,nrows);
-          a2 = ms.getcol('ANTENNA2',row0,nrows);
-          # update mask
-          for p,q in baselines:
-            rowmask |= (a1==p) & (a2==q);
-          self.dprintf(2,"baseline selection leaves %d rows\n",nr);
-        # else select all rows
-        else:
-          # rowmask will be True for all selected rows
-          rowmask = numpy.ones(nrows,bool);
-        # read legacy flags to get a datashape
-        lf = ms.getcol('FLAG',row0,nrows);
-        datashape = lf.shape;
-        nv_per_row = reduce(lambda x,y:x*y,datashape);
-        # rowflags and visflags will be constructed on-demand below. Make helper functions for this
-        rowflags = visflags = None;
-        def get_rowflags ():
-          if rowflags is None:
-            # read legacy flags and convert them to bitmask, then add bitflags
-            lfr = ms.getcol('FLAG_ROW',row0,nrows);
-            rowflags = lfr*self.LEGACY;
-            if self.has_bitflags:
-              rowflags |= ms.getcol('BITFLAG_ROW',row0,nrows);
-        def get_visflags ():
-          if visflags is None:
-            visflags = lf*self.LEGACY;
-            if self.has_bitflags:
-              bf = ms.getcol('BITFLAG',row0,nrows);
-              bitflag_dtype = bf.dtype;
-              visflags |= bf;
+          progress_callback(irow_prev,nrow_tot);
+        track = flagstats is not None and ddid in flagstats.rows;
+        for row0,nrows,tab in chunkio.chunks(ms,self.chunksize,flagstats.columns(columns) if track else columns,cached=track):
+          if progress_callback:
+            progress_callback(irow_prev+row0,nrow_tot);
+          self.dprintf(2,"processing rows %d:%d (%d rows total)\n",row0,row0+nrows-1,nrows);
+          before = track and flagstats.chunk_words(tab,row0,nrows);
+          # apply baseline selection to the mask
+          if baselines:
+            # rowmask will be True for all selected rows
+            rowmask = baseline_mask.rowmask(tab.getcol('ANTENNA1',row0,nrows),tab.getcol('ANTENNA2',row0,nrows));
+            self.dprintf(2,"baseline selection leaves %d rows\n",rowmask.sum());
+          # else select all rows
+          else:
+            # rowmask will be True for all selected rows
+            rowmask = numpy.ones(nrows,bool);
+          # read legacy flags to get a datashape
+          lf = tab.getcol('FLAG',row0,nrows);
+          datashape = lf.shape;
+          nv_per_row = reduce(lambda x,y:x*y,datashape);
+          # rowflags and visflags will be constructed on-demand below. Make helper functions for this
+          rowflags = visflags = None;
+          def get_rowflags ():
+            if rowflags is None:
+              # read legacy flags and convert them to bitmask, then add bitflags
+              lfr = tab.getcol('FLAG_ROW',row0,nrows);
+              rowflags = lfr*self.LEGACY;
+              if self.has_bitflags:
+                rowflags |= tab.getcol('BITFLAG_ROW',row0,nrows);
+          def get_visflags ():
+            if visflags is None:
+              visflags = lf*self.LEGACY;
+              if self.has_bitflags:
+                bf = tab.getcol('BITFLAG',row0,nrows);
+                bitflag_dtype = bf.dtype;
+                visflags |= bf;
                 
-        # apply stats
-        nr = rowmask.sum();
-        nrows_A += nr;
-        nvis_A += nr*nv_per_row;
-        # read flags if selecting subset B on them (and also if clipping data)
-        if flagsubsets:
-          get_rowflags();
-          # apply them to the rowmask
-          if flagmask is not None:
-            rowmask &= ( (rowflags&flagmask) != 0 );
-          if flagmask_all is not None:
-            rowmask &= ( (rowflags&flagmask_all) == flagmask_all );
-          if flagmask_none is not None:
-            rowmask &= ( (rowflags&flagmask_none) == 0 );
-        # now we have a finalized subset B
-        nr = rowmask.sum();
-        nrows_B += nr;
-        nv = nr*nv_per_row;
-        nvis_B += nv;
-        self.dprintf(2,"subset B (rowflag-based selection) leaves %d rows and %d visibilities\n",nr,nv);
-        # get subset C 
-        # vismask will be True for all selected visibilities
-        vismask = numpy.zeros(datashape,False);
-        for channel_slice in channels:
-          for corr_slice in corrs:
-            vismask[rowmask,channel_slice,corr_slice] = True;
-        nv = vismask.sum();
-        nvis_C += vismask.sum();
-        self.dprintf(2,"subset C (freq/corr slicing) leaves %d visibilities\n",nv);
-        # read flags if selecting subset D on them (and also if clipping data)
-        if flagsubsets:
-          get_visflags();
-          # apply them to the rowmask
-          if flagmask is not None:
-            vismask &= ( (visflags&flagmask) != 0 );
-          if flagmask_all is not None:
-            vismask &= ( (visflags&flagmask_all) == flagmask_all );
-          if flagmask_none is not None:
-            vismask &= ( (visflags&flagmask_none) == 0 );
-        nv = vismask.sum();
-        nvis_D += nv;
-        self.dprintf(2,"subset D (flag-based selection) leaves %d visibilities\n",nv);
-        # now apply clipping
-        if dataclip:
-          datacol = ms.getcol(data_column,row0,nrows);
-          # make it a masked array: mask out stuff not in vismask
-          datamask = ~vismask;  
-          # and mask stuff in data_flagmask
-          if data_flagmask is not None:
+          # apply stats
+          nr = rowmask.sum();
+          nrows_A += nr;
+          nvis_A += nr*nv_per_row;
+          # read flags if selecting subset B on them (and also if clipping data)
+          if flagsubsets:
+            get_rowflags();
+            # apply them to the rowmask
+            if flagmask is not None:
+              rowmask &= ( (rowflags&flagmask) != 0 );
+            if flagmask_all is not None:
+              rowmask &= ( (rowflags&flagmask_all) == flagmask_all );
+            if flagmask_none is not None:
+              rowmask &= ( (rowflags&flagmask_none) == 0 );
+          # now we have a finalized subset B
+          nr = rowmask.sum();
+          nrows_B += nr;
+          nv = nr*nv_per_row;
+          nvis_B += nv;
+          self.dprintf(2,"subset B (rowflag-based selection) leaves %d rows and %d visibilities\n",nr,nv);
+          # get subset C 
+          # vismask will be True for all selected visibilities
+          vismask = numpy.zeros(datashape,False);
+          for channel_slice in channels:
+            for corr_slice in corrs:
+              vismask[rowmask,channel_slice,corr_slice] = True;
+          nv = vismask.sum();
+          nvis_C += vismask.sum();
+          self.dprintf(2,"subset C (freq/corr slicing) leaves %d visibilities\n",nv);
+          # read flags if selecting subset D on them (and also if clipping data)
+          if flagsubsets:
             get_visflags();
-            datamask |= ( (visflags&data_flagmask)!=0 );
-          datacol = numpy.masked_array(datacol,datamask);
-          # clip on amplitudes
-          if clip_above is not None:
-            vismask &= abs(datacol)>clip_above;
-          if clip_below is not None:
-            vismask &= abs(datacol)<clip_below;
-          # clip on freq-mean amplitudes
-          if clip_fm_above is not None or clip_fm_below is not None:
-            datacol = datacol.mean(1);
-            if clip_fm_above is not None:
-              vismask &= (datacol>clip_fm_above)[:,numpy.newaxis,...];
-            if clip_fm_below is not None:
-              vismask &= (datacol<clip_fm_below)[:,numpy.newaxis,...];
-        # finally, subset E is ready
-        nv = vismask.sum();
-        nvis_E += nv;
-        self.dprintf(2,"subset E (data clipping) leaves %d visibilities\n",nv);
+            # apply them to the rowmask
+            if flagmask is not None:
+              vismask &= ( (visflags&flagmask) != 0 );
+            if flagmask_all is not None:
+              vismask &= ( (visflags&flagmask_all) == flagmask_all );
+            if flagmask_none is not None:
+              vismask &= ( (visflags&flagmask_none) == 0 );
+          nv = vismask.sum();
+          nvis_D += nv;
+          self.dprintf(2,"subset D (flag-based selection) leaves %d visibilities\n",nv);
+          # now apply clipping
+          if dataclip:
+            datacol = tab.getcol(data_column,row0,nrows);
+            # make it a masked array: mask out stuff not in vismask
+            datamask = ~vismask;  
+            # and mask stuff in data_flagmask
+            if data_flagmask is not None:
+              get_visflags();
+              datamask |= ( (visflags&data_flagmask)!=0 );
+            datacol = numpy.masked_array(datacol,datamask);
+            # clip on amplitudes
+            if clip_above is not None:
+              vismask &= abs(datacol)>clip_above;
+            if clip_below is not None:
+              vismask &= abs(datacol)<clip_below;
+            # clip on freq-mean amplitudes
+            if clip_fm_above is not None or clip_fm_below is not None:
+              datacol = datacol.mean(1);
+              if clip_fm_above is not None:
+                vismask &= (datacol>clip_fm_above)[:,numpy.newaxis,...];
+              if clip_fm_below is not None:
+                vismask &= (datacol<clip_fm_below)[:,numpy.newaxis,...];
+          # finally, subset E is ready
+          nv = vismask.sum();
+          nvis_E += nv;
+          self.dprintf(2,"subset E (data clipping) leaves %d visibilities\n",nv);
         
-        # now, do the actual flagging
-        if flag or unflag or fill_legacy:
-          get_rowflags();
-          get_visflags();
-          # flag/unflag visibilities
-          if flag:
-            visflags[vismask] |= flag;
-          if unflag:
-            visflags[vismask] &= ~unflag;
-          # fill legacy flags
-          if fill_legacy is not None:
-            visflags[rowmask] |= numpy.where(visflags[rowmask,...]&fill_legacy,self.LEGACY,0);
-          # adjust the rowflags 
-          rowflags[rowmask] = numpy.logical_and.reduce(numpy.logical_and.reduce(visflags[rowmask,:,:],2),1);
-          # mask bitflagm, convert back to bitflag type and write out
-          if self.has_bitflags and (flag|unflag)&self.BITMASK_ALL:
-            ms.putcol('BITFLAG',numpy.asarray(visflags&self.BITMASK_ALL,bitflag_dtype),row0,nrows);
-            ms.putcol('BITFLAG_ROW',numpy.asarray(rowflags&self.BITMASK_ALL,bitflag_dtype),row0,nrows);
-          # write legacy flags
-          if fill_legacy is not None or (flag|unflag)&self.LEGACY:
-            ms.putcol('FLAG',(visflags&self.LEGACY)!=0,row0,nrows);
-            ms.putcol('FLAG_ROW',(rowflags&self.LEGACY)!=0,row0,nrows);
+          # now, do the actual flagging
+          if flag or unflag or fill_legacy:
+            get_rowflags();
+            get_visflags();
+            # flag/unflag visibilities
+            if flag:
+              visflags[vismask] |= flag;
+            if unflag:
+              visflags[vismask] &= ~unflag;
+            # fill legacy flags
+            if fill_legacy is not None:
+              visflags[rowmask] |= numpy.where(visflags[rowmask,...]&fill_legacy,self.LEGACY,0);
+            # adjust the rowflags 
+            rowflags[rowmask] = numpy.logical_and.reduce(numpy.logical_and.reduce(visflags[rowmask,:,:],2),1);
+            # mask bitflagm, convert back to bitflag type and write out
+            if self.has_bitflags and (flag|unflag)&self.BITMASK_ALL:
+              tab.putcol('BITFLAG',numpy.asarray(visflags&self.BITMASK_ALL,bitflag_dtype),row0,nrows);
+              tab.putcol('BITFLAG_ROW',numpy.asarray(rowflags&self.BITMASK_ALL,bitflag_dtype),row0,nrows);
+            # write legacy flags
+            if fill_legacy is not None or (flag|unflag)&self.LEGACY:
+              tab.putcol('FLAG',(visflags&self.LEGACY)!=0,row0,nrows);
+              tab.putcol('FLAG_ROW',(rowflags&self.LEGACY)!=0,row0,nrows);
+          track and flagstats.update(ddid,before,flagstats.chunk_words(tab,row0,nrows));
+    finally:
+      chunkio.close();
+    self._commit_flagstats(flagstats);
     if progress_callback:
       progress_callback(99,100);
     # print collected stats
@@ -917,20 +1517,29 @@ class Flagger (Timba.dmi.verbosity):
     # get list of per-DDID subsets
     sub_mss = self._get_submss(ms);
     nrow_tot = ms.nrows();
+    columns = [ 'BITFLAG','BITFLAG_ROW' ];
+    flagstats = self._checkout_flagstats();
     # go through rows of the MS in chunks
-    for ddid,irow_prev,ms in sub_mss:
-      self.dprintf(2,"processing MS subset for ddid %d\n",ddid);
-      if progress_callback:
-        progress_callback(irow_prev,nrow_tot);
-      for row0 in range(0,ms.nrows(),self.chunksize):
+    chunkio = _ChunkIO(self.pipelined);
+    try:
+      for ddid,irow_prev,ms in sub_mss:
+        self.dprintf(2,"processing MS subset for ddid %d\n",ddid);
         if progress_callback:
-          progress_callback(irow_prev+row0,nrow_tot);
-        nrows = min(self.chunksize,ms.nrows()-row0);
-        self.dprintf(2,"filling rows %d:%d\n",row0,row0+nrows-1);
-        bf = self._get_bitflag_col(ms,row0,nrows,ms.getcol('FLAG').shape);
-        bfr = ms.getcol('BITFLAG_ROW',row0,nrows);
-        ms.putcol('FLAG',(bf&flagmask).astype(Timba.array.dtype('bool')),row0,nrows);
-        ms.putcol('FLAG_ROW',(bfr&flagmask).astype(Timba.array.dtype('bool')),row0,nrows);
+          progress_callback(irow_prev,nrow_tot);
+        track = flagstats is not None and ddid in flagstats.rows;
+        for row0,nrows,tab in chunkio.chunks(ms,self.chunksize,flagstats.columns(columns) if track else columns,cached=track):
+          if progress_callback:
+            progress_callback(irow_prev+row0,nrow_tot);
+          self.dprintf(2,"filling rows %d:%d\n",row0,row0+nrows-1);
+          before = track and flagstats.chunk_words(tab,row0,nrows);
+          bf = self._get_bitflag_col(tab,row0,nrows);
+          bfr = tab.getcol('BITFLAG_ROW',row0,nrows);
+          tab.putcol('FLAG',(bf&flagmask).astype(Timba.array.dtype('bool')),row0,nrows);
+          tab.putcol('FLAG_ROW',(bfr&flagmask).astype(Timba.array.dtype('bool')),row0,nrows);
+          track and flagstats.update(ddid,before,flagstats.chunk_words(tab,row0,nrows));
+    finally:
+      chunkio.close();
+    self._commit_flagstats(flagstats);
     if progress_callback:
       progress_callback(99,100);
       
@@ -950,23 +1559,133 @@ class Flagger (Timba.dmi.verbosity):
     # get list of per-DDID subsets
     sub_mss = self._get_submss(ms);
     nrow_tot = ms.nrows();
+    columns = [ 'FLAG' ];
+    flagstats = self._checkout_flagstats();
     # go through each sub-MS, and through rows of the sub-MS in chunks
-    for ddid,irow_prev,ms in sub_mss:
-      self.dprintf(2,"processing MS subset for ddid %d\n",ddid);
-      if progress_callback:
-        progress_callback(irow_prev,nrow_tot);
-      for row0 in range(0,ms.nrows(),self.chunksize):
+    chunkio = _ChunkIO(self.pipelined);
+    try:
+      for ddid,irow_prev,ms in sub_mss:
+        self.dprintf(2,"processing MS subset for ddid %d\n",ddid);
         if progress_callback:
-          progress_callback(row0+irow_prev,ms.nrows());
-        nrows = min(self.chunksize,ms.nrows()-row0);
-        self.dprintf(2,"filling rows %d:%d\n",row0,row0+nrows-1);
-        fl = ms.getcol('FLAG',row0,nrows);
-        fl[:,:,:] = False;
-        ms.putcol('FLAG',fl,row0,nrows);
-        ms.putcol('FLAG_ROW',Timba.array.zeros((nrows,),dtype='bool'),row0,nrows);
+          progress_callback(irow_prev,nrow_tot);
+        track = flagstats is not None and ddid in flagstats.rows;
+        for row0,nrows,tab in chunkio.chunks(ms,self.chunksize,flagstats.columns(columns) if track else columns,cached=track):
+          if progress_callback:
+            progress_callback(row0+irow_prev,ms.nrows());
+          self.dprintf(2,"filling rows %d:%d\n",row0,row0+nrows-1);
+          before = track and flagstats.chunk_words(tab,row0,nrows);
+          fl = tab.getcol('FLAG',row0,nrows);
+          fl[:,:,:] = False;
+          tab.putcol('FLAG',fl,row0,nrows);
+          tab.putcol('FLAG_ROW',Timba.array.zeros((nrows,),dtype='bool'),row0,nrows);
+          track and flagstats.update(ddid,before,flagstats.chunk_words(tab,row0,nrows));
+    finally:
+      chunkio.close();
+    self._commit_flagstats(flagstats);
     if progress_callback:
       progress_callback(99,100);
   
+  def plan (self):
+    """Returns a FlagPlan, which collects several flagging operations, and applies them in one pass over the MS""";
+    return Flagger.FlagPlan(self);
+
+  class FlagPlan (object):
+    """Collects a list of flagging operations, which are then applied by run() in a single pass over the MS:
+    each chunk of rows is read in once, all operations are applied to it in turn, and the modified columns
+    are written back once. The operations take the same arguments as the corresponding Flagger methods,
+    and are applied in the order given. Row selections (ddid, fieldid, antennas, time, taql, etc.) are
+    evaluated per operation, so different operations may apply to different subsets.""";
+    def __init__ (self,flagger):
+      self.flagger = flagger;
+      self._ops = [];
+      self._descs = [];
+
+    def _add (self,desc,**kw):
+      self._ops.append(self.flagger._make_flag_op(**kw));
+      self._descs.append(desc);
+      return self;
+
+    def flag (self,flag=1,**kw):
+      return self._add("flag %s"%(("%x"%flag) if isinstance(flag,int) else flag),flag=flag,unflag=0,**kw);
+
+    def unflag (self,unflag=-1,**kw):
+      return self._add("unflag %s"%(("%x"%unflag) if isinstance(unflag,int) else unflag),flag=0,unflag=unflag,**kw);
+
+    def transfer (self,flag=1,replace=False,**kw):
+      return self._add("transfer FLAG/FLAG_ROW to %s"%(("%x"%flag) if isinstance(flag,int) else flag),
+                       flag=flag,unflag=(replace and flag) or 0,transfer=True,**kw);
+
+    def get_stats (self,flag=0,legacy=False,**kw):
+      return self._add("get stats",flag=flag,get_stats=True,include_legacy_stats=legacy,**kw);
+
+    def set_legacy_flags (self,flags):
+      if not self.flagger.has_bitflags:
+        raise TypeError("MS does not contain a BITFLAG column, cannot use bitflags""");
+      if isinstance(flags,str):
+        flagmask = self.flagger.flagsets.flagmask(flags);
+      elif isinstance(flags,(list,tuple)):
+        flagmask = reduce(lambda a,b:a|b,[ self.flagger.flagsets.flagmask(fl) for fl in flags ],0);
+      elif isinstance(flags,int):
+        flagmask = flags;
+      else:
+        raise TypeError("flagmask argument must be int, str or sequence");
+      return self._add("fill FLAG/FLAG_ROW from bitflags %x"%flagmask,flag=0,unflag=0,fill_legacy=flagmask);
+
+    def clear_legacy_flags (self):
+      return self._add("clear FLAG/FLAG_ROW",flag=0,unflag=0,fill_legacy=0 if self.flagger.has_bitflags else None);
+
+    def run (self,progress_callback=None,purr=True):
+      """Applies all operations. Returns list of per-operation stats (see Flagger.get_stats())""";
+      flagger = self.flagger;
+      ms = flagger._reopen();
+      ops = self._ops;
+      purr and flagger.purrpipe.title("Flagging").comment("Applying %d operations in one pass: %s."%(
+                                                           len(ops),"; ".join(self._descs)));
+      # union of columns needed by all operations, and of all DDIDs
+      columns = [];
+      for op in ops:
+        columns += [ col for col in op.columns if col not in columns ];
+      ddids = sorted(set([ ddid for op in ops for ddid in op.ddids ]));
+      sub_mss = flagger._get_submss(ms,ddids);
+      nrow_tot = sub_mss[-1][1]+sub_mss[-1][2].nrows() if sub_mss else 0;
+      # keep the flag summary up to date, unless we're only collecting stats
+      flagstats = None if all([ op.get_stats for op in ops ]) else flagger._checkout_flagstats();
+      chunkio = _ChunkIO(flagger.pipelined);
+      try:
+        for ddid,irow_prev,subms in sub_mss:
+          flagger.dprintf(2,"processing MS subset for ddid %d\n",ddid);
+          if progress_callback:
+            progress_callback(irow_prev,nrow_tot);
+          # work out row selection of each operation within this sub-MS: None selects all rows,
+          # False means the operation does not apply to this DDID at all
+          selections = [];
+          for op in ops:
+            if ddid not in op.ddids:
+              selections.append(False);
+            elif op.query:
+              sel = numpy.zeros(subms.nrows(),bool);
+              sel[numpy.asarray(subms.query(op.query).rownumbers(subms),int)] = True;
+              selections.append(sel);
+            else:
+              selections.append(None);
+          track = flagstats is not None and ddid in flagstats.rows;
+          for row0,nrows,tab in chunkio.chunks(subms,flagger.chunksize,flagstats.columns(columns) if track else columns,cached=True):
+            if progress_callback:
+              progress_callback(irow_prev+row0,nrow_tot);
+            before = track and flagstats.chunk_words(tab,row0,nrows);
+            for op,sel in zip(ops,selections):
+              if sel is None:
+                flagger._flag_chunk(op,tab,row0,nrows);
+              elif sel is not False and sel[row0:row0+nrows].any():
+                flagger._flag_chunk(op,tab,row0,nrows,sel[row0:row0+nrows]);
+            track and flagstats.update(ddid,before,flagstats.chunk_words(tab,row0,nrows));
+      finally:
+        chunkio.close();
+      flagger._commit_flagstats(flagstats);
+      if progress_callback:
+        progress_callback(99,100);
+      return [ op.stats() for op in ops ];
+
   def autoflagger (self,*args,**kw):
     return Flagger.AutoFlagger(self,*args,**kw);
   
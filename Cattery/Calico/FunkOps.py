@@ -5,32 +5,93 @@
 Each function here is compatible with ParmTab.apply().
 Input argument is a ParmTab.FunkSlie object.
 Return value is a list of output funklets.
+
+The stacked_xxx() functions are array versions of the reductions, which operate on the coefficients and
+domain boundaries of a whole slice at once. See stack() for the stacked representation. The list-based
+reductions are implemented in terms of these.
 """;
 from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import division
 
 import copy
+import numpy
 
 from Timba.Meq import meq
 from Timba import dmi
 from Timba import mequtils
 
 
+def stack (funklets):
+  """Converts a list of funklets (e.g. a FunkSlice) into stacked form. Returns a (coeffs,bounds) tuple, where
+  coeffs is an array of coefficients of shape (N,)+S, and bounds is an (N,max_axis,2) array of domain
+  boundaries, with NaN for axes along which a domain is not defined. If all coefficients are scalar, coeffs has
+  shape (N,). Otherwise, S is the largest coeff shape in the list, and smaller coeff arrays are padded with
+  zeros. ParmTables.FunkSet.get_stacked() reads funklets from a table directly in this form (except that
+  scalar coefficients are stacked with shape (N,1)); the stacked_xxx() functions accept either.
+  """
+  values = [ numpy.asarray(funk.coeff,float) for funk in funklets ];
+  if all([ val.ndim == 0 for val in values ]):
+    coeffs = numpy.array(values,float);
+  else:
+    values = [ numpy.atleast_1d(val) for val in values ];
+    ndim = max([ val.ndim for val in values ]);
+    shapes = [ val.shape + (1,)*(ndim-val.ndim) for val in values ];
+    coeffs = numpy.zeros((len(values),)+tuple(numpy.max(shapes,0)),float);
+    for i,(val,vshape) in enumerate(zip(values,shapes)):
+      coeffs[(i,)+tuple([ slice(0,n) for n in vshape ])] = val.reshape(vshape);
+  bounds = numpy.zeros((len(values),mequtils.max_axis,2),float) + numpy.nan;
+  for i,funk in enumerate(funklets):
+    for axis,rng in funk.domain.items():
+      if str(axis) != 'axis_map':
+        bounds[i,mequtils.get_axis_number(axis)] = rng;
+  return coeffs,bounds;
+
+def stacked_c00 (coeffs):
+  """Returns the c00 coefficients of stacked coeffs, as an array of shape (N,)""";
+  return coeffs.reshape((len(coeffs),-1))[:,0];
+
+def stacked_average (coeffs,bounds,slice_iaxes):
+  """Array version of average(). Returns the mean of the stacked coeffs as a (1,)+S array, and its domain
+  boundaries as a (1,max_axis,2) array: these are the envelope of the input domains along the slice axes,
+  and the same as the first input domain along the others.
+  """
+  iaxes = list(slice_iaxes);
+  out_bounds = bounds[:1].copy();
+  out_bounds[0,iaxes,0] = bounds[:,iaxes,0].min(0);
+  out_bounds[0,iaxes,1] = bounds[:,iaxes,1].max(0);
+  return coeffs.mean(0)[numpy.newaxis,...],out_bounds;
+
+def stacked_linear_interpol (coeffs,bounds,iaxis):
+  """Array version of linear_interpol(), for N>=2 stacked funklets sorted along axis number iaxis.
+  Returns a (coeffs,bounds,offsets,scales) tuple for the N-1 output funklets, where coeffs has shape (N-1,2),
+  and offsets and scales give the polc offset and scale along iaxis.
+  """
+  c00 = stacked_c00(coeffs);
+  x = bounds[:,iaxis,:].sum(1)/2;
+  out_bounds = bounds[:-1].copy();
+  out_bounds[:,iaxis,0] = x[:-1];
+  out_bounds[:,iaxis,1] = x[1:];
+  # first and last output domains extend to the edges of the first/last input domain
+  out_bounds[0,iaxis,0] = bounds[0,iaxis,0];
+  out_bounds[-1,iaxis,1] = bounds[-1,iaxis,1];
+  return numpy.stack([c00[:-1],c00[1:]-c00[:-1]],1),out_bounds,x[:-1],x[1:]-x[:-1];
+
+def stacked_force_rank0 (coeffs,bounds):
+  """Array version of force_rank0(). Returns c00 coefficients of shape (N,), and the unchanged bounds""";
+  return stacked_c00(coeffs),bounds;
+
 def average (funkslice):
   """Reduction function to replace all funklets in a slice with their mean.
   This is the canonical example of a reduction function.
   """
+  coeffs,bounds = stack(funkslice);
+  coeffs,bounds = stacked_average(coeffs,bounds,funkslice.slice_iaxes);
   outfunk = funkslice[0];
-  shape = getattr(outfunk.coeff,'shape',None);   # shape will be None when coeff is just a float
-  # accumulate sum of coefficients and take mean
-  for funk in funkslice[1:]:
-    outfunk.coeff += funk.coeff;
-    # adjust domain to envelope
-    for axis in funkslice.slice_axes:
-      outfunk.domain[axis] = (min(outfunk.domain[axis][0],funk.domain[axis][0]),
-                              max(outfunk.domain[axis][1],funk.domain[axis][1]));
-  outfunk.coeff /= len(funkslice); #mean, float
+  outfunk.coeff = float(coeffs[0]) if coeffs.ndim == 1 else coeffs[0];
+  # adjust domain to envelope
+  for iaxis,axis in zip(funkslice.slice_iaxes,funkslice.slice_axes):
+    outfunk.domain[axis] = tuple(bounds[0,iaxis].tolist());
   return [ outfunk ];
 
 def linear_interpol (funkslice):
@@ -46,36 +107,19 @@ def linear_interpol (funkslice):
     raise TypeError("linear interpolation only available for rank-1 slices");
   iaxis0 = funkslice.slice_iaxes[0];
   axis0 = funkslice.slice_axes[0];
+  coeffs,bounds = stack(funkslice);
+  coeffs,bounds,offsets,scales = stacked_linear_interpol(coeffs,bounds,iaxis0);
   output = [];
-  for ifunk0,funk0 in enumerate(funkslice[:-1]):
-    # funklet for next domain
-    funk1 = funkslice[ifunk0+1];
-    dom0,dom1 = funk0.domain,funk1.domain;
-    # centerpoint and c00 of ourselves
-    x0 = sum(dom0[axis0])/2;
-    c0 = funk0.coeff if isinstance(funk0.coeff,float) else funk0.coeff.ravel()[0];
-    # centerpoint and c00 of next domain
-    x1 = sum(dom1[axis0])/2;
-    c1 = funk1.coeff if isinstance(funk1.coeff,float) else funk1.coeff.ravel()[0];
-    # make output domain
-    out_domain = copy.copy(dom0);
-    # output domain boundaries are original subdomains' centers, with the exception of the first
-    # and the last funklet, in which case the domain needs to extend to the edge of the first/last
-    # subdomain
-    a0 = dom0[axis0][0] if funk0 is funkslice[0] else x0;
-    a1 = dom1[axis0][1] if funk1 is funkslice[-1] else x1;
-    out_domain[axis0] = (a0,a1);
-    # now make output polc
-    output.append(meq.polc(coeff=[c0,c1-c0],domain=out_domain,offset=x0,scale=x1-x0,axis_index=iaxis0))
+  for funk0,c,rng,x0,dx in zip(funkslice,coeffs,bounds[:,iaxis0],offsets,scales):
+    out_domain = copy.copy(funk0.domain);
+    out_domain[axis0] = tuple(rng.tolist());
+    output.append(meq.polc(coeff=c.tolist(),domain=out_domain,offset=float(x0),scale=float(dx),axis_index=iaxis0));
   return output;
 
 def force_rank0 (funkslice):
   """Reduction function to reduce the polynomial rank of a set of funklets"""
-  output = [];
-  for funk in funkslice:
-    c00 = funk.coeff if isinstance(funk.coeff,float) else funk.coeff.ravel()[0];
-    output.append(meq.polc(coeff=c00,domain=funk.domain));
-  return output;
+  coeffs,bounds = stacked_force_rank0(*stack(funkslice));
+  return [ meq.polc(coeff=float(c00),domain=funk.domain) for funk,c00 in zip(funkslice,coeffs) ];
 
 _sub = dict([(a+b+c,b+c+':'+a) for a in 'ri' for b in 'xy' for c in 'xy' ]);
 
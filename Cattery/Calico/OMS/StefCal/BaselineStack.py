@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import numpy
+
+from .MatrixOps import *
+
+
+class BaselineStack (object):
+  """Support class to convert the per-baseline dicts used by StefCal (mapping (p,q) to a flat 4-list of
+  time/freq planes) into contiguous arrays indexed by antenna.
+
+  The following attributes are defined:
+
+      antennas    = [p0,p1,...]             # sorted list of antenna IDs
+      index       = { p: ip }               # mapping from antenna ID to stack index
+      nant        = len(antennas)
+      ifrs        = [ (p,q),... ]           # baselines covered by the stack
+
+  Visibility matrices are stacked into arrays of shape (Nant,Nant,2,2)+datashape. The stack is Hermitian:
+  a (p,q) matrix is placed at [ip,iq], and its conjugate transpose at [iq,ip], so that every antenna
+  sees all of its baselines along the second axis, regardless of how the baseline is ordered in the input.
+  """
+
+  def __init__ (self,antennas,ifrs):
+    self.antennas = sorted(antennas);
+    self.index = dict([ (p,i) for i,p in enumerate(self.antennas) ]);
+    self.nant = len(self.antennas);
+    self.ifrs = sorted([ pq for pq in ifrs if pq[0] in self.index and pq[1] in self.index ]);
+
+  def stack_matrices (self,data,shape,dtype=complex,hermitian=True):
+    """Stacks the data dict into a (Nant,Nant,2,2)+shape array. Missing baselines and null elements are zero.""";
+    n = self.nant;
+    out = numpy.zeros((n,n,2,2)+tuple(shape),dtype);
+    for pq in self.ifrs:
+      mat = data.get(pq);
+      if mat is None:
+        continue;
+      ip,iq = self.index[pq[0]],self.index[pq[1]];
+      for x,(i,j) in zip(mat,IJ2x2):
+        if not is_null(x):
+          out[ip,iq,i,j] = x;
+          if hermitian:
+            out[iq,ip,j,i] = numpy.conj(x);
+    return out;
+
+  def stack_flags (self,bitflags,shape):
+    """Stacks a bitflags dict into a boolean (Nant,Nant)+shape array, True where flagged""";
+    n = self.nant;
+    out = numpy.zeros((n,n)+tuple(shape),bool);
+    for pq in self.ifrs:
+      fl = bitflags.get(pq);
+      if fl is not None and not numpy.isscalar(fl):
+        ip,iq = self.index[pq[0]],self.index[pq[1]];
+        out[ip,iq] = out[iq,ip] = (fl!=0);
+    return out;
+
+  def stack_weights (self,weight,shape,dtype=float):
+    """Stacks a weights dict into a real (Nant,Nant)+shape array. Baselines without a weight get 0""";
+    n = self.nant;
+    out = numpy.zeros((n,n)+tuple(shape),dtype);
+    for pq in self.ifrs:
+      w = weight.get(pq,weight.get((pq[1],pq[0])));
+      if not is_null(w):
+        ip,iq = self.index[pq[0]],self.index[pq[1]];
+        out[ip,iq] = out[iq,ip] = w;
+    return out;
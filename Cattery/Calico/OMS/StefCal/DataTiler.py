@@ -9,6 +9,13 @@ from Timba.Meq import meq
 from functools import reduce
 
 
+def _new_expanded_array (shape,dtype):
+  """Allocates output array for expand_subshape(). Boolean and single-precision inputs keep their type,
+  everything else is expanded into complex vells""";
+  if dtype == bool or dtype == numpy.complex64:
+    return numpy.zeros(shape,dtype);
+  return meq.complex_vells(shape);
+
 class DataTiler (object):
   """Support class to handle subtiling of data, i.e. covering every axis of length N with K subtiles of length M=N/K.
 
@@ -70,6 +77,8 @@ class DataTiler (object):
           self.tiled_shape.append(ng);
           self.tiling_slice.append(slice(None));
       self.subtiled_axes = self.subtiled_axes[-1::-1];
+      # numpy only takes tuples as multidimensional indices
+      self.tiling_slice = tuple(self.tiling_slice);
 
   # define methods
   def tile_data (self,x,dtype=None):
@@ -95,6 +104,14 @@ class DataTiler (object):
     """Converts something of shape subshape into a subtiled_shape"""
     return x[self.tiling_slice] if not (numpy.isscalar(x) or x.size == 1) else x;
     
+  def multiply_tiled (self,x,y,dtype=None,out=None):
+    """Returns untile_data(tile_data(x)*y), where x is of datashape and y is of tiled_shape (or broadcastable to it).
+    If out is given (an array of datashape, which may be x itself), the product is written into it.""";
+    if out is None:
+      return self.untile_data(self.tile_data(x,dtype=dtype)*y);
+    numpy.multiply(self.tile_data(x),y,out=self.tile_data(out));
+    return out;
+
   def reduce_tiles (self,x,method='sum'):
     """reduces something of shape tiled_shape into a subshape by collapsing the M-axes""";
     try:
@@ -106,21 +123,32 @@ class DataTiler (object):
       print('reduce_tiles exception, axes:',self.subtiled_axes,', arg:',getattr(x,'shape',()));
       raise;
     
+  def tile_stacked_data (self,x,nlead):
+    """Like tile_data(), but for an array with nlead leading (e.g. antenna/correlation) axes in front of datashape"""
+    return x.reshape(tuple(x.shape[:nlead])+tuple(self.tiled_shape));
+
+  def tile_stacked_subshape (self,x,nlead):
+    """Like tile_subshape(), but for an array with nlead leading axes in front of subshape"""
+    return x[(slice(None),)*nlead+tuple(self.tiling_slice)];
+
+  def reduce_stacked_tiles (self,x,nlead,method='sum'):
+    """Like reduce_tiles(), but for an array with nlead leading axes in front of tiled_shape"""
+    for ax in self.subtiled_axes:
+      x = getattr(x,method)(ax+nlead);
+    return x;
+
   def expand_subshape (self,x,datashape=None,data_subset=None):
     """expands subshape to original data shape"""
     if numpy.isscalar(x):
       return x;
     a = numpy.empty(self.tiled_shape,dtype=x.dtype);
     a[...] = self.tile_subshape(x);
-    if x.dtype == bool:
-      b = numpy.zeros(datashape or self.datashape,bool);
-    else:
-      b = meq.complex_vells(datashape or self.datashape);
+    b = _new_expanded_array(datashape or self.datashape,x.dtype);
     b[...] = self.untile_data(a);
     return b[data_subset or ()];
     
   def _expand_trivial_subshape (self,x,datashape=None,data_subset=None):
-    a = meq.complex_vells(x.shape);
+    a = _new_expanded_array(x.shape,x.dtype);
     a[...] = x;
     return a[data_subset];
       
\ No newline at end of file
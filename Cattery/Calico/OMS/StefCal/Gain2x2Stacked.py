@@ -0,0 +1,144 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import numpy
+import math
+import scipy.ndimage.filters
+import Kittens.utils
+
+from .MatrixOps import *
+from .Gain2x2 import Gain2x2
+from .BaselineStack import BaselineStack
+
+_verbosity = Kittens.utils.verbosity(name="gain2x2stacked");
+dprint = _verbosity.dprint;
+dprintf = _verbosity.dprintf;
+
+square = lambda x:(x*numpy.conj(x)).real;
+
+class Gain2x2Stacked (Gain2x2):
+  """Version of Gain2x2 that keeps data and model in contiguous (Nant,Nant,2,2,time,freq) arrays,
+  and updates all antennas at once using array reductions, rather than looping over antenna pairs.
+
+  Since all antennas are updated simultaneously, the feed-forward option has no effect.
+  """;
+
+  def __init__ (self,*args,**kw):
+    Gain2x2.__init__(self,*args,**kw);
+    self._stack = None;
+
+  def _stack_inputs (self,lhs,rhs,bitflags,weight):
+    """Converts model (lhs) and data (rhs) dicts into stacked, tiled arrays of w*M^H and w*D""";
+    stack = self._stack = BaselineStack(self._antennas,self._solve_ifrs);
+    mh = numpy.conj(stack.stack_matrices(lhs,self.datashape,self._dtype)).swapaxes(2,3);
+    dd = stack.stack_matrices(rhs,self.datashape,self._dtype);
+    wdtype = numpy.float32 if self._float else numpy.float64;
+    w = stack.stack_weights(weight,self.datashape,wdtype) if weight is not None else \
+        numpy.ones((stack.nant,stack.nant)+tuple(self.datashape),wdtype);
+    w[stack.stack_flags(bitflags,self.datashape)] = 0;
+    w = w[:,:,numpy.newaxis,numpy.newaxis,...];
+    self._mh = self.tile_stacked_data(numpy.ascontiguousarray(mh*w),4);
+    self._dd = self.tile_stacked_data(dd*w,4);
+    dprint(2,"stacked %d baselines into arrays of shape"%len(stack.ifrs),self._mh.shape);
+
+  def iterate (self,lhs,rhs,bitflags,bounds=None,verbose=0,niter=0,weight=None):
+    self._reset();
+    # data, model, weights and bitflags are fixed for the duration of a solution, so restack only at the start
+    if not niter or self._stack is None:
+      self._stack_inputs(lhs,rhs,bitflags,weight);
+    stack = self._stack;
+    nant = stack.nant;
+    subshape = tuple(self.subshape);
+    # (Nant,2,2)+subshape array of current gains
+    gain = numpy.empty((nant,2,2)+subshape,self._dtype);
+    for ip,p in enumerate(stack.antennas):
+      for x,(i,j) in zip(self.gain[p],IJ2x2):
+        gain[ip,i,j] = x;
+    # (Nant,)+subshape array of gain flags, and (Nant,Nant,1,1)+subshape array of per-baseline gain flags
+    gainflags = numpy.zeros((nant,)+subshape,bool);
+    for p,gf in self.gainflags.items():
+      if p in stack.index:
+        gainflags[stack.index[p]] = gf;
+    pqmask = (gainflags[:,numpy.newaxis,...]|gainflags[numpy.newaxis,:,...])[:,:,numpy.newaxis,numpy.newaxis,...];
+    pqmask = pqmask if pqmask.any() else None;
+    flag0 = gainflags[:,numpy.newaxis,numpy.newaxis,...];
+    omega = self.opts.omega if self.opts.omega is not None else 0.5;
+    nflag = 0;
+    gd2 = 0;
+    g0 = gain;
+    for step in 0,1:
+      # v[p,q] = Gq.Mpq^H, dv = Dpq.v, vhv = v^H.v
+      v = numpy.einsum('qab...,pqbc...->pqac...',self.tile_stacked_subshape(g0,3),self._mh);
+      sum_dv  = self.reduce_stacked_tiles(numpy.einsum('pqab...,pqbc...->pqac...',self._dd,v),4);
+      sum_vhv = self.reduce_stacked_tiles(numpy.einsum('pqba...,pqbc...->pqac...',numpy.conj(v),v),4);
+      v = None;
+      # mask out flagged elements
+      if pqmask is not None:
+        sum_dv *= ~pqmask;
+        sum_vhv *= ~pqmask;
+      # sum over q (in double precision, even if the data is single)
+      sum_dv = sum_dv.sum(1,dtype=numpy.complex128);
+      sum_vhv = sum_vhv.sum(1,dtype=numpy.complex128);
+      # antennas without any valid data keep their previous gains
+      nodata = ~(sum_vhv!=0).reshape((nant,-1)).any(1);
+      # smooth with gaussian along the time/freq axes, if enabled
+      if self.opts.smoothing:
+        sigma = [0,0,0]+list(self.opts.smoothing);
+        sum_vhv = scipy.ndimage.filters.gaussian_filter(sum_vhv.real,sigma,mode='constant') + \
+              1j*scipy.ndimage.filters.gaussian_filter(sum_vhv.imag,sigma,mode='constant');
+        sum_dv = scipy.ndimage.filters.gaussian_filter(sum_dv.real,sigma,mode='constant') + \
+              1j*scipy.ndimage.filters.gaussian_filter(sum_dv.imag,sigma,mode='constant');
+      # invert and do update
+      with numpy.errstate(divide='ignore',invalid='ignore'):
+        inv_vhv = numpy.array(matrix_invert([ sum_vhv[:,i,j] for i,j in IJ2x2 ]));
+      inv_vhv = inv_vhv.reshape((2,2,nant)+subshape).transpose((2,0,1)+tuple(range(3,3+len(subshape))));
+      g1 = numpy.einsum('pab...,pbc...->pac...',sum_dv,inv_vhv).astype(self._dtype);
+      # take mean with previous value
+      if self.opts.average == 1 or (self.opts.average == 2 and step):
+        g1 *= omega;
+        g1 += g0*(1-omega);
+      # mask out infs/nans and flagged gains
+      mask = (~numpy.isfinite(g1))|flag0;
+      g1[mask] = g0[mask];
+      g1[nodata] = g0[nodata];
+      # compute norm of gain diff
+      if step:
+        gd2 = square(g1-g0).sum(2).sum(1);
+        gd2[nodata] = 0;
+        # flag out-of-bounds gains
+        if bounds:
+          lower,upper = bounds;
+          absg = abs(g1[:,(0,1),(0,1),...]);
+          flag = (absg<(lower or 0)).any(1);
+          if upper:
+            flag |= (absg>upper).any(1);
+          flag[nodata] = False;
+          nflag = flag.sum();
+          if nflag:
+            for ip,p in enumerate(stack.antennas):
+              if flag[ip].any():
+                if p in self.gainflags:
+                  self.gainflags[p] |= flag[ip];
+                else:
+                  self.gainflags[p] = flag[ip];
+            # reset gains to unity and diff to zero
+            gd2[flag] = 0;
+            for (i,j),default in zip(IJ2x2,(1,0,0,1)):
+              g1[:,i,j][flag] = default;
+            dprint(3,"new gain-flags: "," ".join([ "%s:%d"%(p,n) for p,n in zip(stack.antennas,flag.reshape((nant,-1)).sum(1)) if n ]));
+      g0 = g1;
+
+    deltanorm_sq = gd2.sum(0);
+    gainnorm_sq  = square(g0).sum(2).sum(1).sum(0);
+    self.gainnorm = numpy.sqrt(gainnorm_sq).max();
+    # find how many have converged
+    with numpy.errstate(divide='ignore',invalid='ignore'):
+      self.delta_sq = deltanorm_sq/gainnorm_sq;
+    self.delta_sq[gainnorm_sq==0] = 0;
+    self.converged_mask = self.delta_sq <= self.opts.epsilon**2;
+    self.num_converged = self.converged_mask.sum() - self.padded_slots;
+    self.delta_max = math.sqrt(self.delta_sq.max());
+    self.gain = dict([ (p,[ g0[ip,i,j] for i,j in IJ2x2 ]) for ip,p in enumerate(stack.antennas) ]);
+    self.opts.save_intermediate_values(niter);
+    return (self.num_converged >= self.convergence_target),self.delta_max,self.delta_sq,nflag;
@@ -342,16 +342,17 @@ class Gain2x2a (DataTiler):
   def get_last_timeslot (self):
     """Returns dict of p->g, where p is a parm ID, and g is the gain solution for the last timeslot.
     This can be used to initialize new gain objects (for init_value)"""
-    return dict([((p,i,j),self.gain[p,i,j][-1,...]) for p in self._antennas for i,j in IJ2x2 ]);
+    return dict([ (p,[ g if numpy.isscalar(g) else g[-1,...] for g in gmat ]) for p,gmat in self.gain.items() ]);
 
-  def residual (self,lhs,rhs,pq,tiler=None,cache=True):
+  def residual (self,lhs,rhs,pq,tiler=None,cache=True,out=None):
     """Returns residual R = Gp*lhs*conj(Gq) - rhs, tiled into subtile shape.
-    Computes it on-demand, if not already cached""";
-    cache = cache and tiler;
+    Computes it on-demand, if not already cached. If out is given (a flat 4-list of arrays of the
+    data shape), the residual is computed in place in these arrays.""";
+    cache = cache and tiler and out is None;
     r = self._residual_cache.get(pq);
     if not cache or r is None:
-      c = self.apply(lhs,pq,cache=cache,tiler=tiler);
-      r = matrix_sub(c,rhs[pq]);
+      c = self.apply(lhs,pq,cache=cache,tiler=tiler,out=out);
+      r = matrix_sub(c,rhs[pq]) if out is None else matrix_sub_into(c,rhs[pq],out);
       if cache:
         self._residual_cache[pq] = r;
       if pq in verbose_baselines_corr:
@@ -381,28 +382,39 @@ class Gain2x2a (DataTiler):
         print(pq,"Ri",[ 0 if is_null(g) else g[verbose_element] for g in r ]);
     return r;
 
-  def apply (self,lhs,pq,cache=False,tiler=False):
-    """Returns G*lhs*Gq^H."""
+  def apply (self,lhs,pq,cache=False,tiler=False,out=None):
+    """Returns G*lhs*Gq^H.
+    If out is given (a flat 4-list of arrays of the data shape, which may be lhs[pq] itself), writes the result into it."""
     p,q = pq;
-    cache = cache and tiler;
+    cache = cache and tiler and out is None;
     tiler = tiler or self;
     appl = self._apply_cache.get(pq) if cache else None;
     if appl is None:
       lhs = self._get_matrix(p,q,lhs);
-      appl = list(map(tiler.untile_data,matrix_multiply(self._G(p),matrix_multiply(lhs,self._Gconj(q)))));
+      if out is None:
+        appl = list(map(tiler.untile_data,matrix_multiply(self._G(p),matrix_multiply(lhs,self._Gconj(q)))));
+      else:
+        # the inner product is a temporary, so out may overlap with lhs
+        appl = matrix_multiply_into(self._G(p),matrix_multiply(lhs,self._Gconj(q)),list(map(self.tile_data,out)));
+        appl = [ x if is_null(x) else o for x,o in zip(appl,out) ];
       if cache:
         self._apply_cache[pq] = appl;
     return appl;
 
-  def apply_inverse (self,rhs,pq,cache=False,regularize=0,tiler=None):
-    """Returns corrected data Gp^{-1}*D*Gq^{H-1}."""
+  def apply_inverse (self,rhs,pq,cache=False,regularize=0,tiler=None,out=None):
+    """Returns corrected data Gp^{-1}*D*Gq^{H-1}.
+    If out is given (a flat 4-list of arrays of the data shape, which may be rhs[pq] itself), writes the result into it."""
     p,q = pq;
-    cache = cache and tiler;
+    cache = cache and tiler and out is None;
     tiler = tiler or self;
     appl = self._apply_inverse_cache.get(pq) if cache else None;
     if appl is None:
-      appl = list(map(tiler.untile_data,matrix_multiply(self._Ginv(p,regularize),
-        matrix_multiply(list(map(tiler.tile_data,rhs[pq])),self._Ginvconj(q,regularize)))));
+      inner = matrix_multiply(list(map(tiler.tile_data,rhs[pq])),self._Ginvconj(q,regularize));
+      if out is None:
+        appl = list(map(tiler.untile_data,matrix_multiply(self._Ginv(p,regularize),inner)));
+      else:
+        appl = matrix_multiply_into(self._Ginv(p,regularize),inner,list(map(tiler.tile_data,out)));
+        appl = [ x if is_null(x) else o for x,o in zip(appl,out) ];
       if cache:
         self._apply_inverse_cache[pq] = appl;
       if pq in verbose_baselines_corr:
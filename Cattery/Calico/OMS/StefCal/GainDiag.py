@@ -87,7 +87,7 @@ class GainDiag (DataTiler):
             g[slc] = value[slc];
     # else assume scalar init value, and use it to initialize default array
     else:
-      default = numpy.empty(self.subshape,dtype=complex);
+      default = numpy.empty(self.subshape,dtype=self._dtype);
       default[...] = init_value;
       self.gain = dict([ (pp,default) for pp in parms ]);
     # setup gain flags
@@ -129,9 +129,10 @@ class GainDiag (DataTiler):
       # converge from one side (solve for Gp)
       for p,i in list(self.gain.keys()):
         pmask = self.gainflags.get(p,False);
-        # build up sums
-        sum_reim = 0;
-        sum_sq = 0;
+        # build up sums (always in double precision)
+        sum_reim = numpy.zeros(self.subshape,numpy.complex128);
+        sum_sq = numpy.zeros(self.subshape,numpy.float64);
+        ncontrib = 0;
         for q,j in list(self.gain.keys()):
           pq,direct,conjugate = pq_direct_conjugate(p,q,rhs);
           if pq in self._solve_ifrs:
@@ -168,6 +169,7 @@ class GainDiag (DataTiler):
             # sum
             sum_reim += dmh;
             sum_sq += mh2;
+            ncontrib += 1;
         if self.opts.real_only:
           sum_reim = sum_reim.real;
         # generate update
@@ -182,14 +184,14 @@ class GainDiag (DataTiler):
           print("S%d %s:%s"%(step,p,i),"sum DV",sum_reim[verbose_element],"sum VHV",sum_sq[verbose_element]);
           print("S%d %s:%s"%(step,p,i),"G'",(sum_reim/sum_sq),(sum_reim/sum_sq)[verbose_element]);
         gold = g0[p,i];
-        # null sumsq means no valid data (or gain flagged)
-        if is_null(sum_sq):
+        # no contributions means no valid data (or gain flagged)
+        if not ncontrib:
           gnew = g1[p,i] = gold;
           mask = True;
         else:
           # null sumsq in some slot means null model, so keep the gain constant there
           # (this is ok -- null model means simply that the slot was flagged)
-          gnew = g1[p,i] = sum_reim/sum_sq;
+          gnew = g1[p,i] = (sum_reim/sum_sq).astype(self._dtype);
           mask = sum_sq==0;
           gnew[mask] = gold[mask];
         # inf/nan gains means something else is very wrong, better print a diagnostic
@@ -318,14 +320,15 @@ class GainDiag (DataTiler):
   def reset_residuals (self):
     self._residual = {};
 
-  def residual (self,lhs,rhs,pq,tiler=None,cache=False):
+  def residual (self,lhs,rhs,pq,tiler=None,cache=False,out=None):
     """Returns residual R = apply(lhs) - rhs, tiled into subtile shape.
-    Computes it on-demand, if not already cached""";
-    cache = cache and tiler;
+    Computes it on-demand, if not already cached. If out is given (a flat 4-list of arrays of the
+    data shape), the residual is computed in place in these arrays.""";
+    cache = cache and tiler and out is None;
     res = self._residual_cache.get(pq);
     if not cache or res is None:
-      corr = self.apply(lhs,pq,index=True,cache=cache,tiler=tiler);
-      res = matrix_sub(corr,rhs[pq]);
+      corr = self.apply(lhs,pq,index=True,cache=cache,tiler=tiler,out=out);
+      res = matrix_sub(corr,rhs[pq]) if out is None else matrix_sub_into(corr,rhs[pq],out);
       if cache:
         self._residual_cache[pq] = res;
       if pq in verbose_baselines_corr:
@@ -352,8 +355,9 @@ class GainDiag (DataTiler):
         print(pq,"R",[ 0 if is_null(g) else g[verbose_element] for g in res ]);
     return res;
 
-  def apply (self,lhs,pq,index=True,cache=False,tiler=None):
-    """Returns lhs with gains applied: Gp*lhs*Gq^H."""
+  def apply (self,lhs,pq,index=True,cache=False,tiler=None,out=None):
+    """Returns lhs with gains applied: Gp*lhs*Gq^H.
+    If out is given (a flat 4-list of arrays of the data shape, which may be lhs itself), writes the result into it."""
     cache = False and cache and tiler;
     tiler = tiler or self;
     if index:
@@ -361,8 +365,8 @@ class GainDiag (DataTiler):
     appl = self._apply_cache.get(pq) if cache else None;
     if appl is None:
 #      print [ (getattr(tiler.untile_data(tiler.tile_data(d)),'shape',()),getattr(self.gpgq(pq,i,j),'shape',())) for d,(i,j) in zip(lhs,IJ2x2) ];
-      appl = [ 0 if is_null(d) else tiler.untile_data(tiler.tile_data(d,dtype=self._dtype)*self.gpgq(pq,i,j))
-                                   for d,(i,j) in zip(lhs,IJ2x2) ];
+      appl = [ 0 if is_null(d) else tiler.multiply_tiled(d,self.gpgq(pq,i,j),dtype=self._dtype,out=out and out[n])
+                                   for n,(d,(i,j)) in enumerate(zip(lhs,IJ2x2)) ];
       if cache:
         self._apply_cache[pq] = appl;
       if pq in verbose_baselines_corr:
@@ -370,15 +374,16 @@ class GainDiag (DataTiler):
         print(pq,"APPL(LHS)",[ 0 if is_null(g) else g[verbose_element] for g in appl ]);
     return appl;
 
-  def apply_inverse (self,rhs,pq,cache=False,regularize=0,tiler=None):
-    """Returns rhs with inverse gains applied: Gp^{-1}*rhs*Gq^{H-1}."""
+  def apply_inverse (self,rhs,pq,cache=False,regularize=0,tiler=None,out=None):
+    """Returns rhs with inverse gains applied: Gp^{-1}*rhs*Gq^{H-1}.
+    If out is given (a flat 4-list of arrays of the data shape, which may be rhs[pq] itself), writes the result into it."""
     cache = False and cache and tiler;
     tiler = tiler or self;
     appl = self._apply_inverse_cache.get(pq) if cache else None;
     if appl is None:
       mod = rhs[pq];
-      appl = [ 0 if is_null(m) else tiler.untile_data(tiler.tile_data(m,dtype=self._dtype)*
-                  self.gpgq_inv(pq,i,j,regularize=regularize)) for m,(i,j) in zip(mod,IJ2x2) ];
+      appl = [ 0 if is_null(m) else tiler.multiply_tiled(m,self.gpgq_inv(pq,i,j,regularize=regularize),dtype=self._dtype,out=out and out[n])
+                  for n,(m,(i,j)) in enumerate(zip(mod,IJ2x2)) ];
       if cache:
         self._apply_inverse_cache[pq] = appl;
     return appl;
@@ -323,14 +323,15 @@ class GainDiagPhase (DataTiler):
   def reset_residuals (self):
     self._residual = {};
 
-  def residual (self,lhs,rhs,pq,tiler=None,cache=False):
+  def residual (self,lhs,rhs,pq,tiler=None,cache=False,out=None):
     """Returns residual R = apply(lhs) - rhs, tiled into subtile shape.
-    Computes it on-demand, if not already cached""";
-    cache = cache and tiler;
+    Computes it on-demand, if not already cached. If out is given (a flat 4-list of arrays of the
+    data shape), the residual is computed in place in these arrays.""";
+    cache = cache and tiler and out is None;
     res = self._residual_cache.get(pq);
     if not cache or res is None:
-      corr = self.apply(lhs,pq,index=True,cache=cache,tiler=tiler);
-      res = matrix_sub(corr,rhs[pq]);
+      corr = self.apply(lhs,pq,index=True,cache=cache,tiler=tiler,out=out);
+      res = matrix_sub(corr,rhs[pq]) if out is None else matrix_sub_into(corr,rhs[pq],out);
       if cache:
         self._residual_cache[pq] = res;
       if pq in verbose_baselines_corr:
@@ -357,8 +358,9 @@ class GainDiagPhase (DataTiler):
         print(pq,"R",[ 0 if is_null(g) else g[verbose_element] for g in res ]);
     return res;
 
-  def apply (self,lhs,pq,index=True,cache=False,tiler=None):
-    """Returns lhs with gains applied: Gp*lhs*Gq^H."""
+  def apply (self,lhs,pq,index=True,cache=False,tiler=None,out=None):
+    """Returns lhs with gains applied: Gp*lhs*Gq^H.
+    If out is given (a flat 4-list of arrays of the data shape, which may be lhs itself), writes the result into it."""
     cache = False and cache and tiler;
     tiler = tiler or self;
     if index:
@@ -366,8 +368,8 @@ class GainDiagPhase (DataTiler):
     appl = self._apply_cache.get(pq) if cache else None;
     if appl is None:
 #      print [ (getattr(tiler.untile_data(tiler.tile_data(d)),'shape',()),getattr(self.gpgq(pq,i,j),'shape',())) for d,(i,j) in zip(lhs,IJ2x2) ];
-      appl = [ 0 if is_null(d) else tiler.untile_data(tiler.tile_data(d)*self.gpgq(pq,i,j))
-                                   for d,(i,j) in zip(lhs,IJ2x2) ];
+      appl = [ 0 if is_null(d) else tiler.multiply_tiled(d,self.gpgq(pq,i,j),out=out and out[n])
+                                   for n,(d,(i,j)) in enumerate(zip(lhs,IJ2x2)) ];
       if cache:
         self._apply_cache[pq] = appl;
       if pq in verbose_baselines_corr:
@@ -375,15 +377,16 @@ class GainDiagPhase (DataTiler):
         print(pq,"APPL(LHS)",[ 0 if is_null(g) else g[verbose_element] for g in appl ]);
     return appl;
 
-  def apply_inverse (self,rhs,pq,cache=False,regularize=0,tiler=None):
-    """Returns rhs with inverse gains applied: Gp^{-1}*rhs*Gq^{H-1}."""
+  def apply_inverse (self,rhs,pq,cache=False,regularize=0,tiler=None,out=None):
+    """Returns rhs with inverse gains applied: Gp^{-1}*rhs*Gq^{H-1}.
+    If out is given (a flat 4-list of arrays of the data shape, which may be rhs[pq] itself), writes the result into it."""
     cache = False and cache and tiler;
     tiler = tiler or self;
     appl = self._apply_inverse_cache.get(pq) if cache else None;
     if appl is None:
       mod = rhs[pq];
-      appl = [ 0 if is_null(m) else tiler.untile_data(tiler.tile_data(m)*
-                  self.gpgq_inv(pq,i,j,regularize=regularize)) for m,(i,j) in zip(mod,IJ2x2) ];
+      appl = [ 0 if is_null(m) else tiler.multiply_tiled(m,self.gpgq_inv(pq,i,j,regularize=regularize),out=out and out[n])
+                  for n,(m,(i,j)) in enumerate(zip(mod,IJ2x2)) ];
       if cache:
         self._apply_inverse_cache[pq] = appl;
     return appl;
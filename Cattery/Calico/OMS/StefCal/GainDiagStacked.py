@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import numpy
+import scipy.ndimage.filters
+
+from .MatrixOps import *
+from .GainDiag import GainDiag
+from .BaselineStack import BaselineStack
+
+import Kittens.utils
+
+_verbosity = Kittens.utils.verbosity(name="gaindiagstacked");
+dprint = _verbosity.dprint;
+dprintf = _verbosity.dprintf;
+
+square = lambda x:(x*numpy.conj(x)).real;
+
+class GainDiagStacked (GainDiag):
+  """Version of GainDiag that keeps data and model in contiguous (Nant,Nant,2,2,time,freq) arrays,
+  and updates all antennas at once using array reductions, rather than looping over antenna pairs.
+
+  Since all antennas are updated simultaneously, the feed-forward option has no effect.
+  """;
+
+  def __init__ (self,*args,**kw):
+    GainDiag.__init__(self,*args,**kw);
+    self._stack = None;
+
+  def _stack_inputs (self,lhs,rhs,bitflags,weight):
+    """Converts model (lhs) and data (rhs) dicts into stacked, tiled arrays of conj(M)*w and D*w""";
+    stack = self._stack = BaselineStack(self._antennas,self._solve_ifrs);
+    dtype = numpy.complex64 if self._float else numpy.complex128;
+    wdtype = numpy.float32 if self._float else numpy.float64;
+    mc = numpy.conj(stack.stack_matrices(lhs,self.datashape,dtype));
+    dd = stack.stack_matrices(rhs,self.datashape,dtype);
+    # as in GainDiag, an empty weights dict (e.g. when all noise estimates are null) means unit weights
+    w = stack.stack_weights(weight,self.datashape,wdtype) if weight else \
+        numpy.ones((stack.nant,stack.nant)+tuple(self.datashape),wdtype);
+    w[stack.stack_flags(bitflags,self.datashape)] = 0;
+    w = w[:,:,numpy.newaxis,numpy.newaxis,...];
+    mc *= w;
+    dd *= w;
+    self._mc = self.tile_stacked_data(mc,4);
+    self._dd = self.tile_stacked_data(dd,4);
+    dprint(2,"stacked %d baselines into arrays of shape"%len(stack.ifrs),self._mc.shape);
+
+  def iterate (self,lhs,rhs,bitflags,bounds=None,verbose=0,niter=0,weight=None):
+    """Does one iteration of Gp*lhs*Gq^H -> rhs for all antennas at once""";
+    self._reset();
+    # data, model, weights and bitflags are fixed for the duration of a solution, so restack only at the start
+    if not niter or self._stack is None:
+      self._stack_inputs(lhs,rhs,bitflags,weight);
+    stack = self._stack;
+    nant = stack.nant;
+    # (Nant,2)+subshape array of current gains
+    gain = numpy.empty((nant,2)+tuple(self.subshape),self._dtype);
+    for ip,p in enumerate(stack.antennas):
+      for i in range(2):
+        gain[ip,i] = self.gain.get((p,i),self._unity);
+    # (Nant,)+subshape array of gain flags, and (Nant,Nant,1,1)+subshape array of per-baseline gain flags
+    gainflags = numpy.zeros((nant,)+tuple(self.subshape),bool);
+    for p,gf in self.gainflags.items():
+      if p in stack.index:
+        gainflags[stack.index[p]] = gf;
+    pqmask = (gainflags[:,numpy.newaxis,...]|gainflags[numpy.newaxis,:,...])[:,:,numpy.newaxis,numpy.newaxis,...];
+    pqmask = pqmask if pqmask.any() else None;
+    gaindiff2 = 0;
+    # this does two iterations at a time
+    g0 = gain;
+    for step in 0,1:
+      # mh[p,q,i,j] = conj(Mpq^ij)*Gqj
+      mh = self._mc*self.tile_stacked_subshape(g0,2)[numpy.newaxis,:,numpy.newaxis,:,...];
+      dmh = self.reduce_stacked_tiles(self._dd*mh,4);
+      mh2 = self.reduce_stacked_tiles(square(mh),4);
+      # mask out flagged gain elements
+      if pqmask is not None:
+        dmh *= ~pqmask;
+        mh2 *= ~pqmask;
+      # sum over q,j (in double precision, even if the data is single)
+      sum_reim = dmh.sum(3,dtype=numpy.complex128).sum(1);
+      sum_sq = mh2.sum(3,dtype=numpy.float64).sum(1);
+      if self.opts.real_only:
+        sum_reim = sum_reim.real;
+      # smooth along the time/freq axes only
+      if self.opts.smoothing:
+        sigma = [0,0]+list(self.opts.smoothing);
+        sum_sq = scipy.ndimage.filters.gaussian_filter(sum_sq,sigma,mode='mirror');
+        if self.opts.real_only:
+          sum_reim = scipy.ndimage.filters.gaussian_filter(sum_reim,sigma,mode='mirror');
+        else:
+          sum_reim.real = scipy.ndimage.filters.gaussian_filter(sum_reim.real,sigma,mode='mirror');
+          sum_reim.imag = scipy.ndimage.filters.gaussian_filter(sum_reim.imag,sigma,mode='mirror');
+      # null sumsq in some slot means null model (or flagged gain), so keep the gain constant there
+      with numpy.errstate(divide='ignore',invalid='ignore'):
+        gnew = (sum_reim/sum_sq).astype(self._dtype);
+      mask = sum_sq==0;
+      gnew[mask] = g0[mask];
+      # inf/nan gains means something else is very wrong, better print a diagnostic
+      mask = (~mask)&(~numpy.isfinite(gnew));
+      if mask.any():
+        gnew[mask] = g0[mask];
+        dprint(2,"%d values reset due to INF/NAN"%mask.sum());
+      diff2 = square(gnew-g0);
+      diff2[mask] = 0;
+      gaindiff2 = gaindiff2 + diff2.sum(1);
+      # apply solution averaging
+      if self.opts.average == 1 or (self.opts.average == 2 and step):
+        gnew += g0;
+        gnew /= 2;
+      g0 = gnew;
+    gain1 = g0;
+    # apply gain flags based on bounds
+    num_flagged = 0;
+    if bounds:
+      lower,upper = bounds;
+      absg = abs(gain1);
+      mask = numpy.zeros(absg.shape,bool);
+      if lower:
+        mask |= absg<lower;
+      if upper:
+        mask |= absg>upper;
+      mask = mask.any(1);
+      if mask.any():
+        gain1[numpy.stack([mask,mask],1)] = 1;
+        gaindiff2[mask] = 0;
+        num_flagged = mask.sum();
+        for ip,p in enumerate(stack.antennas):
+          if mask[ip].any():
+            if p in self.gainflags:
+              self.gainflags[p] |= mask[ip];
+            else:
+              self.gainflags[p] = mask[ip];
+    # now sum the ||delta-G||^2 over all gains
+    deltanorm_sq = gaindiff2.sum(0);
+    # norm-squared of new gain solution, per each t/f slot
+    gainnorm_sq = square(gain1).sum(1).sum(0);
+    self.gainnorm = numpy.sqrt(gainnorm_sq).max();
+    # find how many have converged
+    with numpy.errstate(divide='ignore',invalid='ignore'):
+      self.delta_sq = deltanorm_sq/gainnorm_sq;
+    self.delta_sq[gainnorm_sq==0] = 0;
+    self.converged_mask = self.delta_sq <= self.opts.epsilon**2;
+    self.num_converged = self.converged_mask.sum() - self.padded_slots;
+    self.delta_max = numpy.sqrt(self.delta_sq.max());
+    self.gain = dict([ ((p,i),gain1[ip,i]) for ip,p in enumerate(stack.antennas) for i in range(2) ]);
+    return (self.num_converged >= self.convergence_target),self.delta_max,self.delta_sq,num_flagged;
@@ -12,6 +12,7 @@ import numpy
 import traceback
 from functools import reduce
 from Timba.TDL import *
+from .GainTable import GainTable,FORMAT_PICKLE,FORMAT_CHUNKED
 MODE_SOLVE_SAVE = "solve-save";
 MODE_SOLVE_NOSAVE = "solve-nosave"
 MODE_SOLVE_APPLY = "apply"
@@ -43,6 +44,9 @@ class GainOpts (object):
   """Encapsulates a set of options for a gains object"""
   def __init__ (self,desc,name,label,tdl_basespace=None,node=None,mystate=None,pre_opts=[],post_opts=[]):
     self.desc,self.name,self.label = desc,name,label;
+    # in-memory warm-start solutions: (freq0,freq1) -> solutions for the last timeslot of the previous tile.
+    # These are held per instance (i.e. per StefCal node), so that nodes sharing a gain label don't seed each other
+    self._warm_start = {};
     ### init options on TDL side of things
     if tdl_basespace:
       self.tdloption_namespace = "%s_%s"%(tdl_basespace,name.lower());
@@ -69,7 +73,8 @@ class GainOpts (object):
               TDLOption("flag_ampl_low","Lower threshold (0 disables)",[0,.5],more=float,default=0,namespace=self),
               TDLOption("flag_ampl_high","Upper threshold (0 disables)",[0,1.5],more=float,default=0,namespace=self),
             toggle='flag_ampl',namespace=self),
-          TDLOption("implementation","Jones matrix type",["GainDiag","Gain2x2","Gain2x2a","GainDiagCommon","GainDiagPhase" ] ,namespace=self),
+          TDLOption("implementation","Jones matrix type",["GainDiag","Gain2x2","Gain2x2a","GainDiagCommon","GainDiagPhase",
+                                                            "GainDiagStacked","Gain2x2Stacked" ] ,namespace=self),
           TDLOption("mode","Solution mode",
             {MODE_SOLVE_SAVE:"solve and save",MODE_SOLVE_NOSAVE:"solve, do not save",MODE_SOLVE_APPLY:"load and apply"},
             default=MODE_SOLVE_SAVE,namespace=self),
@@ -93,6 +98,9 @@ class GainOpts (object):
               TDLOption("average","Averaging mode",[0,1,2],default=2,namespace=self),
               TDLOption("ff","Enable feed-forward averaging",True,namespace=self),
               TDLOption("table","Filename for solution table",["%s.cp"%name],more=str,namespace=self),
+              TDLOption("table_format","Solution table format",
+                {FORMAT_PICKLE:"single file",FORMAT_CHUNKED:"chunked directory, one file per tile"},
+                default=FORMAT_PICKLE,namespace=self),
               TDLOption("intermediate_table","Filename for intermediate values table",[None,"intermediate-%s.cp"%name],more=str,namespace=self),
             )
         ] + post_opts;
@@ -140,6 +148,7 @@ class GainOpts (object):
             ('visualize',True),
             ('bounds',[]),
             ('table','%s.cp'%self.name),
+            ('table_format',FORMAT_PICKLE),
             ('intermediate_table',None),
             ('implementation','GainDiag'),
           ]:
@@ -190,6 +199,7 @@ class GainOpts (object):
     kw['%s_average'%name]    = self.average;
     kw['%s_feed_forward'%name] = self.ff;
     kw['%s_table'%name]      = self.table;
+    kw['%s_table_format'%name] = self.table_format;
     kw['%s_intermediate_table'%name] = self.intermediate_table;
     kw['%s_solve'%name]      = (self.mode != MODE_SOLVE_APPLY);
     kw['%s_save'%name]       = (self.mode == MODE_SOLVE_SAVE);
@@ -215,11 +225,16 @@ class GainOpts (object):
     """Loads initial values from table (if available)"""
     self.init_value = default;
     self.has_init_value = False;
+    self._init_table = None;
+    # forget any warm-start solutions from the previous dataset
+    self._warm_start = {};
     if not self.enable:
       return;
     if not os.path.exists(self.table):
       dprint(0,"not loading %s solutions: %s does not exist"%(self.label,self.table));
       return;
+    if GainTable.is_chunked(self.table):
+      return self._load_initval_chunked();
     try:
       struct = GainOpts._incoming_tables.get(self.table);
       if not struct:
@@ -241,12 +256,38 @@ class GainOpts (object):
       traceback.print_exc();
       dprint(0,"error loading %s solutions from"%self.label,self.table);
 
+  def _load_initval_chunked (self):
+    """Loads initial values from chunked table. Solutions of the last tile become the default initial value,
+    while init_solver() will look for solutions matching each new tile.""";
+    try:
+      table = GainOpts._incoming_tables.get(self.table);
+      if not table:
+        table = GainOpts._incoming_tables[self.table] = GainTable(self.table);
+      if self.label not in table.labels():
+        dprint(0,"no %s solutions found in %s (table contains: %s)"%(self.label,self.table,", ".join(sorted(table.labels()))));
+        return;
+      if table.get_implementation(self.label) != self.implementation:
+        dprint(0,"%s solutions in %s are for class %s, expected %s"%(self.label,self.table,
+                  table.get_implementation(self.label),self.implementation));
+      self.init_value = table.get(self.label);
+      self.has_init_value = True;
+      self._init_table = table;
+      dprint(1,"found %d tiles of %s solutions in %s"%(len(table.tiles(self.label)),self.name,self.table));
+    except:
+      traceback.print_exc();
+      dprint(0,"error loading %s solutions from"%self.label,self.table);
+
   _outgoing_tables = {};
+  _outgoing_chunked_tables = {};
         
-  def save_values (self):
+  def save_values (self,domain=None):
     if self.save:
-      GainOpts._outgoing_tables.setdefault(self.table,{})[self.label] = \
-        dict(solutions=self.solver.gain,implementation=self.implementation);
+      if self.table_format == FORMAT_CHUNKED:
+        GainOpts._outgoing_chunked_tables.setdefault(self.table,{})[self.label] = \
+          dict(solutions=self.solver.gain,implementation=self.implementation,domain=domain);
+      else:
+        GainOpts._outgoing_tables.setdefault(self.table,{})[self.label] = \
+          dict(solutions=self.solver.gain,implementation=self.implementation);
 
   def save_intermediate_values (self,niter):
     if self.intermediate_table:
@@ -266,6 +307,17 @@ class GainOpts (object):
           traceback.print_exc();
           dprint(0,"error saving gains to",table);
     GainOpts._outgoing_tables = {};
+    for table,initval in GainOpts._outgoing_chunked_tables.items():
+      try:
+        gt = GainTable(table,create=True);
+        for label,entry in initval.items():
+          gt.append(label,entry['implementation'],entry['solutions'],domain=entry['domain']);
+        gt.flush();
+        dprint(1,"saved %d gain set(s) to %s"%(len(initval),table));
+      except:
+        traceback.print_exc();
+        dprint(0,"error saving gains to",table);
+    GainOpts._outgoing_chunked_tables = {};
 
   @staticmethod
 #  @profile
@@ -299,10 +351,25 @@ class GainOpts (object):
 
     return expanded_datashape;
 
-  def init_solver (self,datashape,expanded_datashape,solvable_ifrs,downsample_subtiling):
-    """Initializes gain solver object""";
+  def init_solver (self,datashape,expanded_datashape,solvable_ifrs,downsample_subtiling,domain=None):
+    """Initializes gain solver object. If solutions were loaded from a chunked table, and the table has
+    a tile matching domain, that tile is used as the initial value. Otherwise, if update_initval() was called
+    on a previous tile with the same frequency range, its solutions are used.""";
     if not self.enable:
       return;
+    init_value = self.init_value;
+    initval = None;
+    if getattr(self,'_init_table',None) is not None and domain is not None:
+      initval = self._init_table.get(self.label,domain,exact=True);
+      if initval is not None:
+        dprint(1,"  using %s solutions for domain"%self.label,domain,"from",self.table);
+        init_value = self.init_value = initval;
+        self.has_init_value = True;
+    if initval is None:
+      warm = self._warm_start.get(self._warm_start_key(domain));
+      if warm is not None:
+        dprint(1,"  using %s solutions of previous tile as starting point"%self.label);
+        init_value = warm;
     dprintf(0,"stefcal %s solve=%d %s, using %d solvable inteferometers\n",
       self.label,self.solve,self.impl_class.__name__,
       len(solvable_ifrs));
@@ -318,10 +385,24 @@ class GainOpts (object):
     self.solver = self.impl_class(datashape,expanded_datashape,
         self.subtiling,solvable_ifrs,opts=self,
         force_subtiling=bool(downsample_subtiling),
-        init_value=self.init_value,
+        init_value=init_value,
         verbose=_verbosity.verbose);
     dprint(1,"  subshape",self.solver.subshape,"tiled",self.solver.tiled_shape);
 
-  def update_initval (self):
-    self.init_value = self.solver.get_last_timeslot();
-        
\ No newline at end of file
+  @staticmethod
+  def _warm_start_key (domain):
+    """Tiles with the same frequency range (the last two elements of the domain) share warm-start solutions""";
+    return tuple(domain[2:4]) if domain is not None else ();
+
+  def update_initval (self,domain=None):
+    """Keeps the solutions for the last timeslot in memory, as the starting point for the next tile with the
+    same frequency range. Antennas whose gains are flagged throughout the last timeslot are left out, and
+    will start from the default initial value instead.""";
+    values = self.solver.get_last_timeslot();
+    flagged = set([ p for p,fl in self.solver.gainflags.items() if numpy.ndim(fl) and fl[-1,...].all() ]);
+    if flagged:
+      dprint(2,"%s: not carrying over gains of flagged antennas"%self.label," ".join(map(str,sorted(flagged))));
+      values = dict([ (key,value) for key,value in values.items()
+                      if (key[0] if isinstance(key,tuple) else key) not in flagged ]);
+    self._warm_start[self._warm_start_key(domain)] = values;
+        
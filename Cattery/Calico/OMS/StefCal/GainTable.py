@@ -0,0 +1,271 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import os
+import os.path
+import pickle
+import bisect
+import numpy
+import Kittens.utils
+
+_verbosity = Kittens.utils.verbosity(name="gaintable");
+dprint = _verbosity.dprint;
+dprintf = _verbosity.dprintf;
+
+FORMAT_PICKLE = "pickle";
+FORMAT_CHUNKED = "chunked";
+
+def flatten_values (values):
+  """Splits a (possibly nested) dict/list structure of gain values into a skeleton and a list of leaves.
+  The skeleton is the same structure, with each leaf replaced by its index in the list.""";
+  leaves = [];
+  def _flatten (x):
+    if isinstance(x,dict):
+      return dict([ (key,_flatten(value)) for key,value in x.items() ]);
+    elif isinstance(x,(list,tuple)):
+      return [ _flatten(value) for value in x ];
+    else:
+      leaves.append(x);
+      return len(leaves)-1;
+  return _flatten(values),leaves;
+
+def _map_skeleton (skeleton,func):
+  """Returns a copy of skeleton with each leaf x replaced by func(x)""";
+  if isinstance(skeleton,dict):
+    return dict([ (key,_map_skeleton(value,func)) for key,value in skeleton.items() ]);
+  elif isinstance(skeleton,list):
+    return [ _map_skeleton(value,func) for value in skeleton ];
+  else:
+    return func(skeleton);
+
+def unflatten_values (skeleton,arrays):
+  """Reverse of flatten_values() for a stored skeleton: rebuilds a gain values structure. Leaves of the
+  skeleton are either (ifile,i) tuples referring to arrays[ifile][i], or scalar values, which are used as is.""";
+  return _map_skeleton(skeleton,lambda x:arrays[x[0]][x[1]] if isinstance(x,tuple) else x);
+
+def _atomic_write (filename,writer):
+  """Writes file via a temporary file and a rename, so that readers (and memory maps) of the old file are not disturbed""";
+  tmpname = filename + ".tmp";
+  ff = open(tmpname,'wb');
+  try:
+    writer(ff);
+  finally:
+    ff.close();
+  os.rename(tmpname,filename);
+
+
+class GainTable (object):
+  """Chunked on-disk table of gain solutions.
+
+  The table is a directory containing an append-only index file, plus one .npy file per tile per dtype/shape
+  of its solutions. Each tile file holds the array-valued solutions of that tile stacked into a single array
+  (in their own dtype), so that saving a tile writes only that tile, and reading a tile back memory-maps only
+  its files. The index starts with a header record, followed by one pickled record per saved tile, giving
+  the label, solver implementation, domain, filenames and skeleton (see flatten_values()). Saving a tile
+  appends a record, so the cost of a flush does not depend on the number of tiles already in the table.
+
+  Domains are arbitrary tuples, starting with (time0,time1) in timeslots, or None. A tile saved with the same
+  label and domain as an existing tile replaces it: its record is appended later in the index, and the files
+  of the old tile are removed. Once superseded records make up most of the index, it is rewritten with
+  only the current ones.
+  """;
+  INDEX = "index.log";
+  VERSION = 1;
+
+  @staticmethod
+  def is_chunked (path):
+    """Returns True if path refers to a chunked gain table""";
+    return os.path.isdir(path) and os.path.exists(os.path.join(path,GainTable.INDEX));
+
+  def __init__ (self,path,create=False):
+    """Opens table at path. If create is True, a new table is created if none exists. A (non-chunked)
+    pickle gain table at path is then replaced: if it holds gain solutions saved by GainOpts, these are
+    migrated into the new table as tiles with a domain of None.""";
+    self.path = path;
+    self._indexfile = os.path.join(path,self.INDEX);
+    # the index is only read in when needed, so opening a table is cheap
+    self._index = None;
+    # tiles appended since the last flush
+    self._pending = [];
+    if not os.path.exists(self._indexfile):
+      if not create:
+        raise IOError("%s: not a chunked gain table"%path);
+      legacy = None;
+      if os.path.isfile(path):
+        legacy = self._remove_legacy_file(path);
+      if not os.path.isdir(path):
+        os.mkdir(path);
+      _atomic_write(self._indexfile,lambda ff:pickle.dump(self._header(),ff,2));
+      if legacy:
+        for label,gains in legacy.items():
+          self.append(label,gains['implementation'],gains['solutions']);
+        self.flush();
+        dprint(1,"migrated %d gain set(s) from legacy table %s"%(len(legacy),path));
+
+  @staticmethod
+  def _remove_legacy_file (path):
+    """Helper method. Removes the pickle gain table at path. Returns its gain solutions, if it has any""";
+    gains = None;
+    try:
+      struct = pickle.load(open(path,"rb"));
+      if isinstance(struct,dict) and struct.get('version',0) >= 2:
+        gains = struct['gains'];
+    except Exception as exc:
+      dprint(0,"%s: can't read legacy gain table (%s), replacing it"%(path,exc));
+    else:
+      if gains is None:
+        dprint(1,"%s: replacing legacy gain table"%path);
+    os.remove(path);
+    return gains;
+
+  def _header (self,base=0):
+    """Helper method. Returns header record of the index. 'base' is added to the index size when naming
+    tile files, so that names stay unique after the index has been rewritten.""";
+    return dict(description="stefcal chunked gain solutions table",version=self.VERSION,base=base);
+
+  def _load_index (self):
+    """Reads the index records, if not already done""";
+    if self._index is not None:
+      return;
+    # label -> dict(implementation=,tiles={domain:record},last=record,starts={domain[2:]:([time0,...],[domain,...])}),
+    # where the starts lists are sorted by time0, for bisection
+    self._index = {};
+    # current records as (label,domain) -> record, in the order they were saved
+    self._live = {};
+    self._nrecords = 0;
+    ff = open(self._indexfile,"rb");
+    try:
+      header = pickle.load(ff);
+      if not isinstance(header,dict) or header.get('version',0) != self.VERSION:
+        raise TypeError("%s: format or version not known"%self.path);
+      self._base = header.get('base',0);
+      while True:
+        try:
+          record = pickle.load(ff);
+        except EOFError:
+          break;
+        self._add_record(record);
+    finally:
+      ff.close();
+
+  def _add_record (self,record):
+    """Adds an index record to the in-memory lookup structures. Returns the record it supersedes, if any.""";
+    self._nrecords += 1;
+    key = record['label'],record['domain'];
+    superseded = self._live.pop(key,None);
+    self._live[key] = record;
+    entry = self._index.setdefault(record['label'],dict(tiles={},starts={}));
+    entry['implementation'] = record['implementation'];
+    domain = record['domain'];
+    if domain is not None and domain not in entry['tiles']:
+      times,domains = entry['starts'].setdefault(tuple(domain[2:]),([],[]));
+      i = bisect.bisect_right(times,domain[0]);
+      times.insert(i,domain[0]);
+      domains.insert(i,domain);
+    entry['tiles'][domain] = entry['last'] = record;
+    return superseded;
+
+  def labels (self):
+    self._load_index();
+    return list(self._index.keys());
+
+  def get_implementation (self,label):
+    self._load_index();
+    return self._index[label]['implementation'];
+
+  def tiles (self,label):
+    """Returns list of domains for which label has solutions""";
+    self._load_index();
+    return list(self._index.get(label,{}).get('tiles',{}).keys());
+
+  def _find_tile (self,label,domain=None,exact=False):
+    self._load_index();
+    entry = self._index.get(label);
+    if not entry:
+      return None;
+    if domain is None:
+      return entry['last'];
+    tile = entry['tiles'].get(domain);
+    if tile is not None:
+      return tile;
+    # look for a tile that contains the first timeslot of the domain (and matches the rest of the domain)
+    times,domains = entry['starts'].get(tuple(domain[2:]),([],[]));
+    i = bisect.bisect_right(times,domain[0]);
+    if i:
+      dom = domains[i-1];
+      if domain[0] < dom[1]:
+        return entry['tiles'][dom];
+    return None if exact else entry['last'];
+
+  def get (self,label,domain=None,exact=False):
+    """Returns solutions for label. If domain is given, finds the tile with that domain (or the one containing its
+    first timeslot), else the last tile. If nothing matches, returns the last tile, or None if exact=True.
+    The solutions refer to copy-on-write memory maps of the tile files, so they are only read in when accessed,
+    and may be modified without affecting the table.""";
+    tile = self._find_tile(label,domain,exact);
+    if tile is None:
+      return None;
+    arrays = [ numpy.load(os.path.join(self.path,filename),mmap_mode='c') for filename in tile['files'] ];
+    return unflatten_values(tile['skeleton'],arrays);
+
+  def append (self,label,implementation,values,domain=None):
+    """Adds solutions for one tile. Nothing is written until flush() is called.""";
+    skeleton,leaves = flatten_values(values);
+    self._pending.append((dict(label=label,implementation=implementation,domain=domain,skeleton=skeleton),leaves));
+
+  def flush (self):
+    """Writes the files of tiles added since the last flush, and appends their records to the index.
+    Files of the tiles they replace are removed.""";
+    if not self._pending:
+      return;
+    # the index tells us which tiles are being replaced
+    self._load_index();
+    superseded = [];
+    ff = open(self._indexfile,"ab");
+    try:
+      # the current size of the index is unique to this flush, so it makes for unique tile filenames
+      base = self._base + ff.tell();
+      for itile,(record,leaves) in enumerate(self._pending):
+        # stack array-valued leaves of the same dtype and shape together, scalars stay in the skeleton
+        groups = {};
+        for ileaf,x in enumerate(leaves):
+          if isinstance(x,numpy.ndarray):
+            groups.setdefault((x.dtype.str,x.shape),[]).append(ileaf);
+        refs = {};
+        record['files'] = [];
+        for igroup,((dtype,shape),ileaves) in enumerate(groups.items()):
+          array = numpy.empty((len(ileaves),)+tuple(shape),dtype);
+          for i,ileaf in enumerate(ileaves):
+            array[i] = leaves[ileaf];
+            refs[ileaf] = (igroup,i);
+          filename = "tile%d-%d-%d.npy"%(base,itile,igroup);
+          _atomic_write(os.path.join(self.path,filename),lambda f,array=array:numpy.save(f,array));
+          record['files'].append(filename);
+        record['skeleton'] = _map_skeleton(record['skeleton'],lambda ileaf:refs.get(ileaf,leaves[ileaf]));
+        pickle.dump(record,ff,2);
+        old = self._add_record(record);
+        if old is not None:
+          superseded.append(old);
+    finally:
+      ff.close();
+    self._pending = [];
+    for record in superseded:
+      for filename in record['files']:
+        try:
+          os.remove(os.path.join(self.path,filename));
+        except OSError as exc:
+          dprint(0,"error removing superseded tile file %s: %s"%(filename,exc));
+    if self._nrecords > 2*len(self._live):
+      self._compact();
+
+  def _compact (self):
+    """Helper method. Rewrites the index with only the current records""";
+    base = self._base + os.path.getsize(self._indexfile);
+    def _write (ff):
+      pickle.dump(self._header(base),ff,2);
+      for record in self._live.values():
+        pickle.dump(record,ff,2);
+    _atomic_write(self._indexfile,_write);
+    dprint(2,"%s: rewrote index, %d of %d records kept"%(self.path,len(self._live),self._nrecords));
+    self._base,self._nrecords = base,len(self._live);
@@ -17,6 +17,10 @@ def is_null (x):
 # list of matrix indices in a flat 4-list representation
 IJ2x2 = [ (i,j) for i in range(2) for j in range(2) ];
 
+def matrix_astype (A,dtype):
+  """Converts the array elements of matrix A to the given dtype (scalars are left as is)""";
+  return [ x.astype(dtype) if isinstance(x,numpy.ndarray) and x.dtype != dtype else x for x in A ];
+
 def NULL_MATRIX():
   return [0,0,0,0];
 
@@ -37,6 +41,21 @@ def matrix_multiply (A,B):
   b11,b12,b21,b22 = B;
   return [ _mul(a11,b11)+_mul(a12,b21),_mul(a11,b12)+_mul(a12,b22),_mul(a21,b11)+_mul(a22,b21),_mul(a21,b12)+_mul(a22,b22) ];
 
+def matrix_multiply_into (A,B,out):
+  """Multiplies two matrices given as flat 4-lists, writing the result into the arrays given by out
+  (which must not overlap with A or B). Returns the product, with null elements as 0""";
+  res = [];
+  for (i,j),o in zip(IJ2x2,out):
+    terms = [ (a,b) for a,b in ((A[2*i],B[j]),(A[2*i+1],B[2+j])) if not (is_null(a) or is_null(b)) ];
+    if not terms:
+      res.append(0);
+    else:
+      numpy.multiply(terms[0][0],terms[0][1],out=o);
+      for a,b in terms[1:]:
+        o += a*b;
+      res.append(o);
+  return res;
+
 def matrix_conj (A):
   """Conjugates a matrix given as a flat 4-list""";
   return [ numpy.conj(A[i]) for i in (0,2,1,3) ];
@@ -72,6 +91,18 @@ def matrix_sub (A,B):
   """Subtracts two matrices given as a flat 4-list""";
   return [ a-b for a,b in zip(A,B) ];
 
+def matrix_sub_into (A,B,out):
+  """Subtracts two matrices given as a flat 4-list, writing the result into the arrays given by out
+  (which may be the same as A's). Returns the difference, with null elements as 0""";
+  res = [];
+  for a,b,o in zip(A,B,out):
+    if is_null(a) and is_null(b):
+      res.append(0);
+    else:
+      numpy.subtract(a,b,out=o);
+      res.append(o);
+  return res;
+
 def matrix_negate (A):
   """Negates a matrix""";
   return [ -a for a in A ];
@@ -98,23 +129,27 @@ def matrix_maskinf (A):
       a[mask] = defval;
   return A
   
-def array_to_vells (x,vellshape=None,expanded_slice=None):
+# dtypes of the arrays underlying meq.complex_vells and meq.flags
+_VELLS_DTYPE = meq.complex_vells((1,)).dtype;
+_FLAGS_DTYPE = meq.flags((1,)).dtype;
+
+def _as_vells (x,dtype,factory,vellshape=None,expanded_slice=None):
+  """Returns x (or its expanded_slice) as a vells-compatible array. If x is already a contiguous array
+  of the right dtype, a view of it is returned, else the data is copied into a new vells""";
+  x = numpy.ma.getdata(x);
   if expanded_slice is not None:
-    a = meq.complex_vells(vellshape);
-    a[...] = x[expanded_slice];
-  else:
-    a = meq.complex_vells(x.shape);
-    a[...] = x;
+    x = x[expanded_slice];
+  if isinstance(x,numpy.ndarray) and x.dtype == dtype and x.flags['C_CONTIGUOUS']:
+    return x;
+  a = factory(vellshape if expanded_slice is not None else x.shape);
+  a[...] = x;
   return a;
 
+def array_to_vells (x,vellshape=None,expanded_slice=None):
+  return _as_vells(x,_VELLS_DTYPE,meq.complex_vells,vellshape,expanded_slice);
+
 def mask_to_flags (x,vellshape=None,expanded_slice=None):
-  if expanded_slice is not None:
-    a = meq.flags(vellshape);
-    a[...] = x[expanded_slice];
-  else:
-    a = meq.flags(x.shape);
-    a[...] = x;
-  return a;
+  return _as_vells(x,_FLAGS_DTYPE,meq.flags,vellshape,expanded_slice);
 
 def matrix_sqrt (A):
   """Returns the matrix square root of A""";
@@ -0,0 +1,200 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import time
+import json
+import contextlib
+import threading
+import Kittens.utils
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None;
+
+_verbosity = Kittens.utils.verbosity(name="profiler");
+dprint = _verbosity.dprint;
+dprintf = _verbosity.dprintf;
+
+# tracemalloc only keeps one (process-wide) peak, so only one outermost phase at a time, across all profilers
+# and threads, may reset it. Phases that start while another one holds the peak do not report a peak.
+_peak_lock = threading.Lock();
+_peak_open = [0];
+
+class Profiler (object):
+  """Collects a timing breakdown of StefCalNode.get_result().
+
+  Each measurement is keyed by (tile,phase,gain), where tile is the domain being processed, phase is
+  a name such as "unpack" or "iterate", and gain is the gain label (or None for phases not specific to
+  a gain term). Per key, the following is accumulated:
+
+      calls       = number of times the phase was entered
+      time        = total wall time, in seconds
+      alloc       = net memory allocated over the phase, in bytes (if tracemalloc is available)
+      peak        = peak memory above the starting level, in bytes (outermost phases only, None if the
+                    peak was held by another profiler at the time)
+      iterations  = solver iterations, see count()
+
+  Phases may be nested, in which case the time of the inner phase is also included in the outer one.
+
+  Measurements are written out with dump() after each tile, by appending one JSON record per line to
+  a file, so the cost of a dump does not depend on the number of tiles processed. Use load() to read
+  the records back and compute totals.
+  """;
+  FORMAT_VERSION = 2;
+
+  def __init__ (self,trace_memory=True):
+    self.tile = None;
+    self.stats = {};
+    self._depth = 0;
+    # number of our outermost phases counted in _peak_open
+    self._open_outer = 0;
+    self.trace_memory = bool(trace_memory and tracemalloc);
+    # only stop tracing in close() if we were the ones to start it
+    self._started_tracing = False;
+    if self.trace_memory and not tracemalloc.is_tracing():
+      tracemalloc.start();
+      self._started_tracing = True;
+
+  def close (self):
+    """Stops memory tracing, if this profiler started it""";
+    self._release_outer();
+    if self._started_tracing and tracemalloc.is_tracing():
+      tracemalloc.stop();
+    self._started_tracing = False;
+    self.trace_memory = False;
+
+  def start_tile (self,tile):
+    """Sets the tile (domain) to which subsequent measurements will be attributed. Phases left open
+    by the previous tile (e.g. due to an early return) are abandoned.""";
+    self.tile = tuple(tile);
+    self._depth = 0;
+    self._release_outer();
+
+  def _release_outer (self):
+    with _peak_lock:
+      _peak_open[0] -= self._open_outer;
+    self._open_outer = 0;
+
+  def _entry (self,phase,gain):
+    entry = self.stats.get((self.tile,phase,gain));
+    if entry is None:
+      entry = self.stats[self.tile,phase,gain] = dict(calls=0,time=0.,alloc=0,peak=0,iterations=0);
+    return entry;
+
+  def start (self,phase,gain=None):
+    """Starts measuring a phase. Returns a token to be passed to stop()""";
+    entry = self._entry(phase,gain);
+    outer = not self._depth;
+    mem0 = None;
+    owns_peak = False;
+    if self.trace_memory:
+      if outer:
+        with _peak_lock:
+          owns_peak = not _peak_open[0] and hasattr(tracemalloc,'reset_peak');
+          if owns_peak:
+            tracemalloc.reset_peak();
+          _peak_open[0] += 1;
+        self._open_outer += 1;
+      mem0 = tracemalloc.get_traced_memory()[0];
+    self._depth += 1;
+    return entry,outer,owns_peak,mem0,time.time();
+
+  def stop (self,token):
+    """Stops measuring the phase started by start()""";
+    entry,outer,owns_peak,mem0,t0 = token;
+    entry['time'] += time.time()-t0;
+    entry['calls'] += 1;
+    self._depth -= 1;
+    if mem0 is not None:
+      mem1,peak = tracemalloc.get_traced_memory();
+      entry['alloc'] += mem1-mem0;
+      if outer:
+        if self._open_outer:
+          with _peak_lock:
+            _peak_open[0] -= 1;
+          self._open_outer -= 1;
+        if owns_peak and entry['peak'] is not None:
+          entry['peak'] = max(entry['peak'],peak-mem0);
+        else:
+          entry['peak'] = None;
+
+  @contextlib.contextmanager
+  def phase (self,phase,gain=None):
+    """Context manager measuring one phase""";
+    token = self.start(phase,gain);
+    try:
+      yield;
+    finally:
+      self.stop(token);
+
+  def count (self,phase,gain=None,iterations=1):
+    """Adds to the iteration count of a phase""";
+    self._entry(phase,gain)['iterations'] += iterations;
+
+  def records (self):
+    """Returns list of JSON-serializable per-measurement records""";
+    return [ dict(tile=tile and list(tile),phase=phase,gain=gain,**entry)
+             for (tile,phase,gain),entry in sorted(self.stats.items(),key=lambda x:repr(x[0])) ];
+
+  def dump (self,filename):
+    """Appends the records accumulated since the last dump to file, one JSON object per line.
+    A header line is written first if the file is new.""";
+    records = self.records();
+    self.stats = {};
+    try:
+      ff = open(filename,'a');
+      try:
+        if not ff.tell():
+          ff.write(json.dumps(dict(description="stefcal profile",version=self.FORMAT_VERSION,
+                                   trace_memory=self.trace_memory),sort_keys=True)+"\n");
+        for rec in records:
+          ff.write(json.dumps(rec,sort_keys=True)+"\n");
+      finally:
+        ff.close();
+      dprint(2,"appended %d records to profile"%len(records),filename);
+    except (IOError,OSError) as exc:
+      dprint(0,"error writing profile to %s: %s"%(filename,exc));
+
+  @staticmethod
+  def load (filename):
+    """Reads a profile written by dump(). Returns a dict with the header fields, the list of records,
+    and totals per phase and per gain""";
+    lines = [ line for line in open(filename) if line.strip() ];
+    summary = json.loads(lines[0]) if lines else {};
+    records = summary['records'] = [ json.loads(line) for line in lines[1:] ];
+    totals = summary['totals'] = {};
+    for rec in records:
+      tot = totals.setdefault(rec['phase'] if rec['gain'] is None else "%s:%s"%(rec['phase'],rec['gain']),
+                              dict(calls=0,time=0.,alloc=0,peak=0,iterations=0));
+      for key in 'calls','time','alloc','iterations':
+        tot[key] += rec[key];
+      if rec['peak'] is not None:
+        tot['peak'] = max(tot['peak'],rec['peak']);
+    return summary;
+
+
+class NullProfiler (object):
+  """Stand-in for Profiler used when profiling is disabled. All methods do nothing""";
+  def close (self):
+    pass;
+
+  def start_tile (self,tile):
+    pass;
+
+  def start (self,phase,gain=None):
+    return None;
+
+  def stop (self,token):
+    pass;
+
+  @contextlib.contextmanager
+  def phase (self,phase,gain=None):
+    yield;
+
+  def count (self,phase,gain=None,iterations=1):
+    pass;
+
+  def dump (self,filename):
+    pass;
@@ -14,11 +14,15 @@ import time
 import pickle
 import os.path
 import traceback
+import re
 import gc
+import multiprocessing
 import scipy.ndimage.measurements
 
 from Cattery.Calico.OMS.StefCal.MatrixOps import *
 import Cattery.Calico.OMS.StefCal.DataTiler as DataTiler
+from Cattery.Calico.OMS.StefCal.GainTable import GainTable,FORMAT_PICKLE,FORMAT_CHUNKED
+from Cattery.Calico.OMS.StefCal.Profiler import Profiler,NullProfiler
 from functools import reduce
 
 _verbosity = Kittens.utils.verbosity(name="stefcal");
@@ -69,6 +73,77 @@ def dump_data_model (data,model,ifrs,filename="dump.txt"):
 
 global_gains = {};
 
+def _slice_values (x,slc):
+  """Helper function: applies slice to all arrays found in a (possibly nested) dict or list of gain values""";
+  if isinstance(x,dict):
+    return dict([ (key,_slice_values(value,slc)) for key,value in x.items() ]);
+  elif isinstance(x,(list,tuple)):
+    return [ _slice_values(value,slc) for value in x ];
+  elif numpy.isscalar(x) or getattr(x,'ndim',0) < len(slc):
+    return x;
+  else:
+    return x[slc];
+
+def _expand_values (x,shape):
+  """Helper function: broadcasts all scalars found in a (possibly nested) dict or list of gain values to full arrays""";
+  if isinstance(x,dict):
+    return dict([ (key,_expand_values(value,shape)) for key,value in x.items() ]);
+  elif isinstance(x,(list,tuple)):
+    return [ _expand_values(value,shape) for value in x ];
+  elif getattr(x,'shape',None) == tuple(shape):
+    return x;
+  else:
+    return numpy.broadcast_to(x,shape).copy();
+
+def _merge_values (chunks,shapes,axis=1):
+  """Helper function: concatenates a list of (possibly nested) dicts or lists of gain values along the given axis.
+  Dict entries missing from some chunks are filled with zeros of the given chunk shape.""";
+  x0 = chunks[0];
+  if isinstance(x0,dict):
+    keys = set();
+    for x in chunks:
+      keys.update(x.keys());
+    return dict([ (key,_merge_values([ x.get(key) for x in chunks ],shapes,axis)) for key in keys ]);
+  elif isinstance(x0,(list,tuple)):
+    return [ _merge_values(list(x),shapes,axis) for x in zip(*chunks) ];
+  else:
+    dtype = [ x for x in chunks if x is not None ][0].dtype;
+    return numpy.concatenate([ x if x is not None else numpy.zeros(shape,dtype)
+                               for x,shape in zip(chunks,shapes) ],axis);
+
+def _result_dtype (solvers,matrices):
+  """Helper function: returns dtype of the result of applying gain solvers to matrices (an iterable of flat
+  4-lists of visibilities), i.e. the promotion of the solver and visibility dtypes, but at least complex64""";
+  dtypes = set([ x.dtype for mat in matrices for x in mat if not numpy.isscalar(x) ]);
+  dtypes.update([ getattr(solver,'_dtype',numpy.complex128) for solver in solvers ]);
+  return numpy.result_type(numpy.complex64,*dtypes);
+
+# max number of elements in a stacked block of baselines, see _baseline_blocks()
+STACK_BLOCK_SIZE = 1<<22;
+
+def _baseline_blocks (ifrs,size):
+  """Helper function: splits list of baselines into blocks of no more than STACK_BLOCK_SIZE elements,
+  where each baseline accounts for size elements""";
+  nb = max(STACK_BLOCK_SIZE//max(size,1),1);
+  return [ ifrs[i:i+nb] for i in range(0,len(ifrs),nb) ];
+
+# arguments of the parallel gain solution currently in progress. Set by StefCalNode._run_gain_solution_parallel()
+# just before the worker processes are forked, so that the workers inherit all data without copying
+_parallel_solution_args = None;
+
+def _run_gain_solution_chunk (ichunk):
+  """Worker process entry point, solves for one frequency chunk""";
+  node,args,chunks = _parallel_solution_args;
+  return node._run_gain_solution_chunk(*(args+chunks[ichunk]));
+
+# arguments of the Jacobi-style diffgain solution currently in progress. Set by StefCalNode._run_diffgain_solutions()
+_parallel_diffgain_args = None;
+
+def _run_diffgain_solution (idg):
+  """Worker process entry point, solves for one diffgain""";
+  node,args = _parallel_diffgain_args;
+  return node._run_diffgain_solution(idg,*args,worker=True);
+
 class StefCalVisualizer (pynode.PyNode):
   def __init__ (self,*args):
     pynode.PyNode.__init__(self,*args);
@@ -141,6 +216,9 @@ class StefCalNode (pynode.PyNode):
     pynode.PyNode.__init__(self,*args);
     self._dataset_id = None;
     self.ifr_gain = {};
+    # scratch matrices, see _work_matrix()
+    self._work_matrices = {};
+    self._profiler = NullProfiler();
 
   def update_state (self,mystate):
     """Standard function to update our state""";
@@ -162,6 +240,15 @@ class StefCalNode (pynode.PyNode):
     mystate('verbose',0);
     # verbosity level
     mystate('critical_flag_threshold',20);
+    # number of worker processes used to solve independent frequency chunks in parallel (<2 solves serially)
+    mystate('solve_processes',0);
+    # solve for all diffgains against the same residual (Jacobi-style), rather than one after another.
+    # The directions are then solved in solve_processes parallel processes.
+    mystate('diffgain_jacobi',False);
+    # if True, record a timing and memory breakdown of each request, and append it to profile_file (by default,
+    # stefcal-profile-<nodename>.jsonl in the directory of the first gain table)
+    mystate('profile',False);
+    mystate('profile_file','');
     # number of diffgains
     mystate('diffgain_labels',[]);
     # init gain objects
@@ -187,6 +274,23 @@ class StefCalNode (pynode.PyNode):
       dg.update_state(self,option_suffix=label);
       if dg.enable:
         self.dgopts.append(dg);
+    # setup profiler
+    if not self.profile:
+      # stops memory tracing, if the profiler had started it
+      self._profiler.close();
+      self._profiler = NullProfiler();
+    elif not isinstance(self._profiler,Profiler):
+      self._profiler = Profiler();
+    if not self.profile_file:
+      tables = [ opt.table for opt in self.gainopts+self.dgopts if opt.table ];
+      # include the node name, so that several StefCal nodes don't write to the same file
+      nodename = re.sub(r'[^\w.+-]','_',getattr(self,'name','stefcal'));
+      self.profile_file = os.path.join(os.path.dirname(tables[0]) if tables else "","stefcal-profile-%s.jsonl"%nodename);
+    # solver-wide single precision: data, model, gains and residuals are kept as complex64 throughout
+    mystate('single_precision',False);
+    if self.single_precision:
+      for opt in self.gainopts+self.dgopts:
+        opt.use_float = True;
     self.use_float_di = all([gg.use_float for gg in self.gainopts])
     self.use_float_dd = all([dg.use_float for dg in self.dgopts])
     dprintf(2,"using float di %s dd %s\n",self.use_float_di,self.use_float_dd)
@@ -216,6 +320,8 @@ class StefCalNode (pynode.PyNode):
     mystate('regularize_intermediate',False);
     # name of gain tables to which solutions are saved (or from which they are loaded)
     mystate('ifr_gain_table','ifrgains.cp');
+    # format of IFR gain table: FORMAT_PICKLE or FORMAT_CHUNKED
+    mystate('ifr_gain_table_format',FORMAT_PICKLE);
     # filenames for solutions
     # return residuals (else corrected data)
     mystate('residuals',True);
@@ -244,6 +350,11 @@ class StefCalNode (pynode.PyNode):
     mystate('print_variance',False);
     # lis of all ifrs, as p,q pairs
     self._ifrs = [ tuple(x.split(':')) for x in self.ifrs ];
+    # list of all antennas, in order of first appearance in the ifrs
+    self._antennas = [];
+    for p in [ p for pq in self._ifrs for p in pq ]:
+      if p not in self._antennas:
+        self._antennas.append(p);
     # make list of ifrs sorted by baselines
     self.ifr_by_baseline = list(zip(self._ifrs,self.baselines));
     from past.builtins import cmp
@@ -260,12 +371,24 @@ class StefCalNode (pynode.PyNode):
 
 #  @profile
   def get_result (self,request,*children):
+    time0,time1,timestep,numtime,freq0,freq1,freqstep,numfreq = request.cells.domain.domain_id;
+    prof = self._profiler;
+    prof.start_tile((time0,time1,freq0,freq1));
+    # the profile of the tile is written out even if the request returns early or fails
+    try:
+      with prof.phase("total"):
+        return self._get_result(request,*children);
+    finally:
+      prof.dump(self.profile_file);
+
+  def _get_result (self,request,*children):
     dprint(1,"get_result entry");
     timestamp0 = time.time();
     # get dataset ID from request
     dataset_id,domain_id = meq.split_request_id(request.request_id);
     # get domain ID from request
     time0,time1,timestep,numtime,freq0,freq1,freqstep,numfreq = request.cells.domain.domain_id;
+    prof = self._profiler;
     # child 0 is data
     # child 1 is direction-independent model
     # children 2 and on are models subject to dE terms
@@ -292,7 +415,10 @@ class StefCalNode (pynode.PyNode):
       self.ifr_gain = {};
       if self.apply_ifr_gains and not self.reset_ifr_gains and os.path.exists(self.ifr_gain_table):
         try:
-          self.ifr_gain = pickle.load(open(self.ifr_gain_table, "rb"));
+          if GainTable.is_chunked(self.ifr_gain_table):
+            self.ifr_gain = GainTable(self.ifr_gain_table).get("ifr") or {};
+          else:
+            self.ifr_gain = pickle.load(open(self.ifr_gain_table, "rb"));
           dprint(1,"loaded %d ifr gains from %s"%(len(self.ifr_gain),self.ifr_gain_table));
           # reset off-diagonals to 1
           if self.diag_ifr_gains:
@@ -308,189 +434,192 @@ class StefCalNode (pynode.PyNode):
     # children 2 and on are models subject to dE terms
 
     # check inputs and populate mappings
-    pqij_all = [];      # list of all (p,q),i,j tuples
-    pqij_data = [];     # subset of (p,q),i,j tuples for which we have non-null input
-    pqij_solvable = []; # subset of (p,q),i,j tuples for which we solve for gains
-    data  = {};         # mapping from (p,q) to four data time-freq planes
-    model0 = {};        # mapping from (p,q) to four model (M0) time-freq planes
-    dgmodel = [ {} for i in range(num_diffgains) ];
-                        # for each diff gain, mapping from (p,q) to M1,M2,... model time-freq planes (4 each)
-    dgmodel_corr = [ {} for i in range(num_diffgains) ];
-                        # diffgain model, corrupted with appropriate diffgain term
-    model = {};         # this is the full model, M0+M1+M2+...
+    with prof.phase("unpack"):
+      pqij_all = [];      # list of all (p,q),i,j tuples
+      pqij_data = [];     # subset of (p,q),i,j tuples for which we have non-null input
+      pqij_solvable = []; # subset of (p,q),i,j tuples for which we solve for gains
+      data  = {};         # mapping from (p,q) to four data time-freq planes
+      model0 = {};        # mapping from (p,q) to four model (M0) time-freq planes
+      dgmodel = [ {} for i in range(num_diffgains) ];
+                          # for each diff gain, mapping from (p,q) to M1,M2,... model time-freq planes (4 each)
+      dgmodel_corr = [ {} for i in range(num_diffgains) ];
+                          # diffgain model, corrupted with appropriate diffgain term
+      model = {};         # this is the full model, M0+M1+M2+...
 
-    # This will contain a mask of flagged values. I would use masked arrays, but they seem to slow something down, so no no. 
-    # Instead, we'll use 0.0 for missing values in model and data (since zeroes do not upset the equations), and maintain a 
-    # bitflags array for masking things out.
-    # Need bitflags rather than a single flag so that we can distinguish what the origin of the flag was 
-    # (and also because we may clear flags in the first cycle of the major loop)
-    bitflags = {};
+      # This will contain a mask of flagged values. I would use masked arrays, but they seem to slow something down, so no no. 
+      # Instead, we'll use 0.0 for missing values in model and data (since zeroes do not upset the equations), and maintain a 
+      # bitflags array for masking things out.
+      # Need bitflags rather than a single flag so that we can distinguish what the origin of the flag was 
+      # (and also because we may clear flags in the first cycle of the major loop)
+      bitflags = {};
 
-    antennas = set([p for p,q in self._ifrs]) | set([q for p,q in self._ifrs]);
+      antennas = set([p for p,q in self._ifrs]) | set([q for p,q in self._ifrs]);
 
-    # per-baseline noise
-    variance = {};
-    # antennas for which we have non-trivial data
-    solvable_antennas = set();
-    # this will count the valid visibilities per each antenna, per each time/freq slot
-    vis_per_antenna = None;
+      # per-baseline noise
+      variance = {};
+      # antennas for which we have non-trivial data
+      solvable_antennas = set();
+      # this will count the valid visibilities per each antenna, per each time/freq slot
+      vis_per_antenna = None;
 
-    datares = children[0]
-    data_dims = getattr(datares,'dims',None);
-    if data_dims is None:
-      raise TypeError("No data dimensions. Have you specified a valid input column?");
-    modelres = children[1];
-    if any( [ getattr(ch,'dims',None) != data_dims for ch in children[1:] ] ):
-      raise TypeError("Dimensions of data and model(s) do not match. Have you specified a sky model?");
-    # expecting Nx2x2 matrices
-    if len(datares.dims) == 3:
-      if datares.dims[1] != 2 or datares.dims[2] != 2:
-        raise TypeError("Data and model must be of rank Nx2x2");
-      nifrs = datares.dims[0];
-      # setup antenna names
-      if nifrs != len(self.ifrs):
-        raise TypeError("first dimension of data and model must match the number of interferometers in the ifrs field");
-      # setup list of data, values and parameter names
-      nvells = -1;
-      for pq in self._ifrs:
-        # get IFR gain for this p,q
-        ifrgain = self.ifr_gain.get(pq,[1,1,1,1]);
-#        print pq,"IFR gain is",ifrgain;
-        # now loop over the 4 matrix elements
-        for num,(i,j) in enumerate(IJ2x2):
-          # increment vells count upfront (this is why we start at -1)
-          nvells += 1;
-          # get data
-          d = getattr(datares.vellsets[nvells],'value',0);
-          # apply ifr gains if we have them
-          if not is_null(d):
-            # convert if needed
-            if self.use_float_di:
-              d = d.astype(numpy.complex64)  # make copy by default
-            if d.flags['WRITEABLE']:
-              d *= ifrgain[num]
+      datares = children[0]
+      data_dims = getattr(datares,'dims',None);
+      if data_dims is None:
+        raise TypeError("No data dimensions. Have you specified a valid input column?");
+      modelres = children[1];
+      if any( [ getattr(ch,'dims',None) != data_dims for ch in children[1:] ] ):
+        raise TypeError("Dimensions of data and model(s) do not match. Have you specified a sky model?");
+      # expecting Nx2x2 matrices
+      if len(datares.dims) == 3:
+        if datares.dims[1] != 2 or datares.dims[2] != 2:
+          raise TypeError("Data and model must be of rank Nx2x2");
+        nifrs = datares.dims[0];
+        # setup antenna names
+        if nifrs != len(self.ifrs):
+          raise TypeError("first dimension of data and model must match the number of interferometers in the ifrs field");
+        # setup list of data, values and parameter names
+        nvells = -1;
+        for pq in self._ifrs:
+          # get IFR gain for this p,q
+          ifrgain = self.ifr_gain.get(pq,[1,1,1,1]);
+  #        print pq,"IFR gain is",ifrgain;
+          # now loop over the 4 matrix elements
+          for num,(i,j) in enumerate(IJ2x2):
+            # increment vells count upfront (this is why we start at -1)
+            nvells += 1;
+            # get data
+            d = getattr(datares.vellsets[nvells],'value',0);
+            # get model
+            m = getattr(modelres.vellsets[nvells],'value',0);
+            if hasattr(datares.vellsets[nvells],'flags'):
+              flags = (datares.vellsets[nvells].flags != 0);
             else:
-              d = d*ifrgain[num]
-          # get model
-          m = getattr(modelres.vellsets[nvells],'value',0);
-          if hasattr(datares.vellsets[nvells],'flags'):
-            flags = (datares.vellsets[nvells].flags != 0);
-          else:
-            flags = None;
-          # does this need to be skipped? only process data otherwise
-          if not ( is_null(d) if self.polarized else (is_null(m) or is_null(d)) ):
-            # if this is the first datum, then check shape, and prepare subtilings etc.
-            # for the first valid result, setup shapes and stuff
-            if not model0:
-              def get_dtype (dd):
-                if dd:
-                  return numpy.complex64 if self.use_float_dd else numpy.complex128
+              flags = None;
+            # does this need to be skipped? only process data otherwise
+            if not ( is_null(d) if self.polarized else (is_null(m) or is_null(d)) ):
+              # if this is the first datum, then check shape, and prepare subtilings etc.
+              # for the first valid result, setup shapes and stuff
+              if not model0:
+                def get_dtype (dd):
+                  if dd:
+                    return numpy.complex64 if self.use_float_dd else numpy.complex128
+                  else:
+                    return numpy.complex64 if self.use_float_di else numpy.complex128
+                # this is the basic time-frequency shape
+                self._datashape = datashape = tuple(d.shape);
+                self._datasize = reduce(operator.mul,datashape);
+                # figure out subtiling
+                self._expanded_datashape = expanded_datashape = GainOpts.resolve_tilings(datashape,*(self.gainopts+self.dgopts));
+                # if tiling does not tile the data shape perfectly, we'll need to expand the input arrays
+                # Define pad_array() as a function for this: it will set to be identity if no expansion is needed
+                if datashape != expanded_datashape:
+                  self._expanded_dataslice = expanded_dataslice = tuple([ slice(0,nd) for nd in datashape ]);
+                  def pad_array (x,initval=0,dd=False):
+                    if is_null(x):
+                      return 0;
+                    x1 = numpy.empty(expanded_datashape, dtype=bool if type(initval) is bool else get_dtype(dd))
+                    x1[...] = initval;
+                    x1[expanded_dataslice] = x;
+                    return x1;
+                  # multiplies the valid part of a padded array in place
+                  def scale_array (x,factor):
+                    x1 = x[expanded_dataslice];
+                    x1 *= factor;
+                  self._expanded_size = reduce(operator.mul,expanded_datashape);
+                  self._expansion_ratio = self._expanded_size/float(self._datasize);
+                  self._expansion_mask = numpy.zeros(expanded_datashape,bool);
+                  self._expansion_mask[expanded_dataslice] = True;
+                  dprint(1,"input arrays will be expanded to shape",expanded_datashape,"ratio %.2f"%self._expansion_ratio);
                 else:
-                  return numpy.complex64 if self.use_float_di else numpy.complex128
-              # this is the basic time-frequency shape
-              self._datashape = datashape = tuple(d.shape);
-              self._datasize = reduce(operator.mul,datashape);
-              # figure out subtiling
-              self._expanded_datashape = expanded_datashape = GainOpts.resolve_tilings(datashape,*(self.gainopts+self.dgopts));
-              # if tiling does not tile the data shape perfectly, we'll need to expand the input arrays
-              # Define pad_array() as a function for this: it will set to be identity if no expansion is needed
-              if datashape != expanded_datashape:
-                self._expanded_dataslice = expanded_dataslice = tuple([ slice(0,nd) for nd in datashape ]);
-                def pad_array (x,initval=0,dd=False):
-                  if is_null(x):
-                    return 0;
-                  x1 = numpy.empty(expanded_datashape, dtype=bool if type(initval) is bool else get_dtype(dd))
-                  x1[...] = initval;
-                  x1[expanded_dataslice] = x;
-                  return x1;
-                self._expanded_size = reduce(operator.mul,expanded_datashape);
-                self._expansion_ratio = self._expanded_size/float(self._datasize);
-                self._expansion_mask = numpy.zeros(expanded_datashape,bool);
-                self._expansion_mask[expanded_dataslice] = True;
-                dprint(1,"input arrays will be expanded to shape",expanded_datashape,"ratio %.2f"%self._expansion_ratio);
+                  self._expanded_size = self._datasize;
+                  self._expansion_ratio = 1;
+                  self._expanded_dataslice = expanded_dataslice = None;
+                  self._expansion_mask = numpy.ones(datashape,bool);
+                  def pad_array (x,initval=0,dd=False):
+                    if is_null(x):
+                      return x
+                    elif type(initval) is bool:
+                      return x
+                    else:
+                      return x.astype(get_dtype(dd))  # copy=True implicitly
+                  def scale_array (x,factor):
+                    x *= factor;
+                # this counts how many valid visibilities we have per each antenna, per each time/freq slot
+                vis_per_antenna = dict([(p,numpy.zeros(expanded_datashape,dtype=int)) for p in antennas ]);
+              # now check inputs and add them to data and model dicts
+              if d.shape != datashape:
+                raise TypeError("data shape mismatch at %s:%s:%s:%s, %s vs %s" % (pq[0], pq[1],
+                  self.corr_names[i], self.corr_names[j], d.shape, datashape ))
+              if not is_null(m) and m.shape != datashape:
+                raise TypeError("model shape mismatch at %s:%s:%s:%s, %s vs %s" % (pq[0], pq[1],
+                  self.corr_names[i], self.corr_names[j], m.shape, datashape ))
+              # add to data/model matrices, applying the padding function defined above
+              m0 = model0.setdefault(pq,[0,0,0,0])[num] = pad_array(m);
+              d0 = data.setdefault(pq,[0,0,0,0])[num] = pad_array(d);
+              # apply ifr gains if we have them. pad_array() always makes a private copy (converting to the working
+              # dtype on the way), so this can be done in place without further copies of the input
+              g = ifrgain[num];
+              if not is_null(d0) and not (numpy.isscalar(g) and g == 1):
+                scale_array(d0,g);
+              # apply flags
+              if flags is not None:
+                flags = pad_array(flags,True);
+                if not is_null(m0):
+                  m0[flags] = 0;
+                if not is_null(d0):
+                  d0[flags] = 0;
+                invalid = (d0==0)&(m0==0);
+                self.add_flags(bitflags,pq,invalid*FPRIOR);
+              # if there are at least some valid points on this baseline, add it to solvable antennas
+              if (bitflags.get(pq) is None) or not bitflags[pq].all():
+                if pq in self._solvable_ifrs:
+                  solvable_antennas.update(pq);
+    #              print pq,validmask[pq];
+              # get models for dE-subjected terms
+              if num_diffgains:
+                for k in range(num_diffgains):
+                  m1 = children[2+k].vellsets[nvells].value
+                  m1 = pad_array(m1,dd=True);
+                  if flags is not None and not is_null(m1):
+                    m1[flags] = 0;
+                  dgmodel[k].setdefault(pq,[0,0,0,0])[num] = m1;
+          # ok, done looping over the 2x2 visibility matrix elements. 
+          # If we have found anything valid at all, finalize flagmasks etc.
+          if pq in model0:
+            # look at bitflags to see how many valid correlations we have, and zero the flagged ones
+            fmask = bitflags.get(pq);
+            if fmask is not None:
+              fmask = fmask!=0;
+              valid = self._expanded_size - fmask.sum();
+              if valid > 0:
+                dprint(4,"%s-%s"%pq,"has %d of %d unflagged correlation matrices"%(valid,self._datasize));
+                for dataset in [data,model0] + dgmodel:
+                  for x in dataset.get(pq,[]):
+                    if not is_null(x):
+                      x[fmask] = 0;
+                validmask = (~fmask).astype(int);
+                vis_per_antenna[pq[0]] += validmask;
+                vis_per_antenna[pq[1]] += validmask;
               else:
-                self._expanded_size = self._datasize;
-                self._expansion_ratio = 1;
-                self._expanded_dataslice = expanded_dataslice = None;
-                self._expansion_mask = numpy.ones(datashape,bool);
-                def pad_array (x,initval=0,dd=False):
-                  if is_null(x):
-                    return x
-                  elif type(initval) is bool:
-                    return x
-                  else:
-                    return x.astype(get_dtype(dd))  # copy=True implicitly
-              # this counts how many valid visibilities we have per each antenna, per each time/freq slot
-              vis_per_antenna = dict([(p,numpy.zeros(expanded_datashape,dtype=int)) for p in antennas ]);
-            # now check inputs and add them to data and model dicts
-            if d.shape != datashape:
-              raise TypeError("data shape mismatch at %s:%s:%s:%s, %s vs %s" % (pq[0], pq[1],
-                self.corr_names[i], self.corr_names[j], d.shape, datashape ))
-            if not is_null(m) and m.shape != datashape:
-              raise TypeError("model shape mismatch at %s:%s:%s:%s, %s vs %s" % (pq[0], pq[1],
-                self.corr_names[i], self.corr_names[j], m.shape, datashape ))
-            # add to data/model matrices, applying the padding function defined above
-            m0 = model0.setdefault(pq,[0,0,0,0])[num] = pad_array(m);
-            d0 = data.setdefault(pq,[0,0,0,0])[num] = pad_array(d);
-            # apply flags
-            if flags is not None:
-              flags = pad_array(flags,True);
-              if not is_null(m0):
-                m0[flags] = 0;
-              if not is_null(d0):
-                d0[flags] = 0;
-              invalid = (d0==0)&(m0==0);
-              self.add_flags(bitflags,pq,invalid*FPRIOR);
-            # if there are at least some valid points on this baseline, add it to solvable antennas
-            if (bitflags.get(pq) is None) or not bitflags[pq].all():
-              if pq in self._solvable_ifrs:
-                solvable_antennas.update(pq);
-  #              print pq,validmask[pq];
-            # get models for dE-subjected terms
-            if num_diffgains:
-              for k in range(num_diffgains):
-                m1 = children[2+k].vellsets[nvells].value
-                m1 = pad_array(m1,dd=True);
-                if flags is not None and not is_null(m1):
-                  m1[flags] = 0;
-                dgmodel[k].setdefault(pq,[0,0,0,0])[num] = m1;
-        # ok, done looping over the 2x2 visibility matrix elements. 
-        # If we have found anything valid at all, finalize flagmasks etc.
-        if pq in model0:
-          # look at bitflags to see how many valid correlations we have, and zero the flagged ones
-          fmask = bitflags.get(pq);
-          if fmask is not None:
-            fmask = fmask!=0;
-            valid = self._expanded_size - fmask.sum();
-            if valid > 0:
-              dprint(4,"%s-%s"%pq,"has %d of %d unflagged correlation matrices"%(valid,self._datasize));
-              for dataset in [data,model0] + dgmodel:
-                for x in dataset.get(pq,[]):
-                  if not is_null(x):
-                    x[fmask] = 0;
-              validmask = (~fmask).astype(int);
-              vis_per_antenna[pq[0]] += validmask;
-              vis_per_antenna[pq[1]] += validmask;
+                # if nothing is valid, remove baseline from dicts
+                dprint(4,"%s-%s"%pq,"is completely flagged, skipping");
+                for dataset in [data,model0] + dgmodel:
+                  del dataset[pq];
             else:
-              # if nothing is valid, remove baseline from dicts
-              dprint(4,"%s-%s"%pq,"is completely flagged, skipping");
-              for dataset in [data,model0] + dgmodel:
-                del dataset[pq];
-          else:
-            dprint(4,"%s-%s"%pq,"has no flagged correlation matrices, all data is valid");
-            vis_per_antenna[pq[0]] += 1;
-            vis_per_antenna[pq[1]] += 1;
-    else:
-      # in principle could also handle [N], but let's not bother for now
-      raise TypeError("data and model must be of rank Nx2x2");
+              dprint(4,"%s-%s"%pq,"has no flagged correlation matrices, all data is valid");
+              vis_per_antenna[pq[0]] += 1;
+              vis_per_antenna[pq[1]] += 1;
+      else:
+        # in principle could also handle [N], but let's not bother for now
+        raise TypeError("data and model must be of rank Nx2x2");
 
-    # hang onto datares record since we'll be putting the results into it
-    # release modelres and all the other child results (they're already held in model and dgmodel)
-    # use resize to explicitly release the memory since we KNOW nobody else is using it
-    dprint(1,"constructed internal arrays, trying to release array memory");
-    modelres = children = None
-    gc.collect()
-    dprint(1,"released memory");
+      # hang onto datares record since we'll be putting the results into it
+      # release modelres and all the other child results (they're already held in model and dgmodel)
+      # use resize to explicitly release the memory since we KNOW nobody else is using it
+      dprint(1,"constructed internal arrays, trying to release array memory");
+      modelres = children = None
+      gc.collect()
+      dprint(1,"released memory");
     
     valid_ifrs = list(data.keys());
     solvable_ifrs = set(self._solvable_ifrs)&set(valid_ifrs);
@@ -507,109 +636,117 @@ class StefCalNode (pynode.PyNode):
 
 
 ## -------------------- downsample data and model, if needed
-    downsample_subtiling = self.downsample_subtiling;
-    downsampler = None;
-    if downsample_subtiling:
-      downsample_subtiling = [ max(d,1) for d in downsample_subtiling ];
-      for iaxis,ds in enumerate(downsample_subtiling):
-        for opt in self.gainopts+self.dgopts:
-          if opt.subtiling[iaxis]%ds != 0:
-            raise RuntimeError("axis %d: %s solution interval must be a multiple of downsample interval"%(iaxis,opt.name));
-      if max(downsample_subtiling) == 1:
-        downsample_subtiling = None;
-      else:
-        # create retiler for going from downsampled to full resolution
-        downsampler = DataTiler.DataTiler(expanded_datashape,downsample_subtiling,original_datashape=datashape);
-        # create retilers for going from gain tiling to full resolution
-        for opt in self.gainopts+self.dgopts:
-          opt.vis_tiler = DataTiler.DataTiler(expanded_datashape,opt.subtiling,original_datashape=datashape,force_subtiling=True);
-          if not self.downsample_output:
-            opt.tiler = opt.vis_tiler;
-          # update option settings
-          opt.smoothing = [ ds/float(st) for ds,st in zip(opt.smoothing,downsample_subtiling) ];
-          opt.subtiling = [ gs//st for gs,st in zip(opt.subtiling,downsample_subtiling) ];
-        # keep copies of model and data at original sampling
-        orig_sampled_data = data.copy();
-        orig_sampled_bitflags = bitflags.copy();
-        orig_sampled_model0 = model0.copy();
-        orig_sampled_dgmodel = [ dg.copy() for dg in dgmodel ];
-        # resample
-        downsample_factor = reduce(operator.mul,downsample_subtiling);
-        dprint(1,"resampling data by a factor of %d=%s"%(downsample_factor,"x".join(map(str,downsample_subtiling))));
-        for pq in list(data.keys()):
-          flags = bitflags.get(pq);
-          # resample flags, and compute number of valid slots per resampled interval, and a norm based on this
-          if flags is not None and not numpy.isscalar(flags):
-            nv = downsample_factor - downsampler.reduce_tiles(downsampler.tile_data(flags!=0));
-            fl = bitflags[pq] = FPRIOR*(nv==0);
-            norm = numpy.where(fl,0,1./nv);
-          else:
-            norm = 1./downsample_factor;
-          # resample data
-          for vissets in [data,model0] + dgmodel:
-            dd = vissets.get(pq);
-            if dd is not None:
-              vissets[pq] = [ downsampler.reduce_tiles(downsampler.tile_data(d))*norm if 
-                              d is not None and not numpy.isscalar(d) else d for d in dd ];
-        # change other settings
-        orig_sampled_expanded_datashape = expanded_datashape;
-        orig_sampled_datashape = datashape;
-        orig_expansion_mask = self._expansion_mask;
-        self._expansion_mask = numpy.zeros(expanded_datashape);
-        self._datashape = datashape = [ int(math.ceil(ds/float(st))) for ds,st in zip(datashape,downsample_subtiling) ];
-        self._expansion_mask[tuple([ slice(0,nd) for nd in datashape ])] =True;
-        self._expanded_datashape = expanded_datashape = [ ds//st for ds,st in zip(expanded_datashape,downsample_subtiling) ];
-        self._datasize /= downsample_factor;
-        self._expanded_size /= downsample_factor;
+    with prof.phase("downsample"):
+      downsample_subtiling = self.downsample_subtiling;
+      downsampler = None;
+      if downsample_subtiling:
+        downsample_subtiling = [ max(d,1) for d in downsample_subtiling ];
+        for iaxis,ds in enumerate(downsample_subtiling):
+          for opt in self.gainopts+self.dgopts:
+            if opt.subtiling[iaxis]%ds != 0:
+              raise RuntimeError("axis %d: %s solution interval must be a multiple of downsample interval"%(iaxis,opt.name));
+        if max(downsample_subtiling) == 1:
+          downsample_subtiling = None;
+        else:
+          # create retiler for going from downsampled to full resolution
+          downsampler = DataTiler.DataTiler(expanded_datashape,downsample_subtiling,original_datashape=datashape);
+          # create retilers for going from gain tiling to full resolution
+          for opt in self.gainopts+self.dgopts:
+            opt.vis_tiler = DataTiler.DataTiler(expanded_datashape,opt.subtiling,original_datashape=datashape,force_subtiling=True);
+            if not self.downsample_output:
+              opt.tiler = opt.vis_tiler;
+            # update option settings
+            opt.smoothing = [ ds/float(st) for ds,st in zip(opt.smoothing,downsample_subtiling) ];
+            opt.subtiling = [ gs//st for gs,st in zip(opt.subtiling,downsample_subtiling) ];
+          # keep copies of model and data at original sampling
+          orig_sampled_data = data.copy();
+          orig_sampled_bitflags = bitflags.copy();
+          orig_sampled_model0 = model0.copy();
+          orig_sampled_dgmodel = [ dg.copy() for dg in dgmodel ];
+          # resample
+          downsample_factor = reduce(operator.mul,downsample_subtiling);
+          dprint(1,"resampling data by a factor of %d=%s"%(downsample_factor,"x".join(map(str,downsample_subtiling))));
+          # (the norm is applied in place, so as to preserve the precision of the data)
+          def downsample_array (x,norm):
+            x = downsampler.reduce_tiles(downsampler.tile_data(x));
+            x *= norm;
+            return x;
+          for pq in list(data.keys()):
+            flags = bitflags.get(pq);
+            # resample flags, and compute number of valid slots per resampled interval, and a norm based on this
+            if flags is not None and not numpy.isscalar(flags):
+              nv = downsample_factor - downsampler.reduce_tiles(downsampler.tile_data(flags!=0));
+              fl = bitflags[pq] = FPRIOR*(nv==0);
+              norm = numpy.where(fl,0,1./nv);
+            else:
+              norm = 1./downsample_factor;
+            # resample data
+            for vissets in [data,model0] + dgmodel:
+              dd = vissets.get(pq);
+              if dd is not None:
+                vissets[pq] = [ downsample_array(d,norm) if d is not None and not numpy.isscalar(d) else d for d in dd ];
+          # change other settings
+          orig_sampled_expanded_datashape = expanded_datashape;
+          orig_sampled_datashape = datashape;
+          orig_expansion_mask = self._expansion_mask;
+          self._expansion_mask = numpy.zeros(expanded_datashape);
+          self._datashape = datashape = [ int(math.ceil(ds/float(st))) for ds,st in zip(datashape,downsample_subtiling) ];
+          self._expansion_mask[tuple([ slice(0,nd) for nd in datashape ])] =True;
+          self._expanded_datashape = expanded_datashape = [ ds//st for ds,st in zip(expanded_datashape,downsample_subtiling) ];
+          self._datasize /= downsample_factor;
+          self._expanded_size /= downsample_factor;
+      # kept for solvers made later on for parts of the data (see _run_gain_solution_chunk)
+      self._downsample_subtiling = downsample_subtiling;
     
 ## -------------------- rescale data to model if asked to
-    if self.rescale and self.rescale != "no":
-      scale = {};
-      finite = {};
-      # compute scales as s(p) = ||sum_q Mpq||/||sum_q Dpq||
-      for p in antennas:
-        dsum = msum = 0;
-        for q in antennas:
-          d = m = None;
-          if (p,q) in data:
-            d,m = data.get((p,q)),model0.get((p,q));
-          elif (q,p) in data:
-            d,m = data.get((q,p)),model0.get((q,p));
-          if d is None or m is None:
-            continue;
-          dsum += sum([x*numpy.conj(x) for x in d]);
-          msum += sum([x*numpy.conj(x) for x in m]);
-        if self.rescale == "scalar":
-          dsum = dsum.sum() if dsum is not 0 else 0+0j;
-          msum = msum.sum() if msum is not 0 else 0+0j;
-          if dsum:
-            scale[p] = numpy.power(msum.real/dsum.real,0.25),True;
+    with prof.phase("rescale"):
+      if self.rescale and self.rescale != "no":
+        scale = {};
+        finite = {};
+        # compute scales as s(p) = ||sum_q Mpq||/||sum_q Dpq||
+        for p in antennas:
+          dsum = msum = 0;
+          for q in antennas:
+            d = m = None;
+            if (p,q) in data:
+              d,m = data.get((p,q)),model0.get((p,q));
+            elif (q,p) in data:
+              d,m = data.get((q,p)),model0.get((q,p));
+            if d is None or m is None:
+              continue;
+            dsum += sum([x*numpy.conj(x) for x in d]);
+            msum += sum([x*numpy.conj(x) for x in m]);
+          if self.rescale == "scalar":
+            dsum = dsum.sum() if dsum is not 0 else 0+0j;
+            msum = msum.sum() if msum is not 0 else 0+0j;
+            if dsum:
+              scale[p] = numpy.power(msum.real/dsum.real,0.25),True;
+            else:
+              dprint(2,"no valid data (and thus no scale) for",p);
           else:
-            dprint(2,"no valid data (and thus no scale) for",p);
-        else:
-          if dsum is not 0:
-            s = numpy.power(msum.real/dsum.real,0.25);
-            f = numpy.isfinite(s);
-          if dsum is 0 or (~f).all():
-            dprint(2,"no valid data (and thus no scale) for",p);
+            if dsum is not 0:
+              s = numpy.power(msum.real/dsum.real,0.25);
+              f = numpy.isfinite(s);
+            if dsum is 0 or (~f).all():
+              dprint(2,"no valid data (and thus no scale) for",p);
+            else:
+              s[~f] = 0;
+              scale[p] = s,f;
+        # apply scales
+        if scale:
+          if self.rescale == "scalar":
+            dprint(2,"per-antenna data scaling factors are ",", ".join(["%s %.3g"%(p,s) for p,(s,f) in scale.items() ]));
           else:
-            s[~f] = 0;
-            scale[p] = s,f;
-      # apply scales
-      if scale:
-        if self.rescale == "scalar":
-          dprint(2,"per-antenna data scaling factors are ",", ".join(["%s %.3g"%(p,s) for p,(s,f) in scale.items() ]));
+            dprint(1,"min/max scaling factors are",min([s[f].min() for s,f in scale.values()]),
+                                                  max([s[f].max() for s,f in scale.values()]));
+            dprint(2,"per-antenna data scaling factors are ",", ".join(["%s %.3g"%(p,s.max()) for p,(s,f) in scale.items() ]));
         else:
-          dprint(1,"min/max scaling factors are",min([s[f].min() for s,f in scale.values()]),
-                                                max([s[f].max() for s,f in scale.values()]));
-          dprint(2,"per-antenna data scaling factors are ",", ".join(["%s %.3g"%(p,s.max()) for p,(s,f) in scale.items() ]));
-      else:
-        dprint(1,"rescaling not done, as none of the antennas appear to have any valid data");
-      for (p,q),dd in data.items():
-        s1,f = scale.get(p,(None,None));
-        s2,f = scale.get(q,(None,None));
-        if s1 is not None and s2 is not None:
-          matrix_scale1(dd,s1*s2);
+          dprint(1,"rescaling not done, as none of the antennas appear to have any valid data");
+        for (p,q),dd in data.items():
+          s1,f = scale.get(p,(None,None));
+          s2,f = scale.get(q,(None,None));
+          if s1 is not None and s2 is not None:
+            matrix_scale1(dd,s1*s2);
           
 ## -------------------- compute the noise estimate, and weights based on this
     noise,weight = self.compute_noise(data,bitflags);
@@ -681,7 +818,8 @@ class StefCalNode (pynode.PyNode):
       dprintf(0,"Solvable: %d of %d inteferometers (%d have valid data), with %d solvable antennas\n",
         len(self._solvable_ifrs),len(self.ifrs),len(solvable_ifrs),len(solvable_antennas));
     for opt in self.gainopts+self.dgopts:
-      opt.init_solver(datashape,expanded_datashape,solvable_ifrs,downsample_subtiling);
+      with prof.phase("init",opt.label):
+        opt.init_solver(datashape,expanded_datashape,solvable_ifrs,downsample_subtiling,domain=(time0,time1,freq0,freq1));
 
     if self.print_variance:
       print_variance(variance);
@@ -726,6 +864,10 @@ class StefCalNode (pynode.PyNode):
       # initdata: contains the original data D
       # model0: contains the original M0
       # initmodel: contains M = M0+M1+M2+... i.e. without dE values, or with initial guess for dE values
+      # workdata: buffers into which the corrected data is computed in place
+      workdtype = _result_dtype([ opt.solver for opt in self.gainopts ],[ data[pq] for pq in solvable_ifrs ]);
+      workdata = dict([ (pq,[ numpy.empty(self._expanded_datashape,workdtype) for i in range(4) ])
+                        for pq in solvable_ifrs ]);
       
       dprint(1,"resetting data and model to initial values");
       
@@ -790,9 +932,10 @@ class StefCalNode (pynode.PyNode):
             di_solved = True;
           ## apply correction to data
           dprint(1,"applying %s-inverse to data"%opt.label);
-          data = dict([ (pq,opt.solver.apply_inverse(data,pq,
-              regularize=self.regularization_factor if self.regularize_intermediate or last_loop else 0))
-              for pq in solvable_ifrs ]);
+          with prof.phase("apply",opt.label):
+            data = dict([ (pq,opt.solver.apply_inverse(data,pq,
+                regularize=self.regularization_factor if self.regularize_intermediate or last_loop else 0,
+                out=workdata[pq])) for pq in solvable_ifrs ]);
           dprint(1,"done");
           ## check for NANs in the data
           self.check_finiteness(data,"corrected data",bitflags);
@@ -820,43 +963,56 @@ class StefCalNode (pynode.PyNode):
           # each DG loop iteration
           for pq in solvable_ifrs:
             model[pq] = matrix_copy(model0[pq]);
-          # now loop over all diffgains and iterate each set once
-          for idg,dgopt in enumerate(self.dgopts):
-            # we want to solve for dE1 minimizing D=G.(M0+dE1.M1.dE1^H+dE2.M2.dE2^H+...).G^H
-            # which is the same as G^{-1}.D.G^{-H} = M0 + dE1.M1.dE1^H + dE2.M2.dE2^H + ...
-            # which is the same as D_corr - (M0 + dE1.M1.dE1^H + dE2.M2.dE2^H + ...) + dE1.M1.dE1^H = dE1.M1.dE1^H
-            # which is the same as D_corr - full_model_old                           + model1_old   = model1
-            # at this point, data is D_corr - full_model_old
-            # so, add model1_old to data, and fit model1 to it
-            # dgmodel_corr always contains the modelN_old values
-            report_prec = False
-            for pq in solvable_ifrs:
-              if not report_prec:
-                dprintf(2,"%s %s data type of dgmodel is %s\n",dgopt.label,pq,dgmodel[idg][pq][0].dtype)
-              corr = dgopt.solver.apply(dgmodel[idg],pq);
-              ##dgm: corr = dgmodel_corr[idg][pq];
-              if not report_prec:
-                dprintf(2,"%s %s data type of corrected is %s\n",dgopt.label,pq,corr[0].dtype)
-                report_prec = True
-              for (c,dd) in zip(corr,data[pq]):
-                dd += c;
-            if ( idg == self.dump_diffgain or self.dump_diffgain == -1 ) and \
-              ( domain_id == self.dump_domain or self.dump_domain == -1 ):
-              dump_data_model(dgmodel[idg],data,solvable_ifrs,"dump_E%d-%d.txt"%(idg,nmajor));
-            # iterate this diffgain solution
-            self.check_finiteness(data,"data after DG%d added in"%idg,bitflags);
-            flagged = self.run_gain_solution(dgopt,dgmodel[idg],data,weight,bitflags,flag_null_gains=False,looptype=looptype);
-            # now, add to model1 to model, and subtract back from data if needed
+          # in Jacobi mode, solve for all diffgains at once, then add them to the model
+          if self.diffgain_jacobi and num_diffgains > 1:
+            flagged = self._run_diffgain_solutions(dgmodel,data,weight,bitflags,looptype,solvable_ifrs);
             for pq in solvable_ifrs:
-              corr = dgopt.solver.apply(dgmodel[idg],pq);
-              #dgm: corr = dgmodel_corr[idg][pq] = dgopt.solver.apply(dgmodel[idg],pq,cache=True);
-              for i,(c,mm,dd) in enumerate(zip(corr,model[pq],data[pq])):
-                if is_null(mm):
-                  model[i] = c;
-                else:
-                  mm += c;
-                if idg<num_diffgains-1:
-                  dd -= c;
+              mm = model[pq];
+              for idg,dgopt in enumerate(self.dgopts):
+                corr = dgopt.solver.apply(dgmodel[idg],pq,out=self._work_matrix(dgopt.solver,dgmodel[idg][pq]));
+                for i,c in enumerate(corr):
+                  if is_null(mm[i]):
+                    mm[i] = c if is_null(c) else c.copy();
+                  else:
+                    mm[i] += c;
+          else:
+            # loop over all diffgains and iterate each set once
+            for idg,dgopt in enumerate(self.dgopts):
+              # we want to solve for dE1 minimizing D=G.(M0+dE1.M1.dE1^H+dE2.M2.dE2^H+...).G^H
+              # which is the same as G^{-1}.D.G^{-H} = M0 + dE1.M1.dE1^H + dE2.M2.dE2^H + ...
+              # which is the same as D_corr - (M0 + dE1.M1.dE1^H + dE2.M2.dE2^H + ...) + dE1.M1.dE1^H = dE1.M1.dE1^H
+              # which is the same as D_corr - full_model_old                           + model1_old   = model1
+              # at this point, data is D_corr - full_model_old
+              # so, add model1_old to data, and fit model1 to it
+              # dgmodel_corr always contains the modelN_old values
+              report_prec = False
+              for pq in solvable_ifrs:
+                if not report_prec:
+                  dprintf(2,"%s %s data type of dgmodel is %s\n",dgopt.label,pq,dgmodel[idg][pq][0].dtype)
+                corr = dgopt.solver.apply(dgmodel[idg],pq,out=self._work_matrix(dgopt.solver,dgmodel[idg][pq]));
+                ##dgm: corr = dgmodel_corr[idg][pq];
+                if not report_prec:
+                  dprintf(2,"%s %s data type of corrected is %s\n",dgopt.label,pq,corr[0].dtype)
+                  report_prec = True
+                for (c,dd) in zip(corr,data[pq]):
+                  dd += c;
+              if ( idg == self.dump_diffgain or self.dump_diffgain == -1 ) and \
+                ( domain_id == self.dump_domain or self.dump_domain == -1 ):
+                dump_data_model(dgmodel[idg],data,solvable_ifrs,"dump_E%d-%d.txt"%(idg,nmajor));
+              # iterate this diffgain solution
+              self.check_finiteness(data,"data after DG%d added in"%idg,bitflags);
+              flagged = self.run_gain_solution(dgopt,dgmodel[idg],data,weight,bitflags,flag_null_gains=False,looptype=looptype);
+              # now, add to model1 to model, and subtract back from data if needed
+              for pq in solvable_ifrs:
+                corr = dgopt.solver.apply(dgmodel[idg],pq);
+                #dgm: corr = dgmodel_corr[idg][pq] = dgopt.solver.apply(dgmodel[idg],pq,cache=True);
+                for i,(c,mm,dd) in enumerate(zip(corr,model[pq],data[pq])):
+                  if is_null(mm):
+                    model[i] = c;
+                  else:
+                    mm += c;
+                  if idg<num_diffgains-1:
+                    dd -= c;
           # at end of loop over diffgains:
           # model already contains an up-to-date model with dEs applied
           
@@ -872,9 +1028,13 @@ class StefCalNode (pynode.PyNode):
         mm = model[pq] = model0[pq];
         for idg,dg in enumerate(self.dgopts):
           #dgm: corr = dgmodel_corr[idg][pq] = dg.solver.apply(dgmodel[idg],pq,cache=True);
-          corr = dg.solver.apply(dgmodel[idg],pq);
+          corr = dg.solver.apply(dgmodel[idg],pq,out=self._work_matrix(dg.solver,dgmodel[idg][pq]));
           for i,c in enumerate(corr):
-            mm[i] += c;
+            # corr is a scratch matrix, so copy it rather than keep a reference
+            if is_null(mm[i]):
+              mm[i] = c if is_null(c) else c.copy();
+            else:
+              mm[i] += c;
       # apply corrections to missing baselines in data
       data1 = initdata;
       for opt in self.gainopts:
@@ -883,9 +1043,10 @@ class StefCalNode (pynode.PyNode):
                     for pq in missing_ifrs ]);
       data.update(data1);
       dprint(1,"saving solutions");        
-      for opt in self.gainopts+self.dgopts:
-        opt.save_values();
-      GainOpts.flush_tables();
+      with prof.phase("flush"):
+        for opt in self.gainopts+self.dgopts:
+          opt.save_values(domain=(time0,time1,freq0,freq1));
+        GainOpts.flush_tables();
     # endif not skip_solve
     else:
       # no solve -- simply apply corrections to data
@@ -906,7 +1067,7 @@ class StefCalNode (pynode.PyNode):
     # remember init value for next tile
     if self.init_from_previous:
       for opt in self.gainopts+self.dgopts:
-        opt.update_initval();
+        opt.update_initval(domain=(time0,time1,freq0,freq1));
     
     dprint(1,"checking flagging");  
     # check for excessive flagging
@@ -1013,77 +1174,96 @@ class StefCalNode (pynode.PyNode):
     variance = {};
     nvells = 0;
     dprint(1,"computing result");
-    for pq in self._ifrs:
-      dd = corrdata.get(pq);
-      mm = model.get(pq);
-      if mm is None:
-        for i in range(4):
-          vs = datares.vellsets[nvells];
-          if getattr(vs,'value',None) is not None:
-            fl = getattr(vs,'flags',None);
-            if fl is None:
-              fl = vs.flags = meq.flags(datashape);
-            else:
-              fl = vs.flags = fl.copy()
-            fl[...] |= self.output_flag_bit;
-          nvells += 1;
-        continue;
-      else:
-        if self.residuals:
-          out = [ d-m for d,m in zip(dd,mm) ];
-#          out = mm  ### write model!
-#          if pq == pq00:
-#            dprint(0,"***DEBUG*** residuals:",pq00,out[0][DEBUG_SLICE])
-        else:
-          out = dd;
-          # subtract dE'd sources, if so specified
-          if self.subtract_dgsrc:
-            for idg,dg in enumerate(self.dgopts):
-              corr = dg.solver.apply(dgmodel[idg],pq);
-              for d,m in zip(out,corr):
-                d -= m;
-            #dgm: for idg,dgcorr in enumerate(dgmodel_corr):
-            #dgm:   for d,m in zip(out,dgcorr[pq]):
-            #dgm:     d -= m;
-        # get flagmask, clear prior flags
-        flagmask = bitflags.get(pq);
-        # clear prior flags
-        if flagmask is not None:
-          flagmask &= ~FPRIOR;
-          if self.downsample_output and downsampler and not numpy.isscalar(flagmask):
-            flagmask = downsampler.expand_subshape(flagmask);
-          if not flagmask.any():
-            flagmask = None;
-        for n,x in enumerate(out):
-          if self.downsample_output and downsampler and not numpy.isscalar(x):
-            x = downsampler.expand_subshape(x);
-          vs = datares.vellsets[nvells];
-          val = getattr(vs,'value',None);
-          if val is not None:
-            vs.value = val = val.copy()
-            try:
-              val[...] = x[expanded_dataslice] if expanded_dataslice \
-                and not is_null(x) else x;
-            except:
-              print(x,getattr(x,'shape',None));
-          if not is_null(flagmask) and self.output_flag_bit:
-            newflags = (flagmask!=0);
-            nnew = newflags.sum();
-            if nnew:
-              counts = [];
-              for bit,label in (FINSUFF,"n/d"),(FNOCONV,"n/c"),(FCHISQ,"chi2"),(FSOLOOB,"oob"):
-                nf = ((flagmask&bit)!=0).sum();
-                if nf:
-                  counts.append("%s: %d"%(label,nf));
-              dprint(3,"generated %d new flags in baseline %s-%s (%s)"%(nnew,pq[0],pq[1]," ".join(counts)));
+    with prof.phase("output"):
+      # the old values are completely overwritten, so rather than copying them, new values are written into
+      # a single block of storage, allocated here for all vellsets of the result
+      values = [ getattr(vs,'value',None) for vs in datares.vellsets ];
+      value0 = ([ val for val in values if val is not None and not numpy.isscalar(val) ] or [None])[0];
+      outblock = value0 is not None and numpy.empty((len(values),)+value0.shape,value0.dtype);
+      for pq in self._ifrs:
+        dd = corrdata.get(pq);
+        mm = model.get(pq);
+        if mm is None:
+          for i in range(4):
+            vs = datares.vellsets[nvells];
+            if getattr(vs,'value',None) is not None:
               fl = getattr(vs,'flags',None);
               if fl is None:
                 fl = vs.flags = meq.flags(datashape);
               else:
                 fl = vs.flags = fl.copy()
-              fl[newflags if expanded_dataslice is None else newflags[expanded_dataslice]] |=  self.output_flag_bit;
-          # compute stats
-          nvells += 1;
+              fl[...] |= self.output_flag_bit;
+            nvells += 1;
+          continue;
+        else:
+          # residuals are subtracted straight into the output vellsets below, unless they need to be resampled first
+          resample_output = self.downsample_output and downsampler;
+          if self.residuals:
+            out = [ d-m for d,m in zip(dd,mm) ] if resample_output else list(zip(dd,mm));
+  #          out = mm  ### write model!
+  #          if pq == pq00:
+  #            dprint(0,"***DEBUG*** residuals:",pq00,out[0][DEBUG_SLICE])
+          else:
+            out = dd;
+            # subtract dE'd sources, if so specified
+            if self.subtract_dgsrc:
+              for idg,dg in enumerate(self.dgopts):
+                corr = dg.solver.apply(dgmodel[idg],pq,out=self._work_matrix(dg.solver,dgmodel[idg][pq]));
+                for d,m in zip(out,corr):
+                  d -= m;
+              #dgm: for idg,dgcorr in enumerate(dgmodel_corr):
+              #dgm:   for d,m in zip(out,dgcorr[pq]):
+              #dgm:     d -= m;
+          # get flagmask, clear prior flags
+          flagmask = bitflags.get(pq);
+          # clear prior flags
+          if flagmask is not None:
+            flagmask &= ~FPRIOR;
+            if self.downsample_output and downsampler and not numpy.isscalar(flagmask):
+              flagmask = downsampler.expand_subshape(flagmask);
+            if not flagmask.any():
+              flagmask = None;
+          for n,x in enumerate(out):
+            if resample_output and not numpy.isscalar(x):
+              x = downsampler.expand_subshape(x);
+            vs = datares.vellsets[nvells];
+            val = getattr(vs,'value',None);
+            if val is not None:
+              val0 = val;
+              if value0 is not None and getattr(val0,'shape',None) == value0.shape and val0.dtype == value0.dtype:
+                val = outblock[nvells];
+              else:
+                val = numpy.array(val0,copy=True);
+              vs.value = val;
+              try:
+                if type(x) is tuple:
+                  d,m = [ y[expanded_dataslice] if expanded_dataslice and not is_null(y) else y for y in x ];
+                  numpy.subtract(d,m,out=val);
+                else:
+                  val[...] = x[expanded_dataslice] if expanded_dataslice \
+                    and not is_null(x) else x;
+              except ValueError:
+                # shape mismatch: keep the old value
+                print(x,getattr(x,'shape',None));
+                val[...] = val0;
+            if not is_null(flagmask) and self.output_flag_bit:
+              newflags = (flagmask!=0);
+              nnew = newflags.sum();
+              if nnew:
+                counts = [];
+                for bit,label in (FINSUFF,"n/d"),(FNOCONV,"n/c"),(FCHISQ,"chi2"),(FSOLOOB,"oob"):
+                  nf = ((flagmask&bit)!=0).sum();
+                  if nf:
+                    counts.append("%s: %d"%(label,nf));
+                dprint(3,"generated %d new flags in baseline %s-%s (%s)"%(nnew,pq[0],pq[1]," ".join(counts)));
+                fl = getattr(vs,'flags',None);
+                if fl is None:
+                  fl = vs.flags = meq.flags(datashape);
+                else:
+                  fl = vs.flags = fl.copy()
+                fl[newflags if expanded_dataslice is None else newflags[expanded_dataslice]] |=  self.output_flag_bit;
+            # compute stats
+            nvells += 1;
     dprint(1,"computing result: done");
 
     # if last domain, then write ifr gains to file
@@ -1111,7 +1291,12 @@ class StefCalNode (pynode.PyNode):
       # save
       if self.save_ifr_gains:
         try:
-          pickle.dump(self.ifr_gain,open(self.ifr_gain_table,'wb'),2);
+          if self.ifr_gain_table_format == FORMAT_CHUNKED:
+            table = GainTable(self.ifr_gain_table,create=True);
+            table.append("ifr","ifrgains",self.ifr_gain);
+            table.flush();
+          else:
+            pickle.dump(self.ifr_gain,open(self.ifr_gain_table,'wb'),2);
           dprint(1,"saved %d ifr gains to %s"%(len(self.ifr_gain),self.ifr_gain_table));
         except:
           traceback.print_exc();
@@ -1125,123 +1310,177 @@ class StefCalNode (pynode.PyNode):
     return datares;
 
   def compute_noise (self,data,bitflags):
-    """Computes delta-std and weights of data""";
-    noise = {};
-    weight = {};
-    sumweight = 0;
-    nweight = 0;
-    # make null-flag array
-    dfshape = list(self._expanded_datashape);
-    dfshape[0] -= 1;
-    alltrue = numpy.ones(dfshape,bool);
-    allfalse = numpy.zeros(dfshape,bool);
-    # loop over data
-    for pq,dd in data.items():
-      flag = bitflags.get(pq);
-      if not is_null(flag):
-        flag = (flag!=0);
-        dflag = flag[1:,...]|flag[:-1,...];
-        dvalid = ~dflag;
-      else:
-        dflag,dvalid = allfalse,alltrue;
-      # number of valid slots (per channel, or in total)
-      num_valid = dvalid.sum(0) if self.noise_per_chan else dvalid.sum();
-      vv2 = [];
-      for d in dd:
-        if is_null(d):
-          vv2.append(0);
+    """Computes delta-std and weights of data.
+    Forward differences are stacked into (Nbaselines,4,...) blocks, and reduced in one vectorized pass per block""";
+    with self._profiler.phase("noise"):
+      noise = {};
+      weight = {};
+      dfshape = list(self._expanded_datashape);
+      dfshape[0] -= 1;
+      dfshape = tuple(dfshape);
+      for block in _baseline_blocks(sorted(data.keys()),4*reduce(operator.mul,dfshape)):
+        nb = len(block);
+        isnull = numpy.array([ [ is_null(d) for d in data[pq] ] for pq in block ]);
+        # weights are returned in the precision of the data, but the sums are always accumulated in double
+        rdtype = [ numpy.float64 ]*nb;
+        dtype = numpy.complex64;
+        for k,pq in enumerate(block):
+          for d,null in zip(data[pq],isnull[k]):
+            if not null:
+              rdtype[k] = d.real.dtype;
+              dtype = numpy.promote_types(dtype,d.dtype);
+        # flags of the forward differences
+        dflag = numpy.zeros((nb,)+dfshape,bool);
+        for k,pq in enumerate(block):
+          flag = bitflags.get(pq);
+          if not is_null(flag):
+            flag = (flag!=0);
+            numpy.logical_or(flag[1:,...],flag[:-1,...],out=dflag[k]);
+        # number of valid slots (per channel, or in total)
+        num_valid = (~dflag).sum(1) if self.noise_per_chan else (~dflag).reshape((nb,-1)).sum(1);
+        # take forward difference, null at flagged points
+        delta = numpy.zeros((nb,4)+dfshape,dtype);
+        for k,pq in enumerate(block):
+          for i,d in enumerate(data[pq]):
+            if not isnull[k,i]:
+              numpy.subtract(d[1:,...],d[:-1,...],out=delta[k,i]);
+        numpy.copyto(delta,0,where=dflag[:,numpy.newaxis,...]);
+        # take squared real and imaginary parts of this
+        # sum them, since taking the difference reduces the noise by sqrt(2); so the
+        # squared-mean-diff is a factor of 2 higher
+        d2 = numpy.square(delta.real);
+        d2 += numpy.square(delta.imag);
+        delta = None;
+        if self.noise_per_chan:
+          v2 = d2.sum(2,dtype=numpy.float64);
+          nv = num_valid[:,numpy.newaxis,...];
         else:
-          # take forward difference, null at flagged points
-          delta = d[1:,...]-d[:-1,...];
-          delta[dflag] = 0;
-          # take squared real and imaginary parts of this
-          # sum them, since taking the difference reduces the noise by sqrt(2); so the
-          # squared-mean-diff is a factor of 2 higher
-          if self.noise_per_chan:
-            v2 = (numpy.square(delta.real).sum(0) + numpy.square(delta.imag).sum(0))/num_valid;
-            v2[num_valid==0] = 0;
-            vv2.append(v2[numpy.newaxis,:]);
-          else:
-            v2 = (numpy.square(delta.real).sum() + numpy.square(delta.imag).sum())/num_valid if num_valid else 0;
-            vv2.append(v2);
-      # convert to weight
-      # if XY/YX is well-defined, use it, else use the XX/YY estimates
-      if self.use_polarizations_for_noise and not is_null(vv2[1]) and not is_null(vv2[2]):
-        n = noise[pq] = numpy.sqrt((vv2[1]+vv2[2])/2);
-        w = weight[pq] = 1/n;
-        w[n==0] = 0; 
-      elif not is_null(vv2[0]) and not is_null(vv2[3]):
-        n = noise[pq] = numpy.sqrt((vv2[0]+vv2[3])/2);
-        w = weight[pq] = 1/n;
-        if numpy.isscalar(n):
-          if n == 0:
-            w = 0;
-        else:
-          w[n==0] = 0; 
-      else:
-        n,w = 0,0;
-    ## normalize weights ## NB why? what was I thinking?
-    #if nweight:
-      #meanweight = sumweight/nweight;
-      #for pq,w in weight.iteritems():
-        #weight[pq] = w/meanweight;
+          v2 = d2.reshape((nb,4,-1)).sum(2,dtype=numpy.float64);
+          nv = num_valid[:,numpy.newaxis];
+        d2 = None;
+        with numpy.errstate(divide='ignore',invalid='ignore'):
+          v2 /= nv;
+        v2[numpy.broadcast_to(nv==0,v2.shape)] = 0;
+        v2[isnull] = 0;
+        # null estimates (same as is_null() on the per-baseline values)
+        v2null = isnull | ( (v2.reshape((nb,4,-1)).shape[-1] == 1) & (v2.reshape((nb,4,-1))[...,0] == 0) );
+        # convert to weight
+        # if XY/YX is well-defined, use it, else use the XX/YY estimates
+        usepol = ~(v2null[:,1]|v2null[:,2]) if self.use_polarizations_for_noise else numpy.zeros(nb,bool);
+        usepar = ~usepol & ~(v2null[:,0]|v2null[:,3]);
+        n = numpy.sqrt(numpy.where(usepol.reshape((nb,)+(1,)*(v2.ndim-2)),v2[:,1]+v2[:,2],v2[:,0]+v2[:,3])/2);
+        with numpy.errstate(divide='ignore'):
+          w = 1/n;
+        w[n==0] = 0;
+        for k,pq in enumerate(block):
+          if usepol[k] or usepar[k]:
+            if self.noise_per_chan:
+              noise[pq] = n[k][numpy.newaxis,...];
+              weight[pq] = w[k][numpy.newaxis,...].astype(rdtype[k]);
+            else:
+              noise[pq] = n[k];
+              weight[pq] = w[k].astype(rdtype[k]);
+      ## normalize weights ## NB why? what was I thinking?
+      #if nweight:
+        #meanweight = sumweight/nweight;
+        #for pq,w in weight.iteritems():
+          #weight[pq] = w/meanweight;
     
-    if _verbosity.verbose>3:
-      dprint(4,"noise estimates by baseline:");
-      from past.builtins import cmp
-      from functools import cmp_to_key
-      npq = sorted([ (n,pq) for pq,n in noise.items() ],key=cmp_to_key(lambda x,y:cmp(numpy.mean(x[0]),numpy.mean(y[0]))));
-      for n,pq in npq:
-        dprint(4,"  %s-%s"%pq," ".join(["%.2g"%float(x) for x in n.ravel()[:20]]));
+      if _verbosity.verbose>3:
+        dprint(4,"noise estimates by baseline:");
+        from past.builtins import cmp
+        from functools import cmp_to_key
+        npq = sorted([ (n,pq) for pq,n in noise.items() ],key=cmp_to_key(lambda x,y:cmp(numpy.mean(x[0]),numpy.mean(y[0]))));
+        for n,pq in npq:
+          dprint(4,"  %s-%s"%pq," ".join(["%.2g"%float(x) for x in n.ravel()[:20]]));
         
     return noise,weight;
 
+  def _work_matrix (self,solver,matrix):
+    """Returns a flat 4-list of scratch arrays of the current expanded data shape, to receive the result of
+    applying the given gain solver to matrix. The dtype is taken from both, so that double-precision terms are
+    not truncated when other terms are in single precision. The arrays are allocated once per shape and dtype
+    and reused, so their contents are only valid until the next call.""";
+    shape = tuple(self._expanded_datashape);
+    key = shape,_result_dtype([solver],[matrix]);
+    mat = self._work_matrices.get(key);
+    if mat is None:
+      # drop scratch arrays of any previous shape
+      self._work_matrices = dict([ (k,m) for k,m in self._work_matrices.items() if k[0] == shape ]);
+      mat = self._work_matrices[key] = [ numpy.empty(shape,key[1]) for i in range(4) ];
+    return mat;
+
   def compute_chisq (self,model,data,gain,weight=None,bitflags={}):
-    # per-slot normalized and unnormalized chisq
-    chisq0 = numpy.zeros(self._expanded_datashape);
-    chisq1 = numpy.zeros(self._expanded_datashape);
-    # nterms: per-slot number of terms in chi-sq sum
-    nterms = numpy.zeros(self._expanded_datashape,int);
-    # loop over all IFRS
-    for pq in self._solvable_ifrs:
-      if pq not in data:
-        continue;
-      res = gain.residual(model,data,pq);
-      w = weight.get(pq,1)**2 if weight else 1;
-#      fmask = reduce(operator.or_,[(d==0)&(m==0) for (d,m) in zip(data[pq],model[pq])]);
-      fmask = bitflags.get(pq);
-      fmask = fmask is not None and (fmask!=0);
-      # n0 is the nominal number of t/f slots for which we expect to have a residual
-      n0 = self._datasize - ((fmask&self._expansion_mask).sum() if not is_null(fmask) else 0);
-      for ir,r in enumerate(res):
-        if not is_null(r):
-          # fin is a mask of finite residuals, in unflagged slots
-          # in principle all unflagged residuals ought to be finite, but I'm covering
-          # my ass here in case of some pathologies/bugs
-          fin = numpy.isfinite(r);
-          if not is_null(fmask):
-            fin &= ~fmask;
-          # n is the number of slots for which we have a finite, unflagged residual
-          n = fin.sum();
-          if n < n0:
-            dprintf(4,"%s element %d: %d/%d slots are unexpectedly INF/NAN, omitting from chisq sum\n",pq,ir,n0-n,n0);
-          # add residual to chisq sum
-          if n:
-            rsq = (r*numpy.conj(r)).real;
-            chisq0[fin] += (rsq*w)[fin];
-            chisq1[fin] += (rsq)[fin];
-            nterms[fin] += 2;  # each slot contributes two terms (real and imag)
-    # ok chisq0 and chisq1 contain the per-slot chi-squares. Take their mean
-    tot_terms = nterms.sum();
-    if tot_terms:
-      chisq0sum = float(chisq0.sum())/tot_terms;
-      chisq1sum = float(chisq1.sum())/tot_terms;
-      mask = nterms>0;
-      norm = nterms;
-      chisq0[mask] /= norm[mask];
-      chisq1[mask] /= norm[mask];
-    else:
-      chisq0sum = chisq1sum = 0;
+    """Computes the chi-square of the residuals given by the gain solver.
+    Residuals are computed into stacked (Nbaselines,4,...) blocks, and reduced in one vectorized pass per block.
+    Returns the overall weighted and unweighted chi-square, plus the corresponding per-slot arrays.
+    The per-antenna breakdown of the (unweighted) chi-square is stored in self.chisq_per_antenna""";
+    with self._profiler.phase("chisq",gain.opts.label):
+      shape = tuple(self._expanded_datashape);
+      # per-slot normalized and unnormalized chisq
+      chisq0 = numpy.zeros(shape);
+      chisq1 = numpy.zeros(shape);
+      # nterms: per-slot number of terms in chi-sq sum
+      nterms = numpy.zeros(shape,int);
+      # per-antenna sums
+      antsum = {};
+      antterms = {};
+      ifrs = [ pq for pq in self._solvable_ifrs if pq in data ];
+      blocks = _baseline_blocks(ifrs,4*reduce(operator.mul,shape));
+      # residuals are computed in the precision of the gain term and the data, so that double-precision terms
+      # are not truncated when use_float_di is set
+      resdtype = _result_dtype([gain],[ data[pq] for pq in ifrs ]);
+      resbuf = numpy.empty((max([len(block) for block in blocks] or [0]),4)+shape,resdtype);
+      for block in blocks:
+        nb = len(block);
+        res = resbuf[:nb];
+        valid = numpy.zeros((nb,4),bool);
+        fmask = numpy.zeros((nb,)+shape,bool);
+        w2 = numpy.ones((nb,)+shape);
+        for k,pq in enumerate(block):
+          r = gain.residual(model,data,pq,out=list(res[k]));
+          valid[k] = [ not is_null(x) for x in r ];
+          fl = bitflags.get(pq);
+          if not is_null(fl):
+            fmask[k] = (fl!=0);
+          if weight:
+            w2[k] = weight.get(pq,1)**2;
+        rsq = numpy.square(res.real);
+        rsq += numpy.square(res.imag);
+        # fin is a mask of finite residuals, in unflagged slots
+        # in principle all unflagged residuals ought to be finite, but I'm covering
+        # my ass here in case of some pathologies/bugs
+        fin = numpy.isfinite(rsq);
+        fin &= ~fmask[:,numpy.newaxis,...];
+        fin &= valid.reshape((nb,4)+(1,)*len(shape));
+        if _verbosity.verbose > 3:
+          # n0 is the nominal number of t/f slots for which we expect to have a residual
+          n0 = self._datasize - (fmask&self._expansion_mask).reshape((nb,-1)).sum(1);
+          n = fin.reshape((nb,4,-1)).sum(2);
+          for k,ir in zip(*numpy.where(valid&(n<n0[:,numpy.newaxis]))):
+            dprintf(4,"%s element %d: %d/%d slots are unexpectedly INF/NAN, omitting from chisq sum\n",block[k],ir,n0[k]-n[k,ir],n0[k]);
+        # add residuals to chisq sums
+        numpy.copyto(rsq,0,where=~fin);
+        chisq0 += (rsq*w2[:,numpy.newaxis,...]).sum((0,1),dtype=numpy.float64);
+        chisq1 += rsq.sum((0,1),dtype=numpy.float64);
+        nterms += 2*fin.sum((0,1));   # each slot contributes two terms (real and imag)
+        for pq,x,n in zip(block,rsq.reshape((nb,-1)).sum(1,dtype=numpy.float64),2*fin.reshape((nb,-1)).sum(1)):
+          for p in pq:
+            antsum[p] = antsum.get(p,0) + x;
+            antterms[p] = antterms.get(p,0) + n;
+      self.chisq_per_antenna = dict([ (p,antsum[p]/antterms[p]) for p in antsum if antterms[p] ]);
+      dprint(4,"chisq per antenna:"," ".join([ "%s:%.3g"%(p,x) for p,x in sorted(self.chisq_per_antenna.items()) ]));
+      # ok chisq0 and chisq1 contain the per-slot chi-squares. Take their mean
+      tot_terms = nterms.sum();
+      if tot_terms:
+        chisq0sum = float(chisq0.sum())/tot_terms;
+        chisq1sum = float(chisq1.sum())/tot_terms;
+        mask = nterms>0;
+        norm = nterms;
+        chisq0[mask] /= norm[mask];
+        chisq1[mask] /= norm[mask];
+      else:
+        chisq0sum = chisq1sum = 0;
     return chisq0sum,chisq1sum,chisq0,chisq1;
 
   def check_finiteness (self,data,label,bitflags,complete=False):
@@ -1268,8 +1507,148 @@ class StefCalNode (pynode.PyNode):
     else:
       bitflags[pq] = fmask;
 
+  def _get_solution_chunks (self,gopt):
+    """Splits the frequency axis into chunks that can be solved independently, for parallel solutions.
+    Returns list of (f0,f1) channel ranges, or None if the gain term cannot be split up.""";
+    if self.solve_processes < 2 or len(self._expanded_datashape) != 2:
+      return None;
+    # smoothing along frequency couples the solution intervals
+    if gopt.smoothing and len(gopt.smoothing) > 1 and gopt.smoothing[1]:
+      return None;
+    fint = gopt.subtiling[1];
+    nsol = self._expanded_datashape[1]//fint;
+    nchunks = min(self.solve_processes,nsol);
+    if nchunks < 2:
+      return None;
+    return [ (sols[0]*fint,(sols[-1]+1)*fint) for sols in numpy.array_split(numpy.arange(nsol),nchunks) ];
+
+  def _run_gain_solution_parallel (self,gopt,model,data,weight,bitflags,flag_null_gains,looptype,chunks):
+    """Runs a gain solution by farming out frequency chunks to a pool of forked worker processes.
+    The workers inherit the data via fork (i.e. the memory is shared copy-on-write), and return their gain
+    solutions, gain flags and bitflags, which are then merged back into the solver and the bitflags dict.""";
+    global _parallel_solution_args;
+    dprint(1,"solving for %s in %d frequency chunks using %d processes"%(gopt.label,len(chunks),self.solve_processes));
+    t0 = time.time();
+    _parallel_solution_args = self,(gopt,model,data,weight,bitflags,flag_null_gains,looptype),chunks;
+    try:
+      pool = multiprocessing.get_context('fork').Pool(min(self.solve_processes,len(chunks)));
+      try:
+        results = pool.map(_run_gain_solution_chunk,list(range(len(chunks))));
+      finally:
+        pool.close();
+        pool.join();
+    finally:
+      _parallel_solution_args = None;
+    # merge solutions and flags
+    fint = gopt.subtiling[1];
+    shapes = [ (gopt.solver.subshape[0],(f1-f0)//fint) for f0,f1 in chunks ];
+    gopt.solver.set_values(_merge_values([ values for flagged,values,gainflags,bf in results ],shapes));
+    gopt.solver.gainflags = _merge_values([ gainflags for flagged,values,gainflags,bf in results ],shapes);
+    for pq in set().union(*[ chunk_bitflags.keys() for flagged,values,gainflags,chunk_bitflags in results ]):
+      # make a new flag array, since the old one may be shared between baselines
+      bf = bitflags.get(pq);
+      bf = numpy.zeros(self._expanded_datashape,int) if bf is None or numpy.isscalar(bf) else bf.copy();
+      for (f0,f1),(flagged,values,gainflags,chunk_bitflags) in zip(chunks,results):
+        x = chunk_bitflags.get(pq);
+        if x is not None and not numpy.isscalar(x):
+          bf[:,f0:f1] = x;
+      bitflags[pq] = bf;
+    dprint(1,"%s solved in %.2fs"%(gopt.label,time.time()-t0));
+    return any([ flagged for flagged,values,gainflags,bf in results ]);
+
+  def _run_gain_solution_chunk (self,gopt,model,data,weight,bitflags,flag_null_gains,looptype,f0,f1):
+    """Runs a gain solution on channels f0:f1. Called in a worker process, so modifies node state freely.
+    Returns flagged,values,gainflags,bitflags for this chunk.""";
+    nf = self._expanded_datashape[1];
+    slc = (slice(None),slice(f0,f1));
+    fint = gopt.subtiling[1];
+    sslc = (slice(None),slice(f0//fint,f1//fint));
+    # slice inputs
+    model = _slice_values(model,slc);
+    data = _slice_values(data,slc);
+    weight = dict([ (pq,w[...,f0:f1] if getattr(w,'ndim',0) and w.shape[-1] == nf else w)
+                    for pq,w in weight.items() ]) if weight else weight;
+    bitflags = dict([ (pq,bf if numpy.isscalar(bf) else bf[slc].copy()) for pq,bf in bitflags.items() ]);
+    # adjust node state to the shape of the chunk. No nested parallelism, and no visualization
+    # from worker processes
+    self.solve_processes = 0;
+    self._set_ds_array = lambda field,array:None;
+    self._expanded_datashape = (self._expanded_datashape[0],f1-f0);
+    self._expansion_mask = self._expansion_mask[slc];
+    self._datasize = int(self._expansion_mask.sum());
+    # make solver for this chunk, starting from the current solutions
+    solver = gopt.solver;
+    original_datashape = (self._datashape[0],max(min(f1,self._datashape[1])-f0,0));
+    gopt.solver = gopt.impl_class(original_datashape,self._expanded_datashape,
+        gopt.subtiling,solver._solve_ifrs,opts=gopt,
+        force_subtiling=bool(self._downsample_subtiling),
+        verbose=_verbosity.verbose);
+    gopt.solver.set_values(_slice_values(solver.get_values(),sslc));
+    gopt.solver.gainflags = _slice_values(solver.gainflags,sslc);
+    flagged = self.run_gain_solution(gopt,model,data,weight,bitflags,flag_null_gains=flag_null_gains,looptype=looptype);
+    subshape = gopt.solver.subshape;
+    return flagged,_expand_values(gopt.solver.get_values(),subshape),_expand_values(gopt.solver.gainflags,subshape),bitflags;
+
+  def _run_diffgain_solutions (self,dgmodel,residual,weight,bitflags,looptype,solvable_ifrs):
+    """Jacobi-style diffgain update: solves for every diffgain against the same residual (plus that diffgain's
+    own current model contribution), so that the directions are independent of each other. If solve_processes
+    is 2 or more, the directions are farmed out to forked worker processes. Returns True if anything was flagged.""";
+    global _parallel_diffgain_args;
+    args = (dgmodel,residual,weight,bitflags,looptype,solvable_ifrs);
+    nproc = min(self.solve_processes,len(self.dgopts));
+    t0 = time.time();
+    if nproc >= 2:
+      dprint(1,"solving for %d diffgains using %d processes"%(len(self.dgopts),nproc));
+      _parallel_diffgain_args = self,args;
+      try:
+        pool = multiprocessing.get_context('fork').Pool(nproc);
+        try:
+          results = pool.map(_run_diffgain_solution,list(range(len(self.dgopts))));
+        finally:
+          pool.close();
+          pool.join();
+      finally:
+        _parallel_diffgain_args = None;
+    else:
+      results = [ self._run_diffgain_solution(idg,*args) for idg in range(len(self.dgopts)) ];
+    # set solutions, and merge in new flags
+    for dgopt,(flagged,values,gainflags,newflags) in zip(self.dgopts,results):
+      dgopt.solver.set_values(values);
+      dgopt.solver.gainflags = gainflags;
+      for pq,nf in newflags.items():
+        # make a new flag array, since the old one may be shared between baselines
+        bitflags[pq] = bitflags.get(pq,0)|nf;
+    dprint(1,"%d diffgains solved in %.2fs"%(len(self.dgopts),time.time()-t0));
+    return any([ flagged for flagged,values,gainflags,newflags in results ]);
+
+  def _run_diffgain_solution (self,idg,dgmodel,residual,weight,bitflags,looptype,solvable_ifrs,worker=False):
+    """Solves for diffgain idg against the residual plus its current model contribution. If worker is True,
+    this is called in a worker process, so modifies node state freely.
+    Returns flagged,values,gainflags,newflags, where newflags is a dict of bitflags raised by the solution.""";
+    dgopt = self.dgopts[idg];
+    if worker:
+      self.solve_processes = 0;
+      self._set_ds_array = lambda field,array:None;
+    data = {};
+    for pq in solvable_ifrs:
+      corr = dgopt.solver.apply(dgmodel[idg],pq,out=self._work_matrix(dgopt.solver,dgmodel[idg][pq]));
+      data[pq] = [ r+c for r,c in zip(residual[pq],corr) ];
+    bf = dict([ (pq,fl if numpy.isscalar(fl) else fl.copy()) for pq,fl in bitflags.items() ]);
+    flagged = self.run_gain_solution(dgopt,dgmodel[idg],data,weight,bf,flag_null_gains=False,looptype=looptype);
+    newflags = {};
+    for pq,fl in bf.items():
+      nf = fl&~bitflags.get(pq,0);
+      if numpy.any(nf):
+        newflags[pq] = nf;
+    return flagged,dgopt.solver.get_values(),dgopt.solver.gainflags,newflags;
+
   def run_gain_solution (self,gopt,model,data,weight,bitflags,flag_null_gains=False,looptype=0):
     """Runs a single gain solution loop to completion"""
+    chunks = self._get_solution_chunks(gopt);
+    if chunks:
+      # (the breakdown within worker processes is not recorded)
+      with self._profiler.phase("solve_parallel",gopt.label):
+        return self._run_gain_solution_parallel(gopt,model,data,weight,bitflags,flag_null_gains,looptype,chunks);
     flagged = False;
     gain_dchi = [];
     gain_maxdiffs = [];
@@ -1278,7 +1657,7 @@ class StefCalNode (pynode.PyNode):
     init_chisq,init_chisq_unnorm,init_chisq_arr,init_chisq_unnorm_arr = \
       self.compute_chisq(model,data,gopt.solver,weight=weight,bitflags=bitflags);
     self._set_ds_array('$init_chisq',init_chisq_arr);
-    lowest_chisq = (init_chisq,gopt.solver.get_values());
+    lowest_chisq = (init_chisq,gopt.solver.get_values(),self.chisq_per_antenna);
     lowest_chisq_iter = 0;
     num_diverged = 0;
     dprint(2,"solving for %s, initial chisq is %.12g"%(gopt.label,init_chisq));
@@ -1288,9 +1667,11 @@ class StefCalNode (pynode.PyNode):
     for niter in range(gopt.max_iter):
       # iterate over normal gains
       # bounds-flagging is enabled after iteration 3
-      converged,maxdiff,deltas,nflag = gopt.solver.iterate(model,data,bitflags,
-                                          niter=niter,weight=weight if gopt.weigh else None,
-                                          bounds=gopt.bounds if niter>2 else None);
+      with self._profiler.phase("iterate",gopt.label):
+        converged,maxdiff,deltas,nflag = gopt.solver.iterate(model,data,bitflags,
+                                            niter=niter,weight=weight if gopt.weigh else None,
+                                            bounds=gopt.bounds if niter>2 else None);
+      self._profiler.count("iterate",gopt.label);
       dprint(3,"iter %d: %.2f%% (%d/%d) conv, %d gfs, max update %g"%(
           niter+1,gopt.solver.num_converged*100./gopt.solver.real_slots,gopt.solver.num_converged,gopt.solver.real_slots,nflag,float(gopt.solver.delta_max)));
       gain_maxdiffs.append(float(maxdiff));
@@ -1337,7 +1718,7 @@ class StefCalNode (pynode.PyNode):
         # if chi-sq decreased, remember this
         if dchi >= 0:
           if chisq < lowest_chisq[0]:
-            lowest_chisq = (chisq,gopt.solver.get_values());
+            lowest_chisq = (chisq,gopt.solver.get_values(),self.chisq_per_antenna);
             lowest_chisq_iter = niter+1;
           num_diverged = 0;
           # and check for chisq-convergence
@@ -1373,7 +1754,7 @@ class StefCalNode (pynode.PyNode):
           chisq,chisq_unnorm,chisq_arr,chisq_unnorm_arr = self.compute_chisq(model,data,gopt.solver,weight=weight,bitflags=bitflags);
         rolled_back = True;
         self._set_ds_array('$high_discarded_chisq',chisq_arr);
-        chisq,gainvals = lowest_chisq;
+        chisq,gainvals,self.chisq_per_antenna = lowest_chisq;
         gopt.solver.set_values(gainvals);
     dprint(2,"  delta-chisq were"," ".join(["%.4g"%x for x in gain_dchi]));
     dprint(2,"  convergence criteria were"," ".join(["%.2g"%x for x in gain_maxdiffs]));
@@ -1410,8 +1791,13 @@ class StefCalNode (pynode.PyNode):
     #
     # implement chisq-based flagging
     #
+    dprint(2,"  final chisq per antenna:"," ".join([ "%s:%.3g"%(p,self.chisq_per_antenna[p])
+                                                    for p in self._antennas if p in self.chisq_per_antenna ]));
     if gopt.visualize:
       self._set_ds_array('$final_chisq',chisq_arr);
+      # in the order of self._antennas, 0 for antennas without data
+      self._set_ds_array('$final_chisq_per_antenna',
+                         numpy.array([ self.chisq_per_antenna.get(p,0.) for p in self._antennas ]));
     if gopt.flag_chisq:
       if False:  # flag on histogram and mean
         # make histogram of chisq values
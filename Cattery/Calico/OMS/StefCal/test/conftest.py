@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""Test setup for the StefCal solver classes.
+
+The solvers only use Timba.Meq.meq to create vells, which are numpy arrays on the Python side. If MeqTrees
+is not installed, a minimal numpy stand-in for that one module is registered, so that the solver math can be
+tested on its own. Tests of StefCalNode itself still need the real thing.""";
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import sys
+import types
+import numpy
+
+try:
+  from Timba.Meq import meq
+except ImportError:
+  meq = types.ModuleType("Timba.Meq.meq");
+  meq.complex_vells = lambda shape=(),value=0:numpy.full(shape,value,numpy.complex128);
+  meq.vells = lambda shape=(),value=0:numpy.full(shape,value,numpy.float64);
+  meq.flags = lambda shape=(),value=0:numpy.full(shape,value,numpy.int32);
+  meq.sca_vells = lambda value=0:numpy.array(value,numpy.float64);
+  timba = types.ModuleType("Timba");
+  timba.__path__ = [];
+  timba.Meq = types.ModuleType("Timba.Meq");
+  timba.Meq.__path__ = [];
+  timba.Meq.meq = meq;
+  sys.modules.update({ "Timba":timba,"Timba.Meq":timba.Meq,"Timba.Meq.meq":meq });
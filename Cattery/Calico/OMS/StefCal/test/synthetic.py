@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""Synthetic data sets for the StefCal solver tests: a random model, known gains, and a little noise""";
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import numpy
+
+NANT = 6
+DATASHAPE = (4,8)
+
+class SolverOpts (object):
+  """Minimal stand-in for the GainOpts attributes used by the solvers""";
+  def __init__ (self,use_float=False):
+    self.use_float = use_float;
+    self.real_only = False;
+    self.convergence_quota = 1;
+    self.epsilon = 1e-8;
+    self.smoothing = None;
+    self.average = 2;
+    self.omega = .5;
+    self.feed_forward = False;
+  def save_intermediate_values (self,niter):
+    pass;
+
+def crandn (rng,*shape):
+  return rng.standard_normal(shape) + 1j*rng.standard_normal(shape);
+
+def make_data (polarized,seed=42,noise=1e-3,diagonal=False):
+  """Returns antennas, ifrs, model and data dicts (in double precision) for a random set of true gains.
+  If diagonal is True, the off-diagonal correlations of model and data are null.""";
+  rng = numpy.random.default_rng(seed);
+  antennas = [ str(p) for p in range(NANT) ];
+  ifrs = [ (p,q) for i,p in enumerate(antennas) for q in antennas[i+1:] ];
+  # true gains: 2x2 matrices of shape datashape, diagonal if not polarized
+  gains = {};
+  for p in antennas:
+    g = [ 1+.1*crandn(rng,*DATASHAPE),.05*crandn(rng,*DATASHAPE),.05*crandn(rng,*DATASHAPE),1+.1*crandn(rng,*DATASHAPE) ];
+    if not polarized:
+      g[1] = g[2] = numpy.zeros(DATASHAPE,complex);
+    gains[p] = g;
+  model = {};
+  data = {};
+  for p,q in ifrs:
+    m = [ crandn(rng,*DATASHAPE) for i in range(4) ];
+    gp,gq = gains[p],gains[q];
+    # D = Gp*M*Gq^H
+    gm = [ gp[0]*m[0]+gp[1]*m[2],gp[0]*m[1]+gp[1]*m[3],gp[2]*m[0]+gp[3]*m[2],gp[2]*m[1]+gp[3]*m[3] ];
+    gqh = [ numpy.conj(gq[0]),numpy.conj(gq[2]),numpy.conj(gq[1]),numpy.conj(gq[3]) ];
+    d = [ gm[0]*gqh[0]+gm[1]*gqh[2],gm[0]*gqh[1]+gm[1]*gqh[3],gm[2]*gqh[0]+gm[3]*gqh[2],gm[2]*gqh[1]+gm[3]*gqh[3] ];
+    model[p,q] = m;
+    data[p,q] = [ x+noise*crandn(rng,*DATASHAPE) for x in d ];
+    if diagonal:
+      m[1] = m[2] = data[p,q][1] = data[p,q][2] = 0;
+  return antennas,ifrs,model,data;
+
+def solve (solver_class,model,data,ifrs,opts,niter=20,weight=None,subtiling=(1,1)):
+  """Creates a solver, and runs niter iterations of it""";
+  solver = solver_class(DATASHAPE,DATASHAPE,subtiling,set(ifrs),opts);
+  for i in range(niter):
+    solver.iterate(model,data,{},niter=i,weight=weight);
+  return solver;
+
+def chisq (solver,model,data,ifrs):
+  """Returns sum of |residual|^2 of the solution over all baselines""";
+  total = 0;
+  for pq in ifrs:
+    corr = solver.apply(model,pq);
+    total += sum([ numpy.sum(abs(c-d)**2) for c,d in zip(corr,data[pq]) ]);
+  return total;
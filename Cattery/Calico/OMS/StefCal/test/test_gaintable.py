@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""Round-trip and lookup checks for the chunked gain table format""";
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import os
+import pickle
+import pytest
+import numpy
+
+pytest.importorskip("Kittens")
+
+from Cattery.Calico.OMS.StefCal.GainTable import GainTable
+
+def _diag_gains (value):
+  return { ('0',0):numpy.full((2,3),value,numpy.complex64),('0',1):numpy.full((2,3),value,numpy.complex64) };
+
+def test_roundtrip_keeps_dtypes_and_scalars (tmp_path):
+  path = str(tmp_path/"gains");
+  table = GainTable(path,create=True);
+  table.append("G","GainDiag",_diag_gains(2));
+  table.append("J","Gain2x2",{ '0':(1,0,0,numpy.ones(3,numpy.float64)) });
+  table.flush();
+  table = GainTable(path);
+  assert sorted(table.labels()) == ["G","J"];
+  g = table.get("G");
+  assert g['0',0].dtype == numpy.complex64 and (g['0',0] == 2).all();
+  j = table.get("J");
+  assert j['0'][:3] == [1,0,0];
+  assert j['0'][3].dtype == numpy.float64;
+
+def test_flush_appends_and_replaces_by_domain (tmp_path):
+  path = str(tmp_path/"gains");
+  table = GainTable(path,create=True);
+  for i in range(4):
+    table.append("G","GainDiag",_diag_gains(i),domain=(i*10,i*10+10,1.,2.));
+    table.flush();
+  indexsize = os.path.getsize(os.path.join(path,GainTable.INDEX));
+  # a later tile with the same domain supersedes the earlier one
+  table.append("G","GainDiag",_diag_gains(99),domain=(10,20,1.,2.));
+  table.flush();
+  assert os.path.getsize(os.path.join(path,GainTable.INDEX)) > indexsize;
+  table = GainTable(path);
+  assert len(table.tiles("G")) == 4;
+  assert (table.get("G",(10,20,1.,2.))['0',0] == 99).all();
+  # lookup by containment of the first timeslot, and misses
+  assert (table.get("G",(25,28,1.,2.))['0',0] == 2).all();
+  assert table.get("G",(45,50,1.,2.),exact=True) is None;
+  assert table.get("G",(20,30,1.,3.),exact=True) is None;
+  # without exact=True, a miss falls back to the most recently saved tile
+  assert (table.get("G",(45,50,1.,2.))['0',0] == 99).all();
+
+def _tile_files (path):
+  return sorted([ f for f in os.listdir(path) if f.endswith(".npy") ]);
+
+def _index_records (path):
+  """Returns number of tile records in the index, including superseded ones""";
+  ff = open(os.path.join(path,GainTable.INDEX),"rb");
+  count = -1;
+  try:
+    while True:
+      pickle.load(ff);
+      count += 1;
+  except EOFError:
+    return count;
+  finally:
+    ff.close();
+
+def test_superseded_tiles_are_removed (tmp_path):
+  path = str(tmp_path/"gains");
+  for i in range(20):
+    table = GainTable(path,create=True);
+    table.append("ifr","ifrgains",_diag_gains(i));
+    table.append("G","GainDiag",_diag_gains(-i),domain=(0,10,1.,2.));
+    table.append("G","GainDiag",_diag_gains(i),domain=(10*i,10*i+10,3.,4.));
+    table.flush();
+    # one file each for the ifr tile, the (0,10,1,2) tile, and the i+1 tiles with distinct domains
+    assert len(_tile_files(path)) == i+3;
+    # the index is rewritten once most of its records are stale
+    assert _index_records(path) <= 2*(i+3);
+  table = GainTable(path);
+  assert (table.get("ifr")['0',0] == 19).all();
+  assert (table.get("G",(0,10,1.,2.))['0',0] == -19).all();
+  for i in range(20):
+    assert (table.get("G",(10*i,10*i+10,3.,4.),exact=True)['0',0] == i).all();
+  # the last tile saved is the default
+  assert (table.get("G")['0',0] == 19).all();
+
+def test_tile_names_stay_unique_after_rewriting_index (tmp_path):
+  path = str(tmp_path/"gains");
+  table = GainTable(path,create=True);
+  for i in range(10):
+    table.append("G","GainDiag",_diag_gains(i));
+    table.flush();
+  for i in range(10):
+    table.append("G","GainDiag",_diag_gains(i),domain=(i,i+1));
+    table.flush();
+  table = GainTable(path);
+  assert len(_tile_files(path)) == 11;
+  assert (table.get("G",None)['0',0] == 9).all();
+  for i in range(10):
+    assert (table.get("G",(i,i+1),exact=True)['0',0] == i).all();
+
+def test_solutions_are_writeable_copies (tmp_path):
+  path = str(tmp_path/"gains");
+  table = GainTable(path,create=True);
+  table.append("G","GainDiag",_diag_gains(1));
+  table.flush();
+  g = GainTable(path).get("G");
+  g['0',0][...] = 5;
+  g['0',0] *= 2;
+  assert (GainTable(path).get("G")['0',0] == 1).all();
+
+def test_legacy_pickle_is_migrated (tmp_path):
+  path = str(tmp_path/"gains");
+  struct = dict(description="stefcal gain solutions table",version=2,
+                gains=dict(G=dict(solutions=_diag_gains(3),implementation="GainDiag")));
+  pickle.dump(struct,open(path,"wb"),2);
+  with pytest.raises(IOError):
+    GainTable(path);
+  table = GainTable(path,create=True);
+  table.append("B","GainDiag",_diag_gains(4));
+  table.flush();
+  table = GainTable(path);
+  assert sorted(table.labels()) == ["B","G"];
+  assert table.get_implementation("G") == "GainDiag";
+  assert (table.get("G")['0',0] == 3).all();
+
+def test_legacy_ifr_pickle_is_replaced (tmp_path):
+  path = str(tmp_path/"ifrgains");
+  pickle.dump({ ('0','1'):[1,0,0,1] },open(path,"wb"),2);
+  table = GainTable(path,create=True);
+  table.append("ifr","ifrgains",{ ('0','1'):[2,0,0,2] });
+  table.flush();
+  assert GainTable.is_chunked(path);
+  assert GainTable(path).get("ifr") == { ('0','1'):[2,0,0,2] };
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""Checks for the StefCal profiler: appended per-tile records, memory tracing and peak ownership""";
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import pytest
+import numpy
+
+pytest.importorskip("Kittens")
+tracemalloc = pytest.importorskip("tracemalloc")
+
+from Cattery.Calico.OMS.StefCal.Profiler import Profiler
+
+def test_dump_appends_tile_records (tmp_path):
+  filename = str(tmp_path/"profile.jsonl");
+  prof = Profiler();
+  try:
+    for tile in range(3):
+      prof.start_tile((tile,tile+1));
+      with prof.phase("total"):
+        with prof.phase("iterate","G"):
+          prof.count("iterate","G",5);
+      prof.dump(filename);
+  finally:
+    prof.close();
+  # one header line, then two records per tile
+  assert len(open(filename).readlines()) == 1+3*2;
+  summary = Profiler.load(filename);
+  assert summary['version'] == Profiler.FORMAT_VERSION;
+  assert summary['totals']['total']['calls'] == 3;
+  assert summary['totals']['iterate:G']['iterations'] == 15;
+
+def test_close_stops_tracing ():
+  if tracemalloc.is_tracing():
+    pytest.skip("tracemalloc already started elsewhere");
+  prof = Profiler();
+  assert tracemalloc.is_tracing();
+  prof.close();
+  assert not tracemalloc.is_tracing();
+
+def test_concurrent_profilers_do_not_reset_each_others_peak ():
+  prof1,prof2 = Profiler(),Profiler();
+  try:
+    prof1.start_tile((0,1));
+    prof2.start_tile((0,1));
+    token1 = prof1.start("total");
+    x = numpy.ones(1000000);
+    del x;
+    with prof2.phase("total"):
+      pass;
+    prof1.stop(token1);
+    # prof1 held the peak throughout, so it sees the 8MB array; prof2 could not measure a peak
+    assert prof1.stats[(0,1),"total",None]['peak'] >= 8000000;
+    assert prof2.stats[(0,1),"total",None]['peak'] is None;
+  finally:
+    prof2.close();
+    prof1.close();
+
+def test_dump_error_is_logged (tmp_path):
+  """A profile that cannot be written is reported, and does not fail the request""";
+  prof = Profiler(trace_memory=False);
+  prof.start_tile((0,1));
+  with prof.phase("total"):
+    pass;
+  # a directory cannot be opened for appending
+  prof.dump(str(tmp_path));
+  assert prof.stats == {};
+
+def test_phase_stopped_on_early_return ():
+  prof = Profiler(trace_memory=False);
+  prof.start_tile((0,1));
+  def request ():
+    with prof.phase("total"):
+      with prof.phase("unpack"):
+        return 1;
+  assert request() == 1;
+  assert prof._depth == 0;
+  assert prof.stats[(0,1),"total",None]['calls'] == 1;
+  assert prof.stats[(0,1),"unpack",None]['calls'] == 1;
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""Checks that StefCal gain solutions obtained in single precision agree with double precision ones.
+
+Runs the GainDiag and Gain2x2 iterate() loops on a synthetic data set (random model, known gains,
+a little noise), once with use_float on and once with it off, and compares the resulting gains.""";
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import pytest
+import numpy
+
+pytest.importorskip("scipy")
+pytest.importorskip("Kittens")
+
+from Cattery.Calico.OMS.StefCal.GainDiag import GainDiag
+from Cattery.Calico.OMS.StefCal.Gain2x2 import Gain2x2
+
+from synthetic import SolverOpts,make_data,solve
+
+# single-precision solutions must agree with double-precision ones to this relative accuracy
+TOLERANCE = 1e-4
+
+def _solve (solver_class,use_float,polarized):
+  antennas,ifrs,model,data = make_data(polarized);
+  if use_float:
+    model = dict([ (pq,[ x.astype(numpy.complex64) for x in m ]) for pq,m in model.items() ]);
+    data = dict([ (pq,[ x.astype(numpy.complex64) for x in d ]) for pq,d in data.items() ]);
+  return solve(solver_class,model,data,ifrs,SolverOpts(use_float));
+
+def _check_solutions (gain_single,gain_double):
+  assert set(gain_single.keys()) == set(gain_double.keys());
+  for key,g1 in gain_single.items():
+    g2 = gain_double[key];
+    if isinstance(g1,(list,tuple)):
+      pairs = list(zip(g1,g2));
+    else:
+      pairs = [(g1,g2)];
+    for x1,x2 in pairs:
+      x1,x2 = numpy.asarray(x1),numpy.asarray(x2);
+      assert numpy.isfinite(x1).all();
+      numpy.testing.assert_allclose(x1.astype(numpy.complex128),x2,rtol=TOLERANCE,atol=TOLERANCE);
+
+def test_gaindiag_single_vs_double ():
+  single = _solve(GainDiag,True,polarized=False);
+  double = _solve(GainDiag,False,polarized=False);
+  assert all([ g.dtype == numpy.complex64 for g in single.gain.values() ]);
+  _check_solutions(single.gain,double.gain);
+
+def test_gain2x2_single_vs_double ():
+  single = _solve(Gain2x2,True,polarized=True);
+  double = _solve(Gain2x2,False,polarized=True);
+  assert all([ g.dtype == numpy.complex64 for gmat in single.gain.values() for g in gmat if isinstance(g,numpy.ndarray) ]);
+  _check_solutions(single.gain,double.gain);
+
+@pytest.mark.parametrize("use_float",[False,True])
+def test_gaindiag_antenna_without_data (use_float):
+  """An antenna with no valid baselines keeps its gains, without 0/0 divisions""";
+  antennas,ifrs,model,data = make_data(False);
+  dead = antennas[-1];
+  for pq in ifrs:
+    if dead in pq:
+      model[pq] = data[pq] = [0,0,0,0];
+  with numpy.errstate(divide='raise',invalid='raise'):
+    solver = solve(GainDiag,model,data,ifrs,SolverOpts(use_float),niter=2);
+  for i in range(2):
+    assert (solver.gain[dead,i] == 1).all();
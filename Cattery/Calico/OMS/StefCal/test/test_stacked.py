@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""Checks that the stacked-array solvers give the same solutions as the per-baseline ones they replace""";
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import pytest
+import numpy
+
+pytest.importorskip("scipy")
+pytest.importorskip("Kittens")
+
+from Cattery.Calico.OMS.StefCal.GainDiag import GainDiag
+from Cattery.Calico.OMS.StefCal.GainDiagStacked import GainDiagStacked
+
+from synthetic import SolverOpts,make_data,solve,chisq
+
+@pytest.mark.parametrize("weight",[None,{}],ids=["none","empty"])
+def test_gaindiag_stacked_matches_gaindiag (weight):
+  """An empty weights dict (as returned by compute_noise() when all noise estimates are null) means unit weights""";
+  antennas,ifrs,model,data = make_data(False,diagonal=True);
+  ref = solve(GainDiag,model,data,ifrs,SolverOpts(),weight=weight);
+  stacked = solve(GainDiagStacked,model,data,ifrs,SolverOpts(),weight=weight);
+  chisq0 = chisq(ref,model,data,ifrs);
+  assert chisq(stacked,model,data,ifrs) == pytest.approx(chisq0,rel=1e-3);
+  # compare gains up to the overall phase ambiguity of the solutions
+  p0 = antennas[0];
+  for key,g in ref.gain.items():
+    g1 = stacked.gain[key]*stacked.gain[p0,key[1]].conj()/abs(stacked.gain[p0,key[1]]);
+    g0 = g*ref.gain[p0,key[1]].conj()/abs(ref.gain[p0,key[1]]);
+    numpy.testing.assert_allclose(g1,g0,rtol=1e-3,atol=1e-3);
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""Checks StefCalNode requests end to end: solutions obtained by solving frequency chunks, or diffgain directions,
+in parallel processes must match the ones obtained in one go, Jacobi-style diffgain solutions must match the
+(default) Gauss-Seidel ones where the two agree, and the published per-antenna chi-square must match the solution""";
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import os
+import sys
+import pytest
+import numpy
+
+pytest.importorskip("scipy")
+pytest.importorskip("Kittens")
+# StefCalNode is a PyNode, so this needs MeqTrees proper (the conftest stand-in only provides Timba.Meq.meq)
+pytest.importorskip("Timba.pynode")
+
+# StefCal imports its gain classes as Calico.OMS.StefCal.*, with the Cattery directory on the path
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))));
+
+from Timba.Meq import meq
+from Cattery.Calico.OMS.StefCal.StefCal import StefCalNode
+
+NANT = 5
+NTIME,NFREQ = 4,16
+
+class _Record (object):
+  """Plain attribute container standing in for the request and child result records""";
+  def __init__ (self,**kw):
+    self.__dict__.update(kw);
+
+def _make_inputs (seed=0,ndg=0):
+  """Returns list of "p:q" ifr names, 4*Nifr lists of data and model arrays for random diagonal gains, and a list
+  of ndg 4*Nifr lists of model arrays for directions that are also subject to random diagonal diffgains.
+  The diffgains are constant over the tile, and solved for with one solution per tile""";
+  rng = numpy.random.default_rng(seed);
+  shape = (NTIME,NFREQ);
+  crandn = lambda:rng.standard_normal(shape)+1j*rng.standard_normal(shape);
+  gains = [ (1+.1*crandn(),1+.1*crandn()) for p in range(NANT) ];
+  dgains = [ [ (1+.1*crandn()[0,0],1+.1*crandn()[0,0]) for p in range(NANT) ] for k in range(ndg) ];
+  ifrs,data,model,dgmodels = [],[],[],[ [] for k in range(ndg) ];
+  for p in range(NANT):
+    for q in range(p+1,NANT):
+      ifrs.append("%d:%d"%(p,q));
+      for i,j in (0,0),(0,1),(1,0),(1,1):
+        m = crandn();
+        model.append(m);
+        for k in range(ndg):
+          m1 = crandn();
+          dgmodels[k].append(m1);
+          m = m + dgains[k][p][i]*m1*numpy.conj(dgains[k][q][j]);
+        data.append(gains[p][i]*m*numpy.conj(gains[q][j])+.001*crandn());
+  return ifrs,data,model,dgmodels;
+
+def _run (tmp_path,solve_processes,ndg=0,order=None,**state):
+  """Runs one request through a StefCalNode, returns the node, the output visibilities, and the state fields
+  the node has published. If ndg>0, the model includes ndg directions subject to diffgains, given to the node
+  in the given order of directions.""";
+  ifrs,data,model,dgmodels = _make_inputs(ndg=ndg);
+  order = list(range(ndg)) if order is None else order;
+  defaults = dict(ifrs=ifrs,verbose=0,gain_enable=True,gain_implementation="GainDiag",gain_max_iter=20,
+                  gain_save=False,gain_table=str(tmp_path/"gain.cp"),apply_ifr_gains=False,
+                  solve_processes=solve_processes);
+  if ndg:
+    defaults.update(diffgain_labels=[ "S%d"%k for k in order ],diffgain_enable=True,
+                    diffgain_implementation="GainDiag",diffgain_max_iter=20,diffgain_save=False,
+                    diffgain_table=str(tmp_path/"diffgain.cp"),diffgain_subtiling=[NTIME,NFREQ]);
+  defaults.update(state);
+  state = defaults;
+  node = StefCalNode("stefcal_test",0);
+  # the node is not attached to a meqserver, so collect its state updates
+  published = {};
+  node.set_state = published.__setitem__;
+  node.update_state(lambda name,default:setattr(node,name,state.get(name,default)));
+  request = _Record(request_id=meq.requestid(domain_id=1),
+                    cells=_Record(domain=_Record(domain_id=(0,NTIME,1,NTIME,0,NFREQ,1,NFREQ))));
+  make_result = lambda values:_Record(dims=[len(ifrs),2,2],vellsets=[ meq.vellset(x.copy()) for x in values ]);
+  res = node.get_result(request,make_result(data),make_result(model),*[ make_result(dgmodels[k]) for k in order ]);
+  return node,[ numpy.array(vs.value) for vs in res.vellsets ],published;
+
+def _solve (tmp_path,solve_processes,**state):
+  """Runs one request through a StefCalNode, returns the gain solutions and the output visibilities""";
+  node,output,published = _run(tmp_path,solve_processes,**state);
+  return node.gainopts[0].solver.get_values(),output;
+
+@pytest.mark.parametrize("state",[
+    dict(gain_subtiling=[1,2]),
+    # downsampled data: the per-chunk solvers must be subtiled the same way as the full one
+    dict(gain_subtiling=[1,4],downsample_subtiling=[1,2]),
+    dict(gain_subtiling=[2,4],downsample_subtiling=[2,4]),
+  ])
+def test_chunked_solution_matches (tmp_path,state):
+  gains0,output0 = _solve(tmp_path,0,**state);
+  gains1,output1 = _solve(tmp_path,2,**state);
+  assert sorted(gains0.keys()) == sorted(gains1.keys());
+  for key,g0 in gains0.items():
+    numpy.testing.assert_allclose(gains1[key],g0,rtol=1e-9,atol=1e-12,err_msg=str(key));
+  for x1,x0 in zip(output1,output0):
+    numpy.testing.assert_allclose(x1,x0,rtol=1e-9,atol=1e-12);
+
+def test_final_chisq_per_antenna (tmp_path):
+  """The per-antenna chi-square of the final solution is published, and matches a brute-force computation""";
+  node,output,published = _run(tmp_path,0,rescale=False);
+  ifrs,data,model,dgmodels = _make_inputs();
+  pqs = [ tuple(ifr.split(":")) for ifr in ifrs ];
+  model = dict([ (pq,model[4*k:4*k+4]) for k,pq in enumerate(pqs) ]);
+  data = dict([ (pq,data[4*k:4*k+4]) for k,pq in enumerate(pqs) ]);
+  solver = node.gainopts[0].solver;
+  antsum = {};
+  for pq in pqs:
+    rsq = sum([ numpy.sum(abs(c-d)**2) for c,d in zip(solver.apply(model,pq),data[pq]) ]);
+    for p in pq:
+      antsum[p] = antsum.get(p,0) + rsq;
+  # each antenna is in NANT-1 baselines, and each complex value is two terms
+  nterms = 2*4*NTIME*NFREQ*(NANT-1);
+  expected = [ antsum[str(p)]/nterms for p in range(NANT) ];
+  numpy.testing.assert_allclose(published['$final_chisq_per_antenna'],expected,rtol=1e-6);
+  assert sorted(node.chisq_per_antenna.keys()) == [ str(p) for p in range(NANT) ];
+
+def _check_same_gains (opt1,opt0):
+  gains0,gains1 = opt0.solver.get_values(),opt1.solver.get_values();
+  assert sorted(gains0.keys()) == sorted(gains1.keys());
+  for key,g0 in gains0.items():
+    numpy.testing.assert_allclose(gains1[key],g0,rtol=1e-9,atol=1e-12,err_msg="%s %s"%(opt0.label,key));
+
+def test_diffgain_jacobi_parallel_matches_serial (tmp_path):
+  # one DI solution per timeslot, so that only the diffgains are solved in parallel
+  state = dict(ndg=3,diffgain_jacobi=True,num_major_loops=3,gain_subtiling=[1,NFREQ]);
+  node0,output0,published = _run(tmp_path,0,**state);
+  node1,output1,published = _run(tmp_path,2,**state);
+  assert len(node1.dgopts) == 3;
+  for opt1,opt0 in zip(node1.gainopts+node1.dgopts,node0.gainopts+node0.dgopts):
+    _check_same_gains(opt1,opt0);
+  for x1,x0 in zip(output1,output0):
+    numpy.testing.assert_allclose(x1,x0,rtol=1e-9,atol=1e-12);
+
+@pytest.mark.parametrize("solve_processes",[0,2])
+def test_diffgain_jacobi_matches_gauss_seidel (tmp_path,solve_processes):
+  """In the first major loop, the Gauss-Seidel update solves for the first direction against the same residual
+  that the Jacobi update solves every direction against. So with a single major loop, the Jacobi solution for
+  each direction must match the Gauss-Seidel one obtained with that direction ordered first""";
+  ndg = 3;
+  node,output,published = _run(tmp_path,solve_processes,ndg=ndg,diffgain_jacobi=True,num_major_loops=1);
+  for k in range(ndg):
+    order = [k]+[ i for i in range(ndg) if i != k ];
+    node0,output0,published = _run(tmp_path,0,ndg=ndg,order=order,num_major_loops=1);
+    assert node0.dgopts[0].label == node.dgopts[k].label;
+    _check_same_gains(node.dgopts[k],node0.dgopts[0]);
@@ -7,8 +7,10 @@ import time
 import os.path
 import sys
 import traceback
-import pickle
 import copy
+import multiprocessing
+import io
+import json
 import numpy
 import numpy.ma
 
@@ -43,6 +45,14 @@ def sort_qualified_names (inlist):
   from functools import cmp_to_key
   return sorted(inlist,key=cmp_to_key(cmp_qualified_names));
 
+# arguments of the parallel reduction currently in progress. Set by ParmTab.apply()
+_parallel_apply_args = None;
+
+def _run_apply_task (name):
+  """Entry point of worker processes: applies the current reduction to all slices of one funklet name""";
+  parmtab,op_func,slicing = _parallel_apply_args;
+  return name,parmtab.funkset(name).reduce(op_func,slicing);
+
 class _AxisStats (object):
   """_AxisStats represents information about one axis in the parmtable. It is created internally
   by ParmTab.""";
@@ -54,14 +64,13 @@ class _AxisStats (object):
     return not self.cells;
 
   def add_cell (self,x1,x2):
-    assert x1 is int and x2 is int
-    x0 = (x1+x2)//2;
+    x0 = (x1+x2)/2;
     self.cells[x0] = max(x2-x1,self.cells.get(x0,0));
 
   def update (self):
     if self.cells:
       # axis range
-      self.minmax = min([x0-dx//2 for x0,dx in self.cells.items()]),max([x0+dx//2 for x0,dx in self.cells.items()]);
+      self.minmax = min([x0-dx/2 for x0,dx in self.cells.items()]),max([x0+dx/2 for x0,dx in self.cells.items()]);
       # grid is simply a sorted list of cell values
       self.grid = list(self.cells.keys());
       self.grid.sort();
@@ -71,6 +80,18 @@ class _AxisStats (object):
   def lookup_cell (self,x1,x2):
     return self.cell_index[(x1+x2)/2];
 
+  def to_dict (self):
+    """Returns JSON-serializable representation, for the index cache""";
+    return dict(name=self.name,cells=sorted(self.cells.items()));
+
+  @staticmethod
+  def from_dict (rec):
+    """Makes _AxisStats from the output of to_dict()""";
+    stats = _AxisStats(rec['name']);
+    stats.cells = dict([ (x0,dx) for x0,dx in rec['cells'] ]);
+    stats.update();
+    return stats;
+
 class DomainSlicing (list):
   """A DomainSlicing represents a slicing of the ParmTable domain.
   Basically, it is a list of slice_index tuples, with each tuple corresponding to a slice through
@@ -117,7 +138,7 @@ class FunkSlice (object):
         (so e.g. the same slice will have shape [nl,nm]
     """
     # convert things like (0,0) into None
-    if not coeff or not any(coeff):
+    if not coeff or not any(coeff if isinstance(coeff,(tuple,list)) else [coeff]):
       coeff = None;
     # initially array is of uncollapsed: one axis for each dimension (up to max_axies), with those not in the
     # slice having a size of 1. Extra axrs will be trimmed later.
@@ -134,11 +155,11 @@ class FunkSlice (object):
     for funk in self.funklets:
       if numpy.isscalar(funk.coeff):
         if coeff is not None:
-          raise IndexError("invalid coeff index %s (funklet is scalar)"%coeff);
+          raise IndexError("invalid coeff index %s (funklet is scalar)"%(coeff,));
         val = funk.coeff;
       else:
         try:
-          val = funk.coeff[coeff];
+          val = funk.coeff[coeff] if coeff is not None else funk.coeff.ravel()[0];
         except:
           raise IndexError("invalid coeff index %s (funklet coeffs are %s)"%(coeff,funk.coeff.shape));
       # funk.slice_index is the global index of this funklet. We want to use just the axes
@@ -187,6 +208,11 @@ class FunkSet (object):
     # set additional indices from keywords
     for axis,num in axes.items():
       index[mequtils.get_axis_number(axis)] = num;
+    return self._get_slice(index,set(self.pt.name_domains(self.name)));
+
+  def _get_slice (self,index,have_domains):
+    """Helper method for get_slice(). 'index' is a max_axis-long index vector, 'have_domains' is the set
+    of domain indices for which this name has funklets.""";
     # build up list of full indices corresponding to specified slice
     slice_iaxis = [];
     indices = [[]];
@@ -199,12 +225,12 @@ class FunkSet (object):
       else:
         slice_iaxis.append(iaxis);
         indices = [ idx + [i] for idx in indices for i in range(len(stats.grid)) ];
-    # now make funklet list
+    # now make funklet list, skipping domains for which this name has no funklets
     funkslice = FunkSlice(self.pt,self.name,[],index,slice_iaxis);
-    for idx in indices:
+    for idx,idom in zip(indices,self.pt.lookup_domains(indices)):
       idx = tuple(idx);
-      idom = self.pt._domain_reverse_index.get(idx,None);
-      if idom is not None:
+      if idom in have_domains:
+        idom = int(idom);
         funk = self.pt.parmtable().get_funklet(self.name,idom);
         if funk:
           funk.domain_index = idom;
@@ -216,17 +242,77 @@ class FunkSet (object):
     """The () operator on a FunkSet is equivalent to get_slice()""";
     return self.get_slice(*index,**axes);
 
+  def get_coeffs (self,coeff=0,domains=None):
+    """Bulk read of funklet coefficients. Returns a (idoms,coeffs) tuple, where idoms is an array of the
+    domain indices for which funklets exist, and coeffs is an array of their coefficients, stacked along
+    the first axis.
+    'coeff' is applied as an index into each funklet's coeff array, as in FunkSlice.array(), in which case
+    coeffs has shape (N,). If 'coeff' is None, all coefficients are returned, and coeffs has shape
+    (N,)+S, where S is the largest coeff shape in the set (smaller coeff arrays are padded with zeros).
+    'domains' may be None for all domains, a (idom0,idom1) tuple for a range of domain indices
+    (idom1 exclusive), or a list of domain indices.
+    """;
+    idoms = self.pt.name_domains(self.name);
+    if isinstance(domains,tuple) and len(domains) == 2:
+      idoms = idoms[(idoms>=domains[0])&(idoms<domains[1])];
+    elif domains is not None:
+      idoms = numpy.intersect1d(idoms,numpy.asarray(domains,int));
+    # fetch funklets
+    get_funklet = self.pt.parmtable().get_funklet;
+    found = [];
+    values = [];
+    for idom in idoms:
+      funk = get_funklet(self.name,int(idom));
+      if funk:
+        found.append(idom);
+        values.append(funk.coeff);
+    idoms = numpy.array(found,int);
+    # select coefficient, or stack whole coeff arrays
+    if coeff is not None:
+      # convert things like (0,0) into c00
+      if not coeff or not any(coeff if isinstance(coeff,(tuple,list)) else [coeff]):
+        coeff = None;
+      coeffs = numpy.zeros(len(values),float);
+      for i,val in enumerate(values):
+        if numpy.isscalar(val):
+          if coeff is not None:
+            raise IndexError("invalid coeff index %s (funklet is scalar)"%(coeff,));
+          coeffs[i] = val;
+        else:
+          try:
+            coeffs[i] = val[coeff] if coeff is not None else val.ravel()[0];
+          except:
+            raise IndexError("invalid coeff index %s (funklet coeffs are %s)"%(coeff,val.shape));
+    else:
+      values = [ numpy.atleast_1d(val) for val in values ];
+      ndim = max([ val.ndim for val in values ] or [1]);
+      shapes = [ val.shape + (1,)*(ndim-val.ndim) for val in values ];
+      shape = tuple(numpy.max(shapes,0)) if shapes else (1,)*ndim;
+      coeffs = numpy.zeros((len(values),)+shape,float);
+      for i,(val,vshape) in enumerate(zip(values,shapes)):
+        coeffs[(i,)+tuple([ slice(0,n) for n in vshape ])] = val.reshape(vshape);
+    return idoms,coeffs;
+
+  def get_stacked (self,domains=None):
+    """Bulk read of funklets in the stacked form used by the array versions of FunkOps reductions.
+    Returns a (idoms,coeffs,bounds) tuple, where idoms and coeffs are as returned by get_coeffs(None,domains),
+    and bounds is an (N,max_axis,2) array of domain boundaries (see ParmTab.domain_bounds_array()).""";
+    idoms,coeffs = self.get_coeffs(None,domains);
+    return idoms,coeffs,self.pt.domain_bounds_array()[idoms];
+
   def array (self,coeff=0,fill_value=0,masked=True,collapse=True):
     """Makes array corresponding to whole FunkSet. This function will also maintain a disk cache
     of the array, and read it in or regenerate it as needed (unlike FunkSlice.array(), which
     always builds its arrays from scratch.)
     \n\n""" + FunkSlice.array.__doc__;
-    # see if we have a cached array
-    cachefile = os.path.join(self.pt.filename,"array.%s.%s.cache"%(self.name,coeff));
+    # see if we have a cached array. This is stored as two .npy files (data and mask), which are memory-mapped
+    # copy-on-write, so only the pages actually used are read in, and the caller may still modify the array
+    cachefile = os.path.join(self.pt.filename,"array.%s.%s.npy"%(self.name,coeff));
+    maskfile = os.path.join(self.pt.filename,"array.%s.%s.mask.npy"%(self.name,coeff));
     arr = None;
-    if os.path.exists(cachefile) and os.path.getmtime(cachefile) >= self.pt.mtime:
+    if os.path.exists(maskfile) and os.path.getmtime(maskfile) >= self.pt.mtime:
       try:
-        arr = pickle.load(open(cachefile, "rb"));
+        arr = numpy.ma.masked_array(numpy.load(cachefile,mmap_mode='c'),numpy.load(maskfile,mmap_mode='c'),fill_value=0);
         dprintf(2,"read cache %s\n"%cachefile);
       except:
         dprintf(0,"error reading cached array %s, will regenerate\n"%cachefile);
@@ -234,12 +320,26 @@ class FunkSet (object):
     # regenerate array if not read
     if arr is None:
       dprintf(2,"filling array for %s.%s\n",self.name,coeff);
-      fullslice = self.get_slice();
-      # generate full, uncollapsed masked array
-      arr = fullslice.array(coeff,fill_value=0,masked=True,collapse=False);
-      # write to cache
+      # generate full, uncollapsed masked array (as FunkSlice.array() would for a slice over all axes)
+      idoms,values = self.get_coeffs(coeff);
+      slice_iaxes = [ iaxis for iaxis in range(mequtils.max_axis) if not self.pt.axis_stats(iaxis).empty() ];
+      shape = [1]*mequtils.max_axis;
+      for iaxis in slice_iaxes:
+        shape[iaxis] = len(self.pt.axis_stats(iaxis).grid);
+      data = numpy.zeros(shape,float);
+      mask = numpy.ones(shape,bool);
+      cells = self.pt.domain_cell_array()[idoms];
+      # skip domains not defined along all axes of the table (these are never part of a slice)
+      valid = (cells[:,slice_iaxes]>=0).all(1);
+      cells = numpy.maximum(cells[valid],0);
+      data[tuple(cells.T)] = values[valid];
+      mask[tuple(cells.T)] = False;
+      arr = numpy.ma.masked_array(data,mask,fill_value=0);
+      arr.shape = shape[:(slice_iaxes[-1]+1)] if slice_iaxes else shape;
+      # write to cache, mask last, since its timestamp is checked
       try:
-        pickle.dump(arr,open(cachefile,"wb"));
+        numpy.save(cachefile,arr.data);
+        numpy.save(maskfile,numpy.ma.getmaskarray(arr));
       except:
         if verbosity.get_verbose() > 0:
           traceback.print_exc();
@@ -254,27 +354,19 @@ class FunkSet (object):
       arr.shape = [ n for i,n in enumerate(arr.shape) if not self.pt.axis_stats(i).empty() ];
     return arr;
 
-  def apply (self,op_func,slicing=[],outtab=None,remove=False):
-    """For each funklet in the subset, takes all funklets along the designated slicing axis
-    (i.e. for each slice along the non-listed axes), creates a FunkSlice, and calls
-    op_func(slice).
-    The return value of op_func() should be either None if no operation was performed, or a list of
-    funklets to be written to the output table. This list may also contain strings, which are
-    interpreted as funklet names. The default name is the same as the current FunkSet name; a string at
-    any position in the funklet list applies to subsequent funklets.
-    if 'outtab' is None, a new output table is created. Otherwise set outtab to a filename, or a
-    ParmTab, or a FastParmTable.
-    If 'remove' is True, input funklets will be removed if an output funklet is returned.
+  def reduce (self,op_func,slicing=[]):
+    """For each slice of the given slicing (see ParmTab.make_slicing()), gets a FunkSlice and calls
+    op_func(slice). Nothing is written out: returns a list of (slice_index,input_domains,output) tuples,
+    one per slice for which op_func() returned something, where input_domains is a list of the domain
+    indices of the input funklets, and output is the return value of op_func() (see apply() below).
     """;
-    # resolve tables
-    outtab = self.pt.resolve_output_table(outtab);
-    pt = self.pt.parmtable();
-    # resolve slicing
     slicing = self.pt.make_slicing(slicing);
-    # loop over funklets and slices
-    num_infunk = num_outfunk = num_slices = 0;
+    results = [];
+    num_infunk = num_slices = 0;
+    have_domains = set(self.pt.name_domains(self.name));
     for sl0 in slicing:
-      funklets = self.get_slice(*sl0);
+      index = list(sl0) + [None]*(mequtils.max_axis-len(sl0));
+      funklets = self._get_slice(index,have_domains);
       # call reduction function if we find any
       if funklets:
         num_slices += 1;
@@ -291,38 +383,75 @@ class FunkSet (object):
             traceback.print_exc();
             dprintf(1,"this slice will be ignored\n");
           outfunk = None;
-        # if a new funklet was generated, write it to output
         if outfunk:
-          # remove input funklets if successful
-          if remove:
-            dprintf(4,"%s slice %s: removing %d input funklets\n",self.name,sl0,len(funklist));
-            for funk in funklist:
-              try:
-                self.mtime = time.time();
-                self.parmtable(True).delete_funklet(self.name,funk.domain_index);
-              except:
-                if verbosity.get_verbose() > 0:
-                  traceback.print_exc();
-                dprintf(0,"error deleting funklet for %s slice %s\n",self.name,funk.slice_index);
-          dprintf(4,"%s slice %s: writing %d output funklets\n",self.name,sl0,len(outfunk));
-          name = self.name;
-          for ff in outfunk:
-            if isinstance(ff,str):
-              name = ff;
-            else:
-              num_outfunk += 1;
-              try:
-                outtab.mtime = time.time();
-                outtab.parmtable(True).put_funklet(name,ff);
-              except:
-                dprintf(0,"error saving funklet for %s slice %s\n",self.name,sl0);
-                if verbosity.get_verbose() > 0:
-                  traceback.print_exc();
-                dprintf(0,"this slice will be ignored\n");
-                funk = None;
-                break;
-    dprintf(3,"%s: %s() transformed %d input funklets over %d slices into %d output funklets\n",self.name,op_func.__name__,num_infunk,num_slices,num_outfunk);
+          results.append((sl0,[ funk.domain_index for funk in funklets ],list(outfunk)));
+    dprintf(3,"%s: %s() reduced %d input funklets over %d slices\n",self.name,op_func.__name__,num_infunk,num_slices);
+    return results;
+
+  def write (self,results,outtab,remove=False):
+    """Writes the results of reduce() to the output table 'outtab' (a ParmTab).
+    If 'remove' is True, input funklets are removed from our table.
+    All writes are done as one batch, with the tables opened for writing and marked as modified only once.
+    The per-name domain indices of the tables are updated as we go (see ParmTab.name_domains()).
+    Returns the number of output funklets written.
+    """;
+    if not results:
+      return 0;
+    num_outfunk = 0;
+    if remove:
+      pt = self.pt.parmtable(True);
+      self.pt.mtime = time.time();
+      removed = [];
+    outpt = outtab.parmtable(True);
+    outtab.mtime = time.time();
+    for sl0,domains,outfunk in results:
+      # remove input funklets
+      if remove:
+        dprintf(4,"%s slice %s: removing %d input funklets\n",self.name,sl0,len(domains));
+        for idom in domains:
+          try:
+            pt.delete_funklet(self.name,idom);
+            removed.append(idom);
+          except:
+            if verbosity.get_verbose() > 0:
+              traceback.print_exc();
+            dprintf(0,"error deleting funklet for %s slice %s\n",self.name,sl0);
+      dprintf(4,"%s slice %s: writing %d output funklets\n",self.name,sl0,len(outfunk));
+      name = self.name;
+      for ff in outfunk:
+        if isinstance(ff,str):
+          name = ff;
+        else:
+          try:
+            outpt.put_funklet(name,ff);
+            outtab._stale_names.add(name);
+            num_outfunk += 1;
+          except:
+            dprintf(0,"error saving funklet for %s slice %s\n",self.name,sl0);
+            if verbosity.get_verbose() > 0:
+              traceback.print_exc();
+            dprintf(0,"this slice will be ignored\n");
+            break;
+    if remove and removed:
+      self.pt._remove_name_domains(self.name,removed);
+    return num_outfunk;
 
+  def apply (self,op_func,slicing=[],outtab=None,remove=False):
+    """For each funklet in the subset, takes all funklets along the designated slicing axis
+    (i.e. for each slice along the non-listed axes), creates a FunkSlice, and calls
+    op_func(slice).
+    The return value of op_func() should be either None if no operation was performed, or a list of
+    funklets to be written to the output table. This list may also contain strings, which are
+    interpreted as funklet names. The default name is the same as the current FunkSet name; a string at
+    any position in the funklet list applies to subsequent funklets.
+    if 'outtab' is None, a new output table is created. Otherwise set outtab to a filename, or a
+    ParmTab, or a FastParmTable.
+    If 'remove' is True, input funklets will be removed if an output funklet is returned.
+    """;
+    outtab = self.pt.resolve_output_table(outtab);
+    results = self.reduce(op_func,slicing);
+    num_outfunk = self.write(results,outtab,remove=remove);
+    dprintf(3,"%s: %s() transformed %d slices into %d output funklets\n",self.name,op_func.__name__,len(results),num_outfunk);
 
 
 class ParmTab (object):
@@ -335,6 +464,8 @@ class ParmTab (object):
      'new' is True to delete any existing parmtable by the same name and open a new one.
     """;
     self._pt = self._pt_write = None;
+    # names whose entries in the per-name domain index are out of date, see name_domains()
+    self._stale_names = set();
     self.load(filename,write=write,new=new);
 
   def _start_progress(self,label,maxval=100):
@@ -367,7 +498,6 @@ class ParmTab (object):
       dprintf(1,"loading table %s (write=%d)\n",filename,write);
     self.filename = filename;
     self.parmtable(write);
-    self._cachepath = os.path.join(filename,'ParmTab.cache');
     self._make_axis_index();
 
   def merge (self,filename):
@@ -380,13 +510,22 @@ class ParmTab (object):
     nfunk = len(funklist);
     dprintf(1,"merging in %d funklets from table %s\n",nfunk,filename);
     if funklist:
+      # group funklets by name, so that each name is read in and written out in one batch
+      by_name = {};
+      for name,idom,domain in funklist:
+        by_name.setdefault(name,[]).append(idom);
       pt = self.parmtable(True);
+      self.mtime = time.time();
+      self._stale_names.update(by_name.keys());
       self._start_progress("merging in parmtable %s"%filename,nfunk);
       try:
-        for ifunk,(name,idom,domain) in enumerate(funklist):
+        ifunk = 0;
+        for name in sort_qualified_names(by_name.keys()):
           self._report_progress(ifunk);
-          self.mtime = time.time();
-          pt.put_funklet(name,pt1.get_funklet(name,idom));
+          funklets = [ pt1.get_funklet(name,idom) for idom in by_name[name] ];
+          for funk in funklets:
+            pt.put_funklet(name,funk);
+          ifunk += len(funklets);
         dprintf(2,"elapsed time: %f seconds\n",time.time()-t0); t0 = time.time();
         pt1 = None;
         self._make_axis_index();
@@ -457,10 +596,110 @@ class ParmTab (object):
     """Returns _AxisStats object for the specified parmtable.""";
     return self._axis_stats[iaxis];
 
+  def name_domains (self,name):
+    """Returns sorted array of indices of the domains for which funklets of the given name exist.
+    This comes from the index cache. Removing funklets updates the index in place, while writing funklets
+    marks their names as stale, since their domain indices are assigned by the table. Looking up a stale
+    name rebuilds the index with a single funklet_list() call.""";
+    if self._name_domains is None or name in self._stale_names:
+      t0 = time.time();
+      self._name_domains = self._index_name_domains();
+      self._stale_names = set();
+      dprintf(2,"indexed domains of %d funklet names in %f seconds\n",len(self._name_domains),time.time()-t0);
+    return self._name_domains.get(name,numpy.zeros(0,int));
+
+  def _remove_name_domains (self,name,domains):
+    """Helper method. Removes domain indices from the per-name index, after their funklets have been deleted""";
+    if self._name_domains is not None and name in self._name_domains:
+      self._name_domains[name] = numpy.setdiff1d(self._name_domains[name],numpy.asarray(domains,int));
+
+  def _index_name_domains (self):
+    """Helper method. Returns dict of name: sorted array of domain indices""";
+    index = {};
+    for fname,idom,domain in self.parmtable().funklet_list():
+      index.setdefault(fname,[]).append(idom);
+    return dict([ (fname,numpy.array(sorted(idoms),int)) for fname,idoms in index.items() ]);
+
+  def domain_cell_array (self):
+    """Returns the cell index of every domain as an integer array of shape (ndomains,max_axis).
+    Axes along which a domain is not defined have an index of -1.""";
+    return self._domain_cells;
+
+  def domain_bounds_array (self):
+    """Returns the boundaries of every domain as a float array of shape (ndomains,max_axis,2).
+    Axes along which a domain is not defined have boundaries of NaN.""";
+    return self._domain_bounds;
+
+  def _domain_keys_of (self,cells):
+    """Helper method. Converts (N,max_axis) array of cell indices (-1 for undefined) into scalar keys""";
+    return (numpy.asarray(cells,numpy.int64)+1).dot(self._domain_strides);
+
+  def lookup_domains (self,indices):
+    """Looks up domains by cell index. 'indices' is a list of max_axis-long index vectors (with None for
+    undefined axes, as in get_slice()). Returns array of the corresponding domain indices, or -1 where
+    there is no such domain.""";
+    cells = numpy.array([ [ -1 if i is None else i for i in idx ] for idx in indices ],numpy.int64
+                       ).reshape((len(indices),mequtils.max_axis));
+    keys = self._domain_keys_of(cells);
+    if not len(self._domain_keys):
+      return numpy.zeros(len(keys),int)-1;
+    pos = numpy.minimum(numpy.searchsorted(self._domain_keys,keys),len(self._domain_keys)-1);
+    return numpy.where(self._domain_keys[pos]==keys,self._domain_key_order[pos],-1);
+
+  # index cache: a JSON header with the small items, and memory-mappable arrays for the per-domain and
+  # per-name indices, so that opening a large table only reads in the pages that are actually used
+  INDEX_CACHE_VERSION = 2;
+  INDEX_CACHE_HEADER = "ParmTab.index.json";
+  INDEX_CACHE_ARRAYS = [ "domain_cells","domain_bounds","domain_keys","domain_key_order","name_domains","name_offsets" ];
+
+  def _index_cache_path (self,item):
+    return os.path.join(self.filename,"ParmTab.%s.npy"%item if item in self.INDEX_CACHE_ARRAYS else item);
+
+  def _load_index_cache (self):
+    """Helper method. Loads the index cache. Throws an exception if it can't""";
+    header = json.load(io.open(self._index_cache_path(self.INDEX_CACHE_HEADER)));
+    if header.get('version') != self.INDEX_CACHE_VERSION:
+      raise ValueError("unknown index cache version");
+    arrays = dict([ (item,numpy.load(self._index_cache_path(item),mmap_mode='r')) for item in self.INDEX_CACHE_ARRAYS ]);
+    self._funklet_names = header['funklet_names'];
+    self._name_components = [ set(x) for x in header['name_components'] ];
+    self._axis_stats = [ _AxisStats.from_dict(rec) for rec in header['axis_stats'] ];
+    self._domain_fullset = header['domain_fullset'];
+    self._domain_strides = numpy.array(header['domain_strides'],numpy.int64);
+    self._domain_cells = arrays['domain_cells'];
+    self._domain_bounds = arrays['domain_bounds'];
+    self._domain_keys = arrays['domain_keys'];
+    self._domain_key_order = arrays['domain_key_order'];
+    # slices of a memmap are views, so this doesn't read anything in
+    offsets,name_domains = arrays['name_offsets'],arrays['name_domains'];
+    self._name_domains = dict([ (name,name_domains[offsets[i]:offsets[i+1]])
+                                for i,name in enumerate(header['name_domains']) ]);
+
+  def _save_index_cache (self):
+    """Helper method. Writes the index cache""";
+    names = sorted(self._name_domains.keys());
+    offsets = numpy.cumsum([0]+[ len(self._name_domains[name]) for name in names ]);
+    arrays = dict(domain_cells=self._domain_cells,domain_bounds=self._domain_bounds,domain_keys=self._domain_keys,
+                  domain_key_order=self._domain_key_order,name_offsets=offsets,
+                  name_domains=numpy.concatenate([numpy.zeros(0,int)]+[ self._name_domains[name] for name in names ]));
+    for item in self.INDEX_CACHE_ARRAYS:
+      numpy.save(self._index_cache_path(item),arrays[item]);
+    # header is written last, since its timestamp is checked
+    header = dict(version=self.INDEX_CACHE_VERSION,
+                  funklet_names=list(self._funklet_names),
+                  name_components=[ sorted(x) for x in self._name_components ],
+                  axis_stats=[ stats.to_dict() for stats in self._axis_stats ],
+                  domain_fullset=self._domain_fullset,
+                  domain_strides=[ int(x) for x in self._domain_strides ],
+                  name_domains=names);
+    with io.open(self._index_cache_path(self.INDEX_CACHE_HEADER),'w') as fobj:
+      fobj.write(json.dumps(header));
+
   def _make_axis_index (self):
     """Builds up various indices based on content of the parmtable""";
+    self._stale_names = set();
     # check if cache is up-to-date
-    cachepath = os.path.join(self.filename,'ParmTab.cache');
+    cachepath = self._index_cache_path(self.INDEX_CACHE_HEADER);
     funkpath = os.path.join(self.filename,'funklets');
     self.mtime = os.path.getmtime(funkpath) if os.path.exists(funkpath) else time.time();
     try:
@@ -475,9 +714,7 @@ class ParmTab (object):
     if has_cache:
       try:
         dprintf(2,"loading index cache\n");
-        self._funklet_names,self._domain_list,self._axis_stats,self._name_components, \
-        self._domain_fullset,self._domain_cell_index,self._domain_reverse_index \
-          = pickle.load(open(cachepath, "rb"));
+        self._load_index_cache();
         dprintf(2,"elapsed time: %f seconds\n",time.time()-t0); t0 = time.time();
         return;
       except:
@@ -490,11 +727,10 @@ class ParmTab (object):
       self._axis_stats = [ _AxisStats(mequtils.get_axis_id(i)) for i in range(mequtils.max_axis) ];
       pt = self.parmtable();
       dprintf(2,"loading domain list\n");
-      self._domain_list = pt.domain_list();
+      domain_list = pt.domain_list();
       dprintf(2,"elapsed time: %f seconds\n",time.time()-t0); t0 = time.time();
       dprintf(2,"collecting axis stats\n");
-      self._axes = {};
-      for domain in self._domain_list:
+      for domain in domain_list:
         for axis,rng in domain.items():
           if str(axis) != 'axis_map':
             self._axis_stats[mequtils.get_axis_number(axis)].add_cell(*rng);
@@ -508,23 +744,27 @@ class ParmTab (object):
           dprintf(2,"axis %s: %d unique cells from %g to %g\n",stats.name,len(stats.cells),*stats.minmax);
       dprintf(2,"elapsed time: %f seconds\n",time.time()-t0); t0 = time.time();
       dprintf(2,"making subdomain indices\n");
-      # now make a subdomain index
-      self._domain_cell_index = [0]*len(self._domain_list);
-      self._domain_reverse_index = {};
-      for idom,domain in enumerate(self._domain_list):
-        index = [None]*mequtils.max_axis;
+      # now make a subdomain index: cell index of each domain (-1 for undefined axes), and
+      # a sorted array of scalar keys for reverse lookups
+      # also keep the boundaries of each domain (NaN for undefined axes)
+      self._domain_cells = numpy.zeros((len(domain_list),mequtils.max_axis),numpy.int32) - 1;
+      self._domain_bounds = numpy.zeros((len(domain_list),mequtils.max_axis,2),float) + numpy.nan;
+      for idom,domain in enumerate(domain_list):
         for axis,rng in domain.items():
           if str(axis) != 'axis_map':
             iaxis = mequtils.get_axis_number(axis);
-            index[iaxis] = self._axis_stats[iaxis].lookup_cell(*rng);
-        # insert into domain_cells_index and domain_reverse_index
-        index = tuple(index);
-        self._domain_cell_index[idom] = index;
-        self._domain_reverse_index[index] = idom;
+            self._domain_cells[idom,iaxis] = self._axis_stats[iaxis].lookup_cell(*rng);
+            self._domain_bounds[idom,iaxis] = rng;
+      dims = [ (len(stats.grid)+1 if not stats.empty() else 1) for stats in self._axis_stats ];
+      self._domain_strides = numpy.array([ int(numpy.prod(dims[i+1:])) for i in range(len(dims)) ],numpy.int64);
+      keys = self._domain_keys_of(self._domain_cells);
+      self._domain_key_order = numpy.argsort(keys,kind='stable');
+      self._domain_keys = keys[self._domain_key_order];
       dprintf(2,"elapsed time: %f seconds\n",time.time()-t0); t0 = time.time();
 
       dprintf(2,"loading funklet name list\n");
       self._funklet_names = list(pt.name_list());
+      self._name_domains = self._index_name_domains();
       dprintf(2,"elapsed time: %f seconds\n",time.time()-t0); t0 = time.time();
       dprintf(2,"computing funklet indices\n");
       self._name_components = {};
@@ -538,11 +778,7 @@ class ParmTab (object):
 
       dprintf(2,"writing cache\n");
       try:
-        pickle.dump((
-            self._funklet_names,self._domain_list,self._axis_stats,self._name_components, \
-            self._domain_fullset,self._domain_cell_index,self._domain_reverse_index \
-          ),open(cachepath,'wb')
-        );
+        self._save_index_cache();
       except:
         if verbosity.get_verbose() > 0:
           traceback.print_exc();
@@ -576,7 +812,7 @@ class ParmTab (object):
   def funkset (self,name):
     return FunkSet(self,name);
 
-  def apply (self,op_func,slicing,outtab=None,remove=False,newtab=False):
+  def apply (self,op_func,slicing,outtab=None,remove=False,newtab=False,processes=1):
     """For each funklet in our table, takes all funklets along the designated slicing axis
     (i.e. for each slice along the non-listed axes), creates a FunkSlice, and calls
     op_func(slice).
@@ -585,26 +821,62 @@ class ParmTab (object):
     if 'outtab' is None, a new output table is created. Otherwise set outtab to a filename, or a
     ParmTab, or a FastParmTable.
     If 'remove' is True, input funklets will be removed if an output funklet is returned.
+    If 'processes' is >1, the reductions for different funklet names are computed by a pool of
+    worker processes. Output is always written by this process, in batches of one funklet name.
     """;
     t0 = time.time();
-    nn = len(self.funklet_names());
+    names = sort_qualified_names(self.funklet_names());
+    nn = len(names);
     self._start_progress("applying operation '%s'"%op_func.__name__,nn);
     try:
       outtab = self.resolve_output_table(outtab,newtab);
       dprintf(1,"using output table %s\n",outtab.filename);
-      pt = self.parmtable();
       # loop over funklets and slices
       dprintf(3,"input slicing is %s\n",slicing);
       slicing = self.make_slicing(slicing);
       dprintf(2,"%d slices will be iterated over\n",len(slicing));
-      for iname,name in enumerate(sort_qualified_names(self.funklet_names())):
-        self._report_progress(iname);
-        self.funkset(name).apply(op_func,slicing,outtab=outtab,remove=remove);
+      if processes > 1 and nn > 1:
+        self._apply_parallel(op_func,slicing,names,outtab,remove,min(processes,nn));
+      else:
+        for iname,name in enumerate(names):
+          self._report_progress(iname);
+          funkset = self.funkset(name);
+          funkset.write(funkset.reduce(op_func,slicing),outtab,remove=remove);
     finally:
       dprintf(2,"elapsed time: %f seconds\n",time.time()-t0); t0 = time.time();
       self._end_progress(False);
       self.close();
 
+  def _apply_parallel (self,op_func,slicing,names,outtab,remove,nproc):
+    """Helper method for apply(). Computes reductions using a pool of worker processes, and writes
+    the results as they come in. If input funklets are to be removed, or the output goes to the input table,
+    all writing is deferred until the workers have finished reading the table.""";
+    global _parallel_apply_args;
+    defer = remove or os.path.abspath(outtab.filename) == os.path.abspath(self.filename);
+    dprintf(1,"applying '%s' to %d funklet names using %d processes\n",op_func.__name__,len(names),nproc);
+    # build the per-name domain index here, so that the workers inherit it. The input table must not be
+    # open in this process when forking, each worker opens its own.
+    self.name_domains(names[0]);
+    self.close();
+    _parallel_apply_args = self,op_func,slicing;
+    deferred = [];
+    try:
+      pool = multiprocessing.get_context('fork').Pool(nproc);
+      try:
+        for iname,(name,results) in enumerate(pool.imap(_run_apply_task,names)):
+          self._report_progress(iname);
+          if defer:
+            deferred.append((name,results));
+          else:
+            self.funkset(name).write(results,outtab);
+      finally:
+        pool.close();
+        pool.join();
+    finally:
+      _parallel_apply_args = None;
+    for name,results in deferred:
+      self.funkset(name).write(results,outtab,remove=remove);
+
 
 def open (*args,**kw):
   """Opens a ParmTab. Arguments are passed to ParmTab constructor:
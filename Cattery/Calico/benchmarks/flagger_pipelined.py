@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmarks Flagger chunk I/O with and without pipelining.
+
+Builds a synthetic MS (main table with DATA/CORRECTED_DATA, FLAG/FLAG_ROW and BITFLAG/BITFLAG_ROW columns,
+plus a DATA_DESCRIPTION subtable), then runs the same sequence of flagging operations with
+Flagger(pipelined=False) and Flagger(pipelined=True), and reports rows/sec for each operation and mode.
+
+Usage: python flagger_pipelined.py [--nant N] [--ntime N] [--nchan N] [--chunksize N] [--repeat N] [--ms PATH]
+""";
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import numpy
+
+from Cattery.Meow.MSUtils import TABLE
+from Cattery.Calico.Flagger import Flagger
+
+def make_synthetic_ms (msname,nant=16,ntime=200,nchan=64,ncorr=4,nddid=2,seed=0):
+  """Creates a synthetic MS with nddid DATA_DESC_IDs, ntime timeslots per DDID and all nant*(nant-1)/2 baselines.
+  Returns the number of rows.""";
+  import casacore.tables as tables
+  rng = numpy.random.default_rng(seed);
+  a1,a2 = numpy.triu_indices(nant,1);
+  nbl = len(a1);
+  nrows = nddid*ntime*nbl;
+  desc = tables.maketabdesc([
+    tables.makescacoldesc('ANTENNA1',0),
+    tables.makescacoldesc('ANTENNA2',0),
+    tables.makescacoldesc('DATA_DESC_ID',0),
+    tables.makescacoldesc('FIELD_ID',0),
+    tables.makescacoldesc('TIME',0.),
+    tables.makescacoldesc('FLAG_ROW',False),
+    tables.makescacoldesc('BITFLAG_ROW',0),
+    tables.makearrcoldesc('DATA',0j,shape=[nchan,ncorr]),
+    tables.makearrcoldesc('CORRECTED_DATA',0j,shape=[nchan,ncorr]),
+    tables.makearrcoldesc('FLAG',False,shape=[nchan,ncorr]),
+    tables.makearrcoldesc('BITFLAG',0,shape=[nchan,ncorr]),
+  ]);
+  ms = tables.table(msname,desc,nrow=nrows,readonly=False,ack=False);
+  # rows ordered by DDID, then time, then baseline
+  ddid = numpy.repeat(numpy.arange(nddid),ntime*nbl);
+  ms.putcol('DATA_DESC_ID',ddid);
+  ms.putcol('FIELD_ID',numpy.zeros(nrows,int));
+  ms.putcol('ANTENNA1',numpy.tile(a1,nddid*ntime));
+  ms.putcol('ANTENNA2',numpy.tile(a2,nddid*ntime));
+  ms.putcol('TIME',4.7e9+numpy.tile(numpy.repeat(numpy.arange(ntime)*10.,nbl),nddid));
+  # fill the array columns in blocks, to keep memory use down
+  block = max(1,1000000//(nchan*ncorr));
+  for row0 in range(0,nrows,block):
+    n = min(block,nrows-row0);
+    shape = (n,nchan,ncorr);
+    data = (rng.standard_normal(shape)+1j*rng.standard_normal(shape));
+    ms.putcol('DATA',data,row0,n);
+    ms.putcol('CORRECTED_DATA',data,row0,n);
+    ms.putcol('FLAG',numpy.zeros(shape,bool),row0,n);
+    ms.putcol('BITFLAG',(rng.random(shape)<.05).astype(numpy.int32),row0,n);
+  ms.putcol('BITFLAG_ROW',numpy.zeros(nrows,numpy.int32));
+  ms.putcol('FLAG_ROW',numpy.zeros(nrows,bool));
+  # one pre-existing flagset, in bit 1
+  ms.putcolkeyword('BITFLAG','FLAGSET_existing',1);
+  ms.putcolkeyword('BITFLAG','FLAGSETS','existing');
+  # DATA_DESCRIPTION subtable
+  dd = tables.table(os.path.join(msname,'DATA_DESCRIPTION'),tables.maketabdesc([
+    tables.makescacoldesc('SPECTRAL_WINDOW_ID',0),
+    tables.makescacoldesc('POLARIZATION_ID',0),
+    tables.makescacoldesc('FLAG_ROW',False)]),nrow=nddid,readonly=False,ack=False);
+  dd.putcol('SPECTRAL_WINDOW_ID',numpy.arange(nddid));
+  dd.close();
+  ms.putkeyword('DATA_DESCRIPTION','Table: %s'%os.path.abspath(os.path.join(msname,'DATA_DESCRIPTION')));
+  ms.close();
+  return nrows;
+
+# operations to time: name -> function of flagger
+OPERATIONS = [
+  ("flag",              lambda fl:fl.flag("bench",create=True,antennas=list(range(0,16,2)),purr=False)),
+  ("flag (clip)",       lambda fl:fl.flag("bench",create=True,clip_above=3,purr=False)),
+  ("get_stats",         lambda fl:fl.get_stats("bench",purr=False)),
+  ("set_legacy_flags",  lambda fl:fl.set_legacy_flags(["existing","bench"],purr=False)),
+  ("clear_legacy_flags",lambda fl:fl.clear_legacy_flags(purr=False)),
+  ("unflag",            lambda fl:fl.unflag("bench",purr=False)),
+];
+
+def run (msname,nrows,chunksize,repeat=3):
+  """Runs each operation repeat times in both modes, returns dict of (operation,pipelined) -> best rows/sec""";
+  results = {};
+  for pipelined in False,True:
+    flagger = Flagger(msname,chunksize=chunksize,pipelined=pipelined);
+    try:
+      for name,op in OPERATIONS:
+        best = None;
+        for i in range(repeat):
+          t0 = time.time();
+          op(flagger);
+          dt = time.time()-t0;
+          best = dt if best is None else min(best,dt);
+        results[name,pipelined] = nrows/best;
+    finally:
+      flagger.close();
+  return results;
+
+def main ():
+  parser = argparse.ArgumentParser(description=__doc__.split("\n")[0]);
+  parser.add_argument("--nant",type=int,default=16);
+  parser.add_argument("--ntime",type=int,default=200);
+  parser.add_argument("--nchan",type=int,default=64);
+  parser.add_argument("--nddid",type=int,default=2);
+  parser.add_argument("--chunksize",type=int,default=4000);
+  parser.add_argument("--repeat",type=int,default=3);
+  parser.add_argument("--ms",help="where to create the synthetic MS (default is a temporary directory, removed afterwards)");
+  args = parser.parse_args();
+  tmpdir = None;
+  msname = args.ms;
+  if not msname:
+    tmpdir = tempfile.mkdtemp();
+    msname = os.path.join(tmpdir,"bench.ms");
+  try:
+    nrows = make_synthetic_ms(msname,nant=args.nant,ntime=args.ntime,nchan=args.nchan,nddid=args.nddid);
+    print("synthetic MS %s: %d rows, %d channels, chunksize %d"%(msname,nrows,args.nchan,args.chunksize));
+    results = run(msname,nrows,args.chunksize,args.repeat);
+    print("%-20s %14s %14s %8s"%("operation","serial rows/s","pipelined","speedup"));
+    for name,op in OPERATIONS:
+      serial,pipelined = results[name,False],results[name,True];
+      print("%-20s %14.0f %14.0f %7.2fx"%(name,serial,pipelined,pipelined/serial));
+  finally:
+    if tmpdir:
+      shutil.rmtree(tmpdir);
+
+if __name__ == '__main__':
+  main();
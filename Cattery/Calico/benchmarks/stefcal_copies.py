@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Measures the memory allocated by one full StefCal request, using tracemalloc.
+
+A StefCalNode is set up for a diagonal gain solution on synthetic data (random model, known gains, noise),
+and given a warm-up request followed by the measured one. Over the measured get_result() call, reports:
+
+    peak      = peak traced memory above the level at the start of the request
+    retained  = traced memory still held after the request (including the output vellsets)
+    stefcal   = memory allocated during the request by code in the StefCal package and still held after it,
+                from a diff of tracemalloc snapshots taken before and after the request. Each allocation is
+                attributed to the innermost StefCal frame of its traceback, so that e.g. copies made via numpy
+                calls count too. This covers the output vellsets and the padded data/model copies kept for
+                the next request, but not temporaries freed within the request (those show up in peak).
+    copies    = stefcal in units of one data cube (Nifr x 4 correlations x time x freq, in the input dtype),
+                i.e. how many copies of the visibilities each request leaves behind
+    peak/cube = peak in units of one data cube, i.e. roughly how many copies of the visibilities were live
+                at the worst point
+
+With --top N, the N StefCal source lines allocating the most are listed for each revision.
+
+To compare code versions, give one or more git revisions (use "." for the working tree). Each revision is
+exported with git archive into a temporary directory, and measured in a separate process. E.g., to compare
+the code before and after the vells/numpy zero-copy changes:
+
+  python Cattery/Calico/benchmarks/stefcal_copies.py <rev-before> <rev-after> .
+
+For the vells/numpy zero-copy changes, this shows no reduction: with 10 antennas and 30x32 slots, both
+versions leave 2.39 cubes allocated per request (1.72 in single precision), and peak at 6.77 cubes (3.90).
+The allocations that remain are the padded work copies of the data and the output vellsets.
+
+Requires a MeqTrees (Timba) installation, since StefCalNode is a PyNode.
+""";
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import argparse
+import fnmatch
+import gc
+import json
+import os
+import subprocess
+import sys
+import shutil
+import tempfile
+import tracemalloc
+
+REPO = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))));
+
+class _Record (object):
+  """Plain attribute container standing in for the request and child result records""";
+  def __init__ (self,**kw):
+    self.__dict__.update(kw);
+
+def _make_inputs (nant,ntime,nfreq,seed=0):
+  """Returns list of "p:q" ifr names, and 4*Nifr lists of data and model arrays""";
+  import numpy
+  rng = numpy.random.default_rng(seed);
+  shape = (ntime,nfreq);
+  crandn = lambda *shape:rng.standard_normal(shape)+1j*rng.standard_normal(shape);
+  gains = [ (1+.1*crandn(*shape),1+.1*crandn(*shape)) for p in range(nant) ];
+  ifrs = [];
+  data = [];
+  model = [];
+  for p in range(nant):
+    for q in range(p+1,nant):
+      ifrs.append("%d:%d"%(p,q));
+      for i,j in (0,0),(0,1),(1,0),(1,1):
+        m = crandn(*shape);
+        model.append(m);
+        data.append(gains[p][i]*m*numpy.conj(gains[q][j])+.01*crandn(*shape));
+  return ifrs,data,model;
+
+def _make_result (values,nifrs):
+  """Makes a child result with Nifr x 2 x 2 vellsets. Values are copied, since the node may modify its inputs""";
+  from Timba.Meq import meq
+  return _Record(dims=[nifrs,2,2],vellsets=[ meq.vellset(x.copy()) for x in values ]);
+
+def _make_request (domain_id,itile,ntime,nfreq,ntiles):
+  from Timba.Meq import meq
+  t0 = itile*ntime;
+  return _Record(request_id=meq.requestid(domain_id=domain_id),
+                 cells=_Record(domain=_Record(domain_id=(t0,t0+ntime,1,ntiles*ntime,0,nfreq,1,nfreq))));
+
+# allocations are attributed to the innermost frame in one of these files
+STEFCAL_FILES = "*/Calico/OMS/StefCal/*.py";
+# frames kept per allocation traceback, enough to get from numpy internals back to StefCal
+NFRAMES = 25;
+
+def _stefcal_allocations (snap0,snap1):
+  """Returns dict of "file:line" -> bytes allocated between two snapshots, attributed to StefCal source lines""";
+  filters = [ tracemalloc.Filter(True,STEFCAL_FILES,all_frames=True) ];
+  lines = {};
+  for stat in snap1.filter_traces(filters).compare_to(snap0.filter_traces(filters),'traceback'):
+    if stat.size_diff <= 0:
+      continue;
+    # tracebacks are ordered most recent call first
+    for frame in stat.traceback:
+      if fnmatch.fnmatch(frame.filename,STEFCAL_FILES):
+        key = "%s:%d"%(os.path.basename(frame.filename),frame.lineno);
+        lines[key] = lines.get(key,0) + stat.size_diff;
+        break;
+  return lines;
+
+def measure (args):
+  """Runs the warm-up and measured requests in this process, returns dict of measurements""";
+  sys.path.insert(0,args.tree);
+  # StefCal imports its gain classes as Calico.OMS.StefCal.*, with the Cattery directory on the path
+  sys.path.insert(0,os.path.join(args.tree,"Cattery"));
+  import numpy
+  from Cattery.Calico.OMS.StefCal.StefCal import StefCalNode
+  ifrs,data,model = _make_inputs(args.nant,args.ntime,args.nfreq);
+  state = dict(ifrs=ifrs,verbose=0,single_precision=args.single_precision,
+               gain_enable=True,gain_implementation=args.implementation,gain_max_iter=args.max_iter,
+               gain_save=False,gain_table=os.path.join(args.workdir,"gain.cp"),
+               apply_ifr_gains=False,rescale=True);
+  node = StefCalNode("stefcal_bench",0);
+  # the node is not attached to a meqserver, so drop its state updates
+  node.set_state = lambda field,value:None;
+  node.update_state(lambda name,default:setattr(node,name,state.get(name,default)));
+  results = [];
+  for itile in range(2):
+    request = _make_request(1+itile,itile,args.ntime,args.nfreq,2);
+    datares = _make_result(data,len(ifrs));
+    modelres = _make_result(model,len(ifrs));
+    gc.collect();
+    tracemalloc.start(NFRAMES);
+    snap0 = tracemalloc.take_snapshot();
+    mem0 = tracemalloc.get_traced_memory()[0];
+    if hasattr(tracemalloc,'reset_peak'):
+      tracemalloc.reset_peak();
+    res = node.get_result(request,datares,modelres);
+    mem1,peak = tracemalloc.get_traced_memory();
+    snap1 = tracemalloc.take_snapshot();
+    tracemalloc.stop();
+    results.append((peak-mem0,mem1-mem0,_stefcal_allocations(snap0,snap1)));
+    del res,datares,modelres,snap0,snap1;
+  cube = sum([ x.nbytes for x in data ]);
+  peak,retained,lines = results[-1];
+  stefcal = sum(lines.values());
+  top = sorted(lines.items(),key=lambda x:-x[1])[:args.top];
+  return dict(peak=peak,retained=retained,cube=cube,stefcal=stefcal,copies=stefcal/float(cube),
+              peak_copies=peak/float(cube),top=top);
+
+def _export (rev,dest):
+  """Exports the Cattery tree of a git revision into dest (or links the working tree for '.')""";
+  if rev == ".":
+    return REPO;
+  tree = os.path.join(dest,rev.replace("/","_").replace("^","_"));
+  os.mkdir(tree);
+  archive = subprocess.Popen(["git","-C",REPO,"archive",rev,"Cattery"],stdout=subprocess.PIPE);
+  subprocess.check_call(["tar","-x","-C",tree],stdin=archive.stdout);
+  if archive.wait():
+    raise RuntimeError("git archive %s failed"%rev);
+  return tree;
+
+def main ():
+  parser = argparse.ArgumentParser(description=__doc__.split("\n")[0]);
+  parser.add_argument("revs",nargs="*",default=["."],help="git revisions to measure ('.' for the working tree)");
+  parser.add_argument("--nant",type=int,default=14);
+  parser.add_argument("--ntime",type=int,default=60);
+  parser.add_argument("--nfreq",type=int,default=64);
+  parser.add_argument("--max-iter",type=int,default=10);
+  parser.add_argument("--implementation",default="GainDiag");
+  parser.add_argument("--single-precision",action="store_true");
+  parser.add_argument("--top",type=int,default=0,help="list the N StefCal source lines allocating the most");
+  parser.add_argument("--measure",action="store_true",help=argparse.SUPPRESS);
+  parser.add_argument("--tree",help=argparse.SUPPRESS);
+  parser.add_argument("--workdir",help=argparse.SUPPRESS);
+  args = parser.parse_args();
+  if args.measure:
+    print(json.dumps(measure(args)));
+    return;
+  tmpdir = tempfile.mkdtemp();
+  try:
+    print("%d antennas, %dx%d time/freq slots, %s, %s precision, max_iter %d"%(args.nant,args.ntime,args.nfreq,
+          args.implementation,"single" if args.single_precision else "double",args.max_iter));
+    print("%-24s %10s %10s %12s %11s %7s %10s"%("revision","cube MB","peak MB","retained MB","stefcal MB",
+          "copies","peak/cube"));
+    for rev in args.revs:
+      tree = _export(rev,tmpdir);
+      cmd = [sys.executable,os.path.abspath(__file__),"--measure","--tree",tree,"--workdir",tmpdir,
+             "--nant",str(args.nant),"--ntime",str(args.ntime),"--nfreq",str(args.nfreq),
+             "--max-iter",str(args.max_iter),"--implementation",args.implementation,"--top",str(args.top)];
+      if args.single_precision:
+        cmd.append("--single-precision");
+      output = subprocess.check_output(cmd,cwd=tmpdir);
+      res = json.loads(output.decode().strip().split("\n")[-1]);
+      print("%-24s %10.1f %10.1f %12.1f %11.1f %7.2f %10.2f"%(rev,res['cube']/1e6,res['peak']/1e6,res['retained']/1e6,
+            res['stefcal']/1e6,res['copies'],res['peak_copies']));
+      for line,size in res['top']:
+        print("    %-36s %10.2f MB"%(line,size/1e6));
+  finally:
+    shutil.rmtree(tmpdir);
+
+if __name__ == '__main__':
+  main();
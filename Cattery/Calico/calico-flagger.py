@@ -548,7 +548,7 @@ flagger = None;
 def _open_ms (msname):
   global flagger;
   # init a flagger
-  flagger = Calico.Flagger.Flagger(msname,verbose=5,chunksize=50000);
+  flagger = Calico.Flagger.Flagger(msname,verbose=5,chunksize=50000,stats_cache=True);
   # show/hide bitflag-related options
   add_bitflag_opt.show(not flagger.has_bitflags);
   for opt in flag_menu,remove_menu,fill_opt,transfer_menu:
@@ -151,6 +151,7 @@ diffgain_tag = 'dE';
 diffgain_group = 'cluster';
 
 from Calico.OMS.StefCal.GainOpts import GainOpts,MODE_SOLVE_SAVE,MODE_SOLVE_NOSAVE,MODE_SOLVE_APPLY
+from Calico.OMS.StefCal.GainTable import FORMAT_PICKLE,FORMAT_CHUNKED
 
 gopts = GainOpts("direction-independent gain","gain","G","stefcal");
 TDLCompileOptions(*gopts.tdl_options);
@@ -170,11 +171,38 @@ TDLCompileMenu("Use interferometer errors",
             {DIAGONLY:"parallel-hand only",ALLFOUR:"full 2x2"}),
   TDLOption("stefcal_per_chan_ifr_gains","Solve on a per-channel basis",False),
   TDLOption("stefcal_ifr_gain_table","Filename for solutions",["ifrgains.ma"],more=str),
+  TDLOption("stefcal_ifr_gain_table_format","Solution table format",
+    {FORMAT_PICKLE:"single file",FORMAT_CHUNKED:"chunked directory"}),
   toggle="stefcal_ifr_gains",
 );
 TDLCompileOption("stefcal_nmajor","Number of major loops",[1,2,3,5],more=int,default=2);
 TDLCompileOption("stefcal_rescale","Rescale data to model before solving",["no","scalar","per slot"]);
 TDLCompileOption("stefcal_noise_per_chan","Use per-channel noise estimates",True);
+TDLCompileOption("stefcal_solve_processes","Number of processes for solving frequency chunks in parallel",[0,4,8,16,32],more=int,default=0,
+  doc=
+  """If set to 2 or more, frequency chunks (made up of whole solution intervals) are solved independently in
+  this many worker processes. Gain terms that are smoothed in frequency are always solved serially.
+  """
+  );
+TDLCompileOption("stefcal_diffgain_jacobi","Solve for all differential gains simultaneously",False,
+  doc=
+  """If enabled, each major loop solves for all differential gains against the same residual, instead of one
+  direction after another. This converges somewhat slower per major loop, but the directions are independent,
+  so with the number of processes above set to 2 or more, they are solved in parallel.
+  """
+  );
+TDLCompileOption("stefcal_single_precision","Use single precision throughout",False,
+  doc=
+  """If enabled, data, model, gains and residuals are kept in single precision (complex64) for all gain terms,
+  which halves memory use and bandwidth. Solver sums are still accumulated in double precision.
+  """
+  );
+TDLCompileOption("stefcal_profile","Record a timing breakdown of the solution",False,
+  doc=
+  """If enabled, wall time, memory allocation and iteration counts are recorded per processing phase, per tile
+  and per gain term, and appended to stefcal-profile-<nodename>.jsonl next to the gain tables after every tile.
+  """
+  );
 stefcal_downsample = False;
 #TDLCompileMenu("Use on-the-fly downsampling",
 #  TDLCompileOption("stefcal_downsample_timeint","Downsampling interval, time axis (1 for full resolution)",[1],more=int,default=1),
@@ -275,6 +303,10 @@ def _define_forest(ns,parent=None,**kw):
                            baselines=[ array.baseline(ip,iq) for (ip,p),(iq,q) in array.ifr_index() ],
                            solve_ifrs=[ "%s:%s"%(p,q) for p,q in solve_ifrs ],
                            noise_per_chan=stefcal_noise_per_chan,
+                           solve_processes=stefcal_solve_processes,
+                           diffgain_jacobi=stefcal_diffgain_jacobi,
+                           single_precision=stefcal_single_precision,
+                           profile=stefcal_profile,
                            downsample_subtiling=downsample_subtiling,
                            num_major_loops=stefcal_nmajor,
                            regularization_factor=1e-6,#
@@ -290,6 +322,7 @@ def _define_forest(ns,parent=None,**kw):
                            reset_ifr_gains=stefcal_ifr_gain_reset,
                            save_ifr_gains=(stefcal_ifr_gain_mode == MODE_SOLVE_SAVE),
                            ifr_gain_table=stefcal_ifr_gain_table,
+                           ifr_gain_table_format=stefcal_ifr_gain_table_format,
                            per_chan_ifr_gains=stefcal_per_chan_ifr_gains,
                            diag_ifr_gains=(stefcal_diagonal_ifr_gains == DIAGONLY),
                            residuals=(do_output == CORRECTED_RESIDUALS),
@@ -0,0 +1,415 @@
+# -*- coding: utf-8 -*-
+"""Checks that the Flagger gives the same flags and stats in all of its processing modes, on a synthetic MS
+made with casacore, and that these match a plain numpy implementation of the flagging rules""";
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import os
+import time
+import shutil
+import pytest
+import numpy
+from functools import reduce
+
+tables = pytest.importorskip("casacore.tables")
+pytest.importorskip("Timba.Apps")
+pytest.importorskip("Purr")
+
+from Cattery.Calico.Flagger import Flagger
+
+NANT = 6
+NTIME = 20
+NCHAN = 8
+NCORR = 4
+NDDID = 2
+# small enough to give several chunks per DDID
+CHUNKSIZE = 64
+
+FLAG_COLUMNS = [ 'FLAG','FLAG_ROW','BITFLAG','BITFLAG_ROW' ];
+
+def _make_ms (msname,seed=0):
+  """Creates a synthetic MS with NDDID spectral windows, NTIME timeslots and all baselines of NANT antennas,
+  with random data, a few legacy flags and one existing flagset""";
+  rng = numpy.random.default_rng(seed);
+  a1,a2 = numpy.triu_indices(NANT,1);
+  nrows = NDDID*NTIME*len(a1);
+  desc = tables.maketabdesc([
+    tables.makescacoldesc('ANTENNA1',0),
+    tables.makescacoldesc('ANTENNA2',0),
+    tables.makescacoldesc('DATA_DESC_ID',0),
+    tables.makescacoldesc('FIELD_ID',0),
+    tables.makescacoldesc('TIME',0.),
+    tables.makescacoldesc('FLAG_ROW',False),
+    tables.makescacoldesc('BITFLAG_ROW',0),
+    tables.makearrcoldesc('DATA',0j,shape=[NCHAN,NCORR]),
+    tables.makearrcoldesc('CORRECTED_DATA',0j,shape=[NCHAN,NCORR]),
+    tables.makearrcoldesc('FLAG',False,shape=[NCHAN,NCORR]),
+    tables.makearrcoldesc('BITFLAG',0,shape=[NCHAN,NCORR]),
+  ]);
+  ms = tables.table(msname,desc,nrow=nrows,readonly=False,ack=False);
+  shape = (nrows,NCHAN,NCORR);
+  # interleave the DDIDs, so that sub-MSs are not contiguous
+  ms.putcol('DATA_DESC_ID',numpy.tile(numpy.arange(NDDID),nrows//NDDID));
+  ms.putcol('FIELD_ID',numpy.zeros(nrows,int));
+  ms.putcol('ANTENNA1',numpy.repeat(numpy.tile(a1,NTIME),NDDID));
+  ms.putcol('ANTENNA2',numpy.repeat(numpy.tile(a2,NTIME),NDDID));
+  ms.putcol('TIME',4.7e9+numpy.repeat(numpy.arange(NTIME)*10.,len(a1)*NDDID));
+  data = rng.standard_normal(shape)+1j*rng.standard_normal(shape);
+  ms.putcol('DATA',data);
+  ms.putcol('CORRECTED_DATA',data);
+  ms.putcol('FLAG',rng.random(shape)<.02);
+  ms.putcol('FLAG_ROW',rng.random(nrows)<.02);
+  ms.putcol('BITFLAG',(rng.random(shape)<.05).astype(numpy.int32));
+  ms.putcol('BITFLAG_ROW',numpy.zeros(nrows,numpy.int32));
+  ms.putcolkeyword('BITFLAG','FLAGSET_existing',1);
+  ms.putcolkeyword('BITFLAG','FLAGSETS','existing');
+  dd = tables.table(os.path.join(msname,'DATA_DESCRIPTION'),tables.maketabdesc([
+    tables.makescacoldesc('SPECTRAL_WINDOW_ID',0),
+    tables.makescacoldesc('POLARIZATION_ID',0),
+    tables.makescacoldesc('FLAG_ROW',False)]),nrow=NDDID,readonly=False,ack=False);
+  dd.putcol('SPECTRAL_WINDOW_ID',numpy.arange(NDDID));
+  dd.close();
+  ms.putkeyword('DATA_DESCRIPTION','Table: %s'%os.path.abspath(os.path.join(msname,'DATA_DESCRIPTION')));
+  ms.close();
+
+def _read_flags (msname):
+  ms = tables.table(msname,ack=False);
+  try:
+    return dict([ (col,ms.getcol(col)) for col in FLAG_COLUMNS ]);
+  finally:
+    ms.close();
+
+# operations applied in every mode: a mix of row, baseline, channel and clip selections, in both flag
+# and stats mode
+OPERATIONS = [
+  lambda fl:fl.flag("rows",create=True,antennas=[0,3],purr=False),
+  lambda fl:fl.flag("clip",create=True,clip_above=2.5,channels=slice(2,6),purr=False),
+  lambda fl:fl.unflag("rows",baselines=[(0,1),(3,4)],purr=False),
+  lambda fl:fl.transfer("legacy",create=True,ddid=1,purr=False),
+  lambda fl:fl.flag("existing",fill_legacy=1,corrs=[0,3],purr=False),
+  lambda fl:fl.get_stats("rows",purr=False),
+  lambda fl:fl.get_stats("clip",legacy=True,ddid=0,purr=False),
+  lambda fl:fl.get_stats(antennas=[1,2],baselines=[(1,2),(2,5)],purr=False),
+];
+
+# operations on the legacy flags, which take a purr argument as Flagger methods but not as FlagPlan methods
+LEGACY_OPERATIONS = [
+  lambda fl,**kw:fl.flag("clip",create=True,clip_above=2.5,**kw),
+  lambda fl,**kw:fl.set_legacy_flags(["existing","clip"],**kw),
+  lambda fl,**kw:fl.get_stats(0,legacy=True,**kw),
+  lambda fl,**kw:fl.flag("existing",fill_legacy=2,baselines=[(0,2),(1,5)],**kw),
+  lambda fl,**kw:fl.get_stats(0,legacy=True,ddid=1,**kw),
+  lambda fl,**kw:fl.clear_legacy_flags(**kw),
+  lambda fl,**kw:fl.get_stats(0,legacy=True,**kw),
+];
+
+def _fraction (flags):
+  """Fraction of raised flags, 0 for an empty selection""";
+  return flags.mean() if flags.size else 0;
+
+class _ReferenceFlagger (object):
+  """Applies flag(), unflag(), transfer() and get_stats() to the flag columns of a whole MS held in memory,
+  with plain numpy. Implements only the selections used by OPERATIONS.""";
+  def __init__ (self,msname):
+    ms = tables.table(msname,ack=False);
+    try:
+      self.cols = dict([ (col,ms.getcol(col)) for col in FLAG_COLUMNS+['ANTENNA1','ANTENNA2','DATA_DESC_ID','CORRECTED_DATA'] ]);
+    finally:
+      ms.close();
+    self.bits = { 'existing':1 };
+
+  def _bit (self,flag,create=False):
+    if not isinstance(flag,str):
+      return flag;
+    if flag not in self.bits:
+      assert create;
+      self.bits[flag] = min([ 1<<i for i in range(32) if 1<<i not in self.bits.values() ]);
+    return self.bits[flag];
+
+  def _rows (self,ddid=None,antennas=None,baselines=None):
+    """Returns mask of selected rows, checking every row in turn""";
+    a1,a2,dd = self.cols['ANTENNA1'],self.cols['ANTENNA2'],self.cols['DATA_DESC_ID'];
+    ddids = [ddid] if isinstance(ddid,int) else ddid;
+    return numpy.array([ (ddids is None or dd[i] in ddids) and
+                         (antennas is None or a1[i] in antennas or a2[i] in antennas) and
+                         (not baselines or (a1[i],a2[i]) in baselines) for i in range(len(a1)) ],bool);
+
+  def _pixels (self,rows,channels=None,corrs=None):
+    """Returns mask of selected correlations within the selected rows""";
+    chanmask = numpy.zeros(NCHAN,bool);
+    chanmask[channels if channels is not None else slice(None)] = True;
+    corrmask = numpy.zeros(NCORR,bool);
+    corrmask[corrs if corrs is not None else slice(None)] = True;
+    return rows[:,numpy.newaxis,numpy.newaxis]&chanmask[numpy.newaxis,:,numpy.newaxis]&corrmask;
+
+  def _flag (self,flag=0,unflag=0,create=False,fill_legacy=None,channels=None,corrs=None,clip_above=None,
+             purr=False,**sel):
+    flag,unflag = self._bit(flag,create),self._bit(unflag);
+    bf,bfr,lf,lfr = [ self.cols[col] for col in ('BITFLAG','BITFLAG_ROW','FLAG','FLAG_ROW') ];
+    rows = self._rows(**sel);
+    if channels is None and corrs is None and clip_above is None:
+      # whole rows: row and correlation flags are changed alike
+      mask = self._pixels(rows);
+    else:
+      mask = self._pixels(rows,channels,corrs);
+      if clip_above is not None:
+        mask &= abs(self.cols['CORRECTED_DATA'])>clip_above;
+      rows = mask.any(2).any(1);
+    bf[mask] = (bf[mask]&~unflag)|flag;
+    if channels is None and corrs is None and clip_above is None:
+      bfr[rows] = (bfr[rows]&~unflag)|flag;
+    else:
+      # the affected bits of a row flag are raised when they are raised in all correlations of the row
+      affected = flag|unflag;
+      allset = numpy.bitwise_and.reduce(bf[rows].reshape((rows.sum(),NCHAN*NCORR)),1);
+      bfr[rows] = (bfr[rows]&~affected)|(allset&affected);
+    if fill_legacy is not None:
+      lf[mask] = (bf[mask]&fill_legacy)!=0;
+      lfr[rows] = (bfr[rows]&fill_legacy)!=0;
+    return 0,0;
+
+  def flag (self,flag=1,**kw):
+    return self._flag(flag=flag,**kw);
+
+  def unflag (self,unflag=-1,**kw):
+    return self._flag(unflag=unflag,**kw);
+
+  def transfer (self,flag=1,replace=False,create=False,purr=False,**sel):
+    flag = self._bit(flag,create);
+    unflag = (replace and flag) or 0;
+    rows = self._rows(**sel);
+    for bcol,lcol,mask in ('BITFLAG_ROW','FLAG_ROW',rows),('BITFLAG','FLAG',self._pixels(rows)):
+      bf,lf = self.cols[bcol],self.cols[lcol];
+      bf[mask] = numpy.where(lf[mask],(bf[mask]&~unflag)|flag,bf[mask]&~unflag);
+    return _fraction(self.cols['FLAG_ROW'][rows]),_fraction(self.cols['FLAG'][self._pixels(rows)]);
+
+  def set_legacy_flags (self,flags,purr=False):
+    flagmask = reduce(lambda a,b:a|b,[ self._bit(fl) for fl in flags ],0);
+    self.cols['FLAG'][...] = (self.cols['BITFLAG']&flagmask)!=0;
+    self.cols['FLAG_ROW'][...] = (self.cols['BITFLAG_ROW']&flagmask)!=0;
+
+  def clear_legacy_flags (self,purr=False):
+    self.cols['FLAG'][...] = False;
+    self.cols['FLAG_ROW'][...] = False;
+
+  def get_stats (self,flag=0,legacy=False,purr=False,**sel):
+    flag = self._bit(flag);
+    if not flag and not legacy:
+      flag = -1;
+    rows = self._rows(**sel);
+    pixels = self._pixels(rows);
+    rowflags = (self.cols['BITFLAG_ROW'][rows]&flag)!=0;
+    pixflags = (self.cols['BITFLAG'][pixels]&flag)!=0;
+    if legacy:
+      rowflags |= self.cols['FLAG_ROW'][rows];
+      pixflags |= self.cols['FLAG'][pixels];
+    return _fraction(rowflags),_fraction(pixflags);
+
+  def flag_columns (self):
+    return dict([ (col,self.cols[col]) for col in FLAG_COLUMNS ]);
+
+def _run_reference (msname):
+  """Applies the OPERATIONS with a _ReferenceFlagger. Returns list of operation results, and the final
+  flag columns""";
+  fl = _ReferenceFlagger(msname);
+  results = [ op(fl) for op in OPERATIONS ];
+  return results,fl.flag_columns();
+
+def _run (msname,**kw):
+  """Runs the OPERATIONS on msname using a Flagger created with the given arguments.
+  Returns list of operation results, and the final flag columns.""";
+  fl = Flagger(msname,chunksize=CHUNKSIZE,**kw);
+  try:
+    results = [ op(fl) for op in OPERATIONS ];
+  finally:
+    fl.close();
+  return results,_read_flags(msname);
+
+def _run_plan (msname,operations,**kw):
+  """Applies the operations on msname as one FlagPlan, using a Flagger created with the given arguments.
+  Returns list of operation results, and the final flag columns.""";
+  fl = Flagger(msname,chunksize=CHUNKSIZE,**kw);
+  try:
+    plan = fl.plan();
+    for op in operations:
+      op(plan);
+    results = plan.run(purr=False);
+  finally:
+    fl.close();
+  return results,_read_flags(msname);
+
+@pytest.fixture
+def serial_run (tmp_path):
+  """Makes the synthetic MS, returns a function to make a fresh copy of it, and the results of a plain serial run""";
+  ms0 = str(tmp_path/"orig.ms");
+  _make_ms(ms0);
+  counter = [0];
+  def copy_ms ():
+    counter[0] += 1;
+    msname = str(tmp_path/("copy%d.ms"%counter[0]));
+    shutil.copytree(ms0,msname);
+    return msname;
+  return copy_ms,_run(copy_ms());
+
+def _check_same (results,reference):
+  (res,flags),(res0,flags0) = results,reference;
+  assert len(res) == len(res0);
+  # operations that return nothing are only checked through the flags
+  for x,x0 in zip(res,res0):
+    if x0 is not None:
+      numpy.testing.assert_allclose(numpy.array(x,float),numpy.array(x0,float),rtol=1e-12);
+  for col in FLAG_COLUMNS:
+    assert (flags[col] == flags0[col]).all(), col;
+
+def test_operations_change_flags (serial_run):
+  copy_ms,(results,flags) = serial_run;
+  flags0 = _read_flags(copy_ms());
+  assert not (flags['BITFLAG'] == flags0['BITFLAG']).all();
+  assert not (flags['FLAG'] == flags0['FLAG']).all();
+
+def test_serial_matches_reference (serial_run):
+  copy_ms,reference = serial_run;
+  _check_same(reference,_run_reference(copy_ms()));
+
+@pytest.mark.parametrize("kw",[ dict(processes=2),dict(processes=3),dict(processes=2,stats_cache=True),
+                                dict(pipelined=True),dict(pipelined=True,processes=2) ])
+def test_parallel_matches_serial (serial_run,kw):
+  copy_ms,reference = serial_run;
+  _check_same(_run(copy_ms(),**kw),reference);
+
+@pytest.mark.parametrize("kw",[ dict(),dict(pipelined=True),dict(stats_cache=True) ])
+def test_plan_matches_single_operations (serial_run,kw):
+  copy_ms,reference = serial_run;
+  _check_same(_run_plan(copy_ms(),OPERATIONS,**kw),reference);
+
+def test_plan_legacy_flags (serial_run):
+  copy_ms,reference = serial_run;
+  msname = copy_ms();
+  fl = Flagger(msname,chunksize=CHUNKSIZE);
+  try:
+    results = [ op(fl,purr=False) for op in LEGACY_OPERATIONS ];
+  finally:
+    fl.close();
+  single = results,_read_flags(msname);
+  ref = _ReferenceFlagger(copy_ms());
+  _check_same(single,([ op(ref,purr=False) for op in LEGACY_OPERATIONS ],ref.flag_columns()));
+  _check_same(_run_plan(copy_ms(),LEGACY_OPERATIONS),single);
+
+# baseline selections with reversed, repeated, out-of-range and negative antennas
+BASELINE_SELECTIONS = [ [(0,1)],[(1,0),(2,5),(2,5)],[(0,1),(3,4),(4,3),(5,99),(-1,2),(2,-1)],[(7,8)],[(-2,-1)] ];
+
+@pytest.mark.parametrize("baselines",BASELINE_SELECTIONS)
+def test_baseline_mask (baselines):
+  from Cattery.Calico.Flagger import _BaselineMask
+  bmask = _BaselineMask(baselines);
+  a1,a2 = [ x.ravel() for x in numpy.meshgrid(numpy.arange(-2,NANT+3),numpy.arange(-2,NANT+3)) ];
+  expected = numpy.array([ (p,q) in baselines for p,q in zip(a1,a2) ],bool);
+  assert (bmask.rowmask(a1,a2) == expected).all();
+  assert [ bmask.selects(p,q) for p,q in zip(a1,a2) ] == list(expected);
+  # rows of valid antennas only
+  valid = (a1>=0)&(a2>=0)&(a1<NANT)&(a2<NANT);
+  assert (bmask.rowmask(a1[valid],a2[valid]) == expected[valid]).all();
+
+@pytest.mark.parametrize("baselines",BASELINE_SELECTIONS)
+def test_baseline_flagging (serial_run,baselines):
+  copy_ms,reference = serial_run;
+  operations = [
+    lambda fl:fl.flag("bl",create=True,baselines=baselines,purr=False),
+    lambda fl:fl.flag("blchan",create=True,baselines=baselines,channels=slice(1,3),purr=False),
+    lambda fl:fl.unflag("existing",baselines=baselines,antennas=[0,1,2],purr=False),
+    lambda fl:fl.get_stats("bl",baselines=baselines,purr=False),
+    lambda fl:fl.get_stats(legacy=True,baselines=baselines,ddid=1,purr=False),
+  ];
+  msname = copy_ms();
+  fl = Flagger(msname,chunksize=CHUNKSIZE);
+  try:
+    results = [ op(fl) for op in operations ],_read_flags(msname);
+  finally:
+    fl.close();
+  ref = _ReferenceFlagger(copy_ms());
+  _check_same(results,([ op(ref) for op in operations ],ref.flag_columns()));
+
+# get_stats() queries that can be answered from the flag summary
+STATS_QUERIES = [
+  dict(),dict(flag="existing"),dict(flag="existing",legacy=True),dict(flag=0,legacy=True),
+  dict(flag="existing",ddid=1),dict(legacy=True,ddid=[0,1],antennas=[2,5]),
+  dict(flag="existing",baselines=[(0,1),(1,0),(2,5),(5,99),(-1,2)]),
+  dict(flag=3,legacy=True,antennas=[0],baselines=[(0,4),(1,4)]),
+];
+
+def _get_stats (fl):
+  return [ fl.get_stats(purr=False,**kw) for kw in STATS_QUERIES ];
+
+def _check_stats (stats,reference):
+  for x,x0 in zip(stats,reference):
+    numpy.testing.assert_allclose(numpy.array(x,float),numpy.array(x0,float),rtol=1e-12);
+
+def _count_summary_builds (monkeypatch):
+  """Counts chunks read in to build the flag summary from scratch""";
+  from Cattery.Calico.Flagger import _FlagStats
+  builds = [];
+  add = _FlagStats.add;
+  monkeypatch.setattr(_FlagStats,"add",lambda self,*args:builds.append(1) or add(self,*args));
+  return builds;
+
+def test_stats_cache (serial_run,monkeypatch):
+  copy_ms,reference = serial_run;
+  msname = copy_ms();
+  ref = _ReferenceFlagger(copy_ms());
+  builds = _count_summary_builds(monkeypatch);
+  fl = Flagger(msname,chunksize=CHUNKSIZE,stats_cache=True);
+  try:
+    _check_stats(_get_stats(fl),_get_stats(ref));
+    nbuilds = len(builds);
+    assert nbuilds;
+    # the summary is kept up to date by flagging operations, rather than rebuilt
+    for op in OPERATIONS[:5]+LEGACY_OPERATIONS[:3]:
+      op(fl);
+      op(ref);
+      _check_stats(_get_stats(fl),_get_stats(ref));
+    assert len(builds) == nbuilds;
+  finally:
+    fl.close();
+  # the summary is picked up by a new Flagger
+  assert os.path.exists(os.path.join(msname,Flagger.FLAGSTATS_FILE));
+  fl = Flagger(msname,chunksize=CHUNKSIZE,stats_cache=True);
+  try:
+    _check_stats(_get_stats(fl),_get_stats(ref));
+  finally:
+    fl.close();
+  assert len(builds) == nbuilds;
+  # and is the same as one built from scratch
+  fl = Flagger(msname,chunksize=CHUNKSIZE,stats_cache=True);
+  try:
+    os.remove(os.path.join(msname,Flagger.FLAGSTATS_FILE));
+    _check_stats(_get_stats(fl),_get_stats(ref));
+  finally:
+    fl.close();
+  assert len(builds) > nbuilds;
+
+def test_stats_cache_external_change (serial_run,monkeypatch):
+  copy_ms,reference = serial_run;
+  msname = copy_ms();
+  fl = Flagger(msname,chunksize=CHUNKSIZE,stats_cache=True);
+  try:
+    _get_stats(fl);
+  finally:
+    fl.close();
+  # modify the flags behind the Flagger's back. File modification times have a limited resolution, so
+  # give them time to move on.
+  time.sleep(.1);
+  ms = tables.table(msname,readonly=False,ack=False);
+  try:
+    ms.putcol('BITFLAG',ms.getcol('BITFLAG')^1);
+    ms.putcol('FLAG_ROW',~ms.getcol('FLAG_ROW'));
+  finally:
+    ms.close();
+  builds = _count_summary_builds(monkeypatch);
+  fl = Flagger(msname,chunksize=CHUNKSIZE,stats_cache=True);
+  try:
+    stats = _get_stats(fl);
+  finally:
+    fl.close();
+  assert builds;
+  _check_stats(stats,_get_stats(_ReferenceFlagger(msname)));
@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+"""Checks ParmTab reductions and bulk reads against the funklets a synthetic parmtable was made from,
+and against reading the funklets one by one""";
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import os
+import copy
+import time
+import shutil
+import pytest
+import numpy
+
+pytest.importorskip("Timba.parmtables")
+
+from Timba.parmtables import FastParmTable
+from Timba.Meq import meq
+from Cattery.Calico import ParmTables
+from Cattery.Calico import FunkOps
+
+NTIME = 6
+NFREQ = 4
+# scalar funklets for all domains, 2x2 polcs, and a name with missing domains
+SCALAR_NAMES = [ "G:%d:%s"%(ant,corr) for ant in range(3) for corr in ("rxx","ryy") ];
+POLC_NAME = "B:0:rxx";
+SPARSE_NAME = "D:0";
+
+def _domain (itime,ifreq):
+  return meq.gen_domain(time=(itime*10.,itime*10.+10.),freq=(1e8+ifreq*1e6,1e8+ifreq*1e6+1e6));
+
+def _domain_key (domain):
+  return tuple(sorted([ (str(axis),tuple(rng)) for axis,rng in domain.items() if str(axis) != 'axis_map' ]));
+
+def _make_table (path,seed=0):
+  """Writes a synthetic parmtable, returns the funklets it was made from as a dict of
+  name -> { (itime,ifreq):coeff }""";
+  rng = numpy.random.default_rng(seed);
+  funklets = {};
+  for name in SCALAR_NAMES:
+    funklets[name] = dict([ ((i,j),float(rng.standard_normal())) for i in range(NTIME) for j in range(NFREQ) ]);
+  funklets[POLC_NAME] = dict([ ((i,j),rng.standard_normal((2,2))) for i in range(NTIME) for j in range(NFREQ) ]);
+  funklets[SPARSE_NAME] = dict([ ((i,j),float(rng.standard_normal())) for i in range(NTIME) for j in range(NFREQ)
+                                 if (i+j)%3 ]);
+  pt = FastParmTable(path,True);
+  for name,funks in funklets.items():
+    for (i,j),coeff in funks.items():
+      pt.put_funklet(name,meq.polc(coeff,domain=_domain(i,j)));
+  pt = None;
+  return funklets;
+
+def _read_table (path):
+  """Returns content of parmtable as dict of (name,domain_key) -> coeff array""";
+  pt = FastParmTable(path);
+  return dict([ ((name,_domain_key(domain)),numpy.asarray(pt.get_funklet(name,idom).coeff,float))
+                for name,idom,domain in pt.funklet_list() ]);
+
+def _check_same_content (content,reference):
+  assert sorted(content.keys()) == sorted(reference.keys());
+  for key,coeff in content.items():
+    numpy.testing.assert_array_equal(coeff,reference[key],err_msg=str(key));
+
+@pytest.fixture
+def table (tmp_path):
+  """Makes the synthetic parmtable, returns its path, the funklets it was made from, and a function
+  to make fresh copies of it""";
+  path = str(tmp_path/"orig.fmep");
+  funklets = _make_table(path);
+  counter = [0];
+  def copy_table ():
+    counter[0] += 1;
+    newpath = str(tmp_path/("copy%d.fmep"%counter[0]));
+    shutil.copytree(path,newpath);
+    return newpath;
+  return path,funklets,copy_table;
+
+def _expected_time_average (funklets):
+  """Returns expected content of a table reduced by FunkOps.average over time, as _read_table() would""";
+  expected = {};
+  for name,funks in funklets.items():
+    for j in range(NFREQ):
+      times = [ i for i in range(NTIME) if (i,j) in funks ];
+      if times:
+        domain = meq.gen_domain(time=(times[0]*10.,times[-1]*10.+10.),freq=(1e8+j*1e6,1e8+j*1e6+1e6));
+        expected[name,_domain_key(domain)] = numpy.mean([ funks[i,j] for i in times ],0);
+  return expected;
+
+@pytest.mark.parametrize("processes",[1,2])
+def test_apply_average (table,processes):
+  path,funklets,copy_table = table;
+  outpath = copy_table()+".out";
+  ParmTables.open(path).apply(FunkOps.average,"time",outtab=outpath,newtab=True,processes=processes);
+  content = _read_table(outpath);
+  expected = _expected_time_average(funklets);
+  assert sorted(content.keys()) == sorted(expected.keys());
+  for key,coeff in content.items():
+    numpy.testing.assert_allclose(coeff,expected[key],rtol=1e-12,err_msg=str(key));
+
+@pytest.mark.parametrize("processes",[1,2])
+def test_apply_in_place_with_remove (table,processes,monkeypatch):
+  path,funklets,copy_table = table;
+  reference = copy_table();
+  ParmTables.open(reference).apply(FunkOps.average,"time",outtab=reference+".out",newtab=True);
+  # replace the funklets in place: the per-name domain index is kept up to date as names are written,
+  # rather than being rebuilt from the whole table for every name
+  inplace = copy_table();
+  pt = ParmTables.ParmTab(inplace,write=True);
+  rebuilds = [];
+  index_name_domains = ParmTables.ParmTab._index_name_domains;
+  monkeypatch.setattr(ParmTables.ParmTab,"_index_name_domains",lambda self:rebuilds.append(1) or index_name_domains(self));
+  pt.apply(FunkOps.average,"time",outtab=pt,remove=True,processes=processes);
+  assert len(rebuilds) <= 1;
+  _check_same_content(_read_table(inplace),_read_table(reference+".out"));
+  # the index as seen by the same ParmTab object matches the table content
+  fresh = index_name_domains(pt);
+  for name in funklets:
+    numpy.testing.assert_array_equal(pt.name_domains(name),fresh[name]);
+
+def test_name_domains_after_remove (table):
+  path,funklets,copy_table = table;
+  pt = ParmTables.ParmTab(copy_table(),write=True);
+  name = SCALAR_NAMES[0];
+  funkset = pt.funkset(name);
+  results = funkset.reduce(FunkOps.force_rank0,"time");
+  before = dict([ (nm,pt.name_domains(nm).copy()) for nm in funklets ]);
+  # write to a separate table, removing the input funklets of one name: only that name changes
+  outtab = ParmTables.ParmTab(copy_table()+".out",write=True,new=True);
+  funkset.write(results[:2],outtab,remove=True);
+  removed = sorted([ idom for sl0,domains,outfunk in results[:2] for idom in domains ]);
+  numpy.testing.assert_array_equal(pt.name_domains(name),numpy.setdiff1d(before[name],removed));
+  for nm in funklets:
+    if nm != name:
+      numpy.testing.assert_array_equal(pt.name_domains(nm),before[nm]);
+  fresh = pt._index_name_domains();
+  for nm in funklets:
+    numpy.testing.assert_array_equal(pt.name_domains(nm),fresh[nm]);
+  # the output table picks up the names written to it
+  assert len(outtab.name_domains(name)) == sum([ len(outfunk) for sl0,domains,outfunk in results[:2] ]);
+
+def _funklet_coeffs (pt,name):
+  """Reads the funklets of a name one by one over all domains of the table, returns dict of idom -> coeff""";
+  parmtable = pt.parmtable();
+  idoms = sorted(set([ idom for nm,idom,domain in parmtable.funklet_list() ]));
+  coeffs = {};
+  for idom in idoms:
+    funk = parmtable.get_funklet(name,idom);
+    if funk:
+      coeffs[idom] = numpy.asarray(funk.coeff,float);
+  return coeffs;
+
+@pytest.mark.parametrize("domains",[None,(3,11),(0,1000),[0,5,7,7,2,500]])
+def test_get_coeffs (table,domains):
+  path,funklets,copy_table = table;
+  pt = ParmTables.open(path);
+  for name in funklets:
+    expected = _funklet_coeffs(pt,name);
+    if isinstance(domains,tuple):
+      expected = dict([ (idom,c) for idom,c in expected.items() if domains[0] <= idom < domains[1] ]);
+    elif domains is not None:
+      expected = dict([ (idom,c) for idom,c in expected.items() if idom in domains ]);
+    idoms = sorted(expected.keys());
+    fs = pt.funkset(name);
+    # whole coeff arrays
+    idoms1,coeffs = fs.get_coeffs(None,domains);
+    assert list(idoms1) == idoms;
+    for idom,c in zip(idoms1,coeffs):
+      numpy.testing.assert_array_equal(c,numpy.atleast_1d(expected[idom]));
+    # single coefficients
+    for coeff in (0,(0,0),(1,0),(1,1)):
+      if coeff in (0,(0,0)) or name == POLC_NAME:
+        idoms1,values = fs.get_coeffs(coeff,domains);
+        assert list(idoms1) == idoms;
+        numpy.testing.assert_array_equal(values,[ expected[idom].ravel()[0] if coeff in (0,(0,0)) else expected[idom][coeff]
+                                                  for idom in idoms ]);
+      elif idoms:
+        with pytest.raises(IndexError):
+          fs.get_coeffs(coeff,domains);
+
+@pytest.mark.parametrize("collapse",[False,True])
+def test_array_matches_slice (table,collapse):
+  path,funklets,copy_table = table;
+  pt = ParmTables.open(copy_table());
+  for name in funklets:
+    fs = pt.funkset(name);
+    for coeff in ((0,(1,0)) if name == POLC_NAME else (0,)):
+      # the array is built from a bulk read, the slice from per-funklet reads
+      reference = fs.get_slice().array(coeff,fill_value=0,masked=True,collapse=collapse);
+      arr = fs.array(coeff,masked=True,collapse=collapse);
+      assert arr.shape == reference.shape;
+      numpy.testing.assert_array_equal(numpy.ma.getmaskarray(arr),numpy.ma.getmaskarray(reference));
+      numpy.testing.assert_array_equal(arr.filled(0),reference.filled(0));
+      numpy.testing.assert_array_equal(fs.array(coeff,fill_value=-1,masked=False,collapse=collapse),
+                                       fs.get_slice().array(coeff,fill_value=-1,masked=False,collapse=collapse));
+
+def _index_content (pt):
+  """Returns everything the ParmTab index provides, in a comparable form""";
+  ndom = len(pt.domain_cell_array());
+  cells = [ [ None if i < 0 else int(i) for i in cell ] for cell in pt.domain_cell_array() ];
+  return dict(names=list(pt.funklet_names()),
+              components=[ sorted(x) for x in pt.funklet_name_components() ],
+              axes=[ sorted(pt.axis_stats(i).cells.items()) for i in range(len(cells[0])) ],
+              envelope=_domain_key(pt.envelope_domain()),
+              cells=cells,bounds=numpy.array(pt.domain_bounds_array()),
+              lookup=list(pt.lookup_domains(cells+[[0,None]+cells[0][2:],[None,0]+cells[0][2:]])),
+              name_domains=dict([ (name,list(pt.name_domains(name))) for name in pt.funklet_names() ]),
+              ndom=ndom);
+
+def _check_same_index (content,reference):
+  numpy.testing.assert_array_equal(content['bounds'],reference['bounds']);
+  assert dict([ item for item in content.items() if item[0] != 'bounds' ]) == \
+         dict([ item for item in reference.items() if item[0] != 'bounds' ]);
+
+def _check_index (pt,path):
+  """Checks the index of a ParmTab against the domains of the table""";
+  content = _index_content(pt);
+  domains = FastParmTable(path).domain_list();
+  assert content['ndom'] == len(domains);
+  for idom,domain in enumerate(domains):
+    i,j = int(round(domain.time[0]/10.)),int(round((domain.freq[0]-1e8)/1e6));
+    assert content['cells'][idom][:2] == [i,j];
+    assert content['lookup'][idom] == idom;
+  assert content['lookup'][-2:] == [-1,-1];
+  return content;
+
+def test_index_cache_reload (table,monkeypatch):
+  path,funklets,copy_table = table;
+  path = copy_table();
+  content0 = _check_index(ParmTables.ParmTab(path),path);
+  assert sorted(content0['names']) == sorted(funklets.keys());
+  for name,funks in funklets.items():
+    assert [ tuple(content0['cells'][idom][:2]) for idom in content0['name_domains'][name] ] == sorted(funks.keys());
+  # reopening loads the index from the cache, without reading the domain list
+  monkeypatch.setattr(FastParmTable,"domain_list",lambda self:pytest.fail("index regenerated"));
+  pt = ParmTables.ParmTab(path);
+  _check_same_index(_index_content(pt),content0);
+  monkeypatch.undo();
+  # the cache is regenerated once the table is written to. File modification times have a limited resolution,
+  # so give them time to move on.
+  time.sleep(.1);
+  ParmTables.ParmTab(path,write=True).parmtable(True).put_funklet(SPARSE_NAME,meq.polc(1.,domain=_domain(NTIME,0)));
+  content1 = _check_index(ParmTables.ParmTab(path),path);
+  assert content1['ndom'] == content0['ndom']+1;
+  assert content1['name_domains'][SPARSE_NAME] == content0['name_domains'][SPARSE_NAME]+[content0['ndom']];
+  _check_same_index(_index_content(ParmTables.ParmTab(path)),content1);
+  # a broken cache is regenerated
+  with open(os.path.join(path,ParmTables.ParmTab.INDEX_CACHE_HEADER),'w') as fobj:
+    fobj.write("{");
+  os.utime(os.path.join(path,ParmTables.ParmTab.INDEX_CACHE_HEADER),None);
+  _check_same_index(_index_content(ParmTables.ParmTab(path)),content1);
+
+def test_array_cache_reload (table,monkeypatch):
+  path,funklets,copy_table = table;
+  path = copy_table();
+  pt = ParmTables.ParmTab(path);
+  arrays = dict([ (name,pt.funkset(name).array(masked=True,collapse=False)) for name in funklets ]);
+  for name,funks in funklets.items():
+    arr = arrays[name];
+    assert arr.shape == (NTIME,NFREQ);
+    for i in range(NTIME):
+      for j in range(NFREQ):
+        assert arr.mask[i,j] == ((i,j) not in funks);
+        assert arr[i,j] is numpy.ma.masked or arr[i,j] == numpy.asarray(funks[i,j]).ravel()[0];
+  # reopening reads the arrays from the cache, without reading any funklets
+  monkeypatch.setattr(ParmTables.FunkSet,"get_coeffs",lambda self,*args:pytest.fail("array regenerated"));
+  pt = ParmTables.ParmTab(path);
+  for name in funklets:
+    arr = pt.funkset(name).array(masked=True,collapse=False);
+    numpy.testing.assert_array_equal(numpy.ma.getmaskarray(arr),numpy.ma.getmaskarray(arrays[name]));
+    numpy.testing.assert_array_equal(arr.filled(0),arrays[name].filled(0));
+    numpy.testing.assert_array_equal(pt.funkset(name).array(fill_value=-1,masked=False),arrays[name].filled(-1));
+    # the cached array may be modified by the caller, without changing the cache
+    arr[...] = 42;
+    numpy.testing.assert_array_equal(pt.funkset(name).array(masked=True,collapse=False).filled(0),arrays[name].filled(0));
+  monkeypatch.undo();
+  # once the table is written to, the arrays are regenerated
+  time.sleep(.1);
+  ParmTables.ParmTab(path,write=True).parmtable(True).put_funklet(SPARSE_NAME,meq.polc(5.,domain=_domain(0,0)));
+  pt = ParmTables.ParmTab(path);
+  arr = pt.funkset(SPARSE_NAME).array(masked=True,collapse=False);
+  assert arr[0,0] == 5. and not arr.mask[0,0];
+  expected = arrays[SPARSE_NAME].copy();
+  expected[0,0] = 5.;
+  numpy.testing.assert_array_equal(numpy.ma.getmaskarray(arr),numpy.ma.getmaskarray(expected));
+  numpy.testing.assert_array_equal(arr.filled(0),expected.filled(0));
+
+# list-based versions of the FunkOps reductions, which work through the funklets one by one
+def _list_average (funkslice):
+  outfunk = funkslice[0];
+  for funk in funkslice[1:]:
+    outfunk.coeff += funk.coeff;
+    for axis in funkslice.slice_axes:
+      outfunk.domain[axis] = (min(outfunk.domain[axis][0],funk.domain[axis][0]),
+                              max(outfunk.domain[axis][1],funk.domain[axis][1]));
+  outfunk.coeff /= len(funkslice);
+  return [ outfunk ];
+
+def _c00 (funk):
+  return funk.coeff if numpy.isscalar(funk.coeff) else funk.coeff.ravel()[0];
+
+def _list_linear_interpol (funkslice):
+  if len(funkslice) < 2:
+    return funkslice;
+  if funkslice.rank > 1:
+    raise TypeError("linear interpolation only available for rank-1 slices");
+  iaxis0,axis0 = funkslice.slice_iaxes[0],funkslice.slice_axes[0];
+  output = [];
+  for ifunk0,funk0 in enumerate(funkslice[:-1]):
+    funk1 = funkslice[ifunk0+1];
+    x0,x1 = sum(funk0.domain[axis0])/2,sum(funk1.domain[axis0])/2;
+    c0,c1 = _c00(funk0),_c00(funk1);
+    out_domain = copy.copy(funk0.domain);
+    out_domain[axis0] = (funk0.domain[axis0][0] if ifunk0 == 0 else x0,
+                         funk1.domain[axis0][1] if ifunk0 == len(funkslice)-2 else x1);
+    output.append(meq.polc(coeff=[c0,c1-c0],domain=out_domain,offset=x0,scale=x1-x0,axis_index=iaxis0));
+  return output;
+
+def _list_force_rank0 (funkslice):
+  return [ meq.polc(coeff=_c00(funk),domain=funk.domain) for funk in funkslice ];
+
+def _check_same_funklets (funklets,reference):
+  assert len(funklets) == len(reference);
+  for funk,funk0 in zip(funklets,reference):
+    numpy.testing.assert_allclose(numpy.asarray(funk.coeff,float),numpy.asarray(funk0.coeff,float),rtol=1e-12,atol=1e-15);
+    assert _domain_key(funk.domain) == _domain_key(funk0.domain);
+    for attr in 'offset','scale':
+      assert getattr(funk,attr,None) == getattr(funk0,attr,None);
+
+@pytest.mark.parametrize("op_func,list_func",[
+    (FunkOps.average,_list_average),(FunkOps.linear_interpol,_list_linear_interpol),
+    (FunkOps.force_rank0,_list_force_rank0) ])
+@pytest.mark.parametrize("slicing",["time","freq",["time","freq"]])
+def test_stacked_reductions (table,op_func,list_func,slicing):
+  path,funklets,copy_table = table;
+  pt = ParmTables.open(path);
+  for name in funklets:
+    fs = pt.funkset(name);
+    # reduce() reads in fresh funklets for every call, so the reductions can't affect each other
+    results,reference = fs.reduce(op_func,slicing),fs.reduce(list_func,slicing);
+    assert [ (sl0,domains) for sl0,domains,outfunk in results ] == \
+           [ (sl0,domains) for sl0,domains,outfunk in reference ];
+    for (sl0,domains,outfunk),(sl0,domains,outfunk0) in zip(results,reference):
+      _check_same_funklets(outfunk,outfunk0);
+
+def test_get_stacked (table):
+  path,funklets,copy_table = table;
+  pt = ParmTables.open(path);
+  for name in funklets:
+    fs = pt.funkset(name);
+    funkslice = fs.get_slice();
+    coeffs0,bounds0 = FunkOps.stack(funkslice);
+    idoms,coeffs,bounds = fs.get_stacked();
+    assert list(idoms) == [ funk.domain_index for funk in funkslice ];
+    numpy.testing.assert_array_equal(bounds,bounds0);
+    numpy.testing.assert_array_equal(coeffs.reshape(coeffs0.shape),coeffs0);
+    numpy.testing.assert_array_equal(FunkOps.stacked_c00(coeffs),[ _c00(funk) for funk in funkslice ]);
+    # the stacked reductions take either form
+    for c,b in (coeffs,bounds),(coeffs0,bounds0):
+      avg,avg_bounds = FunkOps.stacked_average(c,b,funkslice.slice_iaxes);
+      outfunk, = _list_average(fs.get_slice());
+      numpy.testing.assert_allclose(avg.reshape(numpy.shape(outfunk.coeff)),outfunk.coeff,rtol=1e-12);
+      for iaxis,axis in zip(funkslice.slice_iaxes,funkslice.slice_axes):
+        assert tuple(avg_bounds[0,iaxis]) == tuple(outfunk.domain[axis]);
@@ -37,7 +37,10 @@ from __future__ import division
 
 import sys,time
 import math,struct
+import bisect
+import numpy
 import pickle # for serialization and file io
+import json
 # from Dummy import *
 
 from .common_utils import *
@@ -116,6 +119,8 @@ class PUnit:
  # change apparent brightness
  def setBrightness(self,brightness):
   self.app_brightness=brightness
+  if self.lsm is not None:
+   self.lsm.brightnessChanged(self.name)
 
  # return value
  # type='I','Q','U','V' or 'A' for app_brightness
@@ -263,18 +268,86 @@ class PUnit:
    # change static values
    self.sp.set_staticRA(new_ra)
    self.sp.set_staticDec(new_dec)
+   if self.lsm is not None:
+    self.lsm.invalidateSpatialIndex()
+
+###############################################
+class SpatialIndex:
+ """Spatial index of the p-Units of an LSM, used for positional queries.
+ Attributes are
+  names: p-Unit names, sorted by Dec
+  rank: position of each p-Unit in the p-Unit table (to restore that order)
+  ra,dec: RA and Dec of each p-Unit, in radians
+  xyz: direction cosines of each p-Unit, shape (N,3)
+  types,brightness: type and apparent brightness of each p-Unit
+  in_patch: True for point sources that belong to a patch
+
+ All attributes except names are arrays. Box and cone queries find a band 
+ of Dec by bisection, and only look at the p-Units inside it.
+ The index is built by LSM.getSpatialIndex(), and is discarded whenever
+ p-Units are added, moved or patched.
+ """
+ def __init__(self,p_table):
+  names=list(p_table.keys())
+  punits=[p_table[pname] for pname in names]
+  dec=numpy.array([pu.sp.getDec() for pu in punits],float)
+  order=numpy.argsort(dec,kind='stable')
+  self.names=[names[i] for i in order]
+  self.rank=order
+  self.dec=dec[order]
+  self.ra=numpy.array([pu.sp.getRA() for pu in punits],float)[order]
+  self.types=numpy.array([pu.getType() for pu in punits],int)[order]
+  self.brightness=numpy.array([pu.getBrightness() for pu in punits],float)[order]
+  self.in_patch=numpy.array([pu._patch_name is not None for pu in punits],bool)[order]
+  cosdec=numpy.cos(self.dec)
+  self.xyz=numpy.stack([numpy.cos(self.ra)*cosdec,numpy.sin(self.ra)*cosdec,numpy.sin(self.dec)],1)
+
+ # return mask of p-Units that are "visible" in the LSM, i.e. 
+ # patches and point/Gaussian sources not in a patch
+ def visible(self):
+  return (((self.types==POINT_TYPE)|(self.types==GAUSS_TYPE))&~self.in_patch)|\
+    (self.types==PATCH_TYPE)
+
+ # return [i0,i1) range of p-Units with dec0<=Dec<=dec1
+ def dec_band(self,dec0,dec1):
+  return numpy.searchsorted(self.dec,dec0,'left'),numpy.searchsorted(self.dec,dec1,'right')
+
+ # return indices of p-Units in the box given by RA and Dec ranges,
+ # if ra0>ra1, the RA range is taken to wrap around 2pi
+ def box(self,ra0,ra1,dec0,dec1):
+  i0,i1=self.dec_band(dec0,dec1)
+  ra=self.ra[i0:i1]
+  if ra0<=ra1:
+   mask=(ra>=ra0)&(ra<=ra1)
+  else:
+   mask=(ra>=ra0)|(ra<=ra1)
+  return i0+numpy.nonzero(mask)[0]
+
+ # return indices of p-Units within the given radius (radians) of RA,Dec
+ def cone(self,ra0,dec0,radius):
+  i0,i1=self.dec_band(dec0-radius,dec0+radius)
+  x0=numpy.array([math.cos(ra0)*math.cos(dec0),math.sin(ra0)*math.cos(dec0),math.sin(dec0)])
+  mask=self.xyz[i0:i1].dot(x0)>=math.cos(radius)
+  return i0+numpy.nonzero(mask)[0]
+
+ # return names of p-Units given by an array of indices, in p-Unit table order
+ def select(self,indices):
+  indices=numpy.asarray(indices,int)
+  return [self.names[i] for i in indices[numpy.argsort(self.rank[indices],kind='stable')]]
 
 ###############################################
 class LSM:
  """LSM Object:
  Attributes are
-  s_table: Source table
+  s_table: Source table (a SourceTable, creating Source objects on demand,
+           when loaded from a file)
   m_table: MeqParm table
   tmpl_table: Template tree table
   p_table: p-Unit table
 
   helper attributes:
   __barr: array of p-Units sorted by brightness - private attribute
+          (use __sorted_barr() to access, since new p-Units are merged in lazily)
   __mqs: meqserver proxy
   __root: root of all subtrees of the LSM
   __file: currently opend file or recently saved file name
@@ -299,6 +372,15 @@ class LSM:
   self.__patch_count=0
  
   self.__barr=[] 
+  # negated brightness of each p-Unit in __barr (for bisection),
+  # and p-Units inserted but not yet merged into __barr
+  self.__bkeys=[]
+  self.__barr_pending=[]
+  # set when the brightness of a p-Unit already in the LSM changes,
+  # so that __barr is re-sorted on next use
+  self.__barr_resort=False
+  # spatial index, built on demand
+  self.__spatial=None
   # root of all subtrees
   self.__root=None
   # name of the root node
@@ -396,37 +478,84 @@ class LSM:
   self.insertPUnit(p)
 
  # Helper method 
- # inserts a p-unit into the p-Unit table, and 
- # orders according to the brightness
+ # inserts a p-unit into the p-Unit table. The brightness order is
+ # updated lazily, see __sorted_barr()
  def insertPUnit(self,p):
   if p.name in self.p_table:
    #raise NameError, 'PUnit '+p.name+' is already present'
    print("WARNING: PUnit '"+p.name+"' is already present. Ignoring insertion")
-  else:
-   self.p_table[p.name]=p
-  # now do the sorting of the brightness array
-  tmp_brightness=p.getBrightness() 
-  if (len(self.__barr)==0):
-   self.__barr.insert(0,p.name)
-  else: # list is not empty
-   for i in range(len(self.__barr)):
-    if self.p_table[self.__barr[i]].getBrightness() < tmp_brightness:
-     break
-
-
-   # special check for end of list
-   if i==0: 
-    if self.p_table[self.__barr[i]].getBrightness() < tmp_brightness:
-      self.__barr.insert(0,p.name)
-    else:
-      self.__barr.append(p.name)
-   elif i==len(self.__barr)-1:
-    if self.p_table[self.__barr[i]].getBrightness() < tmp_brightness:
-     self.__barr.insert(i,p.name)
-    else:
-     self.__barr.append(p.name)
+   return
+  self.p_table[p.name]=p
+  self.__barr_pending.append(p.name)
+  self.__spatial=None
+
+ # max number of pending p-units that are merged into __barr 
+ # one by one via bisection. More than this, and the whole list is re-sorted
+ BARR_BISECT_MAX=16
+
+ # Helper method
+ # returns __barr (p-unit names in order of decreasing brightness), after
+ # merging in any pending p-units. Equal brightness p-units stay in
+ # order of insertion.
+ def __sorted_barr(self):
+  if self.__barr_resort:
+   # brightness has changed since sorting: merge everything in again
+   self.__barr_resort=False
+   self.__barr_pending=self.__barr+self.__barr_pending
+   self.__barr=[]
+   self.__bkeys=[]
+  pending=self.__barr_pending
+  if pending:
+   self.__barr_pending=[]
+   if len(pending)<=self.BARR_BISECT_MAX:
+    for pname in pending:
+     key=-self.p_table[pname].getBrightness()
+     i=bisect.bisect_right(self.__bkeys,key)
+     self.__barr.insert(i,pname)
+     self.__bkeys.insert(i,key)
    else:
-    self.__barr.insert(i,p.name)
+    # bulk load: sort everything (this is a stable sort, so the order of equal
+    # keys is preserved, same as with bisection)
+    barr=self.__barr+pending
+    keys=[-self.p_table[pname].getBrightness() for pname in barr]
+    order=sorted(range(len(barr)),key=keys.__getitem__)
+    self.__barr=[barr[i] for i in order]
+    self.__bkeys=[keys[i] for i in order]
+  return self.__barr
+
+ # return the spatial index of the p-Units (see SpatialIndex),
+ # building it if needed
+ def getSpatialIndex(self):
+  if self.__spatial is None:
+   self.__spatial=SpatialIndex(self.p_table)
+  return self.__spatial
+
+ # discard the spatial index, so that it is rebuilt on next use.
+ # Called whenever p-Units are added or moved.
+ def invalidateSpatialIndex(self):
+  self.__spatial=None
+
+ # called when the brightness of p-Unit pname changes: discards the spatial
+ # index, and the brightness order if the p-Unit is already part of it
+ def brightnessChanged(self,pname):
+  self.__spatial=None
+  if pname in self.p_table:
+   self.__barr_resort=True
+
+ # Helper method
+ # removes a p-unit from the brightness order
+ def __remove_barr(self,pname):
+  barr=self.__sorted_barr()
+  key=-self.p_table[pname].getBrightness()
+  i=bisect.bisect_left(self.__bkeys,key)
+  # scan over p-units of equal brightness
+  while i<len(barr) and barr[i]!=pname:
+   i+=1
+  if i>=len(barr):
+   # brightness may have been changed since insertion, fall back to linear search
+   i=barr.index(pname)
+  del barr[i]
+  del self.__bkeys[i]
 
  # method for printing to screen
  def dump(self):
@@ -441,7 +570,7 @@ class LSM:
   print("\n\n")
 
   print("P-Units sorted in Brightness:\n")
-  for p in self.__barr:
+  for p in self.__sorted_barr():
    print(p, self.p_table[p].getBrightness())
 
   print("---------------------------------")
@@ -536,21 +665,16 @@ class LSM:
   max_Dec=-100
   min_Dec=100
 
-  for p in list(self.p_table.keys()):
-   punit=self.p_table[p]
-   if punit.getType()==POINT_TYPE :
-    tmpval=punit.sp.getRA()
-    if tmpval > max_RA:
-     max_RA=tmpval
-    if tmpval <  min_RA:
-     min_RA=tmpval
-    tmpval=punit.sp.getDec()
-    if tmpval > max_Dec:
-     max_Dec=tmpval
-    if tmpval <  min_Dec:
-     min_Dec=tmpval
-   elif punit.getType()==GAUSS_TYPE :
-    [x0,x1,y0,y1]=punit.getLimits()
+  # point sources are taken from the spatial index
+  index=self.getSpatialIndex()
+  mask=(index.types==POINT_TYPE)
+  if mask.any():
+   max_RA=max(max_RA,index.ra[mask].max())
+   min_RA=min(min_RA,index.ra[mask].min())
+   max_Dec=max(max_Dec,index.dec[mask].max())
+   min_Dec=min(min_Dec,index.dec[mask].min())
+  for i in numpy.nonzero(index.types==GAUSS_TYPE)[0]:
+    [x0,x1,y0,y1]=self.p_table[index.names[i]].getLimits()
     if x1 > max_RA:
      max_RA=x1
     if x0 <  min_RA:
@@ -573,9 +697,10 @@ class LSM:
  # f=freq_index, t=time_index
  def getMaxBrightness(self,type='A',f=0,t=0):
   if type=='A':
-   if len(self.__barr)==0:
+   barr=self.__sorted_barr()
+   if len(barr)==0:
     return 0
-   pname=self.__barr[0]
+   pname=barr[0]
    return self.p_table[pname].getBrightness()
   else:
    # select the max value
@@ -671,63 +796,38 @@ class LSM:
    punit=self.p_table[sname]
    #if punit.getType()==POINT_TYPE:
    punit.sp.updateValues(sname)
+  # positions may have changed
+  self.__spatial=None
+
+ # format tag and version of LSM files written by save()
+ FILE_FORMAT="LSM columnar"
+ FILE_VERSION=1
+ # order of the sixpack parameters in the 'sp_values' column
+ SIXPACK_PARMS=('stokesI','stokesQ','stokesU','stokesV','ra','dec','SI','f0','rm')
 
  # save to a file
- # while saving, discard any existing vellsets because
- # they can be recalculated. 
+ # The LSM is saved in columnar form, as a numpy .npz archive of typed arrays:
+ #  header: JSON string with the LSM attributes, format and version 
+ #  names: all p-Unit and source names. The first 'npunits' entries are the
+ #     p-Units, the first 'nbarr' of these in order of decreasing brightness.
+ #     All other columns refer to names by index.
+ #  pu_*: one row per p-Unit (type, cat, brightness, static RA/Dec etc.)
+ #  pu_members,pu_members_offset: source list of p-Unit i (i.e. the members
+ #     of a patch) is pu_members[pu_members_offset[i]:pu_members_offset[i+1]]
+ #  sp_*: sixpack label and parameters of each p-Unit
+ #  src_*: one row per source in the source table
+ # Node trees are not saved, since sixpacks only hold static parameters. 
  def save(self,filename):
   # add safeguard: do not save if the filename has 
   # a 'protected.lsm' term
-  ii=string.find(filename,'protected.lsm')
+  ii=filename.find('protected.lsm')
   if ii!=-1:
    print("WARNING: the filename %s is protected. save failed!!!"%filename)
    return
+  columns=self.__columns()
   try:
    f=open(filename,'wb') 
-   p=pickle.Pickler(f)
-   # create a new LSM from this LSM,
-   # without reference to MeqServer or the forests
-   g=LSM()
-   g.s_table=self.s_table
-   g.m_table=self.m_table
-   g.tmpl_table=self.tmpl_table
-   g.__barr=self.__barr
-   g.mqs=None
-   g.cells=None
-   g.__patch_count=self.__patch_count
-   g.default_patch_center=self.default_patch_center
-   g.default_patch_method=self.default_patch_method
-
-
-   # serialize the root
-   gdict={}
-   if self.__root!=None:
-    # serialize the whole subtree
-    traverse(self.__root,gdict,self.__ns._name)
-
-   # if the nodescope has a subscope, strip the subscope 
-   # name from the root name
-   if self.__ns._name:
-     g.__root_name=strip_subscope(self.__root_name)
-   else: 
-     g.__root_name=self.__root_name
-
-   # remove circular references to the old LSM
-   # serialize the PUnit table 
-   g.p_table={}
-
-   extra_node_list=[]
-   for sname in list(self.p_table.keys()): 
-    punit=self.p_table[sname]
-    # this is just for testing, add a dummy node thats not in the LSM
-    g.p_table[sname]=punit.clone(self.__ns._name)
-    g.p_table[sname].setLSM(g)
-
-   g.__root=pickle.dumps(gdict)
-   g._extra_node_list=extra_node_list
-   #print g._extra_node_list
-
-   p.dump(g)
+   numpy.savez(f,**columns)
    f.close()
 
    self.__file=filename
@@ -741,82 +841,89 @@ class LSM:
    #forest_filename=filename+'.forest'
    #self.mqs.meq('Save.Forest',meq.record(file_name=forest_filename));
 
+ # Helper method
+ # returns the contents of the LSM as a dict of typed arrays, see save()
+ def __columns(self):
+  barr=self.__sorted_barr()
+  inbarr=set(barr)
+  pnames=barr+[pname for pname in self.p_table if pname not in inbarr]
+  src=source_columns(self.s_table)
+  names=list(pnames)
+  index=dict([(name,i) for i,name in enumerate(names)])
+  # return index of name, adding it to names if needed
+  def name_index(name):
+   i=index.get(name)
+   if i is None:
+    i=index[name]=len(names)
+    names.append(name)
+   return i
+  src_index=[name_index(str(name)) for name in src['name']]
+
+  npu=len(pnames)
+  members=[]
+  offset=numpy.zeros(npu+1,numpy.int64)
+  patch=numpy.full(npu,-1,numpy.int32)
+  lm=numpy.full((npu,2),numpy.nan)
+  spkind=numpy.zeros(npu,numpy.int8)
+  splabel=['']*npu
+  spvalues=numpy.zeros((npu,len(self.SIXPACK_PARMS)))
+  for i,pname in enumerate(pnames):
+   punit=self.p_table[pname]
+   members+=[name_index(name) for name in punit.s_list]
+   offset[i+1]=len(members)
+   if punit._patch_name is not None:
+    patch[i]=name_index(punit._patch_name)
+   if punit._lm is not None:
+    lm[i]=punit._lm
+   sp=punit.getSP()
+   if sp is not None:
+    # 1 for point source sixpacks, 2 for patches
+    spkind[i]=1 if sp.ispoint() else 2
+    splabel[i]=sp.label() or ''
+    try:
+     spvalues[i]=[float(getattr(sp,parm)()) for parm in self.SIXPACK_PARMS]
+    except (TypeError,ValueError):
+     raise TypeError("p-Unit %s: only sixpacks with numeric parameters can be saved"%pname)
+
+  header=dict(format=self.FILE_FORMAT,version=self.FILE_VERSION,
+     npunits=npu,nbarr=len(barr),m_table=self.m_table,tmpl_table=self.tmpl_table,
+     patch_count=self.__patch_count,
+     default_patch_center=self.default_patch_center,
+     default_patch_method=self.default_patch_method,
+     root_name=self.__root_name)
+  punits=[self.p_table[pname] for pname in pnames]
+  return dict(header=numpy.array(json.dumps(header)),
+    names=numpy.array(names,str).reshape(-1),
+    pu_type=numpy.array([pu.type for pu in punits],numpy.int16),
+    pu_cat=numpy.array([pu.cat for pu in punits],numpy.int32),
+    pu_brightness=numpy.array([pu.app_brightness for pu in punits],float),
+    pu_fov=numpy.array([pu.FOV_distance for pu in punits],float),
+    pu_radec=numpy.array([(pu.sp.static_RA,pu.sp.static_Dec) for pu in punits],float).reshape((-1,2)),
+    pu_lm=lm,
+    pu_patch=patch,
+    pu_members=numpy.array(members,numpy.int32),
+    pu_members_offset=offset,
+    sp_kind=spkind,
+    sp_label=numpy.array(splabel,str).reshape(-1),
+    sp_values=spvalues,
+    src_index=numpy.array(src_index,numpy.int32),
+    src_table=src['table'],
+    src_type=src['type'],
+    src_ext=src['ext'])
+
  # load from a file 
+ # Files written by save() are loaded by __load_columns(). Older files 
+ # holding a pickled LSM object are loaded by __load_pickled().
  # Note if the saved LSM was created using a Subscope
  # the new LSM will ignore that subscope, i.e. will change
  # all node names such that the subscope part is not present
  def load(self,filename,ns=None):
   try:
    f=open(filename,'rb') 
-   p=pickle.Unpickler(f)
-   tmpl=LSM()
-   tmpl=p.load()
-   self.s_table=tmpl.s_table
-   self.m_table=tmpl.m_table
-   self.tmpl_table=tmpl.tmpl_table
-   self.__barr=tmpl.__barr
-
-   self.__patch_count=tmpl.__patch_count
-   self.default_patch_center=tmpl.default_patch_center
-   self.default_patch_method=tmpl.default_patch_method
-
-   self.__root_name=tmpl.__root_name
-   #print "Root =",self.__root_name
-   if tmpl.__root!=None:
-    if ns==None:
-     ns=NodeScope()
-    self.__ns=ns
-    my_dict=pickle.loads(tmpl.__root)
-    #print my_dict[self.__root_name]
-    # if there is already a node with the root name, we remove it from our dict
-    # and change root name
-    if ns[self.__root_name].initialized():
-      # create a unique name
-      new_root_name=ns.MakeUniqueName(self.__root_name)
-      oldroot=my_dict.pop(self.__root_name)
-      print("WARNING: changing name from %s to %s"%(self.__root_name,new_root_name))
-      self.__root_name=new_root_name
-      my_dict[self.__root_name]=oldroot
-
-    my_dict=reconstruct(my_dict,ns)
-    #self.__root=my_dict[self.__root_name]
+   if self.isColumnarFile(f):
+    self.__load_columns(f,ns)
    else:
-     self.__root=None
-     print("WARNING: cannot find a root node in the LSM. load will fail!")
-
-   # recreate the extra node list, if any
-   if hasattr(tmpl,"_extra_node_list") and len(tmpl._extra_node_list)>0:
-     print("Found extra nodes")
-     extra_root_name=ns.MakeUniqueName(self.__root_name+"_extra")
-     ns[extra_root_name]<<Meq.Composer(children=tmpl._extra_node_list)
-
-   
-   self.p_table=tmpl.p_table
-   # reconstruct PUnits and Sixpacks if possible
-   for sname in list(self.p_table.keys()): 
-    punit=self.p_table[sname]
-    punit.setLSM(self)
-    # now create the sixpack
-    tmp_dict=punit.getSP()
-    #print tmp_dict
-    if 'patchroot' in tmp_dict:
-     my_sp=LSM_Sixpack.Sixpack(label=tmp_dict['label'],\
-      ns=self.__ns, root=self.__ns[tmp_dict['patchroot']])
-    else: 
-     # NOTE: do not give the nodescope because then it tries to
-     # compose, but the tree is already composed
-     my_sp=LSM_Sixpack.Sixpack(label=tmp_dict['label'],\
-       ra=cname_node_stub(self.__ns,tmp_dict['ra']),\
-       dec=cname_node_stub(self.__ns,tmp_dict['dec']),\
-       stokesI=cname_node_stub(self.__ns,tmp_dict['I']),\
-       stokesQ=cname_node_stub(self.__ns,tmp_dict['Q']),\
-       stokesU=cname_node_stub(self.__ns,tmp_dict['U']),\
-      stokesV=cname_node_stub(self.__ns,tmp_dict['V']))
-     # set the root node
-     my_sp=my_sp.clone(sixpack=self.__ns[tmp_dict['pointroot']],ns=self.__ns)
-    punit.setSP(my_sp)
-    # recreate the NodeSet nodes, if any
-
+    self.__load_pickled(f,ns)
    f.close()
 
    self.setFileName(filename)
@@ -830,6 +937,161 @@ class LSM:
    #self.mqs.meq('Load.Forest',meq.record(file_name=forest_filename),wait=True);
    #self.mqs.meq('Load.Forest',meq.record(file_name=forest_filename));
 
+ # returns True if the open file f was written by save(), i.e. it is
+ # a zip (.npz) archive rather than a pickle
+ @staticmethod
+ def isColumnarFile(f):
+  pos=f.tell()
+  magic=f.read(4)
+  f.seek(pos)
+  return magic==b'PK\x03\x04'
+
+ # Helper method
+ # loads LSM from an open file written by save(). p-Units are created
+ # right away, while the source table creates Source objects as they
+ # are accessed (see SourceTable)
+ def __load_columns(self,f,ns=None):
+  data=numpy.load(f,allow_pickle=False)
+  header=json.loads(str(data['header']))
+  if header.get('format')!=self.FILE_FORMAT or header.get('version',0)>self.FILE_VERSION:
+   raise TypeError("unsupported LSM file format %s version %s"%(header.get('format'),header.get('version')))
+  names=data['names'].tolist()
+  npu=header['npunits']
+  nbarr=header['nbarr']
+
+  src_index=data['src_index']
+  self.s_table=SourceTable(dict(name=numpy.array(names,str)[src_index] if len(src_index) else numpy.array([],str),
+    table=data['src_table'],type=data['src_type'],ext=data['src_ext']))
+  self.m_table=header['m_table']
+  self.tmpl_table=header['tmpl_table']
+  self.__patch_count=header['patch_count']
+  self.default_patch_center=header['default_patch_center']
+  self.default_patch_method=header['default_patch_method']
+  self.__root_name=header['root_name']
+  self.__root=None
+  if ns is not None:
+   self.__ns=ns
+
+  ptype=data['pu_type'].tolist()
+  cat=data['pu_cat'].tolist()
+  brightness=data['pu_brightness'].tolist()
+  fov=data['pu_fov'].tolist()
+  radec=data['pu_radec'].tolist()
+  lm=data['pu_lm']
+  has_lm=~numpy.isnan(lm).any(1)
+  lm=lm.tolist()
+  patch=data['pu_patch'].tolist()
+  members=data['pu_members'].tolist()
+  offset=data['pu_members_offset'].tolist()
+  spkind=data['sp_kind'].tolist()
+  splabel=data['sp_label'].tolist()
+  spvalues=data['sp_values'].tolist()
+  self.p_table={}
+  for i,pname in enumerate(names[:npu]):
+   punit=PUnit(pname,self)
+   punit.type=ptype[i]
+   punit.s_list=[names[j] for j in members[offset[i]:offset[i+1]]]
+   punit.cat=cat[i]
+   punit.app_brightness=brightness[i]
+   punit.FOV_distance=fov[i]
+   punit.sp.set_staticRA(radec[i][0])
+   punit.sp.set_staticDec(radec[i][1])
+   if patch[i]>=0:
+    punit._patch_name=names[patch[i]]
+   if has_lm[i]:
+    punit._lm=tuple(lm[i])
+   if spkind[i]:
+    parms=dict(zip(('I0','stokesQ','stokesU','stokesV','RA','Dec','SI','f0','RM'),spvalues[i]))
+    punit.setSP(LSM_Sixpack.Sixpack(label=splabel[i] or None,
+      type='point' if spkind[i]==1 else 'patch',**parms))
+   self.p_table[pname]=punit
+  data.close()
+
+  # the brightness order was saved, so no need to re-sort
+  self.__barr=names[:nbarr]
+  self.__bkeys=[-brightness[i] for i in range(nbarr)]
+  self.__barr_pending=[]
+  self.__barr_resort=False
+  self.__spatial=None
+
+ # Helper method
+ # loads LSM from an open file holding a pickled LSM object
+ def __load_pickled(self,f,ns=None):
+  p=pickle.Unpickler(f)
+  tmpl=LSM()
+  tmpl=p.load()
+  self.s_table=tmpl.s_table
+  self.m_table=tmpl.m_table
+  self.tmpl_table=tmpl.tmpl_table
+  # re-sort on first use
+  self.__barr=[]
+  self.__bkeys=[]
+  self.__barr_pending=list(tmpl.__barr)
+  self.__barr_resort=False
+  self.__spatial=None
+
+  self.__patch_count=tmpl.__patch_count
+  self.default_patch_center=tmpl.default_patch_center
+  self.default_patch_method=tmpl.default_patch_method
+
+  self.__root_name=tmpl.__root_name
+  #print "Root =",self.__root_name
+  if tmpl.__root!=None:
+   if ns==None:
+    ns=NodeScope()
+   self.__ns=ns
+   my_dict=pickle.loads(tmpl.__root)
+   #print my_dict[self.__root_name]
+   # if there is already a node with the root name, we remove it from our dict
+   # and change root name
+   if ns[self.__root_name].initialized():
+     # create a unique name
+     new_root_name=ns.MakeUniqueName(self.__root_name)
+     oldroot=my_dict.pop(self.__root_name)
+     print("WARNING: changing name from %s to %s"%(self.__root_name,new_root_name))
+     self.__root_name=new_root_name
+     my_dict[self.__root_name]=oldroot
+
+   my_dict=reconstruct(my_dict,ns)
+   #self.__root=my_dict[self.__root_name]
+  else:
+    self.__root=None
+    print("WARNING: cannot find a root node in the LSM. load will fail!")
+
+  # recreate the extra node list, if any
+  if hasattr(tmpl,"_extra_node_list") and len(tmpl._extra_node_list)>0:
+    print("Found extra nodes")
+    extra_root_name=ns.MakeUniqueName(self.__root_name+"_extra")
+    ns[extra_root_name]<<Meq.Composer(children=tmpl._extra_node_list)
+
+  
+  self.p_table=tmpl.p_table
+  # reconstruct PUnits and Sixpacks if possible
+  for sname in list(self.p_table.keys()): 
+   punit=self.p_table[sname]
+   punit.setLSM(self)
+   # now create the sixpack
+   tmp_dict=punit.getSP()
+   #print tmp_dict
+   if 'patchroot' in tmp_dict:
+    my_sp=LSM_Sixpack.Sixpack(label=tmp_dict['label'],\
+     ns=self.__ns, root=self.__ns[tmp_dict['patchroot']])
+   else: 
+    # NOTE: do not give the nodescope because then it tries to
+    # compose, but the tree is already composed
+    my_sp=LSM_Sixpack.Sixpack(label=tmp_dict['label'],\
+      ra=cname_node_stub(self.__ns,tmp_dict['ra']),\
+      dec=cname_node_stub(self.__ns,tmp_dict['dec']),\
+      stokesI=cname_node_stub(self.__ns,tmp_dict['I']),\
+      stokesQ=cname_node_stub(self.__ns,tmp_dict['Q']),\
+      stokesU=cname_node_stub(self.__ns,tmp_dict['U']),\
+     stokesV=cname_node_stub(self.__ns,tmp_dict['V']))
+    # set the root node
+    my_sp=my_sp.clone(sixpack=self.__ns[tmp_dict['pointroot']],ns=self.__ns)
+   punit.setSP(my_sp)
+   # recreate the NodeSet nodes, if any
+
+
 
  # send a request to the LSM to give the p-units
  # with highest brightness, or p-unit with name ='name' etc.
@@ -839,6 +1101,10 @@ class LSM:
  # names='list of names': gives a list of p units matching the names in the  'name_list'
  # name='name': gives the p unit matching the name 'name'
  # cat=1,2,.. : gives p units of given category
+ # cone=(ra,dec,radius): gives p units within radius of ra,dec (radians)
+ # box=(ra0,ra1,dec0,dec1): gives p units within the given ranges of ra,dec
+ #   (radians). If ra0>ra1, the ra range wraps around 2pi.
+ # cone and box queries only return p units also returned by all=1
  def queryLSM(self,**kw):
   
   outlist=[]
@@ -861,8 +1127,20 @@ class LSM:
    return outlist
  
   if 'count' in kw:
-   for i in range(min(kw['count'],len(self.__barr))): 
-    outlist.append(self.p_table[self.__barr[i]])
+   barr=self.__sorted_barr()
+   for i in range(min(kw['count'],len(barr))): 
+    outlist.append(self.p_table[barr[i]])
+   return outlist
+
+  if 'cone' in kw or 'box' in kw:
+   index=self.getSpatialIndex()
+   if 'cone' in kw:
+    found=index.cone(*kw['cone'])
+   else:
+    found=index.box(*kw['box'])
+   found=found[index.visible()[found]]
+   for pname in index.select(found):
+    outlist.append(self.p_table[pname])
    return outlist
 
   if 'cat' in kw:
@@ -901,7 +1179,7 @@ class LSM:
        self.p_table[sname]._patch_name ==None):
       correct_slist.append(sname)
       # remove this source from sorted patch list
-      self.__barr.remove(sname)
+      self.__remove_barr(sname)
       # get min,max coords
       ra=self.p_table[sname].sp.getRA() 
       dec=self.p_table[sname].sp.getDec() 
@@ -1014,7 +1292,8 @@ class LSM:
 
    newp.setSP(LSM_Sixpack.Sixpack(root=patch_root,label=patch_root.name))
 
-   # add new PUnit to table
+   # add new PUnit to table (this also discards the spatial index, 
+   # since sources are now in a patch)
    self.insertPUnit(newp)
    #print self.__barr
    #self.p_table[patch_name]=newp
@@ -1075,19 +1354,20 @@ class LSM:
   #print ybins
 
 
-  for sname in list(self.p_table.keys()): 
-    punit=self.p_table[sname]
-    pb=punit.getBrightness('A')
-    if  punit.getType()==POINT_TYPE and\
-       punit._patch_name==None and\
-       (pb<=max_bright) and (pb>=min_bright):
-      # get RA and Dec
-      xx=punit.sp.getRA()
-      yy=punit.sp.getDec()
-      k=bin_search(x_array,xx,0,len(x_array)-1)
-      xbins[k].append(sname)
-      k=bin_search(y_array,yy,0,len(y_array)-1)
-      ybins[k].append(sname)
+  # select sources from the spatial index, and bin them all at once,
+  # in p-Unit table order
+  index=self.getSpatialIndex()
+  pb=index.brightness
+  selected=numpy.nonzero((index.types==POINT_TYPE)&~index.in_patch&\
+       (pb<=max_bright)&(pb>=min_bright))[0]
+  selected=selected[numpy.argsort(index.rank[selected],kind='stable')]
+  # x_{k} <= x < x_{k+1}
+  kx=numpy.searchsorted(x_array,index.ra[selected],'right')-1
+  ky=numpy.searchsorted(y_array,index.dec[selected],'right')-1
+  for i,k in zip(selected,kx):
+    xbins[k].append(index.names[i])
+  for i,k in zip(selected,ky):
+    ybins[k].append(index.names[i])
 
   #print xbins
   #print ybins
@@ -1506,53 +1786,10 @@ class LSM:
  def merge(self,filename,ns=None):
   try:
    f=open(filename,'rb') 
-   p=pickle.Unpickler(f)
-   tmpl=LSM()
-   tmpl=p.load()
-
-   # recreate the sixpacks
-   if tmpl.__root!=None:
-    if ns==None:
-     ns=self.__ns
-    my_dict=pickle.loads(tmpl.__root)
-    my_dict=reconstruct(my_dict,ns)
+   if self.isColumnarFile(f):
+    self.__merge_columns(f,ns)
    else:
-     tmpl.__root=self.__root
-   
-   # reconstruct PUnits and Sixpacks if possible
-   for sname in list(tmpl.p_table.keys()): 
-    if sname not in self.p_table:
-       punit=tmpl.p_table[sname]
-       punit.setLSM(self)
-       # now create the sixpack
-       tmp_dict=punit.getSixpack()
-       #print tmp_dict
-       if 'patchroot' in tmp_dict:
-           my_sp=LSM_Sixpack.Sixpack(label=tmp_dict['label'],\
-            ns=self.__ns, root=self.__ns[tmp_dict['patchroot']])
-       else: 
-       # NOTE: do not give the nodescope because then it tries to
-       # compose, but the tree is already composed
-          my_sp=LSM_Sixpack.Sixpack(label=tmp_dict['label'],\
-            ra=cname_node_stub(self.__ns,tmp_dict['ra']),\
-            dec=cname_node_stub(self.__ns,tmp_dict['dec']),\
-            stokesI=cname_node_stub(self.__ns,tmp_dict['I']),\
-            stokesQ=cname_node_stub(self.__ns,tmp_dict['Q']),\
-            stokesU=cname_node_stub(self.__ns,tmp_dict['U']),\
-            stokesV=cname_node_stub(self.__ns,tmp_dict['V']))
-       # set the root node
-       my_sp=my_sp.clone(sixpack=self.__ns[tmp_dict['pointroot']],ns=self.__ns)
-       punit.setSP(my_sp)
-       # add the new PUnit to self
-       self.insertPUnit(punit)
-    else:
-     print("WARNING: PUnit %s already found. Ignoring"%sname)
-
-   # reconstruct source table too...
-   for sname in list(tmpl.s_table.keys()):
-    if sname not in self.s_table:
-     # add source to source table
-     self.s_table[sname]=Source(sname)
+    self.__merge_pickled(f,ns)
    f.close()
 
   except IOError:
@@ -1561,6 +1798,73 @@ class LSM:
   if self.mqs != None:
    pass
 
+ # Helper method
+ # merges LSM from an open file written by save()
+ def __merge_columns(self,f,ns=None):
+  tmpl=LSM()
+  tmpl.__load_columns(f,ns or self.__ns)
+  for sname in list(tmpl.p_table.keys()): 
+   if sname not in self.p_table:
+    punit=tmpl.p_table[sname]
+    punit.setLSM(self)
+    self.insertPUnit(punit)
+   else:
+    print("WARNING: PUnit %s already found. Ignoring"%sname)
+  for sname in list(tmpl.s_table.keys()):
+   if sname not in self.s_table:
+    self.s_table[sname]=tmpl.s_table[sname]
+
+ # Helper method
+ # merges LSM from an open file holding a pickled LSM object
+ def __merge_pickled(self,f,ns=None):
+  p=pickle.Unpickler(f)
+  tmpl=LSM()
+  tmpl=p.load()
+
+  # recreate the sixpacks
+  if tmpl.__root!=None:
+   if ns==None:
+    ns=self.__ns
+   my_dict=pickle.loads(tmpl.__root)
+   my_dict=reconstruct(my_dict,ns)
+  else:
+    tmpl.__root=self.__root
+  
+  # reconstruct PUnits and Sixpacks if possible
+  for sname in list(tmpl.p_table.keys()): 
+   if sname not in self.p_table:
+      punit=tmpl.p_table[sname]
+      punit.setLSM(self)
+      # now create the sixpack
+      tmp_dict=punit.getSixpack()
+      #print tmp_dict
+      if 'patchroot' in tmp_dict:
+          my_sp=LSM_Sixpack.Sixpack(label=tmp_dict['label'],\
+           ns=self.__ns, root=self.__ns[tmp_dict['patchroot']])
+      else: 
+      # NOTE: do not give the nodescope because then it tries to
+      # compose, but the tree is already composed
+         my_sp=LSM_Sixpack.Sixpack(label=tmp_dict['label'],\
+           ra=cname_node_stub(self.__ns,tmp_dict['ra']),\
+           dec=cname_node_stub(self.__ns,tmp_dict['dec']),\
+           stokesI=cname_node_stub(self.__ns,tmp_dict['I']),\
+           stokesQ=cname_node_stub(self.__ns,tmp_dict['Q']),\
+           stokesU=cname_node_stub(self.__ns,tmp_dict['U']),\
+           stokesV=cname_node_stub(self.__ns,tmp_dict['V']))
+      # set the root node
+      my_sp=my_sp.clone(sixpack=self.__ns[tmp_dict['pointroot']],ns=self.__ns)
+      punit.setSP(my_sp)
+      # add the new PUnit to self
+      self.insertPUnit(punit)
+   else:
+    print("WARNING: PUnit %s already found. Ignoring"%sname)
+
+  # reconstruct source table too...
+  for sname in list(tmpl.s_table.keys()):
+   if sname not in self.s_table:
+    # add source to source table
+    self.s_table[sname]=Source(sname)
+
 
 
  # build the LSM from a NewStar .MDL model file
@@ -1649,9 +1953,13 @@ class LSM:
     unamedict={}
 
     ########## Models -- 56 bytes
+    mdls=Timba.array.fromfile(ff,dtype=Timba.array.uint8,count=56*nsources)
+    # convert the L,M offsets of all models to RA,Dec in one go
+    lm_all=numpy.frombuffer(mdls[:56*nsources].tobytes(),dtype=numpy.float32).reshape((-1,14))[:,1:3]
+    (ra_all,dec_all)=lm_to_radec_array(ra0,dec0,lm_all[:,0],lm_all[:,1])
     for ii in range(0,nsources):
     #for ii in range(0,4):
-       mdl=Timba.array.fromfile(ff,dtype=Timba.array.uint8,count=56)
+       mdl=mdls[56*ii:56*(ii+1)]
 
        ### Amplitude (Stokes I)
        sI=struct.unpack('f',mdl[0:4])
@@ -1744,7 +2052,7 @@ class LSM:
               unamedict[bname]=1
 
             s=Source(uniqname, major=eX, minor=eY, pangle=eP)
-            (source_RA,source_Dec)=lm_to_radec(ra0,dec0,ll,mm)
+            (source_RA,source_Dec)=(float(ra_all[ii]),float(dec_all[ii]))
 
             #print ii,id,ll,mm,source_RA,source_Dec
             if ignore_pol:
@@ -1780,7 +2088,7 @@ class LSM:
               unamedict[bname]=1
 
             s=Source(uniqname, major=eX, minor=eY, pangle=eP)
-            (source_RA,source_Dec)=lm_to_radec(ra0,dec0,ll,mm)
+            (source_RA,source_Dec)=(float(ra_all[ii]),float(dec_all[ii]))
 
             #print ii,id,ll,mm,source_RA,source_Dec
             if ignore_pol:
@@ -1812,7 +2120,7 @@ class LSM:
             unamedict[bname]=1
 
           s=Source(uniqname, major=eX, minor=eY, pangle=eP)
-          (source_RA,source_Dec)=lm_to_radec(ra0,dec0,ll,mm)
+          (source_RA,source_Dec)=(float(ra_all[ii]),float(dec_all[ii]))
 
           #print ii,id,ll,mm,source_RA,source_Dec
           if ignore_pol:
@@ -2148,9 +2456,12 @@ class LSM:
   if f0==None:
    f0=323875000.0;
   a=3e8/(25.0*f0) 
-  for pu in plist:
-     (ra,dec,sI,sQ,sU,sV,SIn,f0,RM)=pu.getEssentialParms(ns)
-     (l,m)=common_utils.radec_to_lm(ra0,dec0,ra,dec)
+  parms=[ pu.getEssentialParms(ns) for pu in plist ]
+  # project all sources in one go
+  (l_all,m_all)=common_utils.radec_to_lm_array(ra0,dec0,[ p[0] for p in parms ],[ p[1] for p in parms ])
+  for (ipu,pu) in enumerate(plist):
+     (ra,dec,sI,sQ,sU,sV,SIn,f0,RM)=parms[ipu]
+     (l,m)=(float(l_all[ipu]),float(m_all[ipu]))
      invscal=math.exp((l*l+m*m)/(a*a))
      sI=sI*invscal
      sQ=sQ*invscal
@@ -2185,9 +2496,12 @@ class LSM:
   if f0==None:
    f0=323875000.0;
   a=3e8/(25.0*f0) 
-  for pu in plist:
-     (ra,dec,sI,sQ,sU,sV,SIn,f0,RM)=pu.getEssentialParms(ns)
-     (l,m)=common_utils.radec_to_lm(ra0,dec0,ra,dec)
+  parms=[ pu.getEssentialParms(ns) for pu in plist ]
+  # project all sources in one go
+  (l_all,m_all)=common_utils.radec_to_lm_array(ra0,dec0,[ p[0] for p in parms ],[ p[1] for p in parms ])
+  for (ipu,pu) in enumerate(plist):
+     (ra,dec,sI,sQ,sU,sV,SIn,f0,RM)=parms[ipu]
+     (l,m)=(float(l_all[ipu]),float(m_all[ipu]))
      invscal=math.exp(-(l*l+m*m)/(a*a))
      sI=sI*invscal
      sQ=sQ*invscal
@@ -35,6 +35,8 @@ from __future__ import division
 
 import sys,time
 import pickle # for serialization and file io
+import numpy
+from collections.abc import MutableMapping
 # from Dummy import *
 
 from .common_utils import *
@@ -99,6 +101,109 @@ class Source:
    temp_str+=" MeqParm Table: "+self.tableName
    temp_str+=" Extended ?: "+str(self.extParms())
    return temp_str
+
+#############################################
+class SourceTable(MutableMapping):
+ """Source table of an LSM loaded from a columnar file.
+ Behaves like a dict of name: Source, but Source objects are only
+ created when first accessed.
+ Attributes are
+  __names: source names, in table order
+  __rows: mapping of name to row in the columns (None for sources
+          added after loading)
+  __columns: dict of arrays with the source attributes
+     (see source_columns())
+  __sources: Source objects created so far
+ """
+ def __init__(self,columns):
+  self.__columns=columns
+  self.__names=[str(name) for name in columns['name']]
+  self.__rows=dict([(name,i) for i,name in enumerate(self.__names)])
+  self.__sources={}
+
+ # create Source object from row i of the columns
+ def __makeSource(self,name,i):
+  ext=self.__columns['ext'][i]
+  s=Source(name,tableName=str(self.__columns['table'][i]),
+     major=float(ext[0]),minor=float(ext[1]),pangle=float(ext[2]))
+  s.setTemplateTree(int(self.__columns['type'][i]))
+  return s
+
+ def __getitem__(self,name):
+  s=self.__sources.get(name)
+  if s is None:
+   i=self.__rows[name]
+   if i is None:
+    raise KeyError(name)
+   s=self.__sources[name]=self.__makeSource(name,i)
+  return s
+
+ def __setitem__(self,name,s):
+  if name not in self.__rows:
+   self.__names.append(name)
+  self.__rows[name]=None
+  self.__sources[name]=s
+
+ def __delitem__(self,name):
+  del self.__rows[name]
+  self.__names.remove(name)
+  self.__sources.pop(name,None)
+
+ def __contains__(self,name):
+  return name in self.__rows
+
+ def __iter__(self):
+  return iter(self.__names)
+
+ def __len__(self):
+  return len(self.__names)
+
+ # return number of Source objects created so far
+ def materialized(self):
+  return len(self.__sources)
+
+ # return columns of this table (see source_columns()), 
+ # without creating the Source objects
+ def columns(self):
+  cols=self.__columns
+  if not self.__sources and len(self.__names)==len(cols['name']):
+   return cols
+  table=[]
+  types=[]
+  ext=[]
+  for name in self.__names:
+   s=self.__sources.get(name)
+   if s is None:
+    i=self.__rows[name]
+    table.append(cols['table'][i])
+    types.append(cols['type'][i])
+    ext.append(cols['ext'][i])
+   else:
+    table.append(s.tableName)
+    types.append(s.treeType)
+    ext.append(s.extParms())
+  return _typed_source_columns(dict(name=self.__names,table=table,type=types,ext=ext))
+
+# convert columns of python objects to typed arrays
+def _typed_source_columns(cols):
+ return dict(name=numpy.array(cols['name'],str).reshape(-1),
+   table=numpy.array(cols['table'],str).reshape(-1),
+   type=numpy.array(cols['type'],numpy.int16).reshape(-1),
+   ext=numpy.array(list(cols['ext']),float).reshape((-1,3)))
+
+# return the attributes of the sources in a source table as a dict of
+# typed arrays:
+#  name,table: source name and MeqParm table name
+#  type: template tree type
+#  ext: (N,3) array of major,minor,pangle
+def source_columns(s_table):
+ if isinstance(s_table,SourceTable):
+  return s_table.columns()
+ sources=list(s_table.values())
+ return _typed_source_columns(dict(name=[s.name for s in sources],
+   table=[s.tableName for s in sources],
+   type=[s.treeType for s in sources],
+   ext=[s.extParms() for s in sources]))
 ###############################################
 # class sixpack is not needed to be defined here (JEN code does that)
 # instead we define a class to store a cell and six vellsets
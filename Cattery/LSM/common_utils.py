@@ -28,9 +28,11 @@ from __future__ import print_function
 from __future__ import division
 
 import math
+import numpy
 from Timba.Meq import meq
 from Timba.TDL import *
 import Timba.array
+from .transform import sin_array,cos_array,atan2_array
 ##############################################
 ### common definitions for the GUI
 ### and utility functions
@@ -732,6 +734,26 @@ def change_radec_patch(patch_name,new_ra,new_dec,ns):
 ################################################################
 ## convert l,m coordinates to RA,Dec coordinates
 ## see wng/wnmccv.for WNMCLM for more detail
+## l,m may be scalars or arrays, ra,dec arrays are returned
+def lm_to_radec_array(ra0,dec0,l,m):
+    dl=numpy.asarray(l,dtype=float)
+    dm=numpy.asarray(m,dtype=float)
+    sind0=math.sin(dec0)
+    cosd0=math.cos(dec0)
+    d0=dm*dm*sind0*sind0+dl*dl-2*dm*cosd0*sind0
+    sind=numpy.sqrt(abs(sind0*sind0-d0))
+    cosd=numpy.sqrt(abs(cosd0*cosd0+d0))
+    if (sind0>0):
+     sind=abs(sind)
+    else:
+     sind=-abs(sind)
+
+    dec=atan2_array(sind,cosd)
+    ra=atan2_array(numpy.where(dl!=0,-dl,1e-10),(cosd0-dm*sind0))+ra0
+
+    return (ra,dec)
+
+## scalar version of the above
 def lm_to_radec(ra0,dec0,l,m):
     sind0=math.sin(dec0)
     cosd0=math.cos(dec0)
@@ -757,6 +779,20 @@ def lm_to_radec(ra0,dec0,l,m):
 
 
 ## convert ra,dec to lm (NCP)
+## ra,dec may be scalars or arrays, l,m arrays are returned
+def radec_to_lm_array(ra0,dec0,ra,dec):
+    ra=numpy.asarray(ra,dtype=float)
+    dec=numpy.asarray(dec,dtype=float)
+    cosdec=cos_array(dec)
+    l=-sin_array(ra-ra0)*cosdec
+    sind0=math.sin(dec0)
+    if sind0 != 0:
+     m=-(cos_array(ra-ra0)*cosdec-math.cos(dec0))/math.sin(dec0)
+    else:
+     m=numpy.zeros_like(l)
+    return (l,m)
+
+## scalar version of the above
 def radec_to_lm(ra0,dec0,ra,dec):
     l=-math.sin(ra-ra0)*math.cos(dec)
     sind0=math.sin(dec0)
@@ -767,6 +803,16 @@ def radec_to_lm(ra0,dec0,ra,dec):
     return (l,m)
 
 ## convert ra,dec to lm (SIN)
+## ra,dec may be scalars or arrays, l,m arrays are returned
+def radec_to_lm_SIN_array(ra0,dec0,ra,dec):
+    ra=numpy.asarray(ra,dtype=float)
+    dec=numpy.asarray(dec,dtype=float)
+    cosdec=cos_array(dec)
+    l=-sin_array(ra-ra0)*cosdec
+    m=-(cos_array(ra-ra0)*cosdec*math.sin(dec0)-math.cos(dec0)*sin_array(dec))
+    return (l,m)
+
+## scalar version of the above
 def radec_to_lm_SIN(ra0,dec0,ra,dec):
     l=-math.sin(ra-ra0)*math.cos(dec)
     m=-(math.cos(ra-ra0)*math.cos(dec)*math.sin(dec0)-math.cos(dec0)*math.sin(dec))
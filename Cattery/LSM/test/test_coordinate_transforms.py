@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""Checks that the array versions of the LSM coordinate transforms give bit-identical results to the scalar
+(math module) ones""";
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import math
+import pytest
+import numpy
+
+from Cattery.LSM.transform import Projector
+
+RA0,DEC0 = 1.2,0.7
+
+def _radec (n=1000,seed=1):
+  rng = numpy.random.default_rng(seed);
+  return RA0+rng.uniform(-.1,.1,n),DEC0+rng.uniform(-.1,.1,n);
+
+def _lm (n=1000,seed=2):
+  rng = numpy.random.default_rng(seed);
+  l,m = rng.uniform(-.05,.05,n),rng.uniform(-.05,.05,n);
+  l[0] = m[0] = 0;
+  return l,m;
+
+def _check (array_func,scalar_func,x,y):
+  a1,a2 = array_func(x,y);
+  s1,s2 = numpy.array([ scalar_func(xx,yy) for xx,yy in zip(x,y) ]).T;
+  numpy.testing.assert_array_equal(a1,s1);
+  numpy.testing.assert_array_equal(a2,s2);
+
+@pytest.mark.parametrize("rot",[0,.3])
+def test_projector (rot):
+  proj = Projector(RA0,DEC0,rot);
+  _check(proj.sp_to_rt_array,proj.sp_to_rt,*_radec());
+  _check(proj.rt_to_sp_array,proj.rt_to_sp,*_lm());
+
+def test_projector_outside_unit_circle ():
+  proj = Projector(RA0,DEC0);
+  l,m = numpy.array([.1,2.]),numpy.array([.1,2.]);
+  _check(proj.rt_to_sp_array,proj.rt_to_sp,l,m);
+
+def test_common_utils ():
+  pytest.importorskip("Timba.TDL");
+  from Cattery.LSM import common_utils
+  ra,dec = _radec();
+  l,m = _lm();
+  _check(lambda x,y:common_utils.radec_to_lm_array(RA0,DEC0,x,y),lambda x,y:common_utils.radec_to_lm(RA0,DEC0,x,y),ra,dec);
+  _check(lambda x,y:common_utils.radec_to_lm_SIN_array(RA0,DEC0,x,y),lambda x,y:common_utils.radec_to_lm_SIN(RA0,DEC0,x,y),ra,dec);
+  _check(lambda x,y:common_utils.lm_to_radec_array(RA0,DEC0,x,y),lambda x,y:common_utils.lm_to_radec(RA0,DEC0,x,y),l,m);
+
+def test_newstar_offsets ():
+  """The NEWSTAR loader converts the float32 l,m offsets of a whole model at once""";
+  pytest.importorskip("Timba.TDL");
+  from Cattery.LSM import common_utils
+  l,m = [ x.astype(numpy.float32) for x in _lm() ];
+  ra,dec = common_utils.lm_to_radec_array(RA0,DEC0,l,m);
+  for i in range(len(l)):
+    assert (ra[i],dec[i]) == common_utils.lm_to_radec(RA0,DEC0,float(l[i]),float(m[i]));
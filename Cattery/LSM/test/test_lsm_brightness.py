@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""Checks that the LSM brightness order follows changes to the brightness of p-Units already in the LSM""";
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import pytest
+import numpy
+
+pytest.importorskip("Timba.TDL")
+
+from Cattery.LSM.LSM import LSM,PUnit
+
+def _make_lsm (brightness):
+  lsm = LSM();
+  for i,b in enumerate(brightness):
+    p = PUnit("S%d"%i,lsm);
+    p.setBrightness(b);
+    lsm.insertPUnit(p);
+  return lsm;
+
+def _check_order (lsm):
+  punits = lsm.queryLSM(count=len(lsm.p_table));
+  assert sorted([ p.name for p in punits ]) == sorted(lsm.p_table.keys());
+  brightness = [ p.getBrightness() for p in punits ];
+  assert brightness == sorted(brightness,reverse=True);
+  assert lsm.getMaxBrightness() == brightness[0];
+
+# fewer and more than LSM.BARR_BISECT_MAX p-Units, so that both merge paths are used
+@pytest.mark.parametrize("nsrc",[5,LSM.BARR_BISECT_MAX*3])
+def test_reorder_after_set_brightness (nsrc):
+  rng = numpy.random.default_rng(nsrc);
+  lsm = _make_lsm(rng.permutation(nsrc)+1.);
+  _check_order(lsm);
+  # make the faintest source the brightest, and the brightest one the faintest
+  punits = lsm.queryLSM(count=nsrc);
+  punits[-1].setBrightness(nsrc*2.);
+  punits[0].setBrightness(.5);
+  _check_order(lsm);
+  assert lsm.queryLSM(count=1)[0] is punits[-1];
+  assert lsm.queryLSM(count=nsrc)[-1] is punits[0];
+  # shuffle all brightnesses, and add a few more p-Units
+  for p,b in zip(lsm.p_table.values(),rng.permutation(nsrc)+1.):
+    p.setBrightness(b);
+  for i in range(3):
+    p = PUnit("N%d"%i,lsm);
+    p.setBrightness(rng.uniform(0,nsrc));
+    lsm.insertPUnit(p);
+  _check_order(lsm);
+
+def test_set_brightness_before_insert ():
+  """A p-Unit whose brightness is set before insertion goes in at the right place""";
+  lsm = _make_lsm([3.,2.,1.]);
+  _check_order(lsm);
+  p = PUnit("N",lsm);
+  p.setBrightness(2.5);
+  lsm.insertPUnit(p);
+  assert [ pu.name for pu in lsm.queryLSM(count=4) ] == ["S0","N","S1","S2"];
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""Checks that an LSM saved in columnar (.npz) form loads back the same: p-Units, sources, sixpacks and the
+brightness order""";
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import math
+import pytest
+import numpy
+
+pytest.importorskip("Timba.TDL")
+
+from Cattery.LSM.LSM import LSM,PUnit,Source,POINT_TYPE,PATCH_TYPE,GAUSS_TYPE
+from Cattery.LSM import LSM_Sixpack
+
+NSRC = 30
+
+def _add_punit (lsm,name,brightness,ptype=POINT_TYPE,members=None,sixpack=None,**kw):
+  p = PUnit(name,lsm);
+  p.setType(ptype);
+  for sname in (members or [name]):
+    p.addSource(sname);
+  p.setBrightness(brightness);
+  p.sp.set_staticRA(kw.get('ra',0.));
+  p.sp.set_staticDec(kw.get('dec',0.));
+  p.setCat(kw.get('cat',1));
+  p.setFOVDist(kw.get('fov',0));
+  p._lm = kw.get('lm');
+  if sixpack is not None:
+    p.setSP(sixpack);
+  lsm.insertPUnit(p);
+  return p;
+
+def _make_lsm ():
+  """Makes an LSM of point and Gaussian sources, two of them grouped into a patch""";
+  rng = numpy.random.default_rng(0);
+  lsm = LSM();
+  for i in range(NSRC):
+    name = "S%d"%i;
+    if i%3:
+      lsm.s_table[name] = Source(name,tableName="T%d"%(i%2));
+    else:
+      lsm.s_table[name] = Source(name,major=.01*i,minor=.005*i,pangle=.1*i);
+    ra,dec = rng.uniform(0,2*math.pi),rng.uniform(-1,1);
+    sixpack = LSM_Sixpack.Sixpack(label=name,I0=float(rng.uniform(.1,10)),stokesQ=.1,stokesU=-.2,stokesV=.01*i,
+                                  RA=ra,Dec=dec,SI=-.7,f0=1.4e9,RM=i);
+    # equal brightness for some pairs, to check that their order is kept
+    _add_punit(lsm,name,float(i//2) if i < 6 else float(rng.uniform(0,100)),
+               ptype=GAUSS_TYPE if i%3 == 0 else POINT_TYPE,sixpack=sixpack,
+               ra=ra,dec=dec,cat=1+i%3,fov=.5*i,lm=(.01*i,-.01*i) if i%4 == 0 else None);
+  # a patch of two sources
+  members = ["S1","S2"];
+  for sname in members:
+    lsm.p_table[sname]._patch_name = "patch0";
+  _add_punit(lsm,"patch0",50.,ptype=PATCH_TYPE,members=members,
+             sixpack=LSM_Sixpack.Sixpack(label="patch0",type='patch'),ra=1.,dec=.5);
+  # a p-Unit without a sixpack
+  _add_punit(lsm,"nosp",3.,ra=2.,dec=-.5);
+  return lsm;
+
+def _sixpack_values (sp):
+  if sp is None:
+    return None;
+  return (sp.ispoint(),sp.label())+tuple([ float(getattr(sp,parm)()) for parm in LSM.SIXPACK_PARMS ]);
+
+def _punit_attrs (p):
+  return (p.type,p.cat,p.app_brightness,p.FOV_distance,p.sp.static_RA,p.sp.static_Dec,list(p.s_list),
+          p._patch_name,p._lm and tuple(p._lm),_sixpack_values(p.getSP()));
+
+def _source_attrs (s):
+  return (s.name,s.tableName,s.treeType,tuple([ float(x) for x in s.extParms() ]));
+
+def _order (lsm):
+  return [ p.name for p in lsm.queryLSM(count=len(lsm.p_table)) ];
+
+def _check_same (lsm1,lsm0):
+  assert sorted(lsm1.p_table.keys()) == sorted(lsm0.p_table.keys());
+  for name,p0 in lsm0.p_table.items():
+    assert _punit_attrs(lsm1.p_table[name]) == _punit_attrs(p0),name;
+  assert list(lsm1.s_table.keys()) == list(lsm0.s_table.keys());
+  for name,s0 in lsm0.s_table.items():
+    assert _source_attrs(lsm1.s_table[name]) == _source_attrs(s0);
+  assert _order(lsm1) == _order(lsm0);
+
+def test_save_load (tmp_path):
+  lsm0 = _make_lsm();
+  filename = str(tmp_path/"test.lsm");
+  lsm0.save(filename);
+  lsm1 = LSM();
+  lsm1.load(filename);
+  # sources are only created as they are accessed
+  assert lsm1.s_table.materialized() == 0;
+  _check_same(lsm1,lsm0);
+  # equal brightness p-Units stay in order of insertion
+  order = _order(lsm1);
+  assert order.index("S4") < order.index("S5") < order.index("S2") < order.index("S3");
+  # saving the loaded LSM gives the same file contents
+  lsm1.save(str(tmp_path/"test2.lsm"));
+  with numpy.load(filename) as data0, numpy.load(str(tmp_path/"test2.lsm")) as data1:
+    assert sorted(data0.files) == sorted(data1.files);
+    for key in data0.files:
+      numpy.testing.assert_array_equal(data1[key],data0[key],err_msg=key);
+
+def test_load_then_modify (tmp_path):
+  """The brightness order loaded from file is kept up to date as p-Units are added and changed""";
+  lsm0 = _make_lsm();
+  filename = str(tmp_path/"test.lsm");
+  lsm0.save(filename);
+  lsm1 = LSM();
+  lsm1.load(filename);
+  for lsm in lsm0,lsm1:
+    _add_punit(lsm,"new",42.);
+    lsm.p_table["S0"].setBrightness(1000.);
+  _check_same(lsm1,lsm0);
+  assert _order(lsm1)[0] == "S0";
+  brightness = [ lsm1.p_table[name].getBrightness() for name in _order(lsm1) ];
+  assert brightness == sorted(brightness,reverse=True);
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""Checks the positional queries of the LSM spatial index (cone and box, including boxes wrapping around
+RA=0), getBounds() and the source binning of createPatchesFromGrid() against brute-force searches""";
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import math
+import pytest
+import numpy
+
+pytest.importorskip("Timba.TDL")
+
+import Cattery.LSM.LSM as LSM_module
+from Cattery.LSM.LSM import LSM,PUnit,Source,POINT_TYPE,PATCH_TYPE,GAUSS_TYPE
+
+NSRC = 500
+
+def _make_lsm (seed=0):
+  """Makes an LSM of point and Gaussian sources all over the sky, with extra sources close to RA=0,
+  and one patch""";
+  rng = numpy.random.default_rng(seed);
+  ra = numpy.concatenate([rng.uniform(0,2*math.pi,NSRC-50),rng.uniform(-.05,.05,50)%(2*math.pi)]);
+  dec = numpy.arcsin(rng.uniform(-1,1,NSRC));
+  lsm = LSM();
+  for i in range(NSRC):
+    name = "S%d"%i;
+    gauss = i%10 == 0;
+    lsm.s_table[name] = Source(name,major=.01,minor=.005,pangle=.3) if gauss else Source(name);
+    p = PUnit(name,lsm);
+    p.setType(GAUSS_TYPE if gauss else POINT_TYPE);
+    p.addSource(name);
+    p.setBrightness(float(rng.uniform(0,20)));
+    p.sp.set_staticRA(float(ra[i]));
+    p.sp.set_staticDec(float(dec[i]));
+    lsm.insertPUnit(p);
+  # group a few sources into a patch: only the patch itself is visible in queries
+  patch = PUnit("patch0",lsm);
+  patch.setType(PATCH_TYPE);
+  for name in ["S1","S2","S3"]:
+    patch.addSource(name);
+    lsm.p_table[name]._patch_name = "patch0";
+  patch.sp.set_staticRA(lsm.p_table["S1"].sp.getRA());
+  patch.sp.set_staticDec(lsm.p_table["S1"].sp.getDec());
+  lsm.insertPUnit(patch);
+  return lsm;
+
+def _visible (p):
+  return p.getType() == PATCH_TYPE or p._patch_name is None;
+
+def _distance (ra0,dec0,ra1,dec1):
+  """Great-circle distance, by the haversine formula""";
+  h = math.sin((dec1-dec0)/2)**2 + math.cos(dec0)*math.cos(dec1)*math.sin((ra1-ra0)/2)**2;
+  return 2*math.asin(math.sqrt(min(h,1)));
+
+def _query (lsm,**kw):
+  return [ p.name for p in lsm.queryLSM(**kw) ];
+
+@pytest.fixture(scope="module")
+def lsm ():
+  return _make_lsm();
+
+@pytest.mark.parametrize("ra0,dec0,radius",[
+    (1.,.3,.2),(3.,-1.2,.5),
+    # cones across RA=0, and around the poles
+    (.01,.1,.1),(6.27,-.2,.15),(2.,1.5,.2),(5.,-1.5,.3),
+    (0.,0.,math.pi),(1.,.5,0.) ])
+def test_cone (lsm,ra0,dec0,radius):
+  expected = [ name for name,p in lsm.p_table.items() if _visible(p) and
+               _distance(ra0,dec0,p.sp.getRA(),p.sp.getDec()) <= radius ];
+  assert _query(lsm,cone=(ra0,dec0,radius)) == expected;
+
+@pytest.mark.parametrize("ra0,ra1,dec0,dec1",[
+    (1.,2.,-.5,.5),(0.,2*math.pi,-math.pi/2,math.pi/2),(3.,3.1,1.,1.4),
+    # boxes wrapping around RA=0
+    (6.2,.1,-1.,1.),(5.,1.,0.,.8),
+    (2.,1.,-.1,-.2) ])
+def test_box (lsm,ra0,ra1,dec0,dec1):
+  def in_range (ra):
+    return ra0 <= ra <= ra1 if ra0 <= ra1 else (ra >= ra0 or ra <= ra1);
+  expected = [ name for name,p in lsm.p_table.items() if _visible(p) and
+               in_range(p.sp.getRA()) and dec0 <= p.sp.getDec() <= dec1 ];
+  assert _query(lsm,box=(ra0,ra1,dec0,dec1)) == expected;
+
+def test_index_follows_changes ():
+  lsm = _make_lsm(1);
+  cone = (1.,.3,.1);
+  before = _query(lsm,cone=cone);
+  # moving a source into the cone, and adding a new one, show up in the next query
+  lsm.p_table["S10"].sp.set_staticRA(1.);
+  lsm.p_table["S10"].sp.set_staticDec(.3);
+  lsm.invalidateSpatialIndex();
+  p = PUnit("new",lsm);
+  p.addSource("new");
+  p.sp.set_staticRA(1.01);
+  p.sp.set_staticDec(.3);
+  lsm.insertPUnit(p);
+  after = _query(lsm,cone=cone);
+  assert sorted(after) == sorted(set(before)|set(["S10","new"]));
+
+def test_get_bounds (lsm):
+  ra = [];
+  dec = [];
+  for p in lsm.p_table.values():
+    if p.getType() == POINT_TYPE:
+      ra.append(p.sp.getRA());
+      dec.append(p.sp.getDec());
+    elif p.getType() == GAUSS_TYPE:
+      x0,x1,y0,y1 = p.getLimits();
+      ra += [x0,x1];
+      dec += [y0,y1];
+  assert lsm.getBounds() == dict(min_RA=min(ra),max_RA=max(ra),min_Dec=min(dec),max_Dec=max(dec));
+
+@pytest.mark.parametrize("min_bright,max_bright,min_sources",[(0.,20.,2),(5.,10.,3),(0.,20.,1000)])
+def test_create_patches_from_grid (monkeypatch,min_bright,max_bright,min_sources):
+  lsm = _make_lsm();
+  # no GUI, and record the patches rather than making node trees for them
+  monkeypatch.setattr(LSM_module,"qApp",None,raising=False);
+  monkeypatch.setattr(LSM_module,"QApplication",type("QApplication",(object,),{}),raising=False);
+  patches = [];
+  lsm.createPatch = lambda slist,resolve_forest=True,sync_kernel=True:patches.append(list(slist)) or \
+                                                                       ["patch%d"%len(patches),0,0,0,0];
+  x = [.5,1.,2.,3.5];
+  y = [-1.,-.2,.4,1.];
+  lsm.createPatchesFromGrid(list(x),list(y),min_bright=min_bright,max_bright=max_bright,min_sources=min_sources);
+  # brute force: x[i] <= RA < x[i+1], with the last grid line included
+  def find_bin (grid,value):
+    for i in range(len(grid)-1):
+      if grid[i] <= value < grid[i+1] or (i == len(grid)-2 and value == grid[-1]):
+        return i;
+    return None;
+  bins = {};
+  for name,p in lsm.p_table.items():
+    if p.getType() == POINT_TYPE and p._patch_name is None and min_bright <= p.getBrightness() <= max_bright:
+      i,j = find_bin(x,p.sp.getRA()),find_bin(y,p.sp.getDec());
+      if i is not None and j is not None:
+        bins.setdefault((i,j),[]).append(name);
+  expected = [ slist for slist in bins.values() if len(slist) >= max(min_sources,2) ];
+  assert expected or min_sources > NSRC;
+  assert sorted(patches) == sorted(expected);
@@ -32,6 +32,25 @@ from __future__ import print_function
 from __future__ import division
 
 import math
+import numpy
+
+## returns an array version of a math module function, applied elementwise
+## (numpy's own transcendental functions may differ from the math module in
+## the last bit, so the array transforms use these to match the scalar ones)
+def math_array(func,nin=1):
+  ufunc=numpy.frompyfunc(func,nin,1)
+  return lambda *args: numpy.asarray(ufunc(*args),dtype=float)
+
+## math.asin, giving nan instead of an exception outside [-1,1]
+def _asin(x):
+  return math.asin(x) if abs(x)<=1 else float('nan')
+
+sin_array=math_array(math.sin)
+cos_array=math_array(math.cos)
+asin_array=math_array(_asin)
+atan_array=math_array(math.atan)
+atan2_array=math_array(math.atan2,2)
+
 ## class to implement projection
 class Projector:
   '''This class will perform spherical to rectangular projections
@@ -48,47 +67,37 @@ class Projector:
 
   # calculation of the bounds in l,m
   def give_limits(self,min_ra,max_ra,min_dec,max_dec):
-   # set to default values 
-   x_min=y_min=1000000
-   x_max=y_max=-1000000
-
-   #print (x_min,x_max,y_min,y_max)
-   # now consider local maxima,minima
+   # sample each edge of the box at npoints+1 positions
    npoints=10
+   steps=numpy.arange(0,npoints+1)
+   ra_edge=min_ra+steps*((max_ra-min_ra)/npoints)
+   dec_edge=min_dec+steps*((max_dec-min_dec)/npoints)
+   ones=numpy.ones(npoints+1)
+   ra=numpy.concatenate((ra_edge,ra_edge,min_ra*ones,max_ra*ones))
+   dec=numpy.concatenate((min_dec*ones,max_dec*ones,dec_edge,dec_edge))
+   (x,y)=self.sp_to_rt_array(ra,dec)
 
-   delta=(max_ra-min_ra)/npoints
-   for i in range(0,npoints+1):
-    pcoord=min_ra+i*delta
-    tmp_val=self.sp_to_rt(pcoord,min_dec)
-    if x_min>tmp_val[0]: x_min=tmp_val[0] 
-    elif x_max<tmp_val[0]: x_max=tmp_val[0] 
-    if y_min>tmp_val[1]: y_min=tmp_val[1] 
-    elif y_max<tmp_val[1]: y_max=tmp_val[1] 
-    tmp_val=self.sp_to_rt(pcoord,max_dec)
-    if x_min>tmp_val[0]: x_min=tmp_val[0] 
-    elif x_max<tmp_val[0]: x_max=tmp_val[0] 
-    if y_min>tmp_val[1]: y_min=tmp_val[1] 
-    elif y_max<tmp_val[1]: y_max=tmp_val[1] 
-
-   delta=(max_dec-min_dec)/npoints
-   for i in range(0,npoints+1):
-    pcoord=min_dec+i*delta
-    tmp_val=self.sp_to_rt(min_ra,pcoord)
-    if x_min>tmp_val[0]: x_min=tmp_val[0] 
-    elif x_max<tmp_val[0]: x_max=tmp_val[0] 
-    if y_min>tmp_val[1]: y_min=tmp_val[1] 
-    elif y_max<tmp_val[1]: y_max=tmp_val[1] 
-    tmp_val=self.sp_to_rt(max_ra,pcoord)
-    if x_min>tmp_val[0]: x_min=tmp_val[0] 
-    elif x_max<tmp_val[0]: x_max=tmp_val[0] 
-    if y_min>tmp_val[1]: y_min=tmp_val[1] 
-    elif y_max<tmp_val[1]: y_max=tmp_val[1] 
-
-
-   return (x_min,x_max,y_min,y_max)
+   return (float(x.min()),float(x.max()),float(y.min()),float(y.max()))
 
   # spherical to rectangular
   # SIN projection
+  # ra,dec may be scalars or arrays, l,m arrays are returned
+  def sp_to_rt_array(self,ra,dec):
+   ra=numpy.asarray(ra,dtype=float)
+   dec=numpy.asarray(dec,dtype=float)
+   if self.__state==0: return (ra,dec)
+   del_a=ra-self.__ra0
+   cosdec=cos_array(dec)
+   L=cosdec*sin_array(del_a)
+   M=sin_array(dec)*math.cos(self.__dec0)-cosdec*math.sin(self.__dec0)*cos_array(del_a)
+   if self.__p==0:
+     return (L,M)
+   else: # we have an axis rotation 
+     l=L*math.cos(self.__p)+M*math.sin(self.__p)
+     m=-L*math.sin(self.__p)+M*math.cos(self.__p)
+     return (l,m)
+
+  # scalar version of the above
   def sp_to_rt(self,ra,dec):
    if self.__state==0: return (ra,dec)
    del_a=ra-self.__ra0
@@ -103,6 +112,30 @@ class Projector:
 
   # rectangular to spherical
   # SIN projection
+  # l,m may be scalars or arrays, ra,dec arrays are returned.
+  # Points outside the unit circle map to (0,0)
+  def rt_to_sp_array(self,l,m):
+   l=numpy.asarray(l,dtype=float)
+   m=numpy.asarray(m,dtype=float)
+   if self.__state==0: return (l,m)
+   if self.__p==0:
+     L=l
+     M=m
+   else:
+     L=l*math.cos(self.__p)-m*math.sin(self.__p)
+     M=l*math.sin(self.__p)+m*math.cos(self.__p)
+
+   with numpy.errstate(invalid='ignore',divide='ignore'):
+     n=numpy.sqrt(1-L*L-M*M)
+     dec=asin_array(M*math.cos(self.__dec0)+math.sin(self.__dec0)*n)
+     ra=self.__ra0+atan_array(L/(math.cos(self.__dec0)*n-M*math.sin(self.__dec0)))
+   bad=numpy.isnan(ra)|numpy.isnan(dec)
+   ra=numpy.where(bad,0.,ra)
+   dec=numpy.where(bad,0.,dec)
+  
+   return (ra,dec)
+
+  # scalar version of the above
   def rt_to_sp(self,l,m):
    if self.__state==0: return (l,m)
    if self.__p==0:
@@ -33,14 +33,30 @@ from .Parameterization import *
 from . import Jones
 from . import Context
 from math import cos,sin,acos,asin,atan2,sqrt,pi
+import numpy
 
-def radec_to_lmn (ra,dec,ra0,dec0):
-  """Returns l,m,n corresponding to direction ra,dec w.r.t. direction ra0,dec0""";
+# elementwise versions of the math module functions used by the array transforms below. numpy's own sin,
+# arcsin etc. may differ from these in the last bit, and the array transforms must agree with the scalar ones.
+def _math_array (func,nin=1):
+  ufunc = numpy.frompyfunc(func,nin,1);
+  return lambda *args:numpy.asarray(ufunc(*args),dtype=float);
+
+_sin = _math_array(sin);
+_cos = _math_array(cos);
+# gives nan rather than an exception outside [-1,1]
+_asin = _math_array(lambda x:asin(x) if abs(x) <= 1 else float('nan'));
+_atan2 = _math_array(atan2,2);
+
+def radec_to_lmn_array (ra,dec,ra0,dec0):
+  """Returns l,m,n arrays corresponding to arrays of directions ra,dec w.r.t. direction ra0,dec0""";
 ## our old formula, perhaps unjustly suspected by me
 ## See purrlog for 3C147_spw0, entries of Nov 21.
 ## Doesn't this break down at the pole (l always 0)?
-  l = cos(dec) * sin(ra-ra0);
-  m = sin(dec) * cos(dec0) - cos(dec) * sin(dec0) * cos(ra-ra0);
+  ra = numpy.asarray(ra,dtype=float);
+  dec = numpy.asarray(dec,dtype=float);
+  cosdec = _cos(dec);
+  l = cosdec * _sin(ra-ra0);
+  m = _sin(dec) * cos(dec0) - cosdec * sin(dec0) * _cos(ra-ra0);
 ## Sarod's formula from LSM.common_utils. Doesn't seem to work right!
 ## (that's because it's for NCP lm coordinates used in NEWSTAR sky models)
 #  l = sin(ra-ra0)*math.cos(dec);
@@ -49,11 +65,36 @@ def radec_to_lmn (ra,dec,ra0,dec0):
 #     m = -(cos(ra-ra0)*cos(dec)-cos(dec0))/math.sin(dec0);
 #   else:
 #     m = 0
+  n = numpy.sqrt(1-l*l-m*m);
+  return l,m,n;
+
+def radec_to_lmn (ra,dec,ra0,dec0):
+  """Returns l,m,n corresponding to direction ra,dec w.r.t. direction ra0,dec0.
+  See radec_to_lmn_array() for a version operating on arrays of directions.""";
+  l = cos(dec) * sin(ra-ra0);
+  m = sin(dec) * cos(dec0) - cos(dec) * sin(dec0) * cos(ra-ra0);
   n = sqrt(1-l*l-m*m);
   return l,m,n;
 
+def lm_to_radec_array (l,m,ra0,dec0):
+  """Returns ra,dec arrays corresponding to arrays of l,m w.r.t. direction ra0,dec0""";
+  # see formula at http://en.wikipedia.org/wiki/Orthographic_projection_(cartography)
+  l = numpy.asarray(l,dtype=float);
+  m = numpy.asarray(m,dtype=float);
+  rho = numpy.sqrt(l**2+m**2);
+  with numpy.errstate(invalid='ignore',divide='ignore'):
+    cc = _asin(rho);
+    sincc = _sin(cc);
+    ra = ra0 + _atan2( l*sincc,rho*cos(dec0)*_cos(cc)-m*sin(dec0)*sincc );
+    dec = _asin( _cos(cc)*sin(dec0) + m*sincc*cos(dec0)/rho );
+  centre = (rho == 0.0);
+  ra = numpy.where(centre,ra0,ra);
+  dec = numpy.where(centre,dec0,dec);
+  return ra,dec;
+
 def lm_to_radec (l,m,ra0,dec0):
-  """Returns ra,dec corresponding to l,m w.r.t. direction ra0,dec0""";
+  """Returns ra,dec corresponding to l,m w.r.t. direction ra0,dec0.
+  See lm_to_radec_array() for a version operating on arrays of l,m.""";
   # see formula at http://en.wikipedia.org/wiki/Orthographic_projection_(cartography)
   rho = sqrt(l**2+m**2);
   if rho == 0.0:
@@ -66,6 +107,26 @@ def lm_to_radec (l,m,ra0,dec0):
 
   return ra,dec;
 
+def lmn_static_list (directions,dir0=None):
+  """Returns list of static LMN tuples for a list of directions, as given by Direction.lmn_static().
+  LMNs that are not yet cached are computed with a single radec_to_lmn_array() call.
+  """;
+  dir0 = Context.get_dir0(dir0);
+  # collect plain static directions that still need their lmn computed
+  pending = {};
+  if dir0.static:
+    ra0,dec0 = dir0.radec_static();
+    for dd in directions:
+      if type(dd).lmn_static is Direction.lmn_static and dd.static and (ra0,dec0) not in dd.static_lmn:
+        pending[id(dd)] = dd;
+  if pending:
+    pending = list(pending.values());
+    ra,dec = numpy.array([ dd.radec_static() for dd in pending ],dtype=float).T;
+    l,m,n = radec_to_lmn_array(ra,dec,ra0,dec0);
+    for i,dd in enumerate(pending):
+      dd.static_lmn[(ra0,dec0)] = float(l[i]),float(m[i]),float(n[i]);
+  return [ dd.lmn_static(dir0) for dd in directions ];
+
 class Direction (Parameterization):
   """A Direction represents an absolute direction on the sky, in ra,dec (radians).
   'name' may be None, this usually identifies the phase centre.
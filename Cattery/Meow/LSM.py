@@ -38,6 +38,7 @@ import traceback
 import Meow
 import Meow.OptionTools
 import Meow.Context
+from Meow.Direction import lmn_static_list
 import math
 from math import *
 
@@ -237,22 +238,26 @@ class MeowLSM (object):
     # make list of direction,punit,I,I_apparent tuples
     parm = Meow.Parm(tags="source solvable");
     srclist = [];
+    freqs = [];
     for pu in plist:
       ra,dec,I,Q,U,V,spi,freq0,RM = pu.getEssentialParms(ns);
       if self.solve_pos:
         ra = parm.new(ra);
         dec = parm.new(dec);
       direction = Meow.Direction(ns,pu.name,ra,dec,static=not self.solve_pos);
-      Iapp = I;
-      if beam_func is not None:
-      # if phase centre is already set (i.e. static), then lmn will be computed here, and we
-      # can apply a beam expression
-        lmn = direction.lmn_static();
+      # append to list
+      srclist.append((pu.name,direction,pu,I,I));
+      freqs.append(freq0);
+    if beam_func is not None:
+    # if phase centre is already set (i.e. static), then lmn will be computed here (for all sources
+    # in one go), and we can apply a beam expression
+      lmns = lmn_static_list([ src[1] for src in srclist ]);
+      for i,(lmn,freq0) in enumerate(zip(lmns,freqs)):
         if lmn is not None:
+          name,direction,pu,I,Iapp = srclist[i];
           r = sqrt(lmn[0]**2+lmn[1]**2);
           Iapp = I*beam_func(r,freq0*1e-9 or 1.4);  # use 1.4 GHz if ref frequency not specified
-      # append to list
-      srclist.append((pu.name,direction,pu,I,Iapp));
+          srclist[i] = name,direction,pu,I,Iapp;
     # sort list by decreasing apparent flux
     from past.builtins import cmp
     from functools import cmp_to_key
@@ -41,6 +41,8 @@ import os
 import os.path
 import math
 import fnmatch
+import json
+import numpy
 
 _addImagingColumns = None;
 # figure out which table implementation to use -- try pyrap/casacore first
@@ -115,6 +117,12 @@ LINEAR_CORRS = set(["XX", "XY", "YX", "YY"]);
 # queue size parameter for MS i/o record
 ms_queue_size = 500;
 
+# if True, MS metadata snapshots are also saved inside the MS (see get_ms_metadata())
+ms_metadata_persist = False;
+
+# number of rows read in at a time when scanning the UVW column (see get_uvw_extents())
+uvw_chunk_size = 1000000;
+
 FLAGBITS = list(range(31));
 FLAG_ADD = "add to set";
 FLAG_REPLACE = "replace set";
@@ -142,6 +150,237 @@ def longest_prefix (*strings):
         return s1[:i];
   return strings[0];
 
+class MSMetadata (object):
+  """MSMetadata is a snapshot of the MS metadata used by MSSelector and MSContentSelector, i.e. the relevant
+  content of the ANTENNA, POLARIZATION, DATA_DESCRIPTION, SPECTRAL_WINDOW, FIELD and OBSERVATION subtables,
+  plus the list of data columns. Use get_ms_metadata() to obtain one.""";
+  SUBTABLES = [ "ANTENNA","POLARIZATION","DATA_DESCRIPTION","SPECTRAL_WINDOW","FIELD","OBSERVATION" ];
+  FIELDS = [ "data_columns","antenna_names","num_antennas","antenna_positions","observatory","corr_types",
+             "spws","polarization_ids","num_chan","field_names","field_phase_dir" ];
+  ARRAY_FIELDS = set([ "antenna_positions","field_phase_dir" ]);
+
+  def __init__ (self,**kw):
+    for field in self.FIELDS:
+      setattr(self,field,kw.get(field));
+
+  @staticmethod
+  def read (ms):
+    """Reads metadata from an MS. ms is a pyrap table object""";
+    md = MSMetadata();
+    md.data_columns = [ name for name in ms.colnames() if name.endswith('DATA') ];
+    anttable = TABLE(str(ms.getkeyword('ANTENNA')),lockoptions='autonoread');
+    md.antenna_names = list(anttable.getcol('NAME') or []);
+    md.num_antennas = anttable.nrows();
+    md.antenna_positions = anttable.getcol('POSITION');
+    try:
+      md.observatory = str(TABLE(str(ms.getkeyword("OBSERVATION"))).getcol("TELESCOPE_NAME")[0]);
+    except:
+      md.observatory = None;
+    pol_tab = TABLE(str(ms.getkeyword('POLARIZATION')),lockoptions='autonoread');
+    md.corr_types = [ [ int(ctype) for ctype in pol_tab.getcol('CORR_TYPE',pol_id,1)[0] ]
+                      for pol_id in range(pol_tab.nrows()) ];
+    ddid_tab = TABLE(str(ms.getkeyword('DATA_DESCRIPTION')),lockoptions='autonoread');
+    md.spws = [ int(x) for x in ddid_tab.getcol('SPECTRAL_WINDOW_ID') ];
+    md.polarization_ids = [ int(x) for x in ddid_tab.getcol('POLARIZATION_ID') ];
+    md.num_chan = [ int(x) for x in TABLE(str(ms.getkeyword('SPECTRAL_WINDOW')),lockoptions='autonoread').getcol('NUM_CHAN') ];
+    field = TABLE(str(ms.getkeyword('FIELD')),lockoptions='autonoread');
+    md.field_names = list(field.getcol('NAME'));
+    md.field_phase_dir = field.getcol('PHASE_DIR');
+    md._freeze();
+    return md;
+
+  def _freeze (self):
+    """Helper method. Makes the array fields read-only, since snapshots are shared by all selectors""";
+    for field in self.ARRAY_FIELDS:
+      value = getattr(self,field);
+      if isinstance(value,numpy.ndarray):
+        value.setflags(write=False);
+
+  def to_dict (self):
+    """Returns JSON-serializable representation""";
+    return dict([ (field,(numpy.asarray(getattr(self,field)).tolist() if field in self.ARRAY_FIELDS else getattr(self,field)))
+                  for field in self.FIELDS ]);
+
+  @staticmethod
+  def from_dict (rec):
+    """Makes MSMetadata from the output of to_dict()""";
+    md = MSMetadata(**rec);
+    for field in md.ARRAY_FIELDS:
+      setattr(md,field,numpy.array(getattr(md,field)));
+    md._freeze();
+    return md;
+
+# cache of MS metadata snapshots, shared by all selectors in this process. Maps MS path to (key,MSMetadata)
+_ms_metadata_cache = {};
+MS_METADATA_FILE = "MEOW_METADATA.json";
+
+def _ms_metadata_key (msname):
+  """Helper function, returns the modification times of the table.* files of the MS and its metadata subtables
+  (lock files excepted), as a list of [subtable,filename,mtime] entries""";
+  key = [];
+  for subtable in [""] + MSMetadata.SUBTABLES:
+    dirname = os.path.join(msname,subtable);
+    if os.path.isdir(dirname):
+      key += [ [subtable,f,os.path.getmtime(os.path.join(dirname,f))] for f in sorted(os.listdir(dirname))
+               if f.startswith("table.") and f != "table.lock" ];
+  return key;
+
+def get_ms_metadata (msname,ms=None,persist=None):
+  """Returns MSMetadata snapshot for the given MS. Snapshots are cached by MS path, and are reused for as
+  long as the modification times of the MS and its subtables stay the same.
+  'ms' may be an already open table object for the MS, else it is opened as needed.
+  If 'persist' is True (default is the module-level ms_metadata_persist setting), the snapshot is also saved
+  inside the MS as MS_METADATA_FILE, so that it can be reused by other processes.
+  """;
+  if persist is None:
+    persist = ms_metadata_persist;
+  path = os.path.abspath(str(msname));
+  filename = os.path.join(path,MS_METADATA_FILE);
+  key = _ms_metadata_key(path);
+  md = None;
+  key0,md0 = _ms_metadata_cache.get(path,(None,None));
+  if md0 is not None and key0 == key:
+    md = md0;
+    if not persist or os.path.exists(filename):
+      return md;
+  # try the saved snapshot
+  elif persist and os.path.exists(filename):
+    try:
+      rec = json.load(open(filename));
+      if rec.get('key') == key:
+        md = MSMetadata.from_dict(rec['metadata']);
+        _ms_metadata_cache[path] = key,md;
+        return md;
+    except:
+      Meow.dprint("Warning: error reading %s, ignoring"%filename);
+  # read from MS
+  if md is None:
+    if ms is None:
+      ms = TABLE(str(msname),lockoptions='autonoread');
+    md = MSMetadata.read(ms);
+    _ms_metadata_cache[path] = key,md;
+  if persist:
+    try:
+      json.dump(dict(key=key,metadata=md.to_dict()),open(filename,'w'));
+    except:
+      Meow.dprint("Warning: error writing %s, ignoring"%filename);
+  return md;
+
+class UVWExtents (object):
+  """UVWExtents holds the extents of the UVW coordinates in an MS, as computed by get_uvw_extents():
+
+      max_abs_w_ifr     = (Nant,Nant) array: max |w| per baseline (indexed by ANTENNA1,ANTENNA2), -1 if no rows
+      ddid_uvw_min/max  = (Nddid,3) arrays: min/max u,v,w per DATA_DESC_ID
+      field_uvw_min/max = (Nfield,3) arrays: min/max u,v,w per FIELD_ID
+
+  DDIDs and fields without any rows have min/max of +inf/-inf.
+  """;
+  ARRAY_FIELDS = [ "max_abs_w_ifr","ddid_uvw_min","ddid_uvw_max","field_uvw_min","field_uvw_max" ];
+
+  def __init__ (self):
+    self.max_abs_w_ifr = numpy.zeros((0,0),float);
+    self.ddid_uvw_min = self.field_uvw_min = numpy.zeros((0,3),float);
+    self.ddid_uvw_max = self.field_uvw_max = numpy.zeros((0,3),float);
+
+  @staticmethod
+  def _grow (arr,shape,fill):
+    """Helper method. Pads array with the fill value up to the given shape, if needed""";
+    shape = [ max(n,n0) for n,n0 in zip(shape,arr.shape) ];
+    if list(arr.shape) == shape:
+      return arr;
+    out = numpy.zeros(shape,float) + fill;
+    out[tuple([ slice(0,n0) for n0 in arr.shape ])] = arr;
+    return out;
+
+  def add (self,uvw,ant1,ant2,ddid,field):
+    """Adds a chunk of rows to the extents""";
+    if not len(uvw):
+      return;
+    absw = abs(uvw[:,2]);
+    nant = max(ant1.max(),ant2.max())+1;
+    self.max_abs_w_ifr = self._grow(self.max_abs_w_ifr,(nant,nant),-1);
+    numpy.maximum.at(self.max_abs_w_ifr,(ant1,ant2),absw);
+    for attr,index in ("ddid",ddid),("field",field):
+      n = index.max()+1;
+      uvwmin = self._grow(getattr(self,attr+"_uvw_min"),(n,3),numpy.inf);
+      uvwmax = self._grow(getattr(self,attr+"_uvw_max"),(n,3),-numpy.inf);
+      numpy.minimum.at(uvwmin,index,uvw);
+      numpy.maximum.at(uvwmax,index,uvw);
+      setattr(self,attr+"_uvw_min",uvwmin);
+      setattr(self,attr+"_uvw_max",uvwmax);
+
+  def max_abs_w (self,ifrs=None):
+    """Returns max |w| over the MS, or over the given list of baselines (as (ip,iq) antenna index pairs)""";
+    arr = self.max_abs_w_ifr;
+    if ifrs is not None:
+      ifrs = [ (p,q) for p,q in ifrs if p < arr.shape[0] and q < arr.shape[1] ];
+      arr = arr[tuple(numpy.array(ifrs,int).reshape((len(ifrs),2)).T)];
+    return max(arr.max(),0) if arr.size else 0;
+
+  def to_record (self):
+    """Returns representation suitable for storing as a table keyword""";
+    rec = dict([ (field,getattr(self,field)) for field in self.ARRAY_FIELDS ]);
+    # table keywords can't hold nested lists, so the shapes go in as an (Nfield,2) array
+    rec['shapes'] = numpy.array([ getattr(self,field).shape for field in self.ARRAY_FIELDS ],int);
+    return rec;
+
+  @staticmethod
+  def from_record (rec):
+    """Makes UVWExtents from the output of to_record()""";
+    ext = UVWExtents();
+    for field,shape in zip(ext.ARRAY_FIELDS,rec['shapes']):
+      setattr(ext,field,numpy.array(rec[field],float).reshape([ int(n) for n in shape ]));
+    return ext;
+
+MS_UVW_KEYWORD = "MEOW_UVW_EXTENTS";
+
+def _uvw_column_key (ms):
+  """Helper function, returns the row count of the MS, and the modification time of the data file
+  holding its UVW column (or -1 if this can't be determined)""";
+  try:
+    filename = os.path.join(ms.name(),"table.f%d"%ms.getdminfo("UVW")["SEQNR"]);
+    mtime = os.path.getmtime(filename);
+  except:
+    mtime = -1;
+  return [ ms.nrows(),mtime ];
+
+def get_uvw_extents (msname,chunksize=None,cache=True):
+  """Returns a UVWExtents object for the given MS. The UVW column is read in chunks of 'chunksize' rows
+  (default is uvw_chunk_size), so memory use is bounded regardless of the size of the MS.
+  If 'cache' is True, the result is stored in the MS as the MS_UVW_KEYWORD table keyword (if the MS is writable),
+  and reused for as long as the row count and UVW data of the MS stay the same.
+  """;
+  ms = TABLE(str(msname),lockoptions='autonoread');
+  key = _uvw_column_key(ms);
+  if cache and MS_UVW_KEYWORD in ms.keywordnames():
+    try:
+      rec = ms.getkeyword(MS_UVW_KEYWORD);
+      if list(rec['key']) == key:
+        Meow.dprint("Using cached UVW extents from %s"%msname);
+        return UVWExtents.from_record(rec);
+    except:
+      Meow.dprint("Warning: error reading cached UVW extents, recomputing");
+  # stream over the MS
+  chunksize = chunksize or uvw_chunk_size;
+  ext = UVWExtents();
+  nrows = ms.nrows();
+  for row0 in range(0,nrows,chunksize):
+    nr = min(chunksize,nrows-row0);
+    ext.add(ms.getcol("UVW",row0,nr),ms.getcol("ANTENNA1",row0,nr),ms.getcol("ANTENNA2",row0,nr),
+            ms.getcol("DATA_DESC_ID",row0,nr),ms.getcol("FIELD_ID",row0,nr));
+  ms.close();
+  # try to store in MS
+  if cache:
+    try:
+      ms = TABLE(str(msname),readonly=False,lockoptions='autonoread');
+      rec = ext.to_record();
+      rec['key'] = key;
+      ms.putkeyword(MS_UVW_KEYWORD,rec);
+      ms.close();
+    except:
+      Meow.dprint("Warning: can't store UVW extents in %s"%msname);
+  return ext;
+
 class MSContentSelector (object):
   def __init__ (self,ddid=[0],field=None,channels=True,namespace='ms_sel'):
     """Creates options for selecting a subset of an MS.
@@ -258,23 +497,20 @@ class MSContentSelector (object):
       selection.selection_string =  taql;
     return selection;
 
-  def _select_new_ms (self,ms):
+  def _select_new_ms (self,ms,metadata=None):
     """Called (from MSSelector) when a new MS is selected. ms is a pycasatable.table
-    object. Fills ddid/field/channel selectors from the MS.
+    object, metadata is its MSMetadata snapshot (looked up if not given).
+    Fills ddid/field/channel selectors from the MS.
     """;
+    md = metadata or get_ms_metadata(ms.name(),ms);
     # DDIDs
-    ddid_tab = TABLE(str(ms.getkeyword('DATA_DESCRIPTION')),lockoptions='autonoread');
-    self.ms_spws = list(ddid_tab.getcol('SPECTRAL_WINDOW_ID'));
-    self.ms_polarization_ids = list(ddid_tab.getcol('POLARIZATION_ID'));
-    ddid_tab = None;
+    self.ms_spws = list(md.spws);
+    self.ms_polarization_ids = list(md.polarization_ids);
     # channels per spectral window
-    numchans = TABLE(str(ms.getkeyword('SPECTRAL_WINDOW')),
-                                  lockoptions='autonoread').getcol('NUM_CHAN');
-    self.ms_ddid_numchannels = [ numchans[spw] for spw in self.ms_spws ];
+    self.ms_ddid_numchannels = [ md.num_chan[spw] for spw in self.ms_spws ];
     # Fields
-    field = TABLE(str(ms.getkeyword('FIELD')),lockoptions='autonoread');
-    self.ms_field_names = list(field.getcol('NAME'));
-    self.ms_field_phase_dir = field.getcol('PHASE_DIR');
+    self.ms_field_names = list(md.field_names);
+    self.ms_field_phase_dir = md.field_phase_dir;
     # update selectors
     self._update_ms_options();
 
@@ -805,16 +1041,14 @@ class MSSelector (object):
     Meow.Context.active_correlations = self.get_correlations();
     # get max W, if needed
     if Meow.Context.discover_max_abs_w:
-      # add baseline selection string
+      # apply baseline selection
       if TABLE:
-        ms = TABLE(str(self.msname),lockoptions='autonoread');
         subset = self.get_ifr_subset();
+        ifrs = None;
         if len(subset.ifrs()) < len(self.ms_ifrset.ifrs()):
-#          print "Applying TaQL subset",subset.taql_string();
-          ms = ms.query(subset.taql_string());
-        Meow.Context.max_abs_w = max(abs(ms.getcol("UVW")[:,2]));
+          ifrs = subset.ifr_numbers();
+        Meow.Context.max_abs_w = get_uvw_extents(self.msname).max_abs_w(ifrs);
 #        print "Max w is ",Meow.Context.max_abs_w;
-        ms.close();
     return array,observation;
 
   def make_subset_selector (self,namespace,**kw):
@@ -870,19 +1104,19 @@ class MSSelector (object):
       return True;
     try:
       ms = TABLE(str(msname),lockoptions='autonoread');
+      md = get_ms_metadata(msname,ms);
       # data columns
-      self.ms_data_columns = [ name for name in ms.colnames() if name.endswith('DATA') ];
+      self.ms_data_columns = list(md.data_columns);
       self.input_col_option.set_option_list(self.ms_data_columns);
       self.model_col_option.set_option_list(self.ms_data_columns);
       outcols = [ col for col in self.ms_data_columns if col not in self._forbid_output ];
       self.output_col_option.set_option_list(outcols);
       # antennas
-      anttable = TABLE(str(ms.getkeyword('ANTENNA')),lockoptions='autonoread');
-      antnames = anttable.getcol('NAME');
+      antnames = md.antenna_names;
       # if NAME column is missing, use indices
       if not antnames:
         Meow.dprint("Warning! This MS does not define ANTENNA names. Using antenna indices instead.")
-        self.ms_antenna_names = list(map(str,list(range(anttable.nrows()))));
+        self.ms_antenna_names = list(map(str,list(range(md.num_antennas))));
       # else use name, but trim off longest common prefix (so that RT0,RT1,..RTD become 0,1,...,D
       else:
         prefix = len(longest_prefix(*antnames));
@@ -891,11 +1125,10 @@ class MSSelector (object):
         if len(set(self.ms_antenna_names)) < len(self.ms_antenna_names):
           Meow.dprint("Warning! This MS does not define unique ANTENNA names. Using antenna indices instead.")
           self.ms_antenna_names = [ str(i) for i in range(len(self.ms_antenna_names)) ];
-      self.ms_antenna_positions = anttable.getcol('POSITION');
+      self.ms_antenna_positions = md.antenna_positions;
       # observatory is from observation subtable
-      try:
-        self.ms_observatory = TABLE(str(ms.getkeyword("OBSERVATION"))).getcol("TELESCOPE_NAME")[0];
-      except:
+      self.ms_observatory = md.observatory;
+      if self.ms_observatory is None:
         Meow.dprint("Warning! This MS does have a valid OBSERVATION table, can't establish telescope name");
         self.ms_observatory = "Unknown";
       # make IfrSet object for the full antenna set
@@ -911,12 +1144,11 @@ class MSSelector (object):
         self.ifrsel_option.set_doc(self.ms_ifrset.subset_doc);
       # correlations
       # polarization IDs
-      pol_tab = TABLE(str(ms.getkeyword('POLARIZATION')),lockoptions='autonoread');
       # get list of corrype enums for each row of polarizxation table, and convert
       # to strings via MS_STOKES_ENUMS. self._corrnames is now a list of lists of strings
       self._corrnames = [ [ (ctype >= 0 and ctype < len(MS_STOKES_ENUMS) and MS_STOKES_ENUMS[ctype]) or
-			    None for ctype in pol_tab.getcol('CORR_TYPE',pol_id,1)[0] ]
-			  for pol_id in range(pol_tab.nrows()) ];
+			    None for ctype in corr_types ]
+			  for corr_types in md.corr_types ];
       # convert to joined names (for ms_polariation option)
       self._corrstrings = [ " ".join(names) for names in self._corrnames ];
       self.polarization_option.set_option_list(self._corrstrings);
@@ -935,7 +1167,7 @@ class MSSelector (object):
         sel.update_flagsets(self.flagsets);
       # notify content selectors
       for sel in self._content_selectors:
-        sel._select_new_ms(ms);
+        sel._select_new_ms(ms,md);
       self._msname = msname;
       # notify callbacks
       for cb in self._when_changed_callbacks:
@@ -31,6 +31,7 @@ from __future__ import division
 from Meow.MeqMaker import *
 import Meow
 from Meow import StdTrees,ParmGroup,Parallelization,MSUtils
+from Meow.Direction import lmn_static_list
 
 import itertools
 
@@ -200,7 +201,7 @@ class TensorMeqMaker (MeqMaker):
       ## create lmn tensor per each source group
       source_groups = [];
       for igrp,sources in enumerate(sgroups):
-        lmn_static = [ src.direction.lmn_static() for src in sources ];
+        lmn_static = lmn_static_list([ src.direction for src in sources ]);
         lmnT = ns["lmnT%d"%igrp];
         # if all sources have static LMN coordinates, use a single constant node
         if all([ lmn is not None for lmn in lmn_static ]):
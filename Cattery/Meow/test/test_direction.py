@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""Checks that the array versions of the Meow direction transforms give bit-identical results to the scalar
+(math module) ones""";
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import os
+import sys
+import pytest
+import numpy
+
+pytest.importorskip("Timba.TDL");
+
+# Meow modules import each other as top-level packages, with the Cattery directory on the path
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))));
+from Meow.Direction import radec_to_lmn,radec_to_lmn_array,lm_to_radec,lm_to_radec_array
+
+RA0,DEC0 = 1.2,0.7
+
+def test_radec_to_lmn ():
+  rng = numpy.random.default_rng(1);
+  ra,dec = RA0+rng.uniform(-.1,.1,1000),DEC0+rng.uniform(-.1,.1,1000);
+  lmn = radec_to_lmn_array(ra,dec,RA0,DEC0);
+  expected = numpy.array([ radec_to_lmn(r,d,RA0,DEC0) for r,d in zip(ra,dec) ]).T;
+  for x,y in zip(lmn,expected):
+    numpy.testing.assert_array_equal(x,y);
+
+def test_lm_to_radec ():
+  rng = numpy.random.default_rng(2);
+  l,m = rng.uniform(-.05,.05,1000),rng.uniform(-.05,.05,1000);
+  # include the phase centre itself
+  l[0] = m[0] = 0;
+  radec = lm_to_radec_array(l,m,RA0,DEC0);
+  expected = numpy.array([ lm_to_radec(x,y,RA0,DEC0) for x,y in zip(l,m) ]).T;
+  for x,y in zip(radec,expected):
+    numpy.testing.assert_array_equal(x,y);
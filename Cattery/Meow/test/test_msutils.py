@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""Checks the MS metadata snapshots of Meow.MSUtils: invalidation when a subtable changes, and read-only
+shared arrays. Checks the UVW extents against a scan of the whole UVW column""";
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import os
+import sys
+import time
+import pytest
+import numpy
+
+tables = pytest.importorskip("casacore.tables");
+pytest.importorskip("Timba.TDL");
+
+# Meow modules import each other as top-level packages, with the Cattery directory on the path
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))));
+from Meow import MSUtils
+
+NANT = 4
+
+def _make_ms (msname):
+  """Creates an empty MS with filled-in ANTENNA, POLARIZATION, DATA_DESCRIPTION, SPECTRAL_WINDOW and FIELD
+  subtables""";
+  tables.default_ms(msname).close();
+  def _fill (subtable,nrows,**columns):
+    tab = tables.table(os.path.join(msname,subtable),readonly=False,ack=False);
+    tab.addrows(nrows);
+    for col,value in columns.items():
+      tab.putcol(col,value);
+    tab.close();
+  _fill("ANTENNA",NANT,NAME=[ "RT%d"%i for i in range(NANT) ],POSITION=numpy.arange(NANT*3.).reshape(NANT,3));
+  _fill("POLARIZATION",1,NUM_CORR=[4],CORR_TYPE=numpy.array([[9,10,11,12]]),
+        CORR_PRODUCT=numpy.zeros((1,4,2),int));
+  _fill("SPECTRAL_WINDOW",1,NUM_CHAN=[8],CHAN_FREQ=numpy.ones((1,8)),CHAN_WIDTH=numpy.ones((1,8)),
+        EFFECTIVE_BW=numpy.ones((1,8)),RESOLUTION=numpy.ones((1,8)));
+  _fill("DATA_DESCRIPTION",1,SPECTRAL_WINDOW_ID=[0],POLARIZATION_ID=[0]);
+  _fill("FIELD",1,NAME=["src"],PHASE_DIR=numpy.array([[[1.,.5]]]),DELAY_DIR=numpy.zeros((1,1,2)),
+        REFERENCE_DIR=numpy.zeros((1,1,2)));
+
+@pytest.fixture
+def msname (tmp_path):
+  msname = str(tmp_path/"test.ms");
+  _make_ms(msname);
+  yield msname;
+  MSUtils._ms_metadata_cache.clear();
+
+def test_metadata (msname):
+  md = MSUtils.get_ms_metadata(msname,persist=False);
+  assert md.antenna_names == [ "RT%d"%i for i in range(NANT) ];
+  assert md.corr_types == [[9,10,11,12]];
+  assert md.num_chan == [8];
+  assert md.field_names == ["src"];
+  assert MSUtils.get_ms_metadata(msname,persist=False) is md;
+
+def test_subtable_column_change (msname):
+  """Changing a column of a subtable in place must invalidate the snapshot, even if table.dat stays the same""";
+  md = MSUtils.get_ms_metadata(msname,persist=False);
+  field = tables.table(os.path.join(msname,"FIELD"),readonly=False,ack=False);
+  field.putcell("PHASE_DIR",0,numpy.array([[2.,-.5]]));
+  field.close();
+  md1 = MSUtils.get_ms_metadata(msname,persist=False);
+  assert md1 is not md;
+  assert (md1.field_phase_dir == [[[2.,-.5]]]).all();
+
+@pytest.mark.parametrize("persist",[False,True])
+def test_arrays_read_only (msname,persist):
+  # second call with persist=True returns the snapshot saved inside the MS
+  for i in range(2):
+    MSUtils._ms_metadata_cache.clear();
+    md = MSUtils.get_ms_metadata(msname,persist=persist);
+    for field in md.ARRAY_FIELDS:
+      with pytest.raises(ValueError):
+        getattr(md,field)[...] = 0;
+  assert (MSUtils.get_ms_metadata(msname,persist=persist).antenna_positions == numpy.arange(NANT*3.).reshape(NANT,3)).all();
+
+NTIME = 25
+
+def _fill_uvw (msname,seed=0):
+  """Adds rows with random UVWs to the MS: all baselines and autocorrelations but one, over NTIME timeslots,
+  two DDIDs and two fields""";
+  rng = numpy.random.default_rng(seed);
+  a1,a2 = numpy.triu_indices(NANT);
+  a1,a2 = a1[1:],a2[1:];
+  nrows = NTIME*len(a1);
+  ms = tables.table(msname,readonly=False,ack=False);
+  row0 = ms.nrows();
+  ms.addrows(nrows);
+  ms.putcol("ANTENNA1",numpy.tile(a1,NTIME),row0,nrows);
+  ms.putcol("ANTENNA2",numpy.tile(a2,NTIME),row0,nrows);
+  ms.putcol("DATA_DESC_ID",rng.integers(0,2,nrows),row0,nrows);
+  ms.putcol("FIELD_ID",rng.integers(0,2,nrows),row0,nrows);
+  ms.putcol("UVW",rng.standard_normal((nrows,3))*1000,row0,nrows);
+  ms.close();
+
+def _scan (msname,taql=None):
+  """Reads the whole UVW column, or the rows selected by a TaQL string, and the index columns""";
+  ms = tables.table(msname,ack=False);
+  try:
+    if taql:
+      ms = ms.query(taql);
+    return dict([ (col,ms.getcol(col)) for col in ("UVW","ANTENNA1","ANTENNA2","DATA_DESC_ID","FIELD_ID") ]);
+  finally:
+    ms.close();
+
+def _check_extents (ext,msname):
+  cols = _scan(msname);
+  uvw = cols["UVW"];
+  assert ext.max_abs_w() == abs(uvw[:,2]).max();
+  for p in range(NANT):
+    for q in range(NANT):
+      rows = (cols["ANTENNA1"]==p)&(cols["ANTENNA2"]==q);
+      expected = abs(uvw[rows,2]).max() if rows.any() else -1;
+      assert (ext.max_abs_w_ifr[p,q] if p < ext.max_abs_w_ifr.shape[0] and q < ext.max_abs_w_ifr.shape[1] else -1) == expected;
+  for col,attr in ("DATA_DESC_ID","ddid"),("FIELD_ID","field"):
+    for i in range(2):
+      rows = cols[col]==i;
+      assert (getattr(ext,attr+"_uvw_min")[i] == uvw[rows].min(0)).all();
+      assert (getattr(ext,attr+"_uvw_max")[i] == uvw[rows].max(0)).all();
+  # baseline subsets, selected by TaQL as an IfrSet would
+  for ifrs in [(0,1)],[(0,1),(2,3)],[(1,1),(0,3),(1,0)],[(0,0)],[(0,1),(5,7)]:
+    taql = "||".join([ "(ANTENNA1==%d&&ANTENNA2==%d)"%(p,q) for p,q in ifrs ]);
+    w = _scan(msname,taql)["UVW"].reshape((-1,3))[:,2];
+    assert ext.max_abs_w(ifrs) == (abs(w).max() if len(w) else 0);
+
+@pytest.mark.parametrize("chunksize",[None,7,NTIME*NANT])
+def test_uvw_extents (msname,chunksize):
+  _fill_uvw(msname);
+  ext = MSUtils.get_uvw_extents(msname,chunksize=chunksize,cache=False);
+  _check_extents(ext,msname);
+  assert MSUtils.MS_UVW_KEYWORD not in tables.table(msname,ack=False).keywordnames();
+
+def test_uvw_extents_cache (msname,monkeypatch):
+  _fill_uvw(msname);
+  _check_extents(MSUtils.get_uvw_extents(msname,chunksize=7),msname);
+  # the second time around, the extents come from the cache
+  add = MSUtils.UVWExtents.add;
+  monkeypatch.setattr(MSUtils.UVWExtents,"add",lambda *args:pytest.fail("UVW column rescanned"));
+  _check_extents(MSUtils.get_uvw_extents(msname,chunksize=7),msname);
+  monkeypatch.setattr(MSUtils.UVWExtents,"add",add);
+  # changing the UVWs (file modification times have a limited resolution, so give them time to move on),
+  # or adding rows, invalidates the cache
+  time.sleep(.1);
+  ms = tables.table(msname,readonly=False,ack=False);
+  ms.putcol("UVW",ms.getcol("UVW")*2);
+  ms.close();
+  _check_extents(MSUtils.get_uvw_extents(msname,chunksize=7),msname);
+  _fill_uvw(msname,seed=1);
+  _check_extents(MSUtils.get_uvw_extents(msname,chunksize=7),msname);